@@ -4,12 +4,13 @@ import shutil
 import socket
 import stat
 import sys
+import time
 import logging
 
+import numpy as np
 from progress.bar import IncrementalBar
 import donkeycar as dk
 from donkeycar.management.joystick_creator import CreateJoystick
-
 from donkeycar.utils import normalize_image, load_image, math
 
 PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -375,23 +376,18 @@ class ShowCnnActivations(BaseCommand):
 
         returns activations/features
         '''
-        from tensorflow.python.keras.models import load_model, Model
+        from tensorflow.keras.models import load_model
+        from donkeycar.parts.salient import ModelIntrospector
 
         model_path = os.path.expanduser(model_path)
         image_path = os.path.expanduser(image_path)
 
         model = load_model(model_path, compile=False)
-        image = load_image(image_path, cfg)[None, ...]
-
-        conv_layer_names = self.get_conv_layers(model)
-        input_layer = model.get_layer(name='img_in').input
-        activations = []
-        for conv_layer_name in conv_layer_names:
-            output_layer = model.get_layer(name=conv_layer_name).output
+        image = normalize_image(load_image(image_path, cfg))[None, ...]
 
-            layer_model = Model(inputs=[input_layer], outputs=[output_layer])
-            activations.append(layer_model.predict(image)[0])
-        return activations
+        introspector = ModelIntrospector.for_model(model)
+        activations = introspector.activations(image, ids=[image_path])
+        return [layer[0] for layer in activations]
 
     def create_figure(self, activations):
         import math
@@ -412,13 +408,6 @@ class ShowCnnActivations(BaseCommand):
 
         self.plt.show()
 
-    def get_conv_layers(self, model):
-        conv_layers = []
-        for layer in model.layers:
-            if layer.__class__.__name__ == 'Conv2D':
-                conv_layers.append(layer.name)
-        return conv_layers
-
     def parse_args(self, args):
         parser = argparse.ArgumentParser(prog='cnnactivations', usage='%(prog)s [options]')
         parser.add_argument('--image', help='path to image')
@@ -465,19 +454,39 @@ class ShowPredictionPlots(BaseCommand):
         records = dataset.get_records()[:limit]
         bar = IncrementalBar('Inferencing', max=len(records))
 
+        # the model was trained on transformed images
+        from donkeycar.parts.image_transformations import \
+            ImageTransformations
+        transformation = ImageTransformations(cfg, 'TRANSFORMATIONS',
+                                              'POST_TRANSFORMATIONS')
+
+        def processors(chunk):
+            """ Image processor for each record of the chunk """
+            if model.seq_size():
+                # records are sequences, transform their images one by one
+                return [lambda x: normalize_image(transformation.run(x))] \
+                    * len(chunk)
+            # transform and normalise the images of the chunk as one batch
+            images = transformation.run_batch(
+                np.stack([r.image() for r in chunk]))
+            images = normalize_image(images)
+            return [lambda x, img=img: img for img in images]
+
         output_names = list(model.output_shapes()[1].keys())
-        for tub_record in records:
-            input_dict = model.x_transform(
-                tub_record, lambda x: normalize_image(x))
-            pilot_angle, pilot_throttle = \
-                model.inference_from_dict(input_dict)
-            user_angle = tub_record.underlying['user/angle']
-            user_throttle = tub_record.underlying['user/throttle']
-            user_angles.append(user_angle)
-            user_throttles.append(user_throttle)
-            pilot_angles.append(pilot_angle)
-            pilot_throttles.append(pilot_throttle)
-            bar.next()
+        chunk_size = 64
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            for tub_record, processor in zip(chunk, processors(chunk)):
+                input_dict = model.x_transform(tub_record, processor)
+                pilot_angle, pilot_throttle = \
+                    model.inference_from_dict(input_dict)
+                user_angle = tub_record.underlying['user/angle']
+                user_throttle = tub_record.underlying['user/throttle']
+                user_angles.append(user_angle)
+                user_throttles.append(user_throttle)
+                pilot_angles.append(pilot_angle)
+                pilot_throttles.append(pilot_throttle)
+                bar.next()
 
         bar.finish()
         angles_df = pd.DataFrame({'user_angle': user_angles,
@@ -592,6 +601,226 @@ class ModelDatabase(BaseCommand):
         print(tub_txt)
 
 
+class BenchmarkModel(BaseCommand):
+
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='benchmark-model',
+                                         usage='%(prog)s [options]')
+        parser.add_argument('--type', nargs='+', default=['linear'],
+                            help='model types to benchmark, like linear '
+                                 'tflite_linear categorical rnn 3d latent')
+        parser.add_argument('--model', default=None,
+                            help='load this model instead of building one, '
+                                 'requires a single --type')
+        parser.add_argument('--config', default='./config.py', help=HELP_CONFIG)
+        parser.add_argument('--tub', default=None,
+                            help='use images from this tub instead of '
+                                 'random images')
+        parser.add_argument('--warmup', type=int, default=20,
+                            help='inferences before timing starts')
+        parser.add_argument('--iterations', type=int, default=200,
+                            help='timed inferences per measurement')
+        parser.add_argument('--batch-sizes', type=int, nargs='+',
+                            default=[1, 8, 32],
+                            help='batch sizes for throughput')
+        parser.add_argument('--threads', type=int, nargs='+',
+                            default=[1, 2, 4],
+                            help='thread counts for tflite thread scaling')
+        parser.add_argument('--out', default='benchmark.json',
+                            help='json report file')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        args = self.parse_args(args)
+        from donkeycar.management.benchmark import benchmark_models, \
+            print_report, save_report
+
+        if os.path.exists(os.path.expanduser(args.config)):
+            cfg = load_config(args.config)
+        else:
+            logger.info(f'No config at {args.config}, using the defaults of '
+                        f'the complete template')
+            cfg = dk.load_config(os.path.join(TEMPLATES_PATH,
+                                              'cfg_complete.py'))
+        if cfg is None:
+            return
+        report = benchmark_models(cfg, args.type, model_path=args.model,
+                                  tub_path=args.tub, warmup=args.warmup,
+                                  iterations=args.iterations,
+                                  batch_sizes=args.batch_sizes,
+                                  threads=args.threads)
+        print_report(report)
+        save_report(report, args.out)
+
+
+class StartupProfile(BaseCommand):
+    '''
+    Report the import and construction time of the configured parts. The
+    profile runs in a new python process so that the modules imported by
+    the donkey command do not hide their import cost.
+    '''
+    def run(self, args):
+        import subprocess
+        start = time.perf_counter()
+        cmd = [sys.executable, '-m', 'donkeycar.management.startup_profile']
+        proc = subprocess.run(cmd + args)
+        print(f'Profiling process finished in '
+              f'{time.perf_counter() - start:.3f}s including interpreter '
+              f'start up.')
+        if proc.returncode != 0:
+            sys.exit(proc.returncode)
+
+
+class PartServerCommand(BaseCommand):
+    '''
+    Run a part for a RemotePart on the car, see donkeycar/parts/remote.py
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='part-server',
+                                         usage='%(prog)s [options]')
+        parser.add_argument('--part', default=None,
+                            help='part to serve as package.module:Class, '
+                                 'e.g. donkeycar.parts.cv:ImgGaussianBlur '
+                                 'with --kwargs \'{"kernel_size": 5}\'')
+        parser.add_argument('--kwargs', default='{}',
+                            help='json dict of constructor arguments of '
+                                 '--part')
+        parser.add_argument('--type', default=None,
+                            help='serve a pilot of this model type instead '
+                                 'of --part')
+        parser.add_argument('--model', default=None,
+                            help='model file to load into the pilot')
+        parser.add_argument('--config', default='./config.py',
+                            help=HELP_CONFIG)
+        parser.add_argument('--port', type=int, default=5560,
+                            help='port to listen on')
+        parser.add_argument('--codec', default='binary',
+                            choices=['binary', 'binary_zlib', 'pickle'],
+                            help='message codec, must match the car')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def create_part(self, args):
+        import json
+        if args.type is not None:
+            cfg = load_config(args.config)
+            if cfg is None:
+                return None
+            part = dk.utils.get_model_by_type(args.type, cfg)
+        elif args.part is not None:
+            from donkeycar.utilities.lazy_registry import LazyRegistry
+            registry = LazyRegistry('remote part')
+            registry.register(args.part, args.part)
+            part = registry.create(args.part, **json.loads(args.kwargs))
+        else:
+            logger.error('Either --part or --type is required')
+            return None
+        if args.model is not None:
+            part.load(os.path.expanduser(args.model))
+        return part
+
+    def run(self, args):
+        args = self.parse_args(args)
+        from donkeycar.parts.remote import PartServer
+        part = self.create_part(args)
+        if part is None:
+            return
+        server = PartServer(part, port=args.port, codec=args.codec)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            logger.info(f'Served {server.served} requests')
+
+
+class TelemetryServerCommand(BaseCommand):
+    '''
+    Collect, store and show the MqttTelemetry of many cars, see
+    donkeycar/management/telemetry_server.py
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='telemetry-server',
+                                         usage='%(prog)s [options]')
+        parser.add_argument('--broker', default='localhost',
+                            help='mqtt broker host')
+        parser.add_argument('--broker-port', type=int, default=1883,
+                            help='mqtt broker port')
+        parser.add_argument('--config', default='./config.py',
+                            help='car config to take the topic template '
+                                 'from, if it exists')
+        parser.add_argument('--topic-template', default=None,
+                            help='TELEMETRY_MQTT_TOPIC_TEMPLATE of the cars, '
+                                 'overrides the config')
+        parser.add_argument('--path', default='./telemetry',
+                            help='directory to store the telemetry in')
+        parser.add_argument('--interval', type=float, default=0.1,
+                            help='downsampling interval in seconds, 0 keeps '
+                                 'all samples')
+        parser.add_argument('--session-gap', type=float, default=300.0,
+                            help='seconds without telemetry of a car which '
+                                 'start a new session')
+        parser.add_argument('--port', type=int, default=8890,
+                            help='port of the dashboard and query api')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        args = self.parse_args(args)
+        from donkeycar.management.telemetry_server import \
+            TelemetryAggregator, TelemetryServer
+
+        template = args.topic_template
+        if template is None:
+            if os.path.exists(os.path.expanduser(args.config)):
+                cfg = load_config(args.config)
+            else:
+                cfg = dk.load_config(os.path.join(TEMPLATES_PATH,
+                                                  'cfg_complete.py'))
+            if cfg is None:
+                return
+            template = cfg.TELEMETRY_MQTT_TOPIC_TEMPLATE
+        aggregator = TelemetryAggregator(args.path, template,
+                                         interval=args.interval,
+                                         session_gap=args.session_gap)
+        server = TelemetryServer(aggregator, args.broker, args.broker_port,
+                                 http_port=args.port)
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+
+
+class TubReceiverCommand(BaseCommand):
+    '''
+    Receive the tubs which cars stream while recording, see
+    donkeycar/parts/tub_stream.py
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tub-receiver',
+                                         usage='%(prog)s [options]')
+        parser.add_argument('--path', default='./data',
+                            help='directory to write the tubs into')
+        parser.add_argument('--port', type=int, default=5580,
+                            help='port to listen on, TUB_STREAM_PORT of '
+                                 'the car')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        args = self.parse_args(args)
+        from donkeycar.parts.tub_stream import TubStreamReceiver
+        receiver = TubStreamReceiver(args.path, args.port)
+        try:
+            receiver.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info(f'Received {receiver.received} records')
+
+
 class Gui(BaseCommand):
     def run(self, args):
         from donkeycar.management.ui.ui import main
@@ -615,6 +844,11 @@ def execute_from_command_line():
         'train': Train,
         'models': ModelDatabase,
         'ui': Gui,
+        'startup-profile': StartupProfile,
+        'benchmark-model': BenchmarkModel,
+        'part-server': PartServerCommand,
+        'telemetry-server': TelemetryServerCommand,
+        'tub-receiver': TubReceiverCommand,
     }
 
     args = sys.argv[:]
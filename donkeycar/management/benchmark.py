@@ -0,0 +1,363 @@
+"""
+benchmark.py
+
+Measures inference latency, batch throughput, thread scaling and memory of
+the pilot models on the current hardware and across interpreters. This is
+used by the `donkey benchmark-model` command and writes a json report, so
+results can be compared between releases.
+"""
+import json
+import logging
+import os
+import platform
+import resource
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import psutil
+
+import donkeycar as dk
+from donkeycar.utils import normalize_image, load_image
+
+logger = logging.getLogger(__name__)
+
+PREFIXES = ('tflite_', 'tensorrt_', 'fastai_')
+
+
+def split_model_type(model_type: str):
+    """
+    :return: tuple of (interpreter prefix, base model type), the prefix is
+             '' for the keras interpreter
+    """
+    for prefix in PREFIXES:
+        if model_type.startswith(prefix):
+            return prefix, model_type[len(prefix):]
+    return '', model_type
+
+
+def latency_summary(times: Sequence[float]) -> Dict[str, float]:
+    ms = np.array(times) * 1000.0
+    return {'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'min_ms': float(ms.min()),
+            'max_ms': float(ms.max())}
+
+
+def rss_mb() -> float:
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+def load_tub_frames(tub_path: str, cfg, limit: int = 100) -> List[np.ndarray]:
+    """
+    Load up to limit camera images from a tub, resized to the configured
+    image size.
+    """
+    from donkeycar.parts.tub_v2 import Tub
+
+    tub = Tub(os.path.expanduser(tub_path), read_only=True)
+    frames = []
+    for record in tub:
+        name = record.get('cam/image_array')
+        if name is None:
+            continue
+        img = load_image(os.path.join(tub.images_base_path, name), cfg)
+        if img is not None:
+            frames.append(img)
+        if len(frames) >= limit:
+            break
+    tub.close()
+    if not frames:
+        raise ValueError(f'No images found in tub {tub_path}')
+    return frames
+
+
+class ModelBenchmark:
+    """
+    Builds or loads pilots and measures their inference performance on
+    synthetic or tub frames.
+    """
+    def __init__(self,
+                 cfg,
+                 warmup: int = 20,
+                 iterations: int = 200,
+                 batch_sizes: Sequence[int] = (1, 8, 32),
+                 threads: Sequence[int] = (1, 2, 4),
+                 frames: Optional[List[np.ndarray]] = None):
+        """
+        :param cfg:         donkey config, image size and model settings
+                            are taken from here
+        :param warmup:      inferences before timing starts
+        :param iterations:  timed inferences per measurement
+        :param batch_sizes: batch sizes for the throughput measurement
+        :param threads:     thread counts for the tflite thread scaling
+        :param frames:      uint8 images, random images are used if None
+        """
+        self.cfg = cfg
+        self.warmup = warmup
+        self.iterations = iterations
+        self.batch_sizes = batch_sizes
+        self.threads = threads
+        if frames is None:
+            shape = (cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH)
+            frames = [np.random.randint(0, 255, size=shape, dtype=np.uint8)
+                      for _ in range(16)]
+        if getattr(cfg, 'TRANSFORMATIONS', None) \
+                or getattr(cfg, 'POST_TRANSFORMATIONS', None):
+            # the model input has the size of the transformed images
+            from donkeycar.parts.image_transformations import \
+                ImageTransformations
+            transformation = ImageTransformations(cfg, 'TRANSFORMATIONS',
+                                                  'POST_TRANSFORMATIONS')
+            frames = [transformation.run(f) for f in frames]
+        self.frames = [normalize_image(f).astype(np.float32) for f in frames]
+
+    def create_pilot(self, model_type: str, model_path: Optional[str],
+                     tmp_dir: str):
+        """
+        Create the pilot for model_type. If no model path is given, the keras
+        model is built with random weights and converted into the format of
+        the interpreter.
+        :return: tuple of (pilot, path of the model file or None)
+        """
+        from donkeycar.parts.registry import pilots
+
+        prefix, base_type = split_model_type(model_type)
+        from donkeycar.parts.image_transformations import \
+            transformed_image_shape
+        input_shape = (*transformed_image_shape(self.cfg),
+                       self.cfg.IMAGE_DEPTH)
+        if model_path:
+            model_path = os.path.expanduser(model_path)
+            pilot = dk.utils.get_model_by_type(model_type, self.cfg)
+            pilot.load(model_path)
+            return pilot, model_path
+        if prefix == 'fastai_':
+            raise ValueError('fastai models can only be benchmarked from a '
+                             'model file, please pass --model')
+
+        if base_type == 'latent':
+            keras_pilot = pilots.create('latent', input_shape=input_shape)
+        else:
+            keras_pilot = dk.utils.get_model_by_type(base_type, self.cfg)
+        if prefix == '':
+            return keras_pilot, None
+
+        model = keras_pilot.interpreter.model
+        if prefix == 'tflite_':
+            from donkeycar.parts.interpreter import keras_to_tflite
+            path = os.path.join(tmp_dir, f'{base_type}.tflite')
+            keras_to_tflite(model, path)
+        else:
+            path = os.path.join(tmp_dir, f'{base_type}.savedmodel')
+            model.save(path)
+        pilot = dk.utils.get_model_by_type(model_type, self.cfg)
+        pilot.load(path)
+        return pilot, path
+
+    def make_inputs(self, interpreter, index: int = 0,
+                    batch_size: Optional[int] = None) \
+            -> Dict[str, np.ndarray]:
+        """
+        Create the model input dictionary. Images go into 'img_in', for
+        sequence models consecutive frames are stacked. All other inputs are
+        filled with random values in [0, 1).
+        :param interpreter: interpreter with loaded model
+        :param index:       index of the first frame to use
+        :param batch_size:  None creates a single sample without batch
+                            dimension, as used by the pilot interface
+        """
+        inputs = {}
+        for key in interpreter.input_keys:
+            # drop batch dimension
+            shape = tuple(int(d) for d in interpreter.get_input_shape(key)[1:])
+            n = batch_size or 1
+            if key == 'img_in':
+                seq = shape[0] if len(shape) == 4 else 0
+                samples = []
+                for b in range(n):
+                    start = index + b * max(seq, 1)
+                    if seq:
+                        sample = np.stack(
+                            [self.frames[(start + s) % len(self.frames)]
+                             for s in range(seq)])
+                    else:
+                        sample = self.frames[start % len(self.frames)]
+                    samples.append(sample.reshape(shape))
+                arr = np.stack(samples)
+            else:
+                arr = np.random.rand(n, *shape).astype(np.float32)
+            inputs[key] = arr if batch_size else arr[0]
+        return inputs
+
+    def measure_latency(self, pilot) -> Dict[str, float]:
+        """ Batch 1 latency through the pilot's inference interface """
+        for i in range(self.warmup):
+            pilot.inference_from_dict(self.make_inputs(pilot.interpreter, i))
+        times = []
+        for i in range(self.iterations):
+            # the interpreters modify the input dict in place
+            inputs = self.make_inputs(pilot.interpreter, i)
+            start = time.perf_counter()
+            pilot.inference_from_dict(inputs)
+            times.append(time.perf_counter() - start)
+        return latency_summary(times)
+
+    def measure_throughput(self, pilot) -> Dict[str, float]:
+        """
+        Samples per second for the configured batch sizes. Only the keras
+        interpreter supports batched inference, other interpreters have a
+        fixed batch size of one.
+        """
+        from donkeycar.parts.interpreter import KerasInterpreter
+
+        if not isinstance(pilot.interpreter, KerasInterpreter):
+            return {}
+        model = pilot.interpreter.model
+        result = {}
+        for batch_size in self.batch_sizes:
+            batch = self.make_inputs(pilot.interpreter, 0, batch_size)
+            for _ in range(max(1, self.warmup // batch_size)):
+                model(batch, training=False)
+            runs = max(3, self.iterations // batch_size)
+            start = time.perf_counter()
+            for _ in range(runs):
+                model(batch, training=False)
+            duration = time.perf_counter() - start
+            result[str(batch_size)] = runs * batch_size / duration
+        return result
+
+    def measure_thread_scaling(self, pilot, model_path: Optional[str]) \
+            -> Dict[str, float]:
+        """
+        Batch 1 p50 latency in ms of a tflite model for the configured
+        number of interpreter threads.
+        """
+        from donkeycar.parts.interpreter import TfLite
+
+        if not isinstance(pilot.interpreter, TfLite) or not model_path:
+            return {}
+        result = {}
+        for num_threads in self.threads:
+            interpreter = TfLite(num_threads=num_threads)
+            interpreter.load(model_path)
+            for i in range(self.warmup):
+                interpreter.predict_from_dict(
+                    self.make_inputs(interpreter, i))
+            times = []
+            for i in range(self.iterations):
+                inputs = self.make_inputs(interpreter, i)
+                start = time.perf_counter()
+                interpreter.predict_from_dict(inputs)
+                times.append(time.perf_counter() - start)
+            result[str(num_threads)] = latency_summary(times)['p50_ms']
+        return result
+
+    def run(self, model_type: str, model_path: Optional[str] = None) \
+            -> Dict:
+        """
+        Benchmark a single model type
+        :return: dictionary with all measurements of this model
+        """
+        result = {'model_type': model_type, 'model_path': model_path}
+        rss_start = rss_mb()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            pilot, path = self.create_pilot(model_type, model_path, tmp_dir)
+            result['interpreter'] = str(pilot.interpreter)
+            result['pilot'] = str(pilot)
+            result['create_s'] = time.perf_counter() - start
+            result['latency'] = self.measure_latency(pilot)
+            result['throughput'] = self.measure_throughput(pilot)
+            result['thread_scaling_p50_ms'] \
+                = self.measure_thread_scaling(pilot, path)
+        result['rss_increase_mb'] = rss_mb() - rss_start
+        return result
+
+
+def environment() -> Dict[str, str]:
+    env = {'donkeycar': dk.__version__,
+           'python': platform.python_version(),
+           'machine': platform.machine(),
+           'platform': platform.platform(),
+           'cpu_count': os.cpu_count()}
+    try:
+        import tensorflow as tf
+        env['tensorflow'] = tf.__version__
+        env['tf_intra_op_threads'] \
+            = tf.config.threading.get_intra_op_parallelism_threads()
+    except ImportError:
+        pass
+    return env
+
+
+def benchmark_models(cfg, model_types: Sequence[str],
+                     model_path: Optional[str] = None,
+                     tub_path: Optional[str] = None, **kwargs) -> Dict:
+    """
+    Benchmark all model types and return the report.
+    :param cfg:         donkey config
+    :param model_types: list of model types like 'linear', 'tflite_linear'
+    :param model_path:  load this model instead of building one, only valid
+                        for a single model type
+    :param tub_path:    use images from this tub instead of random images
+    :param kwargs:      passed to ModelBenchmark
+    """
+    if model_path and len(model_types) != 1:
+        raise ValueError('A model path can only be used with one model type')
+    frames = load_tub_frames(tub_path, cfg) if tub_path else None
+    bench = ModelBenchmark(cfg, frames=frames, **kwargs)
+    results = []
+    for model_type in model_types:
+        logger.info(f'Benchmarking {model_type}')
+        try:
+            results.append(bench.run(model_type, model_path))
+        except Exception as e:
+            logger.error(f'Benchmark of {model_type} failed: {e}')
+            results.append({'model_type': model_type, 'error': str(e)})
+    # ru_maxrss is reported in kilobytes on linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'environment': environment(),
+            'settings': {'image_shape': [cfg.IMAGE_H, cfg.IMAGE_W,
+                                         cfg.IMAGE_DEPTH],
+                         'frames': 'tub' if tub_path else 'synthetic',
+                         'warmup': bench.warmup,
+                         'iterations': bench.iterations,
+                         'batch_sizes': list(bench.batch_sizes),
+                         'threads': list(bench.threads)},
+            'peak_rss_mb': peak_mb,
+            'results': results}
+
+
+def print_report(report: Dict) -> None:
+    from prettytable import PrettyTable
+
+    batch_sizes = report['settings']['batch_sizes']
+    pt = PrettyTable()
+    pt.field_names = ['Model', 'Interpreter', 'p50 (ms)', 'p99 (ms)'] \
+        + [f'bs {b} (1/s)' for b in batch_sizes] \
+        + ['Threads p50 (ms)', 'RSS (MB)']
+    for r in report['results']:
+        if 'error' in r:
+            pt.add_row([r['model_type'], 'failed', '', '']
+                       + [''] * len(batch_sizes) + ['', ''])
+            continue
+        throughput = [f"{r['throughput'][str(b)]:.0f}"
+                      if str(b) in r['throughput'] else ''
+                      for b in batch_sizes]
+        threads = ' '.join(f'{k}:{v:.2f}' for k, v
+                           in r['thread_scaling_p50_ms'].items())
+        pt.add_row([r['model_type'], r['interpreter'],
+                    f"{r['latency']['p50_ms']:.2f}",
+                    f"{r['latency']['p99_ms']:.2f}"] + throughput
+                   + [threads, f"{r['rss_increase_mb']:.0f}"])
+    print(pt)
+    print(f"Peak RSS: {report['peak_rss_mb']:.0f} MB")
+
+
+def save_report(report: Dict, path: str) -> None:
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f'Saved benchmark report to {path}')
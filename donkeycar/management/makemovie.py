@@ -1,9 +1,5 @@
-import tempfile
+from collections import deque
 
-from tensorflow.python.keras import activations
-from tensorflow.python.keras import backend as K
-from tensorflow.python.keras.models import load_model
-import tensorflow as tf
 import cv2
 from matplotlib import cm
 
@@ -16,52 +12,6 @@ from donkeycar.utils import *
 DEG_TO_RAD = math.pi / 180.0
 
 
-def apply_modifications(model, custom_objects=None):
-    """Applies modifications to the model layers to create a new Graph. For
-    example, simply changing `model.layers[idx].activation = new activation`
-    does not change the graph. The entire graph needs to be updated with
-    modified inbound and outbound tensors because of change in layer building
-    function.
-
-    Args:
-        model: The `keras.models.Model` instance.
-
-    Returns:
-        The modified model with changes applied. Does not mutate the original
-        `model`.
-    """
-    # The strategy is to save the modified model and load it back. This is
-    # done because setting the activation in a Keras layer doesnt actually
-    # change the graph. We have to iterate the entire graph and change the
-    # layer inbound and outbound nodes with modified tensors. This is doubly
-    # complicated in Keras 2.x since multiple inbound and outbound nodes are
-    # allowed with the Graph API.
-    model_path = os.path.join(tempfile.gettempdir(),
-                              next(tempfile._get_candidate_names()) + '.h5')
-    try:
-        model.save(model_path)
-        return load_model(model_path, custom_objects=custom_objects)
-    finally:
-        os.remove(model_path)
-
-
-def normalize(array, min_value=0., max_value=1.):
-    """Normalizes the numpy array to (min_value, max_value)
-
-    Args:
-        array: The numpy array
-        min_value: The min value in normalized array (Default value = 0)
-        max_value: The max value in normalized array (Default value = 1)
-
-    Returns:
-        The array normalized to range between (min_value, max_value)
-    """
-    arr_min = np.min(array)
-    arr_max = np.max(array)
-    normalized = (array - arr_min) / (arr_max - arr_min + K.epsilon())
-    return (max_value - min_value) * normalized + min_value
-
-
 class MakeMovie(object):
 
     def run(self, args, parser):
@@ -123,6 +73,10 @@ class MakeMovie(object):
         self.keras_part = None
         self.do_salient = False
         self.user = args.draw_user_input
+        # records read ahead of the current frame, with saliency masks
+        # computed in batches
+        self.lookahead = deque()
+        self.next_batch = None
         if args.model is not None:
             self.keras_part = get_model_by_type(args.type, cfg=self.cfg)
             self.keras_part.load(args.model)
@@ -213,73 +167,63 @@ class MakeMovie(object):
             x += dx
 
     def init_salient(self, model):
-        # Utility to search for layer index by name. 
-        # Alternatively we can specify this as -1 since it corresponds to the last layer.
-        output_name = []
-        layer_idx = []
-        for i, layer in enumerate(model.layers):
-            if "dropout" not in layer.name.lower() and "out" in layer.name.lower():
-                output_name.append(layer.name)
-                layer_idx.append(i)
-
-        if output_name == []:
-            print("Failed to find the model layer named with 'out'. Skipping salient.")
+        from donkeycar.parts.salient import ModelIntrospector
+        try:
+            self.introspector = ModelIntrospector.for_model(model)
+            # trace the graph and check the output layers before we start
+            self.introspector.saliency(
+                np.zeros((1,) + self.introspector.input_shape))
+        except ValueError as e:
+            print(f"{e}. Skipping salient.")
             return False
-
-        print("####################")
-        print("Visualizing activations on layer:", output_name)
-        print("####################")
-        
-        # ensure we have linear activation
-        for li in layer_idx:
-            model.layers[li].activation = activations.linear
-        # build salient model and optimizer
-        sal_model = apply_modifications(model)
-        self.sal_model = sal_model
         return True
 
-    def compute_visualisation_mask(self, img):
-        img = img.reshape((1,) + img.shape)
-        images = tf.Variable(img, dtype=float)
-
-        if self.model_type == 'linear':
-            with tf.GradientTape(persistent=True) as tape:
-                tape.watch(images)
-                pred_list = self.sal_model(images, training=False)
-        elif self.model_type == 'categorical':
-            with tf.GradientTape(persistent=True) as tape:
-                tape.watch(images)
-                pred = self.sal_model(images, training=False)
-                pred_list = []
-                for p in pred:
-                    maxindex = tf.math.argmax(p[0])
-                    pred_list.append(p[0][maxindex])
-                    
-        grads = 0
-        for p in pred_list:
-            grad = tape.gradient(p, images)
-            grads += tf.math.square(grad)
-        grads = tf.math.sqrt(grads)
-
-        channel_idx = 1 if K.image_data_format() == 'channels_first' else -1
-        grads = np.sum(grads, axis=channel_idx)
-        res = normalize(grads)[0]
-        return res
-
-    def draw_salient(self, img):
-
-        alpha = 0.004
-        beta = 1.0 - alpha
-        expected = self.keras_part.interpreter.model.inputs[0].shape[1:]
-        actual = img.shape
-
+    def salient_input(self, img):
+        """ Convert tub image into normalised model input """
+        expected = self.introspector.input_shape
         # check input depth and convert to grey to match expected model input
-        if expected[2] == 1 and actual[2] == 3:
+        if expected[2] == 1 and img.shape[2] == 3:
             grey_img = rgb2gray(img)
             img = grey_img.reshape(grey_img.shape + (1,))
+        return normalize_image(img)
 
-        norm_img = normalize_image(img)
-        salient_mask = self.compute_visualisation_mask(norm_img)
+    def read_batch(self):
+        """
+        Read the next batch of records and their images from the tub and
+        start the saliency computation for them in the background.
+        """
+        num = min(self.introspector.batch_size if self.do_salient else 1,
+                  self.end_index - self.current - len(self.lookahead))
+        batch = []
+        for _ in range(num):
+            rec = self.iterator.next()
+            img_path = os.path.join(self.tub.images_base_path,
+                                    rec['cam/image_array'])
+            with open(img_path, 'rb') as f:
+                batch.append((rec, binary_to_arr(f.read())))
+        masks = None
+        if self.do_salient and batch:
+            images = np.stack([self.salient_input(img) for _, img in batch])
+            ids = [rec['_index'] for rec, _ in batch]
+            masks = self.introspector.submit_saliency(images, ids)
+        return batch, masks
+
+    def next_record(self):
+        """
+        :return: next record, its image and saliency mask, if enabled
+        """
+        if not self.lookahead:
+            batch, masks = self.next_batch or self.read_batch()
+            masks = masks.result() if masks is not None else [None] * len(batch)
+            self.lookahead.extend((rec, img, mask) for (rec, img), mask
+                                  in zip(batch, masks))
+            # compute next batch while the frames of this one get drawn
+            self.next_batch = self.read_batch() if self.do_salient else None
+        return self.lookahead.popleft()
+
+    def draw_salient(self, img, salient_mask):
+        alpha = 0.004
+        beta = 1.0 - alpha
         salient_mask_stacked = cm.inferno(salient_mask)[:,:,0:3]
         salient_mask_stacked = cv2.GaussianBlur(salient_mask_stacked,(3,3),cv2.BORDER_DEFAULT)
         blend = cv2.addWeighted(img.astype('float32'), alpha, salient_mask_stacked.astype('float32'), beta, 0)
@@ -296,13 +240,11 @@ class MakeMovie(object):
         if self.current >= self.end_index:
             return None
 
-        rec = self.iterator.next()
-        img_path = os.path.join(self.tub.images_base_path, rec['cam/image_array'])
-        image_input = img_to_arr(Image.open(img_path))
+        rec, image_input, salient_mask = self.next_record()
         image = image_input
-        
+
         if self.do_salient:
-            image = self.draw_salient(image_input)
+            image = self.draw_salient(image_input, salient_mask)
             image = cv2.normalize(src=image, dst=None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
         
         if self.user: self.draw_user_input(rec, image_input, image)
@@ -0,0 +1,183 @@
+"""
+startup_profile.py
+
+Measures how long the parts configured for a car take to import and to
+construct. This runs in a fresh interpreter, started by the
+`donkey startup-profile` command, so that modules already imported by the
+donkey command itself do not hide their cost.
+
+Usage:
+    python -m donkeycar.management.startup_profile [--config=<config>]
+        [--myconfig=<myconfig>] [--model=<model>] [--type=<type>]
+        [--camera] [--out=<json file>]
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import psutil
+
+# running this module with 'python -m' imports the donkeycar package first,
+# so the interpreter start up and the donkeycar import are measured from the
+# creation time of the process.
+_donkeycar_import_time = time.time() - psutil.Process().create_time()
+
+import donkeycar as dk
+from donkeycar.utilities.lazy_registry import LazyRegistry, startup_timings
+from donkeycar.parts.registry import cameras
+
+logger = logging.getLogger(__name__)
+
+#
+# modules which the vehicle templates import regardless of configuration
+#
+core = LazyRegistry('core')
+core.register('controller', 'donkeycar.parts.controller')
+core.register('tub_v2', 'donkeycar.parts.tub_v2')
+core.register('datastore', 'donkeycar.parts.datastore')
+core.register('kinematics', 'donkeycar.parts.kinematics')
+core.register('template', 'donkeycar.templates.complete')
+
+#
+# modules which complete.add_drivetrain() imports, the drive train parts are
+# not constructed because they open the hardware
+#
+drive_train = LazyRegistry('drive train')
+
+
+def drive_train_modules(drive_train_type):
+    """
+    :param drive_train_type:    cfg.DRIVE_TRAIN_TYPE
+    :return list:               modules imported for the drive train
+    """
+    if drive_train_type == 'MOCK':
+        return []
+    modules = ['donkeycar.parts.actuator', 'donkeycar.parts.pins']
+    if drive_train_type == 'DC_QUAD_WHEEL_PCA9685':
+        modules.append('donkeycar.parts.quad_motor_pca9685')
+    elif drive_train_type == 'MM1':
+        modules.append('donkeycar.parts.robohat')
+    return modules
+
+
+def profile_startup(cfg, model_path=None, model_type=None,
+                    construct_camera=False):
+    """
+    Import, and where it is safe to do so construct, the parts configured
+    in cfg and return the collected timings.
+    :param cfg:                 donkey config
+    :param model_path:          optional model file which gets loaded
+    :param model_type:          model type, defaults to DEFAULT_MODEL_TYPE
+                                if a model path is given
+    :param construct_camera:    also construct the camera, this requires
+                                the camera hardware to be present
+    :return dict:               report with timings and errors
+    """
+    errors = []
+
+    def attempt(name, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            logger.error(f'{name} failed: {e}')
+            errors.append({'part': name, 'error': str(e)})
+            return None
+
+    for key in core.keys():
+        attempt(key, core.resolve, key)
+
+    if not cfg.DONKEY_GYM:
+        camera_type = cfg.CAMERA_TYPE
+        if construct_camera and camera_type in cameras \
+                and camera_type != 'D435':
+            from donkeycar.templates.complete import get_camera
+            cam = attempt(camera_type, get_camera, cfg)
+            if cam is not None and hasattr(cam, 'shutdown'):
+                cam.shutdown()
+        elif camera_type in cameras:
+            attempt(camera_type, cameras.resolve, camera_type)
+
+        for module in drive_train_modules(cfg.DRIVE_TRAIN_TYPE):
+            drive_train.register(module, module)
+            attempt(module, drive_train.resolve, module)
+
+    model_load_time = 0.0
+    if model_path or model_type:
+        model_type = model_type or cfg.DEFAULT_MODEL_TYPE
+        kl = attempt(model_type, dk.utils.get_model_by_type, model_type, cfg)
+        if kl is not None and model_path:
+            start = time.perf_counter()
+            attempt(model_path, kl.load, os.path.expanduser(model_path))
+            model_load_time = time.perf_counter() - start
+
+    parts = [{'registry': registry, 'part': key, 'import_s': import_s,
+              'construct_s': construct_s}
+             for registry, key, import_s, construct_s in startup_timings()]
+    total = _donkeycar_import_time + model_load_time \
+        + sum(p['import_s'] + p['construct_s'] for p in parts)
+    return {'donkeycar_import_s': _donkeycar_import_time,
+            'parts': parts,
+            'model_load_s': model_load_time,
+            'total_s': total,
+            'errors': errors}
+
+
+def print_report(report):
+    from prettytable import PrettyTable
+
+    pt = PrettyTable()
+    pt.field_names = ['Registry', 'Part', 'Import (s)', 'Construct (s)']
+    pt.align = 'r'
+    pt.align['Registry'] = 'l'
+    pt.align['Part'] = 'l'
+    pt.add_row(['package', 'python + donkeycar',
+                f"{report['donkeycar_import_s']:.3f}", ''])
+    for p in sorted(report['parts'],
+                    key=lambda p: p['import_s'] + p['construct_s'],
+                    reverse=True):
+        pt.add_row([p['registry'], p['part'], f"{p['import_s']:.3f}",
+                    f"{p['construct_s']:.3f}" if p['construct_s'] else ''])
+    if report['model_load_s']:
+        pt.add_row(['model', 'load', '', f"{report['model_load_s']:.3f}"])
+    print(pt)
+    print(f"Total startup time of profiled parts: {report['total_s']:.3f}s")
+    for e in report['errors']:
+        print(f"Failed {e['part']}: {e['error']}")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog='startup-profile',
+                                     usage='%(prog)s [options]')
+    parser.add_argument('--config', default='./config.py',
+                        help='location of config file to use. default: '
+                             './config.py')
+    parser.add_argument('--myconfig', default='myconfig.py',
+                        help='file name of myconfig file, defaults to '
+                             'myconfig.py')
+    parser.add_argument('--model', default=None,
+                        help='model to construct and load')
+    parser.add_argument('--type', default=None,
+                        help='model type, defaults to DEFAULT_MODEL_TYPE')
+    parser.add_argument('--camera', action='store_true',
+                        help='also construct the configured camera, this '
+                             'requires the camera to be attached')
+    parser.add_argument('--out', default=None,
+                        help='write the report as json to this file')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    cfg = dk.load_config(os.path.expanduser(args.config), args.myconfig)
+    report = profile_startup(cfg, args.model, args.type, args.camera)
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f'Saved startup profile to {args.out}')
+
+
+if __name__ == "__main__":
+    main()
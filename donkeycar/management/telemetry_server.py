@@ -0,0 +1,458 @@
+"""
+telemetry_server.py
+
+Collects the MqttTelemetry of many cars for the `donkey telemetry-server`
+command. The server subscribes to the TELEMETRY_MQTT_TOPIC_TEMPLATE topics
+of all cars on a broker, downsamples the samples to a fixed interval and
+appends them to one file per car and session. A session ends when a car
+sends nothing for session_gap seconds. A small web server answers queries
+and shows a live dashboard comparing the cars.
+
+Files are stored as <path>/<car>/<session>.dkt and consist of chunks, each a
+uint32 length followed by a telemetry batch in the format of
+donkeycar.parts.telemetry.encode_batch(): a float64 array of times and one
+column per key. Numeric columns are float64 arrays, so a chunk is stored and
+loaded without per sample python objects.
+"""
+import json
+import logging
+import math
+import os
+import re
+import struct
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from donkeycar.parts.telemetry import BATCH_NAME, decode_batch
+from donkeycar.utilities.serialization import BinaryCodec
+
+logger = logging.getLogger(__name__)
+
+FILE_EXTENSION = '.dkt'
+_CHUNK_LENGTH = struct.Struct('<I')
+
+Columns = Dict[str, Any]
+
+
+def parse_payload(payload: bytes) -> Tuple[np.ndarray, Columns]:
+    """
+    :param payload: binary batch or json array of MqttTelemetry
+    :return:        sample times and columns
+    """
+    if payload[:1] in (b'[', b'{'):
+        packets = json.loads(payload)
+        ts = np.array([p['ts'] for p in packets], dtype=np.float64)
+        keys = []
+        for p in packets:
+            keys.extend(k for k in p['values'] if k not in keys)
+        columns = {}
+        for key in keys:
+            columns[key] = _column([p['values'].get(key) for p in packets])
+        return ts, columns
+    return decode_batch(payload)
+
+
+def valid_name(name: str) -> bool:
+    """ True if a car or session name is a plain file name """
+    return bool(name) and '..' not in name and '\0' not in name \
+        and not any(sep in name for sep in ('/', '\\', os.sep))
+
+
+def _column(values: List[Any]):
+    """ float64 array with nan for missing values if all are numbers """
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool)
+           for v in values if v is not None):
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64)
+    return values
+
+
+def downsample(ts: np.ndarray, columns: Columns, interval: float) \
+        -> Tuple[np.ndarray, Columns]:
+    """
+    Reduce samples to one per interval: numeric columns are averaged,
+    ignoring nan, other columns keep the last value of the interval.
+
+    :param ts:          sample times
+    :param columns:     columns of the same length
+    :param interval:    seconds, 0 keeps all samples
+    :return:            start times of the intervals and their columns
+    """
+    if interval <= 0 or len(ts) == 0:
+        return ts, columns
+    buckets = np.floor(ts / interval).astype(np.int64)
+    uniq, inverse = np.unique(buckets, return_inverse=True)
+    out = {}
+    for key, col in columns.items():
+        if isinstance(col, np.ndarray):
+            valid = ~np.isnan(col)
+            sums = np.bincount(inverse, weights=np.where(valid, col, 0.0),
+                               minlength=len(uniq))
+            counts = np.bincount(inverse, weights=valid, minlength=len(uniq))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[key] = sums / counts
+        else:
+            last = [None] * len(uniq)
+            for i, v in zip(inverse, col):
+                if v is not None:
+                    last[i] = v
+            out[key] = last
+    return uniq * interval, out
+
+
+def concat_columns(parts: Sequence[Tuple[np.ndarray, Columns]]) \
+        -> Tuple[np.ndarray, Columns]:
+    """ Join chunks of columns, keys missing in a chunk are filled """
+    ts = np.concatenate([t for t, _ in parts]) if parts \
+        else np.zeros(0, dtype=np.float64)
+    keys = []
+    for _, cols in parts:
+        keys.extend(k for k in cols if k not in keys)
+    columns = {}
+    for key in keys:
+        pieces = []
+        numeric = True
+        for t, cols in parts:
+            col = cols.get(key)
+            if col is None:
+                col = np.full(len(t), np.nan)
+            numeric = numeric and isinstance(col, np.ndarray)
+            pieces.append(col)
+        if numeric:
+            columns[key] = np.concatenate(pieces)
+        else:
+            columns[key] = [None if isinstance(v, float) and math.isnan(v)
+                            else v for p in pieces for v in list(p)]
+    return ts, columns
+
+
+def write_chunk(path: str, ts: np.ndarray, columns: Columns) -> None:
+    data = BinaryCodec().encode_bytes(BATCH_NAME, {'ts': ts,
+                                                   'values': columns})
+    with open(path, 'ab') as f:
+        f.write(_CHUNK_LENGTH.pack(len(data)) + data)
+
+
+def read_chunks(path: str) -> List[Tuple[np.ndarray, Columns]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    chunks = []
+    offset = 0
+    while offset + _CHUNK_LENGTH.size <= len(data):
+        length = _CHUNK_LENGTH.unpack_from(data, offset)[0]
+        offset += _CHUNK_LENGTH.size
+        if offset + length > len(data):
+            logger.warning(f'Ignoring truncated chunk at the end of {path}')
+            break
+        chunks.append(decode_batch(data[offset:offset + length]))
+        offset += length
+    return chunks
+
+
+class CarState:
+    """ Live state and pending samples of one car """
+    def __init__(self, name: str):
+        self.name = name
+        self.session: Optional[str] = None
+        self.last_ts = -math.inf
+        self.last_seen = 0.0
+        self.messages = 0
+        self.samples = 0
+        self.last_values: Dict[str, Any] = {}
+        # (session, times, columns) not yet written
+        self.pending: List[Tuple[str, np.ndarray, Columns]] = []
+        # (receive time, samples) of the recent messages
+        self.recent = deque(maxlen=100)
+        self.loop_hz: Optional[float] = None
+
+    def summary(self, now: float) -> Dict[str, Any]:
+        window = [(t, n) for t, n in self.recent if now - t < 10.0]
+        rate = sum(n for _, n in window) / 10.0
+        return {'car': self.name,
+                'session': self.session,
+                'messages': self.messages,
+                'samples': self.samples,
+                'samples_per_s': round(rate, 1),
+                'loop_hz': None if self.loop_hz is None
+                else round(self.loop_hz, 1),
+                'last_seen_s': round(now - self.last_seen, 1),
+                'values': self.last_values}
+
+
+class TelemetryAggregator:
+    """
+    Ingests telemetry messages of many cars and stores them per car and
+    session. ingest() is called by the mqtt thread, the other methods by the
+    web server, all of them are thread safe.
+    """
+    def __init__(self, path: str,
+                 topic_template: str = 'donkey/%s/telemetry',
+                 interval: float = 0.1, session_gap: float = 300.0):
+        """
+        :param path:            directory of the car folders
+        :param topic_template:  TELEMETRY_MQTT_TOPIC_TEMPLATE of the cars
+        :param interval:        downsampling interval in seconds
+        :param session_gap:     seconds without samples which start a new
+                                session
+        """
+        self.path = os.path.expanduser(path)
+        self.topic_template = topic_template
+        self.interval = interval
+        self.session_gap = session_gap
+        pattern = re.escape(topic_template).replace(re.escape('%s'),
+                                                    '([^/]+)')
+        self._topic_re = re.compile(pattern)
+        self.cars: Dict[str, CarState] = {}
+        self.lock = threading.Lock()
+        self.rejected = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def subscription(self) -> str:
+        """ mqtt topic filter matching all cars """
+        return self.topic_template % '+'
+
+    def car_from_topic(self, topic: str) -> Optional[str]:
+        m = self._topic_re.fullmatch(topic)
+        return m.group(1) if m else None
+
+    def ingest(self, topic: str, payload: bytes) -> int:
+        """
+        :param topic:   topic of the message
+        :param payload: telemetry batch
+        :return:        number of samples ingested
+        """
+        car_name = self.car_from_topic(topic)
+        if car_name is None or not valid_name(car_name):
+            self.rejected += 1
+            return 0
+        try:
+            ts, columns = parse_payload(payload)
+        except Exception as e:
+            logger.warning(f'Bad telemetry message on {topic}: {e}')
+            self.rejected += 1
+            return 0
+        if len(ts) == 0:
+            return 0
+        now = time.time()
+        with self.lock:
+            car = self.cars.get(car_name)
+            if car is None:
+                car = self.cars[car_name] = CarState(car_name)
+            if ts[0] - car.last_ts > self.session_gap:
+                car.session = time.strftime('%Y%m%d-%H%M%S',
+                                            time.localtime(ts[0]))
+                logger.info(f'New session {car.session} of {car_name}')
+            car.last_ts = max(car.last_ts, float(ts[-1]))
+            car.last_seen = now
+            car.messages += 1
+            car.samples += len(ts)
+            car.recent.append((now, len(ts)))
+            if len(ts) > 1:
+                dt = float(np.median(np.diff(ts)))
+                if dt > 0:
+                    car.loop_hz = 1.0 / dt
+            for key, col in columns.items():
+                v = col[-1]
+                car.last_values[key] = None if isinstance(v, float) \
+                    and math.isnan(v) else v
+            car.pending.append((car.session, ts, columns))
+        return len(ts)
+
+    def _session_path(self, car: str, session: str) -> str:
+        folder = os.path.join(self.path, car)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, session + FILE_EXTENSION)
+
+    def flush(self) -> int:
+        """
+        Downsample the pending samples and append them to the session files
+
+        :return: number of rows written
+        """
+        with self.lock:
+            pending = {name: car.pending for name, car in self.cars.items()
+                       if car.pending}
+            for name in pending:
+                self.cars[name].pending = []
+        rows = 0
+        for name, chunks in pending.items():
+            by_session: Dict[str, list] = {}
+            for session, ts, columns in chunks:
+                by_session.setdefault(session, []).append((ts, columns))
+            for session, parts in by_session.items():
+                ts, columns = downsample(*concat_columns(parts),
+                                         self.interval)
+                write_chunk(self._session_path(name, session), ts, columns)
+                rows += len(ts)
+        return rows
+
+    def summary(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self.lock:
+            return [car.summary(now) for car in self.cars.values()]
+
+    def stored_cars(self) -> List[str]:
+        return sorted(d for d in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, d)))
+
+    def sessions(self, car: str) -> List[str]:
+        if not valid_name(car):
+            raise KeyError(f'Invalid car {car}')
+        folder = os.path.join(self.path, car)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(f[:-len(FILE_EXTENSION)] for f in os.listdir(folder)
+                      if f.endswith(FILE_EXTENSION))
+
+    def query(self, car: str, session: Optional[str] = None,
+              keys: Optional[Sequence[str]] = None,
+              start: Optional[float] = None, end: Optional[float] = None) \
+            -> Tuple[np.ndarray, Columns]:
+        """
+        :param car:     car name
+        :param session: session, defaults to the latest one
+        :param keys:    keys to return, defaults to all
+        :param start:   min sample time
+        :param end:     max sample time
+        :return:        sample times and columns of the stored samples
+        """
+        if session is None:
+            sessions = self.sessions(car)
+            if not sessions:
+                raise KeyError(f'No telemetry of car {car}')
+            session = sessions[-1]
+        if not valid_name(car) or not valid_name(session):
+            raise KeyError(f'Invalid car {car} or session {session}')
+        path = os.path.join(self.path, car, session + FILE_EXTENSION)
+        if not os.path.exists(path):
+            raise KeyError(f'No session {session} of car {car}')
+        ts, columns = concat_columns(read_chunks(path))
+        mask = np.ones(len(ts), dtype=bool)
+        if start is not None:
+            mask &= ts >= start
+        if end is not None:
+            mask &= ts <= end
+        if keys is not None:
+            columns = {k: columns[k] for k in keys if k in columns}
+        idx = np.flatnonzero(mask)
+        columns = {k: c[mask] if isinstance(c, np.ndarray)
+                   else [c[i] for i in idx] for k, c in columns.items()}
+        return ts[mask], columns
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return [None if math.isnan(v) else v for v in value.tolist()]
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def make_app(aggregator: TelemetryAggregator):
+    """ Tornado application with the query api and the dashboard """
+    import tornado.web
+
+    class Handler(tornado.web.RequestHandler):
+        def write_json(self, data):
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(_jsonable(data)))
+
+    class CarsHandler(Handler):
+        def get(self):
+            live = {s['car']: s for s in aggregator.summary()}
+            for car in aggregator.stored_cars():
+                live.setdefault(car, {'car': car})
+            self.write_json(sorted(live.values(), key=lambda s: s['car']))
+
+    class SessionsHandler(Handler):
+        def get(self, car):
+            try:
+                self.write_json(aggregator.sessions(car))
+            except KeyError as e:
+                raise tornado.web.HTTPError(404, str(e))
+
+    class QueryHandler(Handler):
+        def get(self, car):
+            keys = self.get_argument('keys', None)
+            start = self.get_argument('start', None)
+            end = self.get_argument('end', None)
+            try:
+                ts, columns = aggregator.query(
+                    car, self.get_argument('session', None),
+                    keys.split(',') if keys else None,
+                    float(start) if start else None,
+                    float(end) if end else None)
+            except KeyError as e:
+                raise tornado.web.HTTPError(404, str(e))
+            self.write_json({'ts': ts, 'values': columns})
+
+    class DashboardHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.render('telemetry_web/dashboard.html')
+
+    this_dir = os.path.dirname(os.path.realpath(__file__))
+    return tornado.web.Application([
+        (r'/', DashboardHandler),
+        (r'/api/cars', CarsHandler),
+        (r'/api/cars/([^/]+)/sessions', SessionsHandler),
+        (r'/api/cars/([^/]+)/query', QueryHandler),
+    ], template_path=this_dir)
+
+
+class TelemetryServer:
+    """
+    Subscribes an aggregator to a mqtt broker and serves its web app
+    """
+    def __init__(self, aggregator: TelemetryAggregator,
+                 broker_host: str = 'localhost', broker_port: int = 1883,
+                 http_port: int = 8890, flush_period: float = 1.0):
+        self.aggregator = aggregator
+        self.broker_host = broker_host
+        self.broker_port = broker_port
+        self.http_port = http_port
+        self.flush_period = flush_period
+        self.client = None
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        topic = self.aggregator.subscription()
+        logger.info(f'Connected to {self.broker_host}, subscribing {topic}')
+        client.subscribe(topic)
+
+    def _on_message(self, client, userdata, message):
+        self.aggregator.ingest(message.topic, message.payload)
+
+    def run(self) -> None:
+        from paho.mqtt.client import Client as MQTTClient
+        from paho.mqtt.enums import CallbackAPIVersion
+        from tornado.ioloop import IOLoop, PeriodicCallback
+
+        self.client = MQTTClient(
+            callback_api_version=CallbackAPIVersion.VERSION2)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.connect_async(self.broker_host, self.broker_port)
+        self.client.loop_start()
+
+        app = make_app(self.aggregator)
+        app.listen(self.http_port)
+        flusher = PeriodicCallback(self.aggregator.flush,
+                                   self.flush_period * 1000)
+        flusher.start()
+        logger.info(f'Telemetry dashboard on http://localhost:'
+                     f'{self.http_port}/, storing into '
+                     f'{self.aggregator.path}')
+        try:
+            IOLoop.current().start()
+        finally:
+            flusher.stop()
+            self.client.loop_stop()
+            self.client.disconnect()
+            self.aggregator.flush()
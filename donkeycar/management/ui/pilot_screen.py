@@ -1,6 +1,8 @@
 from copy import copy #, deepcopy
 import os
 
+import numpy as np
+
 from kivy import Logger
 from kivy.properties import StringProperty, ObjectProperty, ListProperty, \
     NumericProperty, BooleanProperty
@@ -15,7 +17,7 @@ from donkeycar.management.ui.common import FileChooserBase, \
 from donkeycar.management.ui.rc_file_handler import rc_handler
 from donkeycar.parts.image_transformations import ImageTransformations
 from donkeycar.pipeline.augmentations import ImageAugmentation
-from donkeycar.utils import get_model_by_type
+from donkeycar.utils import get_model_by_type, normalize_image, rgb2gray
 
 
 ALL_FILTERS = ['*.h5', '*.tflite', '*.savedmodel', '*.trt']
@@ -121,6 +123,9 @@ class OverlayImage(FullImage):
         except Exception as e:
             Logger.error(e)
 
+        if get_app_screen('pilot').show_salient:
+            img_arr = self.overlay_salient(record, orig_img_arr, aug_img_arr,
+                                           img_arr)
         rgb = (0, 0, 255)
         MakeMovie.draw_line_into_image(output[0], output[1], True, img_arr, rgb)
         out_record = copy(record)
@@ -136,6 +141,29 @@ class OverlayImage(FullImage):
         self.pilot_record = out_record
         return img_arr
 
+    def overlay_salient(self, record, orig_img_arr, aug_img_arr, img_arr):
+        """ Overlay the saliency map of keras pilots onto the image. """
+        from donkeycar.parts.interpreter import KerasInterpreter
+        from donkeycar.parts.salient import ModelIntrospector, \
+            overlay_saliency
+        pilot = self.pilot_loader.pilot
+        if not isinstance(pilot.interpreter, KerasInterpreter):
+            return img_arr
+        try:
+            introspector = ModelIntrospector.for_model(pilot.interpreter.model)
+            img = aug_img_arr
+            if introspector.input_shape[2] == 1 and img.shape[2] == 3:
+                img = rgb2gray(img)
+            img = normalize_image(img).reshape(introspector.input_shape)
+            # only unmodified images can be cached by record index
+            ids = [record.underlying['_index']] \
+                if aug_img_arr is orig_img_arr else None
+            mask = introspector.saliency(img[np.newaxis], ids)[0]
+            return overlay_saliency(img_arr, mask)
+        except Exception as e:
+            Logger.error(f'Pilot: Saliency failed: {e}')
+            return img_arr
+
 
 class TransformationPopup(Popup):
     """ Transformation popup window"""
@@ -254,6 +282,7 @@ class PilotScreen(AppScreen):
     post_trans_list = ListProperty(force_dispatch=True)
     post_transformation = ObjectProperty()
     config = ObjectProperty(allownone=True)
+    show_salient = BooleanProperty(False)
 
     def on_index(self, obj, index):
         """ Kivy method that is called if self.index changes. Here we update
@@ -273,6 +302,11 @@ class PilotScreen(AppScreen):
         for c in self.ids.pilot_board.children:
             c.update(record)
 
+    def on_show_salient(self, obj, show_salient):
+        """ Kivy method that is called if self.show_salient changes. """
+        if self.current_record:
+            self.on_current_record(None, self.current_record)
+
     def on_config(self, obj, cfg):
         if not self.config:
             return
@@ -5,6 +5,52 @@ Created on Sun Jun 25 11:07:48 2017
 
 @author: wroscoe
 """
+import itertools
+import time
+
+
+class Trace:
+    """
+    Timestamps of the processing stages of a value flowing through the
+    vehicle loop, e.g. a camera frame from capture over inference to
+    actuation. The vehicle attaches the trace to the channels computed from
+    the value, see Memory.set_trace().
+    """
+    _ids = itertools.count()
+
+    def __init__(self, stage, timestamp=None):
+        """
+        :param stage: name of the first stage
+        :param timestamp: time of the first stage, defaults to now
+        """
+        self.id = next(Trace._ids)
+        self.stages = [stage]
+        self.stamps = {stage: time.time() if timestamp is None else timestamp}
+
+    def mark(self, stage, timestamp=None):
+        """
+        Record the time of a stage, only the first time is kept.
+        :return: True if the stage was not marked before
+        """
+        if stage in self.stamps:
+            return False
+        self.stages.append(stage)
+        self.stamps[stage] = time.time() if timestamp is None else timestamp
+        return True
+
+    @property
+    def origin(self):
+        return self.stamps[self.stages[0]]
+
+    def latency(self, start, end):
+        """
+        :return: seconds between two marked stages
+        """
+        return self.stamps[end] - self.stamps[start]
+
+    def __repr__(self):
+        return f'Trace({self.id}, {self.stages})'
+
 
 class Memory:
     """
@@ -12,6 +58,8 @@ class Memory:
     """
     def __init__(self, *args, **kw):
         self.d = {}
+        # channel name -> trace of its value
+        self.traces = {}
     
     def __setitem__(self, key, value):
         if type(key) is str:
@@ -58,4 +106,27 @@ class Memory:
     
     def items(self):
         return self.d.items()
-        
\ No newline at end of file
+
+    def set_trace(self, keys, trace):
+        """
+        Attach a trace to the values of channels, None removes the traces.
+        """
+        if trace is None:
+            for k in keys:
+                self.traces.pop(k, None)
+        else:
+            for k in keys:
+                self.traces[k] = trace
+
+    def get_trace(self, keys):
+        """
+        :return: the trace with the latest origin of the values of the
+                 channels or None if none of them is traced
+        """
+        result = None
+        for k in keys:
+            trace = self.traces.get(k)
+            if trace is not None and \
+                    (result is None or trace.origin > result.origin):
+                result = trace
+        return result
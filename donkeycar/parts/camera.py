@@ -1,6 +1,8 @@
 import logging
 import os
+import threading
 import time
+from collections import deque
 import numpy as np
 from PIL import Image
 import glob
@@ -14,10 +16,159 @@ class CameraError(Exception):
     pass
 
 
+class FrameRing:
+    """
+    Preallocated ring of camera frames. The capture thread reads a frame
+    into next_slot() and then calls publish(), consumers get the newest
+    complete frame with its sequence number and capture time. A slot is
+    only written again after slots - 1 newer frames were captured, so a
+    frame stays valid at least that long. Parts which keep frames longer
+    must copy them.
+    """
+    def __init__(self, shape, dtype=np.uint8, slots=4):
+        if slots < 2:
+            raise ValueError("FrameRing: slots must be >= 2")
+        self.frames = np.zeros((slots, *shape), dtype=dtype)
+        # one view per slot, so a frame captured into next_slot() can be
+        # recognised by identity
+        self.views = list(self.frames)
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.index = -1     # slot of the newest frame
+        self.seq = -1       # sequence number of the newest frame
+        self.timestamp = None
+
+    @property
+    def shape(self):
+        return self.frames.shape[1:]
+
+    def next_slot(self) -> np.ndarray:
+        """
+        :return: the slot to capture the next frame into
+        """
+        return self.views[(self.index + 1) % self.slots]
+
+    def publish(self, timestamp=None) -> int:
+        """
+        Make the frame in next_slot() the newest frame.
+        :param timestamp: capture time, defaults to now
+        :return: sequence number of the frame
+        """
+        with self.lock:
+            self.index = (self.index + 1) % self.slots
+            self.seq += 1
+            self.timestamp = time.time() if timestamp is None else timestamp
+            return self.seq
+
+    def put(self, frame, timestamp=None) -> int:
+        """
+        Copy a frame into the next slot and publish it
+        """
+        np.copyto(self.next_slot(), frame)
+        return self.publish(timestamp)
+
+    def latest(self):
+        """
+        :return: tuple of the newest frame, its sequence number and its
+                 capture time, or None, -1 and None before the first frame
+        """
+        with self.lock:
+            if self.index < 0:
+                return None, -1, None
+            return self.views[self.index], self.seq, self.timestamp
+
+
 class BaseCamera:
+    # number of frames in the ring of cameras which capture into a FrameRing
+    frame_slots = 8
+    ring = None
+    # if True, run_threaded() returns the frame, its sequence number and
+    # its capture time
+    frame_metadata = False
+
+    def store_frame(self, frame, timestamp, shape=None):
+        """
+        Publish a captured frame. If it was not captured into the ring's
+        next slot it is copied, or resized if its size differs.
+        :param frame: the captured frame
+        :param timestamp: capture time
+        :param shape: shape of the ring, created on the first frame,
+                      defaults to the shape of the frame
+        """
+        if self.ring is None:
+            self.ring = FrameRing(frame.shape if shape is None else shape,
+                                  frame.dtype, self.frame_slots)
+        slot = self.ring.next_slot()
+        if frame is not slot:
+            if frame.shape == slot.shape:
+                np.copyto(slot, frame)
+            else:
+                import cv2
+                cv2.resize(frame, (slot.shape[1], slot.shape[0]), dst=slot)
+        self.ring.publish(timestamp)
+        self.frame = slot
+
+    def latest_frame(self):
+        """
+        :return: tuple of the newest frame, its sequence number and capture
+                 time. Cameras without a frame ring return None for the
+                 latter.
+        """
+        if self.ring is None:
+            return self.frame, None, None
+        return self.ring.latest()
 
     def run_threaded(self):
-        return self.frame
+        frame, seq, timestamp = self.latest_frame()
+        if self.frame_metadata:
+            return frame, seq, timestamp
+        return frame
+
+
+class FrameMonitor:
+    """
+    Part which counts duplicate and dropped camera frames from the frame
+    sequence numbers and measures the age of the frames, see
+    BaseCamera.frame_metadata
+    """
+    def __init__(self, window=1000):
+        self.last_seq = None
+        self.frames = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=window)
+
+    def run(self, seq, timestamp):
+        """
+        :param seq: frame sequence number
+        :param timestamp: frame capture time
+        :return: age of the frame in seconds
+        """
+        if seq is None or timestamp is None:
+            return None
+        if self.last_seq is not None:
+            if seq == self.last_seq:
+                self.duplicates += 1
+            elif seq > self.last_seq + 1:
+                self.dropped += seq - self.last_seq - 1
+        if seq != self.last_seq:
+            self.frames += 1
+        self.last_seq = seq
+        latency = time.time() - timestamp
+        self.latencies.append(latency)
+        return latency
+
+    def stats(self):
+        stats = {'frames': self.frames, 'duplicates': self.duplicates,
+                 'dropped': self.dropped}
+        if self.latencies:
+            ms = np.array(self.latencies) * 1000.0
+            stats['p50_ms'] = float(np.percentile(ms, 50))
+            stats['p99_ms'] = float(np.percentile(ms, 99))
+        return stats
+
+    def shutdown(self):
+        logger.info(f'Camera frames: {self.stats()}')
 
 
 class PiCamera(BaseCamera):
@@ -62,11 +213,12 @@ class PiCamera(BaseCamera):
 
     def run(self):
         # grab the next frame from the camera buffer
-        self.frame = self.camera.capture_array("main")
+        frame = self.camera.capture_array("main")
+        timestamp = time.time()
         if self.image_d == 1:
-            self.frame = rgb2gray(self.frame)
-
-        return self.frame
+            frame = rgb2gray(frame)
+        self.store_frame(frame, timestamp)
+        return self.run_threaded()
 
     def update(self):
         # keep looping infinitely until the thread is stopped
@@ -94,6 +246,7 @@ class Webcam(BaseCamera):
         #
         super().__init__()
         self.cam = None
+        self.surface = None
         self.framerate = framerate
 
         # initialize variable used to indicate
@@ -157,15 +310,26 @@ class Webcam(BaseCamera):
 
     def run(self):
         import pygame.image
+        import pygame.surfarray
+        import pygame.transform
         if self.cam.query_image():
             snapshot = self.cam.get_image()
             if snapshot is not None:
-                snapshot1 = pygame.transform.scale(snapshot, self.resolution)
-                self.frame = pygame.surfarray.pixels3d(pygame.transform.rotate(pygame.transform.flip(snapshot1, True, False), 90))
+                timestamp = time.time()
+                # scale into the same surface every frame
+                if self.surface is None:
+                    self.surface = pygame.transform.scale(snapshot, self.resolution)
+                else:
+                    pygame.transform.scale(snapshot, self.resolution, self.surface)
+                # surfarray is indexed by x, y, so the transposed view is
+                # the image, like the flipped and rotated surface
+                frame = pygame.surfarray.pixels3d(self.surface).transpose(1, 0, 2)
                 if self.image_d == 1:
-                    self.frame = rgb2gray(frame)
+                    frame = rgb2gray(frame)
+                self.store_frame(frame, timestamp)
+                del frame  # unlocks the surface
 
-        return self.frame
+        return self.run_threaded()
 
     def update(self):	
         from datetime import datetime, timedelta
@@ -177,10 +341,6 @@ class Webcam(BaseCamera):
             if s > 0:
                 time.sleep(s)
 
-
-    def run_threaded(self):
-        return self.frame
-
     def shutdown(self):
         # indicate that the thread should be stopped
         self.on = False
@@ -215,6 +375,7 @@ class CSICamera(BaseCamera):
         self.capture_height = capture_height
         self.framerate = framerate
         self.frame = None
+        self.capture = None
         self.init_camera()
         self.running = True
 
@@ -252,16 +413,19 @@ class CSICamera(BaseCamera):
 
     def poll_camera(self):
         import cv2
-        self.ret , frame = self.camera.read()
+        # read into the same capture buffer and convert into the ring
+        self.ret, frame = self.camera.read(self.capture)
         if frame is not None:
-            self.frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            timestamp = time.time()
+            self.capture = frame
+            if self.ring is None:
+                self.ring = FrameRing(frame.shape, frame.dtype, self.frame_slots)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.ring.next_slot())
+            self.store_frame(self.ring.next_slot(), timestamp)
 
     def run(self):
         self.poll_camera()
-        return self.frame
-
-    def run_threaded(self):
-        return self.frame
+        return self.run_threaded()
     
     def shutdown(self):
         self.running = False
@@ -323,7 +487,10 @@ class V4LCamera(BaseCamera):
             # Wait for the device to fill the buffer.
             select.select((self.video,), (), ())
             image_data = self.video.read_and_queue()
-            self.frame = jpg_conv.run(image_data)
+            timestamp = time.time()
+            frame = jpg_conv.run(image_data)
+            if frame is not None:
+                self.store_frame(frame, timestamp)
 
     def shutdown(self):
         self.running = False
@@ -381,7 +548,10 @@ class ImageListCamera(BaseCamera):
             self.i_frame = (self.i_frame + 1) % self.num_images
             self.frame = Image.open(self.image_filenames[self.i_frame]) 
 
-        return np.asarray(self.frame)
+        frame = np.asarray(self.frame)
+        if self.frame_metadata:
+            return frame, None, None
+        return frame
 
     def shutdown(self):
         pass
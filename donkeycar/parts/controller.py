@@ -8,12 +8,17 @@ import logging
 
 from prettytable import PrettyTable
 
-#import for syntactical ease
-from donkeycar.parts.web_controller.web import LocalWebController
-from donkeycar.parts.web_controller.web import WebFpv
-
 logger = logging.getLogger(__name__)
 
+
+def __getattr__(name):
+    # the web controller parts are exported here for syntactical ease, but
+    # loaded on first use as tornado is slow to import
+    if name in ('LocalWebController', 'WebFpv'):
+        from donkeycar.parts.web_controller import web
+        return getattr(web, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 class Joystick(object):
     '''
     An interface to a physical joystick.
@@ -1,9 +1,11 @@
+from abc import ABC, abstractmethod
+import threading
 import time
 import cv2
 import numpy as np
 import logging
 
-from donkeycar.parts.camera import CameraError
+from donkeycar.parts.camera import BaseCamera, CameraError
 
 logger = logging.getLogger(__name__)
 
@@ -360,7 +362,148 @@ class ImgSimpleBlur:
         pass
 
 
-class ImgTrapezoidalMask:
+class ImageMask:
+    """
+    Mask of an image shape which keeps the pixels inside of it and zeroes
+    the others. Masks of the same geometry are shared, see polygon_mask().
+    """
+    def __init__(self, keep):
+        """
+        :param keep: bool array of the image shape, True for the pixels
+                     which are kept
+        """
+        self.keep = np.asarray(keep, dtype=bool)
+        # uint8 images are masked with bitwise and
+        self.mask = np.where(self.keep, 255, 0).astype(np.uint8)
+        # rows with kept pixels, and the rectangle of kept pixels if the
+        # mask is one, as slices
+        self.rows = slice(0, 0)
+        self.rect = None
+        rows = np.flatnonzero(self.keep.reshape(self.keep.shape[0], -1)
+                              .any(axis=1))
+        if rows.size:
+            self.rows = slice(rows[0], rows[-1] + 1)
+            cols = np.flatnonzero(self.keep[self.rows].any(axis=0)
+                                  .reshape(self.keep.shape[1], -1)
+                                  .any(axis=1))
+            rect = (self.rows, slice(cols[0], cols[-1] + 1))
+            if self.keep[rect].all() and \
+                    np.count_nonzero(self.keep) == self.keep[rect].size:
+                self.rect = rect
+        # the arrays are shared between parts
+        self.keep.flags.writeable = False
+        self.mask.flags.writeable = False
+
+    def apply(self, image, dst=None):
+        """
+        Apply the mask to an image of its shape.
+        :param image: image to mask
+        :param dst: None or the result of a previous apply() of the same
+                    image shape and dtype; the pixels outside of the mask
+                    are not written again
+        :return: masked image
+        """
+        if image.dtype != np.uint8:
+            # multiply like the mask parts always did, so nan and inf
+            # outside of the mask stay the same
+            return np.multiply(image, self.keep,
+                               out=np.empty_like(image) if dst is None
+                               else dst)
+        result = np.zeros_like(image) if dst is None else dst
+        if self.rect is not None:
+            result[self.rect] = image[self.rect]
+        elif self.rows.start < self.rows.stop:
+            # only the rows with kept pixels are touched
+            band = result[self.rows]
+            cv2.bitwise_and(image[self.rows], self.mask[self.rows], dst=band)
+        return result
+
+    def apply_batch(self, images):
+        """
+        Apply the mask to a batch of images of its shape.
+        """
+        if images.dtype != np.uint8:
+            return np.multiply(images, self.keep)
+        result = np.zeros_like(images)
+        if self.rect is not None:
+            region = (slice(None),) + self.rect
+            result[region] = images[region]
+        elif self.rows.start < self.rows.stop:
+            region = (slice(None), self.rows)
+            np.bitwise_and(images[region], self.mask[self.rows],
+                           out=result[region])
+        return result
+
+
+# geometry and shape -> ImageMask, shared by all mask parts of the process
+_image_masks = {}
+_image_masks_lock = threading.Lock()
+
+
+def polygon_mask(points, fill, shape):
+    """
+    Shared mask of a convex polygon.
+    :param points: corners of the polygon as (x, y) pairs
+    :param fill: values of the channels inside of the polygon, channels
+                 with a zero fill value are zeroed everywhere
+    :param shape: image shape
+    :return: ImageMask
+    """
+    points = tuple((int(x), int(y)) for x, y in points)
+    fill = tuple(fill)
+    key = (points, fill, tuple(shape))
+    mask = _image_masks.get(key)
+    if mask is None:
+        height, width = shape[:2]
+        inside = np.zeros((height, width), dtype=np.uint8)
+        cv2.fillConvexPoly(inside, np.array(points, dtype=np.int32), 255)
+        inside = inside != 0
+        if len(shape) == 2:
+            keep = inside if fill and round(fill[0]) != 0 \
+                else np.zeros_like(inside)
+        else:
+            # the fill color of a polygon has at most four channels
+            channels = np.array([c < min(len(fill), 4) and round(fill[c]) != 0
+                                 for c in range(shape[2])], dtype=bool)
+            keep = inside[:, :, np.newaxis] & channels
+        with _image_masks_lock:
+            mask = _image_masks.setdefault(key, ImageMask(keep))
+    return mask
+
+
+def clear_image_masks():
+    """ Free the shared masks """
+    with _image_masks_lock:
+        _image_masks.clear()
+
+
+class ImgMaskPart(ABC):
+    """
+    Base of the mask parts, which keep the shared mask of the latest image
+    shape at hand.
+    """
+    mask = None
+
+    @abstractmethod
+    def image_mask(self, shape):
+        """
+        Shared mask of an image shape
+        """
+        pass
+
+    def run(self, image):
+        if image is None:
+            return None
+        mask = self.mask
+        if mask is None or mask.keep.shape != image.shape:
+            mask = self.mask = self.image_mask(image.shape)
+        return mask.apply(image)
+
+    def shutdown(self):
+        self.mask = None
+
+
+class ImgTrapezoidalMask(ImgMaskPart):
     def __init__(self, left, right, bottom_left, bottom_right, top, bottom, fill=[255,255,255]) -> None:
         """
         Apply a trapezoidal mask to an image, keeping image in
@@ -373,7 +516,18 @@ class ImgTrapezoidalMask:
         self.top = top
         self.bottom = bottom
         self.fill = fill
-        self.masks = {}
+
+    def image_mask(self, shape):
+        """
+        Shared mask of an image shape
+        """
+        points = [
+            [self.top_left, self.top],
+            [self.top_right, self.top],
+            [self.bottom_right, self.bottom],
+            [self.bottom_left, self.bottom]
+        ]
+        return polygon_mask(points, self.fill, shape)
 
     def run(self, image):
         """
@@ -386,34 +540,10 @@ class ImgTrapezoidalMask:
         # x                 xxxxx
         # ll                lr xx max_y
         """
-        transformed = None
-        if image is not None:
-            mask = None
-            key = str(image.shape)
-            if self.masks.get(key) is None:
-                mask = np.zeros(image.shape, dtype=np.int32)
-                points = [
-                    [self.top_left, self.top],
-                    [self.top_right, self.top],
-                    [self.bottom_right, self.bottom],
-                    [self.bottom_left, self.bottom]
-                ]
-                cv2.fillConvexPoly(mask,
-                                    np.array(points, dtype=np.int32),
-                                    self.fill)
-                mask = np.asarray(mask, dtype='bool')
-                self.masks[key] = mask
-
-            mask = self.masks[key]
-            transformed = np.multiply(image, mask)
-
-        return transformed
-    
-    def shutdown(self):
-        self.masks = {}  # free cached masks
+        return super().run(image)
 
 
-class ImgTrapezoidalEdgeMask:
+class ImgTrapezoidalEdgeMask(ImgMaskPart):
     def __init__(self, upper_left, upper_right, lower_left, lower_right, top, bottom, fill=[255,255,255]) -> None:
         """
         Apply a trapezoidal mask to an image, where bounds are
@@ -428,7 +558,19 @@ class ImgTrapezoidalEdgeMask:
         self.top = top
         self.bottom = bottom
         self.fill = fill
-        self.masks = {}
+
+    def image_mask(self, shape):
+        """
+        Shared mask of an image shape
+        """
+        height, width = shape[:2]
+        points = [
+            [self.upper_left, self.top],
+            [width - self.upper_right, self.top],
+            [width - self.lower_right, height - self.bottom],
+            [self.lower_left, height - self.bottom]
+        ]
+        return polygon_mask(points, self.fill, shape)
 
     def run(self, image):
         """
@@ -441,45 +583,64 @@ class ImgTrapezoidalEdgeMask:
         # x                 xxxxx
         # ll                lr xx max_y
         """
-        transformed = None
-        if image is not None:
-            mask = None
-            key = str(image.shape)
-            if self.masks.get(key) is None:
-                height, width, depth = image_shape(image)
-                mask = np.zeros(image.shape, dtype=np.int32)
-                points = [
-                    [self.upper_left, self.top],
-                    [width - self.upper_right, self.top],
-                    [width - self.lower_right, height - self.bottom],
-                    [self.lower_left, height - self.bottom]
-                ]
-                cv2.fillConvexPoly(mask,
-                                    np.array(points, dtype=np.int32),
-                                    self.fill)
-                mask = np.asarray(mask, dtype='bool')
-                self.masks[key] = mask
-
-            mask = self.masks[key]
-            transformed = np.multiply(image, mask)
-
-        return transformed
-    
-    def shutdown(self):
-        self.masks = {}  # free cached masks
+        return super().run(image)
 
 
-class ImgCropMask:
-    def __init__(self, left=0, top=0, right=0, bottom=0, fill=[255, 255, 255]) -> None:
+class ImgCropMask(ImgMaskPart):
+    def __init__(self, left=0, top=0, right=0, bottom=0, fill=[255, 255, 255],
+                 crop=False) -> None:
         """
         Apply a mask to top and/or bottom of image.
+        If crop is True the borders are cut off instead, the image
+        gets smaller and is a view into the given image, no pixels
+        are copied.
         """
         self.left = left
         self.top = top
         self.right = right
         self.bottom = bottom
         self.fill = fill
-        self.masks = {}
+        self.crop = crop
+
+    def region(self, height, width):
+        """
+        Rows and columns kept by the crop mode
+        :return: tuple of row slice and column slice
+        """
+        top = self.top or 0
+        bottom = height - (self.bottom or 0)
+        left = self.left or 0
+        right = width - (self.right or 0)
+        if top >= bottom or left >= right:
+            raise ValueError(f"ImgCropMask: crop of top={self.top}, "
+                             f"bottom={self.bottom}, left={self.left}, "
+                             f"right={self.right} leaves no pixels of a "
+                             f"{width}x{height} image")
+        return slice(top, bottom), slice(left, right)
+
+    def cropped_shape(self, height, width):
+        """
+        Height and width of an image after the crop mode
+        """
+        rows, cols = self.region(height, width)
+        return rows.stop - rows.start, cols.stop - cols.start
+
+    def image_mask(self, shape):
+        """
+        Shared mask of an image shape, used when not in crop mode
+        """
+        height, width = shape[:2]
+        top = self.top if self.top is not None else 0
+        bottom = (height - self.bottom) if self.bottom is not None else height
+        left = self.left if self.left is not None else 0
+        right = (width - self.right) if self.right is not None else width
+        points = [
+            [left, top],
+            [right, top],
+            [right, bottom],
+            [left, bottom]
+        ]
+        return polygon_mask(points, self.fill, shape)
 
     def run(self, image):
         """
@@ -495,36 +656,9 @@ class ImgCropMask:
         # # # # # # # # # # # # #
           left                width - right
         """
-        transformed = None
-        if image is not None:
-            mask = None
-            key = str(image.shape)
-            if self.masks.get(key) is None:
-                height, width, depth = image_shape(image)
-                top = self.top if self.top is not None else 0
-                bottom = (height - self.bottom) if self.bottom is not None else height
-                left = self.left if self.left is not None else 0
-                right = (width - self.right) if self.right is not None else width
-                mask = np.zeros(image.shape, dtype=np.int32)
-                points = [
-                    [left, top],
-                    [right, top],
-                    [right, bottom],
-                    [left, bottom]
-                ]
-                cv2.fillConvexPoly(mask,
-                                    np.array(points, dtype=np.int32),
-                                    self.fill)
-                mask = np.asarray(mask, dtype='bool')
-                self.masks[key] = mask
-
-            mask = self.masks[key]
-            transformed = np.multiply(image, mask)
-
-        return transformed
-
-    def shutdown(self):
-        self.masks = {}  # free cached masks
+        if image is not None and self.crop:
+            return image[self.region(image.shape[0], image.shape[1])]
+        return super().run(image)
 
 
 class ArrowKeyboardControls:
@@ -608,13 +742,15 @@ class CvImgFromFile(object):
         return self.image
 
 
-class CvCam(object):
+class CvCam(BaseCamera):
     def __init__(self, image_w=160, image_h=120, image_d=3, iCam=0, warming_secs=5):
         self.width = image_w
         self.height = image_h
         self.depth = image_d
 
         self.frame = None
+        # frames of another size are read here and resized into the ring
+        self.capture = None
         self.cap = cv2.VideoCapture(iCam)
 
         # warm up until we get a frame or we timeout
@@ -640,11 +776,18 @@ class CvCam(object):
 
     def poll(self):
         if self.cap.isOpened():
-            _, self.frame = self.cap.read()
-            if self.frame is not None:
-                width, height = self.frame.shape[:2]
-                if width != self.width or height != self.height:
-                    self.frame = cv2.resize(self.frame, (self.width, self.height))
+            # read straight into the ring, unless the camera delivers
+            # another size than configured
+            buffer = self.capture
+            if buffer is None and self.ring is not None:
+                buffer = self.ring.next_slot()
+            _, frame = self.cap.read(buffer)
+            if frame is not None:
+                timestamp = time.time()
+                if self.ring is not None and frame is not self.ring.next_slot():
+                    self.capture = frame
+                self.store_frame(frame, timestamp,
+                                 shape=(self.height, self.width) + frame.shape[2:])
 
     def update(self):
         '''
@@ -653,12 +796,9 @@ class CvCam(object):
         while self.running:
             self.poll()
 
-    def run_threaded(self):
-        return self.frame
-
     def run(self):
         self.poll()
-        return self.frame
+        return self.run_threaded()
 
     def shutdown(self):
         self.running = False
@@ -16,7 +16,6 @@ import sys
 import time
 
 import numpy as np
-from PIL import Image
 
 
 class Tub(object):
@@ -206,6 +205,7 @@ class Tub(object):
         return a record with references to the saved values that can
         be saved in a csv.
         """
+        from PIL import Image
         json_data = {}
         self.current_ix += 1
         
@@ -299,6 +299,7 @@ class Tub(object):
         return data
 
     def read_record(self, record_dict):
+        from PIL import Image
         data = {}
         for key, val in record_dict.items():
             typ = self.get_input_type(key)
@@ -501,6 +502,7 @@ class TubTimeStacker(TubImageStacker):
         Each key value has the record index with a suffix of _N where N is
         the frame offset into the data.
         '''
+        from PIL import Image
         data = {}
         for i, iOffset in enumerate(self.frame_list):
             iRec = ix + iOffset
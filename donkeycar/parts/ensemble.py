@@ -0,0 +1,232 @@
+"""
+ensemble.py
+
+A pilot part that combines several KerasPilot models, for example a small
+tflite linear model and a larger memory or 3D CNN model. The first pilot in
+the list is the fast model, it always runs in the vehicle loop thread. All
+other pilots run in their own worker thread and have to answer within a per
+frame deadline, otherwise the fast model's output is used.
+
+Policies:
+    average:    weighted mean of the outputs of all models which answered in
+                time
+    vote:       median of the outputs of all models which answered in time,
+                a single outlier model can't move the result
+    cascade:    use the fast model if it is confident enough (see
+                KerasCategorical.confidence), otherwise use the first of the
+                larger models which answers in time
+
+Latency per model and agreement of each model with the combined output are
+collected and can be retrieved with EnsemblePilot.stats().
+"""
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Optional, Sequence, Tuple, Union, Dict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStats:
+    """
+    Latency and agreement statistics for one model of the ensemble
+    """
+    def __init__(self, name: str, window: int = 1000):
+        self.name = name
+        self.latencies = deque(maxlen=window)
+        self.deviations = deque(maxlen=window)
+        self.count = 0
+        self.missed = 0
+        self.used = 0
+
+    def add_latency(self, seconds: float) -> None:
+        self.count += 1
+        self.latencies.append(seconds)
+
+    def add_deviation(self, output, combined) -> None:
+        self.deviations.append(np.abs(np.subtract(output, combined)))
+
+    def to_dict(self) -> Dict[str, float]:
+        lat = np.array(self.latencies) * 1000.0
+        d = {'name': self.name,
+             'count': self.count,
+             'missed': self.missed,
+             'used': self.used}
+        if len(lat):
+            d.update({'mean_ms': float(lat.mean()),
+                      'p50_ms': float(np.percentile(lat, 50)),
+                      'p99_ms': float(np.percentile(lat, 99)),
+                      'max_ms': float(lat.max())})
+        if self.deviations:
+            dev = np.mean(np.array(self.deviations), axis=0)
+            d['mean_abs_deviation'] = [float(v) for v in np.atleast_1d(dev)]
+        return d
+
+
+class EnsemblePilot:
+    """
+    Runs several pilots on the same inputs and combines their outputs.
+    """
+    POLICIES = ('average', 'vote', 'cascade')
+
+    def __init__(self,
+                 pilots: Sequence['KerasPilot'],
+                 policy: str = 'average',
+                 deadline: Optional[float] = None,
+                 weights: Optional[Sequence[float]] = None,
+                 confidence_threshold: float = 0.8):
+        """
+        :param pilots:                  list of pilots, the first one is the
+                                        fast model which is always used as
+                                        fallback
+        :param policy:                  one of 'average', 'vote', 'cascade'
+        :param deadline:                per frame deadline in seconds for the
+                                        larger models, None waits for them
+        :param weights:                 weights per pilot for 'average'
+        :param confidence_threshold:    'cascade' uses the fast model alone
+                                        if its confidence is at least this
+        """
+        if not pilots:
+            raise ValueError("EnsemblePilot requires at least one pilot")
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown ensemble policy {policy}, supported "
+                             f"policies are {', '.join(self.POLICIES)}")
+        if weights is not None and len(weights) != len(pilots):
+            raise ValueError("Need one weight per pilot")
+        self.pilots = list(pilots)
+        self.policy = policy
+        self.deadline = deadline
+        self.weights = np.array(weights if weights is not None
+                                else [1.0] * len(pilots), dtype=np.float64)
+        self.confidence_threshold = confidence_threshold
+        # one single thread executor per larger model, so a model which is
+        # still busy with an older frame doesn't get a queue of frames
+        self.executors = [ThreadPoolExecutor(max_workers=1)
+                          for _ in self.pilots[1:]]
+        self.futures: List[Optional[Future]] = [None] * len(self.executors)
+        self.model_stats = [ModelStats(f'{i}:{p}')
+                            for i, p in enumerate(self.pilots)]
+        self.frames = 0
+        logger.info(f'Created {self}')
+
+    @staticmethod
+    def _timed_run(pilot, args) -> Tuple[Tuple, float]:
+        start = time.perf_counter()
+        output = pilot.run(*args)
+        return output, time.perf_counter() - start
+
+    def _submit(self, i: int, args) -> Optional[Future]:
+        """ Submit frame to larger model i, unless it is still busy """
+        future = self.futures[i]
+        stats = self.model_stats[i + 1]
+        if future is not None and not future.done():
+            stats.missed += 1
+            return None
+        future = self.executors[i].submit(self._timed_run,
+                                          self.pilots[i + 1], args)
+        # record latency on completion, so late answers are counted too
+        def on_done(f: Future) -> None:
+            if f.exception() is None:
+                stats.add_latency(f.result()[1])
+
+        future.add_done_callback(on_done)
+        self.futures[i] = future
+        return future
+
+    def _collect(self, i: int, future: Optional[Future],
+                 start: float) -> Optional[Tuple]:
+        """ Wait for larger model i until the deadline """
+        if future is None:
+            return None
+        timeout = None
+        if self.deadline is not None:
+            timeout = max(0.0, self.deadline - (time.perf_counter() - start))
+        try:
+            output, _ = future.result(timeout=timeout)
+        except TimeoutError:
+            self.model_stats[i + 1].missed += 1
+            return None
+        except Exception as e:
+            logger.error(f'Ensemble model {self.pilots[i + 1]} failed: {e}')
+            return None
+        return output
+
+    def run(self, img_arr: np.ndarray, *other_arr) \
+            -> Tuple[Union[float, np.ndarray], ...]:
+        start = time.perf_counter()
+        self.frames += 1
+        args = (img_arr, *other_arr)
+
+        if self.policy == 'cascade':
+            fast_out, latency = self._timed_run(self.pilots[0], args)
+            self.model_stats[0].add_latency(latency)
+            confidence = getattr(self.pilots[0], 'confidence', None)
+            outputs = [fast_out] + [None] * len(self.executors)
+            if confidence is None or confidence < self.confidence_threshold:
+                for i in range(len(self.executors)):
+                    out = self._collect(i, self._submit(i, args), start)
+                    if out is not None:
+                        outputs[i + 1] = out
+                        break
+        else:
+            # start larger models first, so they run in parallel with the
+            # fast model in this thread
+            futures = [self._submit(i, args)
+                       for i in range(len(self.executors))]
+            fast_out, latency = self._timed_run(self.pilots[0], args)
+            self.model_stats[0].add_latency(latency)
+            outputs = [fast_out] + [self._collect(i, f, start)
+                                    for i, f in enumerate(futures)]
+
+        return self.combine(outputs)
+
+    def combine(self, outputs: List[Optional[Tuple]]) \
+            -> Tuple[Union[float, np.ndarray], ...]:
+        """
+        Combine the outputs of the models according to the policy. Entries
+        of models which didn't answer in time are None.
+        """
+        answered = [i for i, out in enumerate(outputs) if out is not None]
+        values = np.array([outputs[i] for i in answered], dtype=np.float64)
+        if self.policy == 'cascade':
+            # last answered model is the largest one which made the deadline
+            used = [answered[-1]]
+            combined = values[-1]
+        elif self.policy == 'vote':
+            used = answered
+            combined = np.median(values, axis=0)
+        else:
+            used = answered
+            weights = self.weights[answered]
+            combined = np.average(values, axis=0, weights=weights)
+
+        for i in used:
+            self.model_stats[i].used += 1
+        for i, value in zip(answered, values):
+            self.model_stats[i].add_deviation(value, combined)
+        return tuple(float(v) for v in combined)
+
+    def stats(self) -> Dict[str, Union[int, str, List[Dict[str, float]]]]:
+        """
+        :return: per model latency, deadline misses, how often the model was
+                 used and its mean absolute deviation from the combined
+                 output
+        """
+        return {'policy': self.policy,
+                'frames': self.frames,
+                'models': [s.to_dict() for s in self.model_stats]}
+
+    def shutdown(self) -> None:
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+        for pilot in self.pilots:
+            pilot.shutdown()
+        for s in self.model_stats:
+            logger.info(f'Ensemble model stats: {s.to_dict()}')
+
+    def __str__(self) -> str:
+        names = ', '.join(str(p) for p in self.pilots)
+        return f'{type(self).__name__}-{self.policy}[{names}]'
@@ -1,3 +1,11 @@
+"""
+Fast-Stretch contrast enhancement of the V channel of an image.
+
+The stretch is a function of the pixel value only, so it is computed once
+per frame as a 256 entry lookup table from the mean and the histogram of
+the V channel and applied with cv2.LUT. The FastStretch part keeps its
+buffers between frames and can reuse the table for several frames.
+"""
 import cv2
 import numpy as np
 from pathlib import Path
@@ -10,22 +18,18 @@ Tr = 0.7  # Threshold
 T = -0.3  # Gamma boost
 Epsilon = 1e-07  # Epsilon
 
+_IDENTITY = np.arange(256, dtype=np.uint8)
 
-def fast_stretch(image, debug=False):
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    (h, s, v) = cv2.split(hsv)
-    input = v
-    shape = input.shape
-    rows = shape[0]
-    cols = shape[1]
-    size = rows * cols
-    output = np.empty_like(input)
-    if debug:
-        start = time.time()
-    mean = np.mean(input)
+
+def stretch_parameters(mean, histogram, size):
+    """
+    Low and high cut points and gamma of the stretch.
+    :param mean: mean of the V channel
+    :param histogram: 256 bin histogram of the V channel
+    :param size: number of pixels
+    :return: tuple of low cut, high cut and gamma
+    """
     t = (mean - Mx) / Mx
-    Sl = 0.
-    Sh = 0.
     if t <= 0:
         Sl = C
         Sh = C - (Ts * t)
@@ -37,48 +41,103 @@ def fast_stretch(image, debug=False):
     if t <= T:
         gamma = max((1 + (t - T)), Tr)
 
-    if debug:
-        time_taken = (time.time() - start) * 1000
-        print('Preprocessing time %s' % time_taken)
-        start = time.time()
+    # the cut points are where the counts, walked from either end of the
+    # histogram, reach the target fractions. The walk starts with the count
+    # of the end bin and adds it once more in its first step.
+    histogram = np.asarray(histogram, dtype=np.float64).ravel()
+    low = histogram[0] + np.concatenate(([0.], np.cumsum(histogram)))
+    Xl = int(np.argmax(low >= Sl * size))
+    high = histogram[255] + np.concatenate(([0.],
+                                            np.cumsum(histogram[::-1])))
+    Xh = 255 - int(np.argmax(high >= Sh * size))
+    return Xl, Xh, gamma
+
+
+def stretch_lut(Xl, Xh, gamma):
+    """
+    Lookup table mapping V values to stretched values.
+    :return: uint8 array of 256 entries
+    """
+    lut = np.where(_IDENTITY <= Xl, 0, _IDENTITY)
+    lut = np.where(lut >= Xh, 255, lut)
+    lut = np.where(np.logical_and(lut > Xl, lut < Xh), np.multiply(
+        255, np.power(np.divide(np.subtract(lut, Xl), np.max([np.subtract(Xh, Xl), Epsilon])), gamma)), lut)
+    # max to 255
+    lut = np.where(lut > 255., 255., lut)
+    return np.asarray(lut, dtype='uint8')
+
+
+class FastStretch:
+    """
+    Part which applies Fast-Stretch to BGR images and returns RGB images.
+    """
+    def __init__(self, interval=1):
+        """
+        :param interval: compute the lookup table from every n-th frame
+                         only and use it for the frames in between
+        """
+        if interval < 1:
+            raise ValueError("FastStretch: interval must be >= 1")
+        self.interval = interval
+        self.frames = 0
+        self.hsv = None
+        # lookup table for the hsv channels, only V is stretched
+        self.lut = np.repeat(_IDENTITY, 3).reshape(1, 256, 3)
 
-    histogram = cv2.calcHist([input], [0], None, [256], [0, 256])
-    # Walk histogram
-    Xl = 0
-    Xh = 255
-    targetFl = Sl * size
-    targetFh = Sh * size
+    def update_lut(self, hsv):
+        size = hsv.shape[0] * hsv.shape[1]
+        mean = cv2.mean(hsv)[2]
+        histogram = cv2.calcHist([hsv], [2], None, [256], [0, 256])
+        self.lut[0, :, 2] = stretch_lut(*stretch_parameters(mean, histogram,
+                                                            size))
 
-    count = histogram[Xl]
-    while count < targetFl:
-        count += histogram[Xl]
-        Xl += 1
+    def run(self, image, out=None):
+        """
+        :param image: BGR image
+        :param out: optional array for the RGB result, otherwise a new
+                    array is returned
+        :return: stretched RGB image
+        """
+        if image is None:
+            return None
+        if self.hsv is None or self.hsv.shape != image.shape:
+            self.hsv = np.empty_like(image)
+            self.frames = 0
+        cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=self.hsv)
+        if self.frames % self.interval == 0:
+            self.update_lut(self.hsv)
+        self.frames += 1
+        cv2.LUT(self.hsv, self.lut, dst=self.hsv)
+        return cv2.cvtColor(self.hsv, cv2.COLOR_HSV2RGB, dst=out)
 
-    count = histogram[Xh]
-    while count < targetFh:
-        count += histogram[Xh]
-        Xh -= 1
+    def shutdown(self):
+        self.hsv = None
+
+
+def fast_stretch(image, debug=False):
+    """
+    Stretch a BGR image, see FastStretch.
+    :return: stretched RGB image
+    """
+    if debug:
+        start = time.time()
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    size = hsv.shape[0] * hsv.shape[1]
+    histogram = cv2.calcHist([hsv], [2], None, [256], [0, 256])
+    lut = stretch_lut(*stretch_parameters(cv2.mean(hsv)[2], histogram,
+                                          size))
 
     if debug:
         time_taken = (time.time() - start) * 1000
-        print('Histogram Binning %s' % time_taken)
+        print('Histogram and lookup table %s' % time_taken)
         start = time.time()
 
-    # Vectorized ops
-    output = np.where(input <= Xl, 0, input)
-    output = np.where(output >= Xh, 255, output)
-    output = np.where(np.logical_and(output > Xl, output < Xh), np.multiply(
-        255, np.power(np.divide(np.subtract(output, Xl), np.max([np.subtract(Xh, Xl), Epsilon])), gamma)), output)
-    # max to 255
-    output = np.where(output > 255., 255., output)
-    output = np.asarray(output, dtype='uint8')
-    output = cv2.merge((h, s, output))
-    output = cv2.cvtColor(output, cv2.COLOR_HSV2RGB)
+    hsv[:, :, 2] = cv2.LUT(hsv[:, :, 2], lut)
+    output = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
 
     if debug:
         time_taken = (time.time() - start) * 1000
-        print('Vector Ops %s' % time_taken)
-        start = time.time()
+        print('Lookup and conversion %s' % time_taken)
 
     return output
 
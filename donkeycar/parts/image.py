@@ -1,7 +1,7 @@
 
 from PIL import Image
 import numpy as np
-from donkeycar.utils import img_to_binary, binary_to_img, arr_to_img, \
+from donkeycar.utils import arr_to_binary, binary_to_arr, arr_to_img, \
     img_to_arr, normalize_image
 
 
@@ -11,9 +11,7 @@ class ImgArrToJpg():
         if img_arr is None:
             return None
         try:
-            image = arr_to_img(img_arr)
-            jpg = img_to_binary(image)
-            return jpg
+            return arr_to_binary(img_arr)
         except:
             return None
 
@@ -23,9 +21,7 @@ class JpgToImgArr():
     def run(self, jpg):
         if jpg is None:
             return None
-        image = binary_to_img(jpg)
-        img_arr = img_to_arr(image)
-        return img_arr
+        return binary_to_arr(jpg)
 
 
 class StereoPair:
@@ -1,5 +1,10 @@
 import logging
-from typing import List
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
 from donkeycar.config import Config
 from donkeycar.parts import cv as cv_parts
 
@@ -9,16 +14,21 @@ logger = logging.getLogger(__name__)
 
 class ImageTransformations:
     def __init__(self, config: Config, transformation: str,
-                 post_transformation: str = None) -> object:
+                 post_transformation: str = None, fused: bool = True) -> object:
         """
         Part that constructs a list of image transformers
         and run them in sequence to produce a transformed image
+
+        :param fused: run the transformers as a FusedTransformations chain,
+                      which gives the same images with fewer allocations
         """
-        transformations = getattr(config, transformation, [])
+        transformations = list(getattr(config, transformation, []))
         if post_transformation:
             transformations += getattr(config, post_transformation, [])
         self.transformations = [image_transformer(name, config) for name in
                                 transformations]
+        self.fused = compile_transformations(self.transformations) \
+            if fused else None
         logger.info(f'Creating ImageTransformations {transformations}')
     
     def run(self, image):
@@ -26,10 +36,21 @@ class ImageTransformations:
         Run the list of tranformers on the image
         and return transformed image.
         """
+        if self.fused is not None:
+            return self.fused.run(image)
         for transformer in self.transformations:
             image = transformer.run(image)
         return image
 
+    def run_batch(self, images):
+        """
+        Run the tranformers on a NxHxWxC batch of images, see
+        FusedTransformations.run_batch()
+        """
+        if self.fused is not None:
+            return self.fused.run_batch(images)
+        return _imagewise_batch(self.run, np.asarray(images))
+
 
 def image_transformer(name: str, config):
     """
@@ -60,11 +81,17 @@ def image_transformer(name: str, config):
             config.ROI_TRAPEZE_MAX_Y
         )
     elif "CROP" == name:
+        mode = getattr(config, 'ROI_CROP_MODE', 'mask')
+        if mode not in ('mask', 'crop'):
+            msg = f"ROI_CROP_MODE must be 'mask' or 'crop', not '{mode}'"
+            logger.error(msg)
+            raise ValueError(msg)
         return cv_parts.ImgCropMask(
             config.ROI_CROP_LEFT,
             config.ROI_CROP_TOP,
             config.ROI_CROP_RIGHT,
-            config.ROI_CROP_BOTTOM
+            config.ROI_CROP_BOTTOM,
+            crop=(mode == 'crop')
         )
     #
     # color space transformations
@@ -121,6 +148,35 @@ def image_transformer(name: str, config):
         raise ValueError(msg)
 
 
+def transformed_image_shape(config: Config,
+                            transformation: str = 'TRANSFORMATIONS',
+                            post_transformation: str = 'POST_TRANSFORMATIONS'
+                            ) -> Tuple[int, int]:
+    """
+    Height and width of the camera images after the configured
+    transformations, which is the image size the model sees in training
+    and when driving, e.g. smaller than IMAGE_H x IMAGE_W with
+    ROI_CROP_MODE = 'crop'.
+    :param config: configuration with IMAGE_H, IMAGE_W and IMAGE_DEPTH
+    :return: tuple of height and width
+    """
+    height, width = config.IMAGE_H, config.IMAGE_W
+    names = list(getattr(config, transformation, None) or []) \
+        + list(getattr(config, post_transformation, None) or [])
+    if not names:
+        return height, width
+    depth = getattr(config, 'IMAGE_DEPTH', 3)
+    shape = (height, width) if depth == 1 else (height, width, depth)
+    transformations = ImageTransformations(config, transformation,
+                                           post_transformation)
+    image = transformations.run(np.zeros(shape, dtype=np.uint8))
+    if image is None:
+        logger.warning(f'Transformations {names} failed on a {shape} image, '
+                       f'using the camera image size')
+        return height, width
+    return image.shape[0], image.shape[1]
+
+
 def custom_transformer(name:str,
                        config:Config,
                        file_path:str=None,
@@ -228,8 +284,9 @@ class ImgTransformList:
     a json file and run in the order and with
     the arguments specified in the json.
     """
-    def __init__(self, transforms) -> None:
+    def __init__(self, transforms, fused: bool = True) -> None:
         self.transforms = transforms
+        self.fused = compile_transformations(transforms) if fused else None
 
     @staticmethod
     def fromJson(filepath):
@@ -238,16 +295,394 @@ class ImgTransformList:
         return ImgTransformList(transforms)
 
     def run(self, image):
+        if self.fused is not None:
+            return self.fused.run(image)
         for transform in self.transforms:
             image = transform.run(image)
         return image
 
+    def run_batch(self, images):
+        if self.fused is not None:
+            return self.fused.run_batch(images)
+        return _imagewise_batch(self.run, np.asarray(images))
+
     def shutdown(self):
+        if self.fused is not None:
+            self.fused.shutdown()
         for transform in self.transforms:
             if callable(getattr(transform, "shutdown", None)):
                 transform.shutdown()
 
 
+#
+# Fused transformation chains. compile_transformations() turns a list of
+# the cv.py parts into steps which give the same images as running the
+# parts one after the other, but
+# - consecutive masks are merged into one precomputed mask which is applied
+#   with cv2.bitwise_and, or as a copy of the region if the mask is a
+#   rectangle, like the one of ImgCropMask, see cv.ImageMask,
+# - ImgCropMask in crop mode stays a view of the image,
+# - color conversions, blurs, canny and resizes write into dst buffers
+#   which are allocated once per image shape.
+# The output of the chain is never one of the reused buffers, because parts
+# downstream may keep a reference to it. Parts which are run as they are
+# may return a view of their input, so the last step with buffers before
+# them writes a new array.
+#
+# The steps also run on batches of images, NxHxWxC or NxHxW arrays, see
+# FusedTransformations.run_batch(). Masks and crops broadcast over the
+# batch and per pixel operations like color conversions see the batch as
+# one tall image. Resizes, blurs and canny work on single images but write
+# straight into the result batch. Other parts run image by image.
+#
+MASK_TYPES = (cv_parts.ImgTrapezoidalMask,
+              cv_parts.ImgTrapezoidalEdgeMask,
+              cv_parts.ImgCropMask)
+
+COLOR_CONVERSIONS = {
+    cv_parts.ImgGreyscale: cv2.COLOR_RGB2GRAY,
+    cv_parts.ImgRGB2GRAY: cv2.COLOR_RGB2GRAY,
+    cv_parts.ImgBGR2GRAY: cv2.COLOR_BGR2GRAY,
+    cv_parts.ImgGRAY2RGB: cv2.COLOR_GRAY2RGB,
+    cv_parts.ImgGRAY2BGR: cv2.COLOR_GRAY2BGR,
+    cv_parts.ImgBGR2RGB: cv2.COLOR_BGR2RGB,
+    cv_parts.ImgRGB2BGR: cv2.COLOR_RGB2BGR,
+    cv_parts.ImgHSV2RGB: cv2.COLOR_HSV2RGB,
+    cv_parts.ImgRGB2HSV: cv2.COLOR_RGB2HSV,
+    cv_parts.ImgHSV2BGR: cv2.COLOR_HSV2BGR,
+    cv_parts.ImgBGR2HSV: cv2.COLOR_BGR2HSV,
+}
+
+
+def _buffer_key(image: np.ndarray) -> Tuple:
+    return image.shape, image.dtype.str
+
+
+def _pixelwise_batch(op: Callable[[np.ndarray], np.ndarray],
+                     images: np.ndarray) -> np.ndarray:
+    """ Run a per pixel operation on a batch stacked into one image """
+    n, h = images.shape[:2]
+    stacked = np.ascontiguousarray(images).reshape(n * h, *images.shape[2:])
+    result = op(stacked)
+    return result.reshape(n, h, *result.shape[1:])
+
+
+def _imagewise_batch(op: Callable[[np.ndarray], Optional[np.ndarray]],
+                     images: np.ndarray) -> Optional[np.ndarray]:
+    """ Fallback running an operation image by image """
+    results = [op(image) for image in images]
+    if any(r is None for r in results):
+        return None
+    return np.stack(results)
+
+
+def _dst_batch(op: Callable[[np.ndarray, Optional[np.ndarray]], np.ndarray],
+               images: np.ndarray) -> np.ndarray:
+    """
+    Run an OpenCV operation image by image, writing straight into the
+    images of the result batch
+    """
+    first = op(images[0], None)
+    result = np.empty((len(images),) + first.shape, dtype=first.dtype)
+    result[0] = first
+    for i in range(1, len(images)):
+        op(images[i], result[i])
+    return result
+
+
+class BufferedStep:
+    """
+    Step which runs an OpenCV function into a dst buffer, allocated on the
+    first image of each shape.
+    """
+    def __init__(self, name: str,
+                 op: Callable[[np.ndarray, Optional[np.ndarray]], np.ndarray],
+                 batch: bool = False):
+        """
+        :param name:    name of the step, for logging
+        :param op:      function of the source image and the dst buffer or
+                        None, returning the result
+        :param batch:   True if the operation works on single pixels, so
+                        a batch can be processed as one image
+        """
+        self.name = name
+        self.op = op
+        self.batch = batch
+        self.buffers: Dict[Tuple, np.ndarray] = {}
+
+    def run(self, image: np.ndarray, out: bool = False) -> np.ndarray:
+        """
+        :param image:   source image
+        :param out:     True if the result leaves the chain and must not be
+                        a buffer which is overwritten by the next image
+        """
+        key = _buffer_key(image)
+        dst = None if out else self.buffers.get(key)
+        result = self.op(image, dst)
+        if not out and dst is None:
+            self.buffers[key] = result
+        return result
+
+    def run_batch(self, images: np.ndarray) -> np.ndarray:
+        if self.batch:
+            return _pixelwise_batch(lambda image: self.op(image, None),
+                                    images)
+        return _dst_batch(self.op, images)
+
+    def shutdown(self):
+        self.buffers = {}
+
+
+class MaskStep:
+    """
+    Step which applies one or more consecutive mask parts at once.
+    """
+    def __init__(self, parts: List[Any]):
+        self.name = '+'.join(type(p).__name__ for p in parts)
+        self.parts = parts
+        # image key -> [ImageMask, buffer or None]
+        self.masks: Dict[Tuple, list] = {}
+
+    def _compiled(self, image: np.ndarray) -> list:
+        key = _buffer_key(image)
+        compiled = self.masks.get(key)
+        if compiled is None:
+            masks = [part.image_mask(image.shape) for part in self.parts]
+            mask = masks[0] if len(masks) == 1 else cv_parts.ImageMask(
+                np.logical_and.reduce([m.keep for m in masks]))
+            compiled = [mask, None]
+            self.masks[key] = compiled
+        return compiled
+
+    def run(self, image: np.ndarray, out: bool = False) -> np.ndarray:
+        compiled = self._compiled(image)
+        mask, dst = compiled
+        # the pixels outside of the mask of the kept buffer stay zero
+        result = mask.apply(image, None if out else dst)
+        if not out and dst is None:
+            compiled[1] = result
+        return result
+
+    def run_batch(self, images: np.ndarray) -> np.ndarray:
+        # the mask of the first image broadcasts over the batch
+        return self._compiled(images[0])[0].apply_batch(images)
+
+    def shutdown(self):
+        self.masks = {}
+
+
+class PartStep:
+    """ Step which calls run() of a part that can't be fused """
+    def __init__(self, part):
+        self.name = type(part).__name__
+        self.part = part
+
+    def run(self, image: np.ndarray, out: bool = False) -> np.ndarray:
+        # no buffers of its own, FusedTransformations passes out to the
+        # step before
+        return self.part.run(image)
+
+    def run_batch(self, images: np.ndarray) -> np.ndarray:
+        if isinstance(self.part, cv_parts.ImgCropMask) and self.part.crop:
+            # a view of the batch
+            region = self.part.region(images.shape[1], images.shape[2])
+            return images[(slice(None),) + region]
+        return _imagewise_batch(self.part.run, images)
+
+    def shutdown(self):
+        pass
+
+
+def _fused_step(part):
+    """ BufferedStep or PartStep for a single non mask part """
+    name = type(part).__name__
+    if type(part) in COLOR_CONVERSIONS:
+        code = COLOR_CONVERSIONS[type(part)]
+        return BufferedStep(name, lambda src, dst:
+                            cv2.cvtColor(src, code, dst=dst), batch=True)
+    if isinstance(part, cv_parts.ImageResize):
+        size = (part.width, part.height)
+        return BufferedStep(name, lambda src, dst:
+                            cv2.resize(src, size, dst=dst))
+    if isinstance(part, cv_parts.ImageScale):
+        fx, fy = part.scale, part.scale_height
+        return BufferedStep(name, lambda src, dst:
+                            cv2.resize(src, (0, 0), dst=dst, fx=fx, fy=fy))
+    if isinstance(part, cv_parts.ImgGaussianBlur):
+        ksize = part.kernel_size
+        return BufferedStep(name, lambda src, dst:
+                            cv2.GaussianBlur(src, ksize, 0, dst=dst))
+    if isinstance(part, cv_parts.ImgSimpleBlur):
+        ksize = part.kernel_size
+        return BufferedStep(name, lambda src, dst:
+                            cv2.blur(src, ksize, dst=dst))
+    if isinstance(part, cv_parts.ImgCanny):
+        return BufferedStep(name, lambda src, dst: cv2.Canny(
+            src, part.low_threshold, part.high_threshold, edges=dst,
+            apertureSize=part.aperture_size, L2gradient=part.l2gradient))
+    return PartStep(part)
+
+
+class FusedTransformations:
+    """
+    A compiled chain of image transformation parts, see
+    compile_transformations().
+    """
+    def __init__(self, parts: List[Any], steps: List[Any]):
+        self.parts = parts
+        self.steps = steps
+        # the parts of trailing PartSteps may return their input or a view
+        # of it, so the last step with buffers writes a new array instead
+        self.out_index = max((i for i, step in enumerate(steps)
+                              if not isinstance(step, PartStep)), default=-1)
+
+    def run(self, image):
+        if image is None:
+            return None
+        if not self.steps:
+            return image
+        try:
+            transformed = image
+            for i, step in enumerate(self.steps):
+                transformed = step.run(transformed, out=(i == self.out_index))
+                if transformed is None:
+                    return None
+            return transformed
+        except Exception as e:
+            # the parts log the error and return None for the image
+            logger.debug(f'Fused transformation failed, running the parts: '
+                         f'{e}')
+            return self.run_parts(image)
+
+    def run_parts(self, image):
+        """ Run the parts one after the other, without fusion """
+        for part in self.parts:
+            image = part.run(image)
+        return image
+
+    def _run_steps_batch(self, images):
+        try:
+            for step in self.steps:
+                images = step.run_batch(images)
+                if images is None:
+                    return None
+            return images
+        except Exception as e:
+            logger.debug(f'Batch transformation failed, running the images '
+                         f'one by one: {e}')
+            return _imagewise_batch(self.run_parts, images)
+
+    def run_batch(self, images, chunk_size: int = 64):
+        """
+        Transform a batch of images, the result is the same as running each
+        image through run(). Large batches are processed in chunks, which
+        keeps the intermediate images in the cpu cache.
+
+        :param images:      NxHxWxC or NxHxW array, or a list of images of
+                            the same shape
+        :param chunk_size:  images per chunk
+        :return:            array of the transformed images, None if a part
+                            failed on an image. If the chain only crops, it
+                            is a view of the images
+        """
+        if images is None:
+            return None
+        images = np.asarray(images)
+        if len(images) == 0 or not self.steps:
+            return images
+        if len(images) <= chunk_size:
+            return self._run_steps_batch(images)
+        result = None
+        for start in range(0, len(images), chunk_size):
+            chunk = self._run_steps_batch(images[start:start + chunk_size])
+            if chunk is None:
+                return None
+            if result is None:
+                result = np.empty((len(images),) + chunk.shape[1:],
+                                  dtype=chunk.dtype)
+            result[start:start + len(chunk)] = chunk
+        return result
+
+    def shutdown(self):
+        for step in self.steps:
+            step.shutdown()
+
+    def __repr__(self):
+        return f'FusedTransformations({[s.name for s in self.steps]})'
+
+
+def compile_transformations(transformers: List[Any]) -> FusedTransformations:
+    """
+    Analyse a list of image transformation parts once and fuse them into a
+    chain which gives identical images with fewer passes and allocations.
+    Parts which are not known, like custom transformers, are run as they
+    are.
+
+    :param transformers: list of parts with a run(image) method
+    :return:             FusedTransformations
+    """
+    steps = []
+    masks = []
+    for part in transformers:
+        if isinstance(part, cv_parts.ImgCropMask) and part.crop:
+            if masks:
+                steps.append(MaskStep(masks))
+                masks = []
+            # the part returns a view, nothing to fuse
+            steps.append(PartStep(part))
+            continue
+        if isinstance(part, MASK_TYPES):
+            masks.append(part)
+            continue
+        if masks:
+            steps.append(MaskStep(masks))
+            masks = []
+        steps.append(_fused_step(part))
+    if masks:
+        steps.append(MaskStep(masks))
+    fused = FusedTransformations(list(transformers), steps)
+    logger.debug(f'Compiled {fused}')
+    return fused
+
+
+def benchmark_chain(transformers: List[Any], image: np.ndarray,
+                    iterations: int = 200, warmup: int = 10) \
+        -> Dict[str, float]:
+    """
+    Time a transformation chain run part by part and fused.
+
+    :param transformers:    list of image transformation parts
+    :param image:           image to transform
+    :param iterations:      timed runs of each variant
+    :param warmup:          untimed runs before timing
+    :return:                dict with the mean ms per image of both
+                            variants, the speedup and if the images are
+                            identical
+    """
+    fused = compile_transformations(transformers)
+
+    def timed(run):
+        for _ in range(warmup):
+            run(image)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            run(image)
+        return (time.perf_counter() - start) * 1000.0 / iterations
+
+    sequential_ms = timed(fused.run_parts)
+    fused_ms = timed(fused.run)
+    expected = fused.run_parts(image)
+    actual = fused.run(image)
+    identical = (expected is None and actual is None) or \
+        (expected is not None and actual is not None
+         and expected.dtype == actual.dtype
+         and np.array_equal(expected, actual))
+    return {'sequential_ms': sequential_ms,
+            'fused_ms': fused_ms,
+            'speedup': sequential_ms / fused_ms if fused_ms > 0 else 0.0,
+            'identical': bool(identical)}
+
+
 def img_transform_from_json(transform_config):
     """
     Construct a single Image transform from given dictionary.
@@ -318,7 +753,7 @@ def img_transform_from_json(transform_config):
     elif "RESIZE" == transformation:
         transformer = cv_parts.ImageResize(**args)
     elif "SCALE" == transformation:
-        transformer = cv_parts.ImageScale(args.scale, args.scale_height)
+        transformer = cv_parts.ImageScale(**args)
 
     #
     # custom transform
@@ -475,6 +910,8 @@ if __name__ == "__main__":
                         help = "path to image file to user rather that a camera")
     parser.add_argument("-js", "--json", type=str,
                         help = "path to json file with list of tranforms")
+    parser.add_argument("-b", "--benchmark", action="store_true",
+                        help = "time the transforms run part by part and fused, then exit")
 
  
     # Read arguments from command line
@@ -546,6 +983,15 @@ if __name__ == "__main__":
     transformer = ImgTransformList.fromJson(args.json)
     print("done.")
 
+    if args.benchmark:
+        print(f"Benchmarking {transformer.fused}...")
+        result = benchmark_chain(transformer.transforms, image_source.run())
+        print(f"sequential: {result['sequential_ms']:.3f} ms, "
+              f"fused: {result['fused_ms']:.3f} ms, "
+              f"speedup: {result['speedup']:.2f}x, "
+              f"identical: {result['identical']}")
+        sys.exit(0)
+
     # Creating a window for later use
     window_name = 'image_tranformer'
     cv2.namedWindow(window_name)
@@ -252,18 +252,21 @@ class TfLite(Interpreter):
     This class wraps around the TensorFlow Lite interpreter.
     """
 
-    def __init__(self):
+    def __init__(self, num_threads: int = None):
         super().__init__()
         self.interpreter = None
         self.runner = None
         self.signatures = None
+        # None lets tflite choose the number of threads
+        self.num_threads = num_threads
     
     def load(self, model_path):
         assert os.path.splitext(model_path)[1] == '.tflite', \
             'TFlitePilot should load only .tflite files'
         logger.info(f'Loading model {model_path}')
         # Load TFLite model and extract input and output keys
-        self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.interpreter = tf.lite.Interpreter(model_path=model_path,
+                                               num_threads=self.num_threads)
         self.signatures = self.interpreter.get_signature_list()
         self.runner = self.interpreter.get_signature_runner()
         self.input_keys = self.signatures['serving_default']['inputs']
@@ -9,7 +9,6 @@ include one or more models to help direct the vehicles motion.
 """
 import datetime
 from abc import ABC, abstractmethod
-from collections import deque
 
 import numpy as np
 from typing import Dict, Tuple, Optional, Union, List, Sequence, Callable, Any
@@ -19,6 +18,7 @@ from tensorflow.python.data.ops.dataset_ops import DatasetV1, DatasetV2
 
 import donkeycar as dk
 from donkeycar.utils import normalize_image, linear_bin
+from donkeycar.utilities.circular_buffer import ArrayRingBuffer
 from donkeycar.pipeline.types import TubRecord
 from donkeycar.parts.interpreter import Interpreter, KerasInterpreter
 
@@ -26,7 +26,7 @@ import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.layers import (Dense, Input,Convolution2D,
     MaxPooling2D, Activation, Dropout, Flatten, LSTM, BatchNormalization,
-    Conv3D, MaxPooling3D, Conv2DTranspose)
+    Conv3D, MaxPooling3D, Conv2DTranspose, InputLayer)
 
 from tensorflow.keras.layers import TimeDistributed as TD
 from tensorflow.keras.backend import concatenate
@@ -269,6 +269,9 @@ class KerasCategorical(KerasPilot):
                  input_shape: Tuple[int, ...] = (120, 160, 3),
                  throttle_range: float = 0.5):
         self.throttle_range = throttle_range
+        # smaller of the angle and throttle bin probabilities of the last
+        # inference, used by the cascade policy of the EnsemblePilot
+        self.confidence: Optional[float] = None
         super().__init__(interpreter, input_shape)
 
     def create_model(self):
@@ -284,6 +287,8 @@ class KerasCategorical(KerasPilot):
 
     def interpreter_to_output(self, interpreter_out):
         angle_binned, throttle_binned = interpreter_out
+        self.confidence = float(min(np.max(angle_binned),
+                                    np.max(throttle_binned)))
         N = len(throttle_binned)
         throttle = dk.utils.linear_unbin(throttle_binned, N=N,
                                          offset=0.0, R=self.throttle_range)
@@ -367,11 +372,16 @@ class KerasMemory(KerasLinear):
                  **kwargs):
         self.mem_length = mem_length
         self.mem_start_speed = mem_start_speed
-        # create memory of [anlge=0, throttle=mem_start_speed] * mem_length
-        self.mem_seq = deque([[0.0, mem_start_speed]] * mem_length)
+        self.mem_seq = self._create_mem_seq()
         self.mem_depth = mem_depth
         super().__init__(interpreter, input_shape, **kwargs)
 
+    def _create_mem_seq(self) -> ArrayRingBuffer:
+        # create memory of [anlge=0, throttle=mem_start_speed] * mem_length
+        mem_seq = ArrayRingBuffer(self.mem_length, (2,), dtype=np.float64)
+        mem_seq.fill([0.0, self.mem_start_speed])
+        return mem_seq
+
     def seq_size(self) -> int:
         return self.mem_length + 1
 
@@ -384,15 +394,14 @@ class KerasMemory(KerasLinear):
         mem_shape = self.interpreter.get_input_shape('mem_in')
         # take the mem_shape (index 1), the length (index 1) and divide by 2.
         self.mem_length = mem_shape[1] // 2
-        # create memory of [anlge=0, throttle=mem_start_speed] * mem_length
-        self.mem_seq = deque([[0.0, self.mem_start_speed]] * self.mem_length)
+        self.mem_seq = self._create_mem_seq()
         logger.info(f'Loaded {type(self).__name__} model with mem length'
                     f' {self.mem_length}')
 
     def run(self, img_arr: np.ndarray, *other_arr: List[float]) -> \
             Tuple[Union[float, np.ndarray], ...]:
-        # Only called at start to fill the previous values
-        np_mem_arr = np.array(self.mem_seq).reshape((2 * self.mem_length,))
+        # contiguous view of the command history, oldest first
+        np_mem_arr = self.mem_seq.window().reshape((2 * self.mem_length,))
         norm_img_arr = normalize_image(img_arr)
         # create dictionary on the fly, we expect the order of the arguments:
         # img_arr, *other_arr to exactly match the order of the
@@ -404,8 +413,7 @@ class KerasMemory(KerasLinear):
         input_dict = dict(zip(self.output_shapes()[0].keys(), values))
         angle, throttle = self.inference_from_dict(input_dict)
         # fill new values into back of history list for next call
-        self.mem_seq.popleft()
-        self.mem_seq.append([angle, throttle])
+        self.mem_seq.push([angle, throttle])
         return angle, throttle
 
     def x_transform(
@@ -621,16 +629,50 @@ class KerasLocalizer(KerasPilot):
 
 
 class KerasLSTM(KerasPilot):
+    """
+    LSTM over the per frame features of a time distributed CNN. With the
+    keras interpreter and incremental=True, inference only encodes the
+    newest frame and keeps the features of the last seq_length frames in a
+    ring buffer, so the CNN doesn't run over the whole sequence every tick.
+    """
     def __init__(self,
                  interpreter: Interpreter = KerasInterpreter(),
                  input_shape: Tuple[int, ...] = (120, 160, 3),
                  seq_length=3,
-                 num_outputs=2):
+                 num_outputs=2,
+                 incremental: bool = True):
         self.num_outputs = num_outputs
         self.seq_length = seq_length
+        self.incremental = incremental
         super().__init__(interpreter, input_shape)
-        self.img_seq = deque()
+        self.img_seq = ArrayRingBuffer(seq_length, input_shape)
         self.optimizer = "rmsprop"
+        self._reset_incremental()
+
+    def _reset_incremental(self) -> None:
+        self.encoder: Optional[Model] = None
+        self.head: Optional[Model] = None
+        self.feature_seq: Optional[ArrayRingBuffer] = None
+        self.img_seq.clear()
+        # splitting is only attempted once per model
+        self._split_done = not self.incremental \
+            or not isinstance(self.interpreter, KerasInterpreter)
+
+    def _split_model(self) -> None:
+        self._split_done = True
+        split = split_time_distributed(self.interpreter.model)
+        if split is None:
+            logger.info(f'{self} model can not be split into frame encoder '
+                        f'and sequence head, using full sequence inference')
+            return
+        self.encoder, self.head = split
+        self.feature_seq = ArrayRingBuffer(self.seq_length,
+                                           self.encoder.output_shape[1:])
+        logger.info(f'{self} using incremental inference')
+
+    def load(self, model_path: str) -> None:
+        super().load(model_path)
+        self._reset_incremental()
 
     def seq_size(self) -> int:
         return self.seq_length
@@ -668,16 +710,22 @@ class KerasLSTM(KerasPilot):
     def run(self, img_arr, *other_arr):
         if img_arr.shape[2] == 3 and self.input_shape[2] == 1:
             img_arr = dk.utils.rgb2gray(img_arr)
-
-        while len(self.img_seq) < self.seq_length:
-            self.img_seq.append(img_arr)
-
-        self.img_seq.popleft()
-        self.img_seq.append(img_arr)
-        new_shape = (self.seq_length, *self.input_shape)
-        img_arr = np.array(self.img_seq).reshape(new_shape)
-        img_arr_norm = normalize_image(img_arr)
-        input_dict = {'img_in': img_arr_norm}
+        img_arr_norm = normalize_image(img_arr).reshape(self.input_shape)
+
+        if not self._split_done:
+            self._split_model()
+
+        if self.encoder is not None:
+            # only the newest frame goes through the cnn
+            features = self.encoder(img_arr_norm[np.newaxis],
+                                    training=False).numpy()[0]
+            push_sequence(self.feature_seq, features)
+            outputs = self.head(self.feature_seq.window()[np.newaxis],
+                                training=False)
+            return self.interpreter_to_output(outputs.numpy().squeeze(axis=0))
+
+        push_sequence(self.img_seq, img_arr_norm)
+        input_dict = {'img_in': self.img_seq.window()}
         return self.inference_from_dict(input_dict)
 
     def interpreter_to_output(self, interpreter_out) \
@@ -708,11 +756,16 @@ class Keras3D_CNN(KerasPilot):
         self.num_outputs = num_outputs
         self.seq_length = seq_length
         super().__init__(interpreter, input_shape)
-        self.img_seq = deque()
+        # normalised frames, only the newest frame is normalised per tick
+        self.img_seq = ArrayRingBuffer(seq_length, input_shape)
 
     def seq_size(self) -> int:
         return self.seq_length
 
+    def load(self, model_path: str) -> None:
+        super().load(model_path)
+        self.img_seq.clear()
+
     def create_model(self):
         return build_3d_cnn(self.input_shape, s=self.seq_length,
                             num_outputs=self.num_outputs)
@@ -745,16 +798,11 @@ class Keras3D_CNN(KerasPilot):
     def run(self, img_arr, *other_arr):
         if img_arr.shape[2] == 3 and self.input_shape[2] == 1:
             img_arr = dk.utils.rgb2gray(img_arr)
-
-        while len(self.img_seq) < self.seq_length:
-            self.img_seq.append(img_arr)
-
-        self.img_seq.popleft()
-        self.img_seq.append(img_arr)
-        new_shape = (self.seq_length, *self.input_shape)
-        img_arr = np.array(self.img_seq).reshape(new_shape)
-        img_arr_norm = normalize_image(img_arr)
-        input_dict = {'img_in': img_arr_norm}
+        img_arr_norm = normalize_image(img_arr).reshape(self.input_shape)
+        # the 3d convolutions mix neighbouring frames, so unlike the lstm
+        # model the whole sequence has to go through the network
+        push_sequence(self.img_seq, img_arr_norm)
+        input_dict = {'img_in': self.img_seq.window()}
         return self.inference_from_dict(input_dict)
 
     def interpreter_to_output(self, interpreter_out) \
@@ -793,7 +841,65 @@ class KerasLatent(KerasPilot):
             -> Tuple[Union[float, np.ndarray], ...]:
         steering = interpreter_out[1]
         throttle = interpreter_out[2]
-        return steering[0][0], throttle[0][0]
+        return steering[0], throttle[0]
+
+
+def push_sequence(seq: ArrayRingBuffer, value: np.ndarray) -> None:
+    """
+    Push value into the sequence buffer. The first value fills the whole
+    sequence, so a sequence model can run from the first frame.
+    """
+    if seq.count == 0:
+        seq.fill(value)
+    else:
+        seq.push(value)
+
+
+def split_time_distributed(model: Model, tolerance: float = 1e-4) \
+        -> Optional[Tuple[Model, Model]]:
+    """
+    Split a sequence model, which starts with a chain of TimeDistributed
+    layers like rnn_lstm, into a per frame encoder and a head which runs on
+    the sequence of encoded frames. Both share the weights of the model.
+    The split is verified against the full model on random data.
+
+    :param model:       keras model with input (batch, seq, h, w, c)
+    :param tolerance:   max absolute deviation allowed in the verification
+    :return:            tuple of (encoder, head) or None if the model has
+                        a different structure
+    """
+    layers = [l for l in model.layers if not isinstance(l, InputLayer)]
+    num_td = 0
+    while num_td < len(layers) and isinstance(layers[num_td], TD):
+        num_td += 1
+    if num_td == 0 or len(model.inputs) != 1 or len(model.outputs) != 1 \
+            or any(isinstance(l, TD) for l in layers[num_td:]):
+        return None
+    try:
+        frame_in = Input(shape=model.input_shape[2:])
+        x = frame_in
+        for layer in layers[:num_td]:
+            x = layer.layer(x)
+        encoder = Model(inputs=frame_in, outputs=x, name='frame_encoder')
+        seq_in = Input(shape=(model.input_shape[1], *x.shape[1:]))
+        y = seq_in
+        for layer in layers[num_td:]:
+            y = layer(y)
+        head = Model(inputs=seq_in, outputs=y, name='sequence_head')
+
+        # the chain above assumes a linear model, check that it's the case
+        rng = np.random.default_rng(0)
+        test_in = rng.random((1, *model.input_shape[1:]), dtype=np.float32)
+        expected = model(test_in, training=False).numpy()
+        features = encoder(test_in[0], training=False)
+        actual = head(features[np.newaxis], training=False).numpy()
+    except Exception as e:
+        logger.warning(f'Could not split model {model.name}: {e}')
+        return None
+    if expected.shape != actual.shape \
+            or np.max(np.abs(expected - actual)) > tolerance:
+        return None
+    return encoder, head
 
 
 def conv2d(filters, kernel, strides, layer_num, activation='relu'):
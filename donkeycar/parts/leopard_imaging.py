@@ -1,6 +1,6 @@
 import cv2
-from donkeycar.parts.camera import BaseCamera
-from donkeycar.parts.fast_stretch import fast_stretch
+from donkeycar.parts.camera import BaseCamera, FrameRing
+from donkeycar.parts.fast_stretch import FastStretch
 import time
 
 
@@ -8,8 +8,11 @@ class LICamera(BaseCamera):
     '''
     The Leopard Imaging Camera with Fast-Stretch built in.
     '''
-    def __init__(self, width=224, height=224, capture_width=1280, capture_height=720, fps=60):
+    def __init__(self, width=224, height=224, capture_width=1280, capture_height=720, fps=60,
+                 stretch_interval=1):
         super(LICamera, self).__init__()
+        # stretch_interval > 1 reuses the stretch of a frame for the next ones
+        self.stretch = FastStretch(stretch_interval)
         self.width = width
         self.height = height
         self.capture_width = capture_width
@@ -17,6 +20,7 @@ class LICamera(BaseCamera):
         self.fps = fps
         self.camera_id = LICamera.camera_id(self.capture_width, self.capture_height, self.width, self.height, self.fps)
         self.frame = None
+        self.frame_buffer = None
         print('Connecting to Leopard Imaging Camera')
         self.capture = cv2.VideoCapture(self.camera_id)
         time.sleep(2)
@@ -28,15 +32,18 @@ class LICamera(BaseCamera):
             print('Unable to connect. Are you sure you are using the right camera parameters ?')
 
     def read_frame(self):
-        success, frame = self.capture.read()
+        success, frame = self.capture.read(self.frame_buffer)
         if success:
-            # returns an RGB frame.
-            frame = fast_stretch(frame)
-            self.frame = frame
+            timestamp = time.time()
+            self.frame_buffer = frame
+            if self.ring is None:
+                self.ring = FrameRing(frame.shape, frame.dtype, self.frame_slots)
+            # stretch into the ring, returns an RGB frame.
+            self.store_frame(self.stretch.run(frame, out=self.ring.next_slot()), timestamp)
 
     def run(self):
         self.read_frame()
-        return self.frame
+        return self.run_threaded()
 
     def update(self):
         # keep looping infinitely until the thread is stopped
@@ -9,16 +9,21 @@ logger = logging.getLogger(__name__)
 class LineFollower:
     '''
     OpenCV based controller
-    This controller takes a horizontal slice of the image at a set Y coordinate.
-    Then it converts to HSV and does a color thresh hold to find the yellow pixels.
-    It does a histogram to find the pixel of maximum yellow. Then is uses that iPxel
-    to guid a PID controller which seeks to maintain the max yellow at the same point
-    in the image.
+    This controller samples a few horizontal rows of the image between a set
+    Y coordinate and a set height. It converts only these rows to HSV and
+    does a color thresh hold to find the yellow pixels. In each row it finds
+    the window of line width with the most yellow pixels and the subpixel
+    centroid of the yellow pixels in the window. The centroids, weighted by
+    their yellow pixel count, give the line position which guides a PID
+    controller which seeks to maintain the line at the same point in the
+    image.
     '''
     def __init__(self, pid, cfg):
         self.overlay_image = cfg.OVERLAY_IMAGE
         self.scan_y = cfg.SCAN_Y   # num pixels from the top to start horiz scan
         self.scan_height = cfg.SCAN_HEIGHT  # num pixels high to grab from horiz scan
+        self.scan_rows = getattr(cfg, 'SCAN_ROWS', self.scan_height)  # num rows sampled in the scan
+        self.line_width = getattr(cfg, 'LINE_WIDTH', 20)  # num pixels of the window around the line
         self.color_thr_low = np.asarray(cfg.COLOR_THRESHOLD_LOW)  # hsv dark yellow
         self.color_thr_hi = np.asarray(cfg.COLOR_THRESHOLD_HIGH)  # hsv light yellow
         self.target_pixel = cfg.TARGET_PIXEL  # of the N slots above, which is the ideal relationship target
@@ -31,64 +36,110 @@ class LineFollower:
         self.throttle_min = cfg.THROTTLE_MIN
 
         self.pid_st = pid
-
+        # callable returning True while somebody watches the overlay image,
+        # None to always draw it
+        self.has_viewer = None
+
+        # sampled rows and window offsets, set for the first image size
+        self.rows = None
+        self.image_shape = None
+        self.offsets = None
+        self.row_index = None
+        self.window_index = None
+        self.padded = None
+        # per row centroid and confidence of the latest image
+        self.centroids = None
+        self.confidences = None
+
+    def scan_setup(self, height, width):
+        '''
+        choose the sampled rows of an image size
+        '''
+        top = min(max(self.scan_y, 0), height - 1)
+        bottom = min(self.scan_y + self.scan_height, height)
+        count = max(1, min(self.scan_rows, bottom - top))
+        self.rows = np.unique(np.linspace(top, bottom - 1, count).round()
+                              .astype(np.intp))
+        half = max(1, min(self.line_width, width)) // 2
+        self.offsets = np.arange(-half, half + 1)
+        self.row_index = np.arange(len(self.rows))[:, np.newaxis]
+        self.window_index = self.offsets + half
+        self.padded = np.zeros((len(self.rows), width + 2 * half),
+                               dtype=np.uint8)
+        self.image_shape = (height, width)
 
     def get_i_color(self, cam_img):
         '''
-        get the horizontal index of the color at the given slice of the image
+        get the horizontal position of the color in the sampled rows of the image
         input: cam_image, an RGB numpy array
-        output: index of max color, value of cumulative color at that index, and mask of pixels in range
+        output: subpixel position of the color, confidence as the fraction of sampled
+        pixels which belong to the line, and mask of pixels in range of the sampled rows.
+        The position is None if there are no pixels in range.
         '''
-        # take a horizontal slice of the image
-        iSlice = self.scan_y
-        scan_line = cam_img[iSlice : iSlice + self.scan_height, :, :]
+        height, width = cam_img.shape[:2]
+        if self.image_shape != (height, width):
+            self.scan_setup(height, width)
 
-        # convert to HSV color space
-        img_hsv = cv2.cvtColor(scan_line, cv2.COLOR_RGB2HSV)
+        # convert only the sampled rows to HSV color space
+        img_hsv = cv2.cvtColor(cam_img[self.rows], cv2.COLOR_RGB2HSV)
 
         # make a mask of the colors in our range we are looking for
         mask = cv2.inRange(img_hsv, self.color_thr_low, self.color_thr_hi)
 
-        # which index of the range has the highest amount of yellow?
-        hist = np.sum(mask, axis=0)
-        max_yellow = np.argmax(hist)
-
-        return max_yellow, hist[max_yellow], mask
-
+        # number of pixels in range in the window centered at each column
+        # of each row, times 255
+        half = self.offsets[-1]
+        window = cv2.boxFilter(mask, cv2.CV_32F, (2 * half + 1, 1),
+                               normalize=False,
+                               borderType=cv2.BORDER_CONSTANT)
+        peaks = np.argmax(window, axis=1)
+
+        # subpixel centroid of the pixels in range in the window of each
+        # row, the padding keeps the windows inside the mask
+        self.padded[:, half:half + width] = mask
+        weights = self.padded[self.row_index, peaks[:, np.newaxis]
+                              + self.window_index]
+        counts = weights.sum(axis=1, dtype=np.int64) // 255
+        centroids = peaks + weights @ self.offsets / np.maximum(counts * 255, 1)
+        self.centroids = np.where(counts > 0, centroids, np.nan)
+        self.confidences = counts / width
+
+        total = counts.sum()
+        position = float(counts @ centroids / total) if total else None
+        return position, total / mask.size, mask
 
     def run(self, cam_img):
         '''
         main runloop of the CV controller
         input: cam_image, an RGB numpy array
         output: steering, throttle, and the image.
-        If overlay_image is True, then the output image
-        includes and overlay that shows how the 
-        algorithm is working; otherwise the image
-        is just passed-through untouched. 
+        If overlay_image is True and somebody watches,
+        then the output image includes and overlay
+        that shows how the algorithm is working;
+        otherwise the image is just passed-through untouched.
         '''
         if cam_img is None:
             return 0, 0, False, None
 
-        max_yellow, confidence, mask = self.get_i_color(cam_img)
-        conf_thresh = 0.001
+        position, confidence, mask = self.get_i_color(cam_img)
 
-        if self.target_pixel is None:
-            # Use the first run of get_i_color to set our relationship with the yellow line.
-            # You could optionally init the target_pixel with the desired value.
-            self.target_pixel = max_yellow
-            logger.info(f"Automatically chosen line position = {self.target_pixel}")
+        if position is not None and confidence >= self.confidence_threshold:
+            if self.target_pixel is None:
+                # Use the first detected line to set our relationship with the yellow line.
+                # You could optionally init the target_pixel with the desired value.
+                self.target_pixel = position
+                logger.info(f"Automatically chosen line position = {self.target_pixel:.1f}")
 
-        if self.pid_st.setpoint != self.target_pixel:
-            # this is the target of our steering PID controller
-            self.pid_st.setpoint = self.target_pixel
+            if self.pid_st.setpoint != self.target_pixel:
+                # this is the target of our steering PID controller
+                self.pid_st.setpoint = self.target_pixel
 
-        if confidence >= self.confidence_threshold:
             # invoke the controller with the current yellow line position
             # get the new steering value as it chases the ideal
-            self.steering = self.pid_st(max_yellow)
+            self.steering = self.pid_st(position)
 
             # slow down linearly when away from ideal, and speed up when close
-            if abs(max_yellow - self.target_pixel) > self.target_threshold:
+            if abs(position - self.target_pixel) > self.target_threshold:
                 # we will be turning, so slow down
                 if self.throttle > self.throttle_min:
                     self.throttle -= self.delta_th
@@ -104,28 +155,29 @@ class LineFollower:
             logger.info(f"No line detected: confidence {confidence} < {self.confidence_threshold}")
 
         # show some diagnostics
-        if self.overlay_image:
-            cam_img = self.overlay_display(cam_img, mask, max_yellow, confidence)
+        if self.overlay_image and (self.has_viewer is None or self.has_viewer()):
+            cam_img = self.overlay_display(cam_img, mask, position, confidence)
 
         return self.steering, self.throttle, cam_img
 
-    def overlay_display(self, cam_img, mask, max_yellow, confidense):
+    def overlay_display(self, cam_img, mask, position, confidence):
         '''
-        composite mask on top the original image.
+        composite the mask of the sampled rows and the line centroids
+        on top the original image.
         show some values we are using for control
         '''
-
-        mask_exp = np.stack((mask, ) * 3, axis=-1)
-        iSlice = self.scan_y
         img = np.copy(cam_img)
-        img[iSlice : iSlice + self.scan_height, :, :] = mask_exp
+        for i, (row, centroid) in enumerate(zip(self.rows, self.centroids)):
+            img[row] = mask[i, :, np.newaxis]
+            if not np.isnan(centroid):
+                cv2.circle(img, (int(round(centroid)), int(row)), 2, (255, 0, 0), -1)
         # img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
 
         display_str = []
         display_str.append("STEERING:{:.1f}".format(self.steering))
         display_str.append("THROTTLE:{:.2f}".format(self.throttle))
-        display_str.append("I YELLOW:{:d}".format(max_yellow))
-        display_str.append("CONF:{:.2f}".format(confidense))
+        display_str.append("I YELLOW:{}".format("-" if position is None else "{:.1f}".format(position)))
+        display_str.append("CONF:{:.3f}".format(confidence))
 
         y = 10
         x = 10
@@ -135,4 +187,3 @@ class LineFollower:
             y += 10
 
         return img
-
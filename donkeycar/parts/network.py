@@ -1,24 +1,48 @@
 import socket
-import zlib, pickle
+import struct
 import zmq
 import time
 
+from donkeycar.utilities.serialization import get_codec
+
+# udp messages are split into datagrams of at most this payload size, each
+# datagram starts with message id, chunk index and number of chunks
+MAX_DATAGRAM_PAYLOAD = 60000
+DATAGRAM_HEADER = struct.Struct('<IHH')
+# tcp messages are prefixed with their length
+TCP_LENGTH = struct.Struct('<I')
+
+
+def split_datagrams(data, msg_id):
+    '''
+    split message into datagrams of at most MAX_DATAGRAM_PAYLOAD bytes
+    '''
+    view = memoryview(data)
+    num = max(1, -(-len(view) // MAX_DATAGRAM_PAYLOAD))
+    if num > 0xffff:
+        raise ValueError("message too large for udp")
+    return [DATAGRAM_HEADER.pack(msg_id, i, num)
+            + view[i * MAX_DATAGRAM_PAYLOAD:(i + 1) * MAX_DATAGRAM_PAYLOAD]
+            for i in range(num)]
+
+
 class ZMQValuePub(object):
     '''
-    Use Zero Message Queue (zmq) to publish values
+    Use Zero Message Queue (zmq) to publish values. Values are encoded with
+    the codec, see donkeycar.utilities.serialization, and sent as multipart
+    message, numpy arrays are sent without copying.
     '''
-    def __init__(self, name, port = 5556, hwm=10):
+    def __init__(self, name, port = 5556, hwm=10, codec=None):
         context = zmq.Context()
         self.name = name
+        self.codec = get_codec(codec)
         self.socket = context.socket(zmq.PUB)
         self.socket.set_hwm(hwm)
         self.socket.bind("tcp://*:%d" % port)
     
     def run(self, values):
-        packet = { "name": self.name, "val" : values }
-        p = pickle.dumps(packet)
-        z = zlib.compress(p)
-        self.socket.send(z)
+        frames = self.codec.encode(self.name, values)
+        self.socket.send_multipart(frames, copy=False)
 
     def shutdown(self):
         print("shutting down zmq")
@@ -28,10 +52,13 @@ class ZMQValuePub(object):
 
 class ZMQValueSub(object):
     '''
-    Use Zero Message Queue (zmq) to subscribe to value messages from a remote publisher
+    Use Zero Message Queue (zmq) to subscribe to value messages from a remote publisher.
+    Arrays in the received values are read only, copy them before modifying them.
     '''
-    def __init__(self, name, ip, port = 5556, hwm=10, return_last=True):
+    def __init__(self, name, ip, port = 5556, hwm=10, return_last=True,
+                 codec=None):
         context = zmq.Context()
+        self.codec = get_codec(codec)
         self.socket = context.socket(zmq.SUB)
         self.socket.set_hwm(hwm)
         self.socket.connect("tcp://%s:%d" % (ip, port))
@@ -46,19 +73,22 @@ class ZMQValueSub(object):
         otherwize returns packet data
         '''
         try:
-            z = self.socket.recv(flags=zmq.NOBLOCK)
+            frames = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
         except zmq.Again as e:
             if self.return_last:
                 return self.last
             return None
 
-        #print("got", len(z), "bytes")
-        p = zlib.decompress(z)
-        obj = pickle.loads(p)
+        # arrays in the value are read only views into the received frames
+        try:
+            name, val = self.codec.decode([f.buffer for f in frames])
+        except Exception as e:
+            print("bad zmq message:", e)
+            name = None
 
-        if self.name == obj['name']:
-            self.last = obj['val'] 
-            return obj['val']
+        if self.name == name:
+            self.last = val
+            return val
 
         if self.return_last:
             return self.last
@@ -73,36 +103,45 @@ class UDPValuePub(object):
     '''
     Use udp to broadcast values on local network
     '''
-    def __init__(self, name, port = 37021):
+    def __init__(self, name, port = 37021, codec=None):
         self.name = name
         self.port = port
+        self.codec = get_codec(codec)
+        self.msg_id = 0
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)    
         self.sock.settimeout(0.2)
         self.sock.bind(("", 44444))
 
     def run(self, values):
-        packet = { "name": self.name, "val" : values }
-        p = pickle.dumps(packet)
-        z = zlib.compress(p)
-        #print("broadcast", len(z), "bytes to port", self.port)
-        self.sock.sendto(z, ('<broadcast>', self.port))
+        data = self.codec.encode_bytes(self.name, values)
+        if not self.codec.framed:
+            self.sock.sendto(data, ('<broadcast>', self.port))
+            return
+        self.msg_id = (self.msg_id + 1) & 0xffffffff
+        # messages larger than a datagram are sent in chunks
+        for datagram in split_datagrams(data, self.msg_id):
+            self.sock.sendto(datagram, ('<broadcast>', self.port))
 
     def shutdown(self):
         self.sock.close()
 
 class UDPValueSub(object):
     '''
-    Use UDP to listen for broadcase packets
+    Use UDP to listen for broadcase packets. Arrays in the received values
+    are read only, copy them before modifying them.
     '''
-    def __init__(self, name, port = 37021, def_value=None):
+    def __init__(self, name, port = 37021, def_value=None, codec=None):
         self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
         self.client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.client.bind(("", port))
         print("listening for UDP broadcasts on port", port)
         self.name = name
+        self.codec = get_codec(codec)
         self.last = def_value
         self.running = True
+        # chunks of the message currently being received per sender
+        self.partial = {}
 
     def run(self):
         self.poll()
@@ -118,12 +157,33 @@ class UDPValueSub(object):
     def poll(self):
         data, addr = self.client.recvfrom(1024 * 65)
         #print("got", len(data), "bytes")
-        if len(data) > 0:
-            p = zlib.decompress(data)
-            obj = pickle.loads(p)
+        if not self.codec.framed:
+            msg_id, index, num = 0, 0, 1
+            payload = data
+        elif len(data) < DATAGRAM_HEADER.size:
+            return
+        else:
+            msg_id, index, num = DATAGRAM_HEADER.unpack_from(data)
+            payload = data[DATAGRAM_HEADER.size:]
+        if num > 1:
+            # a chunk of a newer message drops an incomplete older one
+            current_id, chunks = self.partial.get(addr, (None, None))
+            if current_id != msg_id:
+                chunks = {}
+                self.partial[addr] = (msg_id, chunks)
+            chunks[index] = payload
+            if len(chunks) < num:
+                return
+            del self.partial[addr]
+            payload = b''.join(chunks[i] for i in range(num))
+        try:
+            name, val = self.codec.decode_bytes(payload)
+        except Exception as e:
+            print("bad udp message:", e)
+            return
 
-            if self.name == obj['name']:
-                self.last = obj['val']
+        if self.name == name:
+            self.last = val
 
 
     def shutdown(self):
@@ -136,9 +196,10 @@ class TCPServeValue(object):
     '''
     Use tcp to serve values on local network
     '''
-    def __init__(self, name, port = 3233):
+    def __init__(self, name, port = 3233, codec=None):
         self.name = name
         self.port = port
+        self.codec = get_codec(codec)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
@@ -167,9 +228,9 @@ class TCPServeValue(object):
                   timeout)
             
         if len(ready_to_write) > 0:
-            packet = { "name": self.name, "val" : values }
-            p = pickle.dumps(packet)
-            z = zlib.compress(p)
+            data = self.codec.encode_bytes(self.name, values)
+            z = TCP_LENGTH.pack(len(data)) + data if self.codec.framed \
+                else data
             for client in ready_to_write:
                 try:
                     self.send(client, z)
@@ -193,13 +254,16 @@ class TCPServeValue(object):
 
 class TCPClientValue(object):
     '''
-    Use tcp to get values on local network
+    Use tcp to get values on local network. Arrays in the received values
+    are read only, copy them before modifying them.
     '''
-    def __init__(self, name, host, port=3233):
+    def __init__(self, name, host, port=3233, codec=None):
         self.name = name
         self.port = port
+        self.codec = get_codec(codec)
         self.addr = (host, port)
         self.sock = None
+        self.buffer = bytearray()
         self.connect()
         self.timeout = 0.05
         self.lastread = time.time()
@@ -222,33 +286,55 @@ class TCPClientValue(object):
         return self.sock is not None
 
     def read(self, sock):
+        '''
+        read available data and return the latest complete message, or None
+        '''
         data = self.sock.recv(64 * 1024)
+        if len(data) == 0:
+            raise ConnectionResetError("server closed connection")
+        self.buffer += data
 
         ready_to_read, ready_to_write, in_error = \
         select.select(
             [self.sock],
             [],
             [],
-            self.timeout)
+            0)
 
         while len(ready_to_read) == 1:
             more_data = self.sock.recv(64 * 1024)
             if len(more_data) == 0:
                 break
-            data = data + more_data
+            self.buffer += more_data
 
             ready_to_read, ready_to_write, in_error = \
             select.select(
                 [self.sock],
                 [],
                 [],
-                self.timeout)
-
-        return data
+                0)
+
+        if not self.codec.framed:
+            # unframed stream, all data read is taken as one message
+            message = bytes(self.buffer)
+            self.buffer = bytearray()
+            return message
+
+        # skip all but the latest complete message
+        message = None
+        while len(self.buffer) >= TCP_LENGTH.size:
+            length = TCP_LENGTH.unpack_from(self.buffer)[0]
+            end = TCP_LENGTH.size + length
+            if len(self.buffer) < end:
+                break
+            message = bytes(self.buffer[TCP_LENGTH.size:end])
+            del self.buffer[:end]
+        return message
 
     def reset(self):
         self.sock.close()
         self.sock = None
+        self.buffer = bytearray()
         self.lastread = time.time()
             
  
@@ -279,19 +365,19 @@ class TCPClientValue(object):
         if len(ready_to_read) == 1:
             try:
                 data = self.read(self.sock)
-                #print("got", len(data), "bytes")
                 self.lastread = time.time()
-                p = zlib.decompress(data)
-                obj = pickle.loads(p)
+                if data is None:
+                    return None
+                name, val = self.codec.decode_bytes(data)
             except Exception as e:
                 print(e)
                 print("error: server may have died")
                 self.reset()
                 return None
 
-            if self.name == obj['name']:
-                self.last = obj['val'] 
-                return obj['val']
+            if self.name == name:
+                self.last = val
+                return val
 
         if len(in_error) > 0:
             print("connection closed")
@@ -307,10 +393,11 @@ class MQTTValuePub(object):
     Use MQTT to send values on network
     pip install paho-mqtt
     '''
-    def __init__(self, name, broker="iot.eclipse.org"):
+    def __init__(self, name, broker="iot.eclipse.org", codec=None):
         from paho.mqtt.client import Client
 
         self.name = name
+        self.codec = get_codec(codec)
         self.message = None
         self.client = Client()
         print("connecting to broker", broker)
@@ -319,10 +406,8 @@ class MQTTValuePub(object):
         print("connected.")
 
     def run(self, values):
-        packet = { "name": self.name, "val" : values }
-        p = pickle.dumps(packet)
-        z = zlib.compress(p)
-        self.client.publish(self.name, z)
+        self.client.publish(self.name,
+                            self.codec.encode_bytes(self.name, values))
 
     def shutdown(self):
         self.client.disconnect()
@@ -334,10 +419,12 @@ class MQTTValueSub(object):
     Use MQTT to recv values on network
     pip install paho-mqtt
     '''
-    def __init__(self, name, broker="iot.eclipse.org", def_value=None):
+    def __init__(self, name, broker="iot.eclipse.org", def_value=None,
+                 codec=None):
         from paho.mqtt.client import Client
 
         self.name = name
+        self.codec = get_codec(codec)
         self.data = None
         self.client = Client(clean_session=True)
         self.client.on_message = self.on_message
@@ -355,13 +442,11 @@ class MQTTValueSub(object):
         if self.data is None:
             return self.def_value
 
-        p = zlib.decompress(self.data)
-        obj = pickle.loads(p)
+        name, val = self.codec.decode_bytes(self.data)
 
-        if self.name == obj['name']:
-            self.last = obj['val']
-            #print("steering, throttle", obj['val'])
-            return obj['val']
+        if self.name == name:
+            self.last = val
+            return val
             
         return self.def_value
 
@@ -0,0 +1,49 @@
+"""
+registry.py
+
+Lazy registries of the camera, interpreter and pilot parts which are
+selected by the car configuration. Nothing in here imports the parts
+themselves; they are imported on first use, see LazyRegistry.
+"""
+from donkeycar.utilities.lazy_registry import LazyRegistry
+
+
+#
+# cameras, keyed by cfg.CAMERA_TYPE
+#
+cameras = LazyRegistry('camera')
+cameras.register('PICAM', 'donkeycar.parts.camera:PiCamera')
+cameras.register('WEBCAM', 'donkeycar.parts.camera:Webcam')
+cameras.register('CVCAM', 'donkeycar.parts.cv:CvCam')
+cameras.register('CSIC', 'donkeycar.parts.camera:CSICamera')
+cameras.register('V4L', 'donkeycar.parts.camera:V4LCamera')
+cameras.register('IMAGE_LIST', 'donkeycar.parts.camera:ImageListCamera')
+cameras.register('LEOPARD', 'donkeycar.parts.leopard_imaging:LICamera')
+cameras.register('MOCK', 'donkeycar.parts.camera:MockCamera')
+cameras.register('D435', 'donkeycar.parts.realsense435i:RealSense435i')
+
+#
+# interpreters, keyed by the model type prefix
+#
+interpreters = LazyRegistry('interpreter')
+interpreters.register('keras', 'donkeycar.parts.interpreter:KerasInterpreter')
+interpreters.register('tflite', 'donkeycar.parts.interpreter:TfLite')
+interpreters.register('tensorrt', 'donkeycar.parts.interpreter:TensorRT')
+interpreters.register('fastai',
+                      'donkeycar.parts.interpreter:FastAIInterpreter')
+
+#
+# pilots, keyed by the model type without interpreter prefix
+#
+pilots = LazyRegistry('pilot')
+pilots.register('linear', 'donkeycar.parts.keras:KerasLinear')
+pilots.register('categorical', 'donkeycar.parts.keras:KerasCategorical')
+pilots.register('inferred', 'donkeycar.parts.keras:KerasInferred')
+pilots.register('imu', 'donkeycar.parts.keras:KerasIMU')
+pilots.register('memory', 'donkeycar.parts.keras:KerasMemory')
+pilots.register('behavior', 'donkeycar.parts.keras:KerasBehavioral')
+pilots.register('localizer', 'donkeycar.parts.keras:KerasLocalizer')
+pilots.register('rnn', 'donkeycar.parts.keras:KerasLSTM')
+pilots.register('3d', 'donkeycar.parts.keras:Keras3D_CNN')
+pilots.register('latent', 'donkeycar.parts.keras:KerasLatent')
+pilots.register('fastai_linear', 'donkeycar.parts.fastai:FastAILinear')
@@ -0,0 +1,301 @@
+"""
+remote.py
+
+Run an expensive part, like a KerasPilot, on a companion computer. On the
+car a RemotePart takes the place of the part in the vehicle with the same
+inputs and outputs. It sends the inputs to a PartServer, started on the
+other host with `donkey part-server`, which runs the real part and sends
+the outputs back. Messages are encoded with the binary codec of
+donkeycar.utilities.serialization over a zmq DEALER/ROUTER connection.
+
+Each request carries an id and a deadline. The server only runs the newest
+request of each client and answers older queued ones as skipped, so a slow
+server never works on a backlog. With pipelining the car doesn't wait for
+the answer of the current request, it uses the newest answer which is not
+older than max_age and keeps up to max_in_flight requests on the way. If
+there is no such answer, the fallback is used.
+"""
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+import zmq
+
+from donkeycar.utilities.serialization import Codec, get_codec
+
+logger = logging.getLogger(__name__)
+
+STATUS_OK = 'ok'
+STATUS_SKIPPED = 'skipped'
+STATUS_EXPIRED = 'expired'
+STATUS_ERROR = 'error'
+
+
+class RemotePartStats:
+    """
+    Request statistics of a RemotePart
+    """
+    def __init__(self, window: int = 1000):
+        self.latencies = deque(maxlen=window)
+        self.server_times = deque(maxlen=window)
+        self.requests = 0
+        self.responses = 0
+        self.late = 0
+        self.lost = 0
+        self.throttled = 0
+        self.fallbacks = 0
+        self.server_status: Dict[str, int] = {}
+
+    def to_dict(self) -> Dict[str, Union[int, float]]:
+        d = {'requests': self.requests,
+             'responses': self.responses,
+             'late': self.late,
+             'lost': self.lost,
+             'throttled': self.throttled,
+             'fallbacks': self.fallbacks,
+             **self.server_status}
+        if self.latencies:
+            lat = np.array(self.latencies) * 1000.0
+            d.update({'p50_ms': float(np.percentile(lat, 50)),
+                      'p99_ms': float(np.percentile(lat, 99)),
+                      'server_mean_ms':
+                          float(np.mean(self.server_times) * 1000.0)})
+        return d
+
+
+class RemotePart:
+    """
+    Vehicle part which forwards its inputs to a PartServer and returns the
+    outputs of the remote part.
+    """
+    def __init__(self,
+                 host: str,
+                 port: int = 5560,
+                 deadline: float = 0.05,
+                 fallback: Any = None,
+                 num_outputs: int = 1,
+                 pipelined: bool = True,
+                 max_in_flight: int = 2,
+                 max_age: Optional[float] = None,
+                 timeout: float = 1.0,
+                 codec: Union[str, Codec, None] = None):
+        """
+        :param host:            host of the part server
+        :param port:            port of the part server
+        :param deadline:        seconds the server may take for a request
+                                and, without pipelining, how long run()
+                                waits for the answer
+        :param fallback:        value returned if there is no fresh answer,
+                                or a part whose run() is called with the
+                                same inputs instead
+        :param num_outputs:     number of outputs, used if fallback is None
+        :param pipelined:       don't wait for the answer to the current
+                                request but use the newest fresh answer
+        :param max_in_flight:   max number of unanswered requests
+        :param max_age:         answers to requests older than this many
+                                seconds are not used, defaults to three
+                                times the deadline
+        :param timeout:         unanswered requests are counted as lost
+                                after this many seconds
+        :param codec:           codec, see get_codec()
+        """
+        self.address = f"tcp://{host}:{port}"
+        self.deadline = deadline
+        self.fallback = fallback
+        self.num_outputs = num_outputs
+        self.pipelined = pipelined
+        self.max_in_flight = max_in_flight
+        self.max_age = max_age if max_age is not None else 3 * deadline
+        self.timeout = timeout
+        self.codec = get_codec(codec)
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.address)
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.next_id = 0
+        # request id -> send time
+        self.in_flight: Dict[int, float] = {}
+        # newest answer: request id, send time and outputs
+        self.latest_id = -1
+        self.latest_sent = 0.0
+        self.latest = None
+        self.stats = RemotePartStats()
+        logger.info(f'Created remote part on {self.address}')
+
+    def _send(self, args) -> Optional[int]:
+        now = time.time()
+        # forget requests which will not be answered anymore
+        for req_id, sent in list(self.in_flight.items()):
+            if now - sent > self.timeout:
+                del self.in_flight[req_id]
+                self.stats.lost += 1
+        if len(self.in_flight) >= self.max_in_flight:
+            self.stats.throttled += 1
+            return None
+        req_id = self.next_id
+        self.next_id += 1
+        request = {'id': req_id, 'deadline': self.deadline, 'args': list(args)}
+        try:
+            self.socket.send_multipart(self.codec.encode('request', request),
+                                       flags=zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            self.stats.throttled += 1
+            return None
+        self.in_flight[req_id] = now
+        self.stats.requests += 1
+        return req_id
+
+    def _receive(self, timeout_ms: int = 0) -> None:
+        """ Process all available answers, wait up to timeout_ms for one """
+        while self.poller.poll(timeout_ms):
+            timeout_ms = 0
+            frames = self.socket.recv_multipart(copy=False)
+            try:
+                _, response = self.codec.decode([f.buffer for f in frames])
+            except Exception as e:
+                logger.error(f'Bad response from {self.address}: {e}')
+                continue
+            req_id = response['id']
+            sent = self.in_flight.pop(req_id, None)
+            if sent is None:
+                # already counted as lost
+                continue
+            status = response['status']
+            if status != STATUS_OK:
+                self.stats.server_status[status] \
+                    = self.stats.server_status.get(status, 0) + 1
+                if status == STATUS_ERROR:
+                    logger.error(f'Remote part error: {response["error"]}')
+                continue
+            latency = time.time() - sent
+            self.stats.responses += 1
+            self.stats.latencies.append(latency)
+            self.stats.server_times.append(response['server_time'])
+            if latency > self.deadline:
+                self.stats.late += 1
+            if req_id > self.latest_id:
+                self.latest_id = req_id
+                self.latest_sent = sent
+                self.latest = response['result']
+
+    def run(self, *args):
+        self._receive()
+        req_id = self._send(args)
+        if not self.pipelined and req_id is not None:
+            end = time.time() + self.deadline
+            while self.latest_id < req_id and req_id in self.in_flight:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._receive(int(remaining * 1000) + 1)
+            if self.latest_id != req_id:
+                return self._fallback(args)
+        if self.latest is None or time.time() - self.latest_sent > self.max_age:
+            return self._fallback(args)
+        return self.latest
+
+    def _fallback(self, args):
+        self.stats.fallbacks += 1
+        if hasattr(self.fallback, 'run'):
+            return self.fallback.run(*args)
+        if self.fallback is None and self.num_outputs > 1:
+            return (None,) * self.num_outputs
+        return self.fallback
+
+    def shutdown(self):
+        logger.info(f'Remote part {self.address} stats: {self.stats.to_dict()}')
+        self.socket.close()
+
+
+class PartServer:
+    """
+    Serves a part to RemotePart clients.
+    """
+    def __init__(self, part, port: int = 5560,
+                 codec: Union[str, Codec, None] = None):
+        """
+        :param part:    the part to run, its run() is called with the inputs
+                        of the client
+        :param port:    port to listen on
+        :param codec:   codec, must match the one of the clients
+        """
+        self.part = part
+        self.port = port
+        self.codec = get_codec(codec)
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(f"tcp://*:{port}")
+        self.running = True
+        self.served = 0
+        logger.info(f'Serving {type(part).__name__} on port {port}')
+
+    def _reply(self, identity, response: Dict[str, Any]) -> None:
+        self.socket.send_multipart([identity] + self.codec.encode(
+            'response', response), copy=False)
+
+    def _collect(self, timeout_ms: int) -> Dict[bytes, tuple]:
+        """
+        Read all queued requests, only the newest per client is kept, the
+        others are answered as skipped
+        """
+        newest = {}
+        if not self.socket.poll(timeout_ms):
+            return newest
+        while True:
+            try:
+                frames = self.socket.recv_multipart(flags=zmq.NOBLOCK,
+                                                    copy=False)
+            except zmq.Again:
+                break
+            identity = frames[0].bytes
+            try:
+                _, request = self.codec.decode([f.buffer for f in frames[1:]])
+            except Exception as e:
+                logger.error(f'Bad request: {e}')
+                continue
+            older = newest.get(identity)
+            if older is not None:
+                self._reply(identity, {'id': older[0]['id'],
+                                       'status': STATUS_SKIPPED})
+            newest[identity] = (request, time.time())
+        return newest
+
+    def serve_once(self, timeout_ms: int = 100) -> None:
+        for identity, (request, received) in \
+                self._collect(timeout_ms).items():
+            deadline = request.get('deadline')
+            if deadline is not None and time.time() - received > deadline:
+                self._reply(identity, {'id': request['id'],
+                                       'status': STATUS_EXPIRED})
+                continue
+            start = time.time()
+            try:
+                result = self.part.run(*request['args'])
+                response = {'id': request['id'], 'status': STATUS_OK,
+                            'result': result,
+                            'server_time': time.time() - start}
+            except Exception as e:
+                logger.exception('Part failed')
+                response = {'id': request['id'], 'status': STATUS_ERROR,
+                            'error': str(e)}
+            self._reply(identity, response)
+            self.served += 1
+
+    def serve(self) -> None:
+        """ Serve until shutdown() is called """
+        try:
+            while self.running:
+                self.serve_once()
+        finally:
+            # zmq sockets must be closed by the thread using them
+            self.socket.close()
+
+    def shutdown(self) -> None:
+        self.running = False
+        if hasattr(self.part, 'shutdown'):
+            self.part.shutdown()
@@ -1,106 +1,284 @@
-#from https://github.com/ermolenkodev/keras-salient-object-visualisation
-import os
-from keras import backend as K
-import tensorflow as tf
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-from keras.layers import Input, Dense, merge
-from keras.models import Model
-from keras.layers import Convolution2D, MaxPooling2D, Reshape, BatchNormalization
-from keras.layers import Activation, Dropout, Flatten, Dense
+"""
+salient.py
+
+Saliency and activation maps of keras pilots. ModelIntrospector builds the
+gradient and activation graphs of a model once as tf.functions and runs them
+on batches of images. Results are cached per (model hash, image id), so the
+vehicle part SalientVis, the makemovie command, the cnnactivations command
+and the pilot screen of the ui share the results when they look at the same
+model and tub.
+"""
+import hashlib
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
 import cv2
 import numpy as np
+import tensorflow as tf
+
+from donkeycar.utils import normalize_image
+
+logger = logging.getLogger(__name__)
+
+EPSILON = 1e-7
+
+
+def model_hash(model: tf.keras.Model) -> str:
+    """
+    :param model:   keras model
+    :return:        hash of the model architecture and weights
+    """
+    h = hashlib.sha1(model.to_json().encode())
+    for w in model.weights:
+        h.update(w.numpy().tobytes())
+    return h.hexdigest()
+
+
+def overlay_saliency(img: np.ndarray, mask: np.ndarray,
+                     alpha: float = 0.5) -> np.ndarray:
+    """
+    Blend a saliency mask as inferno heat map onto the image.
+
+    :param img:     uint8 RGB or grey image
+    :param mask:    saliency mask in [0, 1] of the same height and width
+    :param alpha:   weight of the image in the blend
+    :return:        uint8 RGB image
+    """
+    heat = cv2.applyColorMap((mask * 255).astype(np.uint8),
+                             cv2.COLORMAP_INFERNO)
+    heat = cv2.cvtColor(heat, cv2.COLOR_BGR2RGB)
+    if img.ndim == 2 or img.shape[2] == 1:
+        img = cv2.cvtColor(img.reshape(img.shape[:2]), cv2.COLOR_GRAY2RGB)
+    return cv2.addWeighted(img, alpha, heat, 1.0 - alpha, 0.0)
+
+
+class ModelIntrospector:
+    """
+    Batched saliency and conv layer activations of a single input keras
+    model. Use ModelIntrospector.for_model() to share one instance, and
+    with it the traced graphs, between all users of a model.
+    """
+    # results of all introspectors, keyed by (model hash, kind, image id)
+    _cache: 'OrderedDict[Tuple[str, str, Hashable], object]' = OrderedDict()
+    _cache_lock = threading.Lock()
+    cache_size = 5000
+    _instances: 'weakref.WeakKeyDictionary[tf.keras.Model, ' \
+                'ModelIntrospector]' = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, model: tf.keras.Model, batch_size: int = 32):
+        """
+        :param model:       keras model with a single image input
+        :param batch_size:  max number of images per graph call
+        """
+        if len(model.inputs) != 1:
+            raise ValueError(f'{type(self).__name__} requires a model with a '
+                             f'single image input, {model.name} has '
+                             f'{len(model.inputs)} inputs')
+        self.model = model
+        self.batch_size = batch_size
+        self.model_hash = model_hash(model)
+        self.input_shape = tuple(model.input_shape[1:])
+        self.conv_layers = [l.name for l in model.layers
+                            if isinstance(l, tf.keras.layers.Conv2D)]
+        self._saliency_fn = None
+        self._activations_fn = None
+        self._build_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_model(cls, model: tf.keras.Model, **kwargs) \
+            -> 'ModelIntrospector':
+        """ Return the shared introspector of the model, create if needed """
+        with cls._instances_lock:
+            introspector = cls._instances.get(model)
+            if introspector is None:
+                introspector = cls(model, **kwargs)
+                cls._instances[model] = introspector
+            return introspector
+
+    def _output_layers(self) -> List[tf.keras.layers.Layer]:
+        # same convention as the model builders in parts/keras.py
+        return [l for l in self.model.layers
+                if 'dropout' not in l.name.lower()
+                and 'out' in l.name.lower()]
+
+    def _build_saliency(self):
+        """
+        Clone the model with linear output activations, so the gradients of
+        softmax outputs don't vanish, and trace the saliency graph.
+        """
+        out_layers = self._output_layers()
+        if not out_layers:
+            raise ValueError(f"Model {self.model.name} has no output layer "
+                             f"named with 'out', can't compute saliency")
+        original = {l.name: l.activation for l in out_layers}
+        try:
+            for l in out_layers:
+                l.activation = tf.keras.activations.linear
+            sal_model = tf.keras.models.clone_model(self.model)
+        finally:
+            for l in out_layers:
+                l.activation = original[l.name]
+        sal_model.set_weights(self.model.get_weights())
+        logger.info(f'Saliency on layers {list(original.keys())} of '
+                    f'{self.model.name}')
+
+        spec = tf.TensorSpec((None, *self.input_shape), tf.float32)
+
+        @tf.function(input_signature=[spec])
+        def saliency(images):
+            with tf.GradientTape(persistent=True) as tape:
+                tape.watch(images)
+                outputs = sal_model(images, training=False)
+                if not isinstance(outputs, (list, tuple)):
+                    outputs = [outputs]
+                # categorical outputs use the logit of the chosen bin
+                targets = [tf.reduce_sum(tf.reduce_max(o, axis=-1))
+                           for o in outputs]
+            sq_grads = tf.add_n([tf.square(tape.gradient(t, images))
+                                 for t in targets])
+            grads = tf.reduce_sum(tf.sqrt(sq_grads), axis=-1)
+            g_min = tf.reduce_min(grads, axis=[1, 2], keepdims=True)
+            g_max = tf.reduce_max(grads, axis=[1, 2], keepdims=True)
+            return (grads - g_min) / (g_max - g_min + EPSILON)
+
+        return saliency
+
+    def _build_activations(self):
+        outputs = [self.model.get_layer(name).output
+                   for name in self.conv_layers]
+        act_model = tf.keras.Model(inputs=self.model.inputs[0],
+                                   outputs=outputs)
+        spec = tf.TensorSpec((None, *self.input_shape), tf.float32)
+
+        @tf.function(input_signature=[spec])
+        def activations(images):
+            return act_model(images, training=False)
+
+        return activations
+
+    def _run(self, kind: str, images: np.ndarray,
+             ids: Optional[Sequence[Hashable]]) -> List:
+        """ Per image results of graph kind, served from cache if possible """
+        with self._build_lock:
+            if kind == 'saliency' and self._saliency_fn is None:
+                self._saliency_fn = self._build_saliency()
+            elif kind == 'activations' and self._activations_fn is None:
+                self._activations_fn = self._build_activations()
+        fn = self._saliency_fn if kind == 'saliency' else self._activations_fn
+
+        n = len(images)
+        results = [None] * n
+        if ids is not None:
+            if len(ids) != n:
+                raise ValueError('Need one id per image')
+            with self._cache_lock:
+                for i, image_id in enumerate(ids):
+                    key = (self.model_hash, kind, image_id)
+                    if key in self._cache:
+                        self._cache.move_to_end(key)
+                        results[i] = self._cache[key]
+        todo = [i for i in range(n) if results[i] is None]
+        self.hits += n - len(todo)
+        self.misses += len(todo)
+
+        for start in range(0, len(todo), self.batch_size):
+            chunk = todo[start:start + self.batch_size]
+            batch = np.asarray(images[chunk], dtype=np.float32)
+            out = fn(tf.constant(batch))
+            if kind == 'saliency':
+                per_image = list(out.numpy())
+            else:
+                if not isinstance(out, (list, tuple)):
+                    out = [out]
+                arrays = [o.numpy() for o in out]
+                per_image = [[a[j] for a in arrays] for j in range(len(chunk))]
+            for i, res in zip(chunk, per_image):
+                results[i] = res
+            if ids is not None:
+                with self._cache_lock:
+                    for i in chunk:
+                        self._cache[(self.model_hash, kind, ids[i])] \
+                            = results[i]
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+        return results
+
+    def saliency(self, images: np.ndarray,
+                 ids: Optional[Sequence[Hashable]] = None) -> np.ndarray:
+        """
+        :param images:  normalised model input images of shape (N, H, W, C)
+        :param ids:     optional ids of the images, like tub record indices,
+                        to cache the results
+        :return:        saliency masks in [0, 1] of shape (N, H, W)
+        """
+        images = np.asarray(images)
+        if len(images) == 0:
+            return np.zeros((0, *self.input_shape[:2]), dtype=np.float32)
+        return np.stack(self._run('saliency', images, ids))
+
+    def activations(self, images: np.ndarray,
+                    ids: Optional[Sequence[Hashable]] = None) \
+            -> List[np.ndarray]:
+        """
+        :param images:  normalised model input images of shape (N, H, W, C)
+        :param ids:     optional ids of the images to cache the results
+        :return:        list with one array of shape (N, h, w, filters) per
+                        conv layer, see self.conv_layers
+        """
+        per_image = self._run('activations', np.asarray(images), ids)
+        return [np.stack([res[l] for res in per_image])
+                for l in range(len(self.conv_layers))]
+
+    def submit_saliency(self, images: np.ndarray,
+                        ids: Optional[Sequence[Hashable]] = None) -> Future:
+        """
+        Compute saliency in the background, e.g. for the next batch of tub
+        records while the current ones are being drawn.
+
+        :return: future of the saliency masks
+        """
+        return self._executor.submit(self.saliency, images, ids)
+
+    def cache_info(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache)}
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        with cls._cache_lock:
+            cls._cache.clear()
 
-class SalientVis():
-    '''
-    Note, this part is quite tuned ust for the image dimensions and layers
-    in our standard models. It will not reflect cropping or additional layers
-    that might be in your model.
-    '''
 
-    def __init__(self, kerasPart):
-        self.model = kerasPart.model
-        self.init_salient(self.model)
+class SalientVis:
+    """
+    Vehicle part which returns the camera image with the saliency map of the
+    pilot overlaid. Only supports pilots with keras interpreter and a single
+    image input, like linear and categorical.
+    """
+    def __init__(self, kerasPart, alpha: float = 0.5):
+        self.pilot = kerasPart
+        self.alpha = alpha
+        self.introspector = \
+            ModelIntrospector.for_model(kerasPart.interpreter.model)
 
     def run(self, image):
         if image is None:
             return
-        image = self.draw_salient(image)
-        image = image * 255
-        image = image.astype('uint8')
-        return image
-
-    def init_salient(self, model):
-        img_in = Input(shape=(120, 160, 3), name='img_in')
-        x = img_in
-        x = Convolution2D(24, (5,5), strides=(2,2), activation='relu', name='conv1')(x)
-        x = Convolution2D(32, (5,5), strides=(2,2), activation='relu', name='conv2')(x)
-        x = Convolution2D(64, (5,5), strides=(2,2), activation='relu', name='conv3')(x)
-        x = Convolution2D(64, (3,3), strides=(2,2), activation='relu', name='conv4')(x)
-        conv_5 = Convolution2D(64, (3,3), strides=(1,1), activation='relu', name='conv5')(x)
-        self.convolution_part = Model(inputs=[img_in], outputs=[conv_5])
-
-        for layer_num in ('1', '2', '3', '4', '5'):
-            self.convolution_part.get_layer('conv' + layer_num).set_weights(model.get_layer('conv2d_' + layer_num).get_weights())
-        
-        self.inp = self.convolution_part.input                                           # input placeholder
-        self.outputs = [layer.output for layer in self.convolution_part.layers[1:]]          # all layer outputs
-        self.functor = K.function([self.inp], self.outputs)
-
-        kernel_3x3 = tf.constant(np.array([
-        [[[1]], [[1]], [[1]]], 
-        [[[1]], [[1]], [[1]]], 
-        [[[1]], [[1]], [[1]]]
-        ]), tf.float32)
-
-        kernel_5x5 = tf.constant(np.array([
-                [[[1]], [[1]], [[1]], [[1]], [[1]]], 
-                [[[1]], [[1]], [[1]], [[1]], [[1]]], 
-                [[[1]], [[1]], [[1]], [[1]], [[1]]],
-                [[[1]], [[1]], [[1]], [[1]], [[1]]],
-                [[[1]], [[1]], [[1]], [[1]], [[1]]]
-        ]), tf.float32)
-
-        self.layers_kernels = {5: kernel_3x3, 4: kernel_3x3, 3: kernel_5x5, 2: kernel_5x5, 1: kernel_5x5}
-
-        self.layers_strides = {5: [1, 1, 1, 1], 4: [1, 2, 2, 1], 3: [1, 2, 2, 1], 2: [1, 2, 2, 1], 1: [1, 2, 2, 1]}
-
-        
-    def compute_visualisation_mask(self, img):
-        #from https://github.com/ermolenkodev/keras-salient-object-visualisation
-        
-        activations = self.functor([np.array([img])])
-        activations = [np.reshape(img, (1, img.shape[0], img.shape[1], img.shape[2]))] + activations
-        upscaled_activation = np.ones((3, 6))
-        for layer in [5, 4, 3, 2, 1]:
-            averaged_activation = np.mean(activations[layer], axis=3).squeeze(axis=0) * upscaled_activation
-            output_shape = (activations[layer - 1].shape[1], activations[layer - 1].shape[2])
-            x = tf.constant(
-                np.reshape(averaged_activation, (1,averaged_activation.shape[0],averaged_activation.shape[1],1)),
-                tf.float32
-            )
-            conv = tf.nn.conv2d_transpose(
-                x, self.layers_kernels[layer],
-                output_shape=(1,output_shape[0],output_shape[1], 1), 
-                strides=self.layers_strides[layer], 
-                padding='VALID'
-            )
-            with tf.Session() as session:
-                result = session.run(conv)
-            upscaled_activation = np.reshape(result, output_shape)
-        final_visualisation_mask = upscaled_activation
-        return (final_visualisation_mask - np.min(final_visualisation_mask))/(np.max(final_visualisation_mask) - np.min(final_visualisation_mask))
-
-    def draw_salient(self, img):
-        #from https://github.com/ermolenkodev/keras-salient-object-visualisation
-        alpha = 0.004
-        beta = 1.0 - alpha
-
-        salient_mask = self.compute_visualisation_mask(img)
-        salient_mask_stacked = np.dstack((salient_mask,salient_mask))
-        salient_mask_stacked = np.dstack((salient_mask_stacked,salient_mask))
-        blend = cv2.addWeighted(img.astype('float32'), alpha, salient_mask_stacked, beta, 0.0)
-        return blend
+        img = image
+        if self.introspector.input_shape[2] == 1 and img.ndim == 3 \
+                and img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        img = normalize_image(img).reshape(self.introspector.input_shape)
+        mask = self.introspector.saliency(img[np.newaxis])[0]
+        return overlay_saliency(image, mask, self.alpha)
 
     def shutdown(self):
         pass
-        
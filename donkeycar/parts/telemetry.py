@@ -5,20 +5,123 @@ Telemetry class distributing real-time metrics to external server
 author: @miro (Meir Tseitlin) 2020
 
 Note:
+Samples are kept in a bounded ring buffer and published in batches by a
+background thread, so neither the drive loop nor memory suffer when the
+broker is slow or unreachable. While the broker is down, batches are
+appended to a local spool file and replayed in order after reconnecting.
+
+In JSON mode a batch is a list of {"ts": <second>, "values": {...}} objects,
+samples of the same second merged. Otherwise a batch is one message of the
+binary codec of donkeycar.utilities.serialization, see encode_batch().
 """
 import os
-import queue
+import struct
+import threading
 import time
 import json
 import logging
-import numpy as np
+from collections import deque
 from logging import StreamHandler
-from paho.mqtt.client import Client as MQTTClient
-from paho.mqtt.enums import CallbackAPIVersion
+from numbers import Real
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from donkeycar.utilities.serialization import BinaryCodec
 
 logger = logging.getLogger()
 
 LOG_MQTT_KEY = 'log/default'
+BATCH_NAME = 'telemetry'
+
+_SPOOL_LENGTH = struct.Struct('<I')
+
+
+class MqttBroker:
+    """
+    Connection to a MQTT broker. Connects in the background and reconnects
+    by itself, so an unreachable broker doesn't block the car.
+    """
+    def __init__(self, host: str, port: int = 1883):
+        from paho.mqtt.client import Client as MQTTClient
+        from paho.mqtt.enums import CallbackAPIVersion
+        self.host = host
+        self.port = port
+        self._client = MQTTClient(
+            callback_api_version=CallbackAPIVersion.VERSION2)
+        self._client.connect_async(host, port)
+        self._client.loop_start()
+
+    def is_connected(self) -> bool:
+        return self._client.is_connected()
+
+    def publish(self, topic: str, payload) -> bool:
+        """ :return: True if the message was handed to the connection """
+        from paho.mqtt.client import MQTT_ERR_SUCCESS
+        info = self._client.publish(topic, payload)
+        return info.rc == MQTT_ERR_SUCCESS
+
+    def close(self) -> None:
+        self._client.loop_stop()
+        self._client.disconnect()
+
+
+class LocalBroker:
+    """
+    In memory stand-in for MqttBroker, for tests and for running without
+    network. Set connected to False to simulate an unreachable broker.
+    """
+    def __init__(self):
+        self.connected = True
+        self.messages: List[Tuple[str, Any]] = []
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def publish(self, topic: str, payload) -> bool:
+        if not self.connected:
+            return False
+        self.messages.append((topic, payload))
+        return True
+
+    def close(self) -> None:
+        self.connected = False
+
+
+def encode_batch(samples: List[Tuple[float, Dict[str, Any]]]) -> bytes:
+    """
+    Encode samples column wise: a float64 array of sample times and one
+    column per key. Columns of numbers are float64 arrays with nan where a
+    sample has no value, other columns are lists with None.
+
+    :param samples: list of (time, metrics) tuples
+    :return:        payload
+    """
+    ts = np.array([t for t, _ in samples], dtype=np.float64)
+    keys = []
+    for _, metrics in samples:
+        keys.extend(k for k in metrics if k not in keys)
+    columns = {}
+    for key in keys:
+        column = [metrics.get(key) for _, metrics in samples]
+        if all(isinstance(v, Real) and not isinstance(v, bool)
+               for v in column if v is not None):
+            column = np.array([np.nan if v is None else v for v in column],
+                              dtype=np.float64)
+        columns[key] = column
+    return BinaryCodec().encode_bytes(BATCH_NAME, {'ts': ts,
+                                                   'values': columns})
+
+
+def decode_batch(payload: bytes) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """
+    :param payload: payload created by encode_batch()
+    :return:        tuple of sample times and dict of columns
+    """
+    name, batch = BinaryCodec().decode_bytes(payload)
+    if name != BATCH_NAME:
+        raise ValueError(f'Not a telemetry batch: {name}')
+    return batch['ts'], batch['values']
 
 
 class MqttTelemetry(StreamHandler):
@@ -27,13 +130,21 @@ class MqttTelemetry(StreamHandler):
     Telemetry reports are timestamped and stored in memory until it is pushed to the server
     """
 
-    def __init__(self, cfg):
-
+    def __init__(self, cfg, broker=None):
+        """
+        :param cfg:     configuration with the TELEMETRY_ settings
+        :param broker:  object with the interface of MqttBroker, like
+                        LocalBroker, defaults to a MqttBroker connection to
+                        TELEMETRY_MQTT_BROKER_HOST
+        """
         StreamHandler.__init__(self)
 
         self.PUBLISH_PERIOD = cfg.TELEMETRY_PUBLISH_PERIOD
-        self._last_publish = time.time()
-        self._telem_q = queue.Queue()
+        self._buffer = deque(
+            maxlen=getattr(cfg, 'TELEMETRY_BUFFER_SIZE', 10000))
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self._batch_size = getattr(cfg, 'TELEMETRY_BATCH_SIZE', 500)
         self._step_inputs = cfg.TELEMETRY_DEFAULT_INPUTS.split(',')
         self._step_types = cfg.TELEMETRY_DEFAULT_TYPES.split(',')
         self._total_updates = 0
@@ -41,24 +152,38 @@ class MqttTelemetry(StreamHandler):
         self._mqtt_broker = os.environ.get('DONKEY_MQTT_BROKER', cfg.TELEMETRY_MQTT_BROKER_HOST)  # 'iot.eclipse.org'
         self._topic = cfg.TELEMETRY_MQTT_TOPIC_TEMPLATE % self._donkey_name
         self._use_json_format = cfg.TELEMETRY_MQTT_JSON_ENABLE
-        self._mqtt_client = MQTTClient(callback_api_version=CallbackAPIVersion.VERSION2)
-        self._mqtt_client.connect(self._mqtt_broker, cfg.TELEMETRY_MQTT_BROKER_PORT)
-        self._mqtt_client.loop_start()
+        # min seconds between two accepted samples of a key
+        self._min_interval = {
+            k: 1.0 / hz for k, hz
+            in getattr(cfg, 'TELEMETRY_RATE_LIMITS', {}).items()}
+        self._last_accepted: Dict[str, float] = {}
+        self._spool_path = getattr(
+            cfg, 'TELEMETRY_SPOOL_PATH',
+            os.path.join(getattr(cfg, 'CAR_PATH', os.getcwd()),
+                         'telemetry.spool'))
+        self._spool_max_bytes = getattr(cfg, 'TELEMETRY_SPOOL_MAX_BYTES',
+                                        50 * 1024 * 1024)
+        self._broker = broker if broker is not None \
+            else MqttBroker(self._mqtt_broker, cfg.TELEMETRY_MQTT_BROKER_PORT)
+        self.counters = {'published': 0, 'batches': 0, 'dropped': 0,
+                         'rate_limited': 0, 'spooled': 0, 'replayed': 0,
+                         'spool_dropped': 0}
         self._on = True
+        self._thread = None
         if cfg.TELEMETRY_LOGGING_ENABLE:
             self.setLevel(logging.getLevelName(cfg.TELEMETRY_LOGGING_LEVEL))
             self.setFormatter(logging.Formatter(cfg.TELEMETRY_LOGGING_FORMAT))
             logger.addHandler(self)
 
     def add_step_inputs(self, inputs, types):
-   
+
         # Add inputs if supported and not yet registered
         for ind in range(0, len(inputs or [])):
             if types[ind] in ['float', 'str', 'int'] and inputs[ind] not in self._step_inputs:
                 self._step_inputs.append(inputs[ind])
                 self._step_types.append(types[ind])
-                
-        return self._step_inputs, self._step_types        
+
+        return self._step_inputs, self._step_types
 
     @staticmethod
     def filter_supported_metrics(inputs, types):
@@ -72,17 +197,29 @@ class MqttTelemetry(StreamHandler):
 
     def report(self, metrics):
         """
-        Basic reporting - gets arbitrary dictionary with values
+        Basic reporting - gets arbitrary dictionary with values. If the
+        buffer is full the oldest sample is dropped.
         """
-        curr_time = int(time.time())
+        now = time.time()
+        with self._lock:
+            if self._min_interval:
+                accepted = {}
+                for k, v in metrics.items():
+                    interval = self._min_interval.get(k)
+                    if interval is not None:
+                        if now - self._last_accepted.get(k, 0.0) < interval:
+                            self.counters['rate_limited'] += 1
+                            continue
+                        self._last_accepted[k] = now
+                    accepted[k] = v
+                metrics = accepted
+            if metrics:
+                if len(self._buffer) == self._buffer.maxlen:
+                    self.counters['dropped'] += 1
+                self._buffer.append((now, metrics))
 
-        # Store sample with time rounded to second
-        try:
-            self._telem_q.put((curr_time, metrics), block=False)
-        except queue.Full:
-            pass
-
-        return curr_time
+        # time rounded to second, as used by the json format
+        return int(now)
 
     def emit(self, record):
         """
@@ -93,93 +230,133 @@ class MqttTelemetry(StreamHandler):
 
     @property
     def qsize(self):
-        return self._telem_q.qsize()
+        return len(self._buffer)
 
-    def publish(self):
+    def _take(self) -> List[Tuple[float, Dict[str, Any]]]:
+        with self._lock:
+            n = min(len(self._buffer), self._batch_size)
+            return [self._buffer.popleft() for _ in range(n)]
 
-        # Create packet
-        packet = {}
-        while not self._telem_q.empty():
-            next_item = self._telem_q.get()
-            packet.setdefault(next_item[0], {}).update(next_item[1])
+    def _payload(self, samples):
+        if self._use_json_format:
+            packet = {}
+            for ts, metrics in samples:
+                packet.setdefault(int(ts), {}).update(
+                    {k: v.item() if isinstance(v, np.generic) else v
+                     for k, v in metrics.items()})
+            return json.dumps([{'ts': k, 'values': v}
+                               for k, v in packet.items()])
+        return encode_batch(samples)
 
-        if not packet:
+    def _send(self, payload) -> bool:
+        try:
+            return self._broker.is_connected() \
+                and self._broker.publish(self._topic, payload)
+        except Exception as e:
+            logger.error(f'Error publishing telemetry {self._topic}: {e}')
+            return False
+
+    def _spool(self, payload) -> None:
+        if not self._spool_path:
+            self.counters['spool_dropped'] += 1
             return
-            
-        if self._use_json_format:
-            packet = [{'ts': k, 'values': v} for k, v in packet.items()]
-            payload = json.dumps(packet)
-
-            try:
-                self._mqtt_client.publish(self._topic, payload)
-            except Exception as e:
-                logger.error(f'Error publishing log {self._topic}: {e}')
-        else:
-            # Publish only the last timestamp for per step metrics
-            last_sample = packet[list(packet)[-1]]
-            for k, v in last_sample.items():
-                if k in self._step_inputs:
-                    topic = f'{self._topic}/{k}'
-                    
-                    try:
-                        # Convert unsupported numpy types to python standard
-                        if isinstance(v, np.generic):
-                            v = np.asscalar(v)
-
-                        self._mqtt_client.publish(topic, v)
-                    except TypeError:
-                        logger.error(f'Cannot publish topic "{topic}" with value of type {type(v)}')
-                    except Exception as e:
-                        logger.error(f'Error publishing log {topic}: {e}')
-
-            # Publish all logs
-            for tm, sample in packet.items():
-                if LOG_MQTT_KEY in sample:
-                    topic = f'{self._topic}/{LOG_MQTT_KEY}'
-                    try:
-                        self._mqtt_client.publish(topic, sample[LOG_MQTT_KEY])
-                    except Exception as e:
-                        logger.error(f'Error publishing log {topic}: {e}')
-
-        self._total_updates += 1
-        return
+        data = payload.encode() if isinstance(payload, str) else payload
+        try:
+            size = os.path.getsize(self._spool_path) \
+                if os.path.exists(self._spool_path) else 0
+            if size + len(data) + _SPOOL_LENGTH.size > self._spool_max_bytes:
+                self.counters['spool_dropped'] += 1
+                return
+            with open(self._spool_path, 'ab') as f:
+                f.write(_SPOOL_LENGTH.pack(len(data)) + data)
+            self.counters['spooled'] += 1
+        except OSError as e:
+            logger.error(f'Error spooling telemetry to {self._spool_path}: '
+                         f'{e}')
+            self.counters['spool_dropped'] += 1
 
-    def run(self, *args):
+    def _replay(self) -> bool:
         """
-        API function needed to use as a Donkey part. Accepts values,
-        pairs them with their inputs keys and saves them to disk.
+        Publish the spooled payloads in order, keep the ones which could not
+        be sent.
+
+        :return: True if the spool is empty
         """
-        assert len(self._step_inputs) == len(args)
-        
-        # Add to queue
-        record = dict(zip(self._step_inputs, args))
-        self.report(record)
+        if not self._spool_path or not os.path.exists(self._spool_path):
+            return True
+        with open(self._spool_path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _SPOOL_LENGTH.size <= len(data):
+            length = _SPOOL_LENGTH.unpack_from(data, offset)[0]
+            payload = data[offset + _SPOOL_LENGTH.size:
+                           offset + _SPOOL_LENGTH.size + length]
+            if len(payload) < length:
+                logger.warning('Dropping truncated telemetry spool record')
+                break
+            if self._use_json_format:
+                payload = payload.decode()
+            if not self._send(payload):
+                with open(self._spool_path, 'wb') as f:
+                    f.write(data[offset:])
+                return False
+            self.counters['replayed'] += 1
+            offset += _SPOOL_LENGTH.size + length
+        os.remove(self._spool_path)
+        return True
 
-        # Periodic publish
-        curr_time = time.time()
-        if curr_time - self._last_publish > self.PUBLISH_PERIOD and self.qsize > 0:
+    def publish(self):
+        """
+        Send all buffered samples in batches of TELEMETRY_BATCH_SIZE, after
+        the spooled ones. Batches which can't be sent are spooled.
+        """
+        with self._publish_lock:
+            online = self._broker.is_connected() and self._replay()
+            while True:
+                samples = self._take()
+                if not samples:
+                    break
+                payload = self._payload(samples)
+                if online and self._send(payload):
+                    self.counters['published'] += len(samples)
+                    self.counters['batches'] += 1
+                else:
+                    online = False
+                    self._spool(payload)
+            self._total_updates += 1
 
-            self.publish()
-            self._last_publish = curr_time
-        return self.qsize
+    def run(self, *args):
+        """
+        API function needed to use as a Donkey part. Accepts values,
+        pairs them with their inputs keys and buffers them for the
+        publisher thread, which is started on the first call.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.update, daemon=True)
+            self._thread.start()
+        return self.run_threaded(*args)
 
     def run_threaded(self, *args):
 
         assert len(self._step_inputs) == len(args)
 
-        # Add to queue
+        # Add to buffer
         record = dict(zip(self._step_inputs, args))
         self.report(record)
         return self.qsize
 
     def update(self):
-        logger.info(f"Telemetry MQTT server connected (publishing: { ', '.join(self._step_inputs) })")
+        logger.info(f"Telemetry MQTT publisher started (publishing: { ', '.join(self._step_inputs) })")
         while self._on:
-            self.publish()
             time.sleep(self.PUBLISH_PERIOD)
+            self.publish()
 
     def shutdown(self):
         # indicate that the thread should be stopped
         self._on = False
         logger.debug('Stopping MQTT Telemetry')
-        time.sleep(.2)
+        logger.removeHandler(self)
+        # keep what could not be sent for the next start
+        self.publish()
+        logger.info(f'MQTT Telemetry {self.counters}')
+        self._broker.close()
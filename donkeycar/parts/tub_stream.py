@@ -0,0 +1,327 @@
+"""
+tub_stream.py
+
+Live replication of a tub to a base station. TubWriter hands every written
+record to a TubStreamSender, which sends the catalog record together with
+the already encoded image files to a TubStreamReceiver, started on the
+base station with `donkey tub-receiver`. The receiver writes a regular
+tub_v2 directory, so training can start as soon as the car stops.
+
+Records are sent in batches over a zmq DEALER/ROUTER connection and the
+receiver acknowledges the last index it has written. The sender keeps the
+catalog records until they are acknowledged and reads the images from the
+car's tub when sending, so a long disconnect costs little memory. After a
+reconnect, the sender asks the receiver for its last index and resumes
+from there. Messages use the binary codec of
+donkeycar.utilities.serialization.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import zmq
+
+from donkeycar.parts.tub_v2 import Tub
+from donkeycar.utilities.serialization import get_codec
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TYPES = ('image_array', 'gray16_array')
+
+
+class TubStreamSender:
+    """
+    Streams the records of a tub to a TubStreamReceiver in a background
+    thread.
+    """
+    def __init__(self, tub: Tub, host: str, port: int = 5580,
+                 batch_size: int = 20, window: int = 4,
+                 ack_timeout: float = 2.0, max_pending: int = 100000):
+        """
+        :param tub:         tub which is written by the car
+        :param host:        host of the receiver
+        :param port:        port of the receiver
+        :param batch_size:  max records per message
+        :param window:      max unacknowledged batches
+        :param ack_timeout: seconds without ack after which the sender asks
+                            the receiver where to resume
+        :param max_pending: max unacknowledged records, streaming stops
+                            when exceeded, as the receiver's tub can't have
+                            gaps
+        """
+        self.tub = tub
+        self.address = f"tcp://{host}:{port}"
+        self.batch_size = batch_size
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.max_pending = max_pending
+        self.codec = get_codec()
+        self.image_keys = [k for k, t in zip(tub.inputs, tub.types)
+                           if t in IMAGE_TYPES]
+        self.lock = threading.Lock()
+        # (index, catalog record) not yet acknowledged
+        self.pending = deque()
+        self.deleted: List[int] = []
+        self.acked = -1
+        # records before this index were written before streaming started
+        self.start_index = tub.manifest.current_index
+        self.sent = 0
+        self.batches = 0
+        self.resumes = 0
+        self.failed = False
+        self.running = True
+        self.thread = threading.Thread(target=self._stream, daemon=True)
+        self.thread.start()
+        logger.info(f'Streaming tub {tub.base_path} to {self.address}')
+
+    def push(self, record: Dict[str, Any]) -> None:
+        """ Queue a record written to the tub, called by the vehicle loop """
+        with self.lock:
+            if self.failed:
+                return
+            if len(self.pending) >= self.max_pending:
+                logger.error(f'{len(self.pending)} records not acknowledged '
+                             f'by {self.address}, stopping the tub stream')
+                self.failed = True
+                self.pending.clear()
+                return
+            self.pending.append((record['_index'], record))
+
+    def set_deleted(self, indexes) -> None:
+        """ Deleted record indexes of the tub, sent with the next batch """
+        with self.lock:
+            self.deleted = sorted(indexes)
+
+    def _hello(self) -> Dict[str, Any]:
+        metadata = [f'{k}:{v}' for k, v in self.tub.manifest.metadata.items()]
+        return {'tub': os.path.basename(os.path.normpath(self.tub.base_path)),
+                'inputs': list(self.tub.inputs),
+                'types': list(self.tub.types),
+                'metadata': metadata}
+
+    def _batch(self, after: int) -> Optional[Dict[str, Any]]:
+        """ Next batch of records with index greater than after """
+        with self.lock:
+            records = [r for i, r in self.pending if i > after]
+            records = records[:self.batch_size]
+            deleted = self.deleted
+        if not records:
+            return None
+        images = {}
+        for record in records:
+            for key in self.image_keys:
+                name = record.get(key)
+                if name is None:
+                    continue
+                path = os.path.join(self.tub.images_base_path, name)
+                with open(path, 'rb') as f:
+                    images[name] = f.read()
+        return {'records': records, 'images': images, 'deleted': deleted}
+
+    def _acknowledge(self, index: int) -> None:
+        with self.lock:
+            self.acked = max(self.acked, index)
+            while self.pending and self.pending[0][0] <= self.acked:
+                self.pending.popleft()
+
+    def _stream(self):
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.address)
+        # highest index sent, None until the receiver told where to resume
+        sent_upto = None
+        in_flight = 0
+        last_ack = 0.0
+        hello_at = 0.0
+        try:
+            while self.running:
+                now = time.time()
+                if sent_upto is not None and in_flight \
+                        and now - last_ack > self.ack_timeout:
+                    # lost connection or messages, ask where to resume
+                    self.resumes += 1
+                    sent_upto = None
+                    in_flight = 0
+                    hello_at = 0.0
+                if sent_upto is None and now - hello_at > self.ack_timeout:
+                    socket.send_multipart(self.codec.encode('hello',
+                                                            self._hello()),
+                                          copy=False)
+                    hello_at = now
+                while sent_upto is not None and in_flight < self.window:
+                    batch = self._batch(sent_upto)
+                    if batch is None:
+                        break
+                    socket.send_multipart(self.codec.encode('batch', batch),
+                                          copy=False)
+                    if not in_flight:
+                        last_ack = time.time()
+                    sent_upto = batch['records'][-1]['_index']
+                    in_flight += 1
+                    self.batches += 1
+                if socket.poll(50):
+                    frames = socket.recv_multipart(copy=False)
+                    try:
+                        name, ack = self.codec.decode(
+                            [f.buffer for f in frames])
+                    except Exception as e:
+                        logger.error(f'Bad message from {self.address}: {e}')
+                        continue
+                    last_ack = time.time()
+                    if name == 'resume':
+                        if ack['index'] + 1 < self.start_index:
+                            logger.error(
+                                f'The receiver has the tub only up to index '
+                                f'{ack["index"]}, but streaming started at '
+                                f'{self.start_index}. Copy the tub instead.')
+                            with self.lock:
+                                self.failed = True
+                                self.pending.clear()
+                            break
+                        self._acknowledge(ack['index'])
+                        sent_upto = self.acked
+                        in_flight = 0
+                    elif 'error' in ack:
+                        # go back to what the receiver has written
+                        logger.error(f'Tub receiver error: {ack["error"]}')
+                        self._acknowledge(ack['index'])
+                        sent_upto = self.acked
+                        in_flight = 0
+                    elif name == 'ack':
+                        self.sent += max(0, ack['index'] - self.acked)
+                        self._acknowledge(ack['index'])
+                        in_flight = max(0, in_flight - 1)
+        finally:
+            socket.close()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """
+        Wait until all records are acknowledged
+
+        :return: True if all were acknowledged
+        """
+        end = time.time() + timeout
+        while time.time() < end:
+            with self.lock:
+                if not self.pending:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def shutdown(self, timeout: float = 5.0):
+        if not self.flush(timeout):
+            logger.warning(f'{len(self.pending)} records were not streamed '
+                           f'to {self.address}, copy the tub to complete it')
+        self.running = False
+        self.thread.join()
+        logger.info(f'Tub stream to {self.address}: {self.sent} records in '
+                    f'{self.batches} batches, {self.resumes} resumes')
+
+
+class TubStreamReceiver:
+    """
+    Writes the records of TubStreamSenders into tubs below a directory,
+    one tub per tub name of the car.
+    """
+    def __init__(self, path: str, port: int = 5580):
+        """
+        :param path:    directory of the tubs
+        :param port:    port to listen on
+        """
+        self.path = os.path.expanduser(path)
+        self.port = port
+        self.codec = get_codec()
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(f"tcp://*:{port}")
+        # tub path -> tub and sender identity -> tub path
+        self.tubs: Dict[str, Tub] = {}
+        self.senders: Dict[bytes, str] = {}
+        self.received = 0
+        self.running = True
+        logger.info(f'Receiving tubs into {self.path} on port {port}')
+
+    def _reply(self, identity: bytes, name: str, value: Dict[str, Any]):
+        self.socket.send_multipart([identity] + self.codec.encode(name, value),
+                                   copy=False)
+
+    def _open(self, identity: bytes, hello: Dict[str, Any]) -> Tub:
+        tub_path = os.path.join(self.path, os.path.basename(hello['tub']))
+        self.senders[identity] = tub_path
+        tub = self.tubs.get(tub_path)
+        if tub is None:
+            tub = Tub(tub_path, hello['inputs'], hello['types'],
+                      hello['metadata'])
+            self.tubs[tub_path] = tub
+        logger.info(f'Receiving into {tub_path} from index '
+                    f'{tub.manifest.current_index}')
+        return tub
+
+    def _write(self, tub: Tub, batch: Dict[str, Any]) -> None:
+        for name, data in batch['images'].items():
+            with open(os.path.join(tub.images_base_path,
+                                   os.path.basename(name)), 'wb') as f:
+                f.write(data)
+        for record in batch['records']:
+            index = record['_index']
+            if index < tub.manifest.current_index:
+                # resent after a lost ack
+                continue
+            if index > tub.manifest.current_index:
+                raise ValueError(f'Missing records {tub.manifest.current_index}'
+                                 f' to {index - 1}')
+            tub.manifest.write_record(record)
+            self.received += 1
+        deleted = set(batch['deleted'])
+        manifest = tub.manifest
+        if deleted != manifest.deleted_indexes:
+            manifest.restore_records(manifest.deleted_indexes - deleted)
+            manifest.delete_records(deleted - manifest.deleted_indexes)
+
+    def serve_once(self, timeout_ms: int = 100) -> None:
+        if not self.socket.poll(timeout_ms):
+            return
+        frames = self.socket.recv_multipart(copy=False)
+        identity = frames[0].bytes
+        try:
+            name, value = self.codec.decode([f.buffer for f in frames[1:]])
+        except Exception as e:
+            logger.error(f'Bad message: {e}')
+            return
+        if name == 'hello':
+            tub = self._open(identity, value)
+            self._reply(identity, 'resume',
+                        {'index': tub.manifest.current_index - 1})
+            return
+        tub = self.tubs.get(self.senders.get(identity))
+        if name != 'batch' or tub is None:
+            # e.g. a batch which was queued before a receiver restart
+            logger.warning(f'Ignoring {name} of an unknown sender')
+            return
+        response = {}
+        try:
+            self._write(tub, value)
+        except Exception as e:
+            logger.exception(f'Failed writing to {tub.base_path}')
+            response['error'] = str(e)
+        response['index'] = tub.manifest.current_index - 1
+        self._reply(identity, 'ack', response)
+
+    def serve(self) -> None:
+        """ Serve until shutdown() is called """
+        try:
+            while self.running:
+                self.serve_once()
+        finally:
+            for tub in self.tubs.values():
+                tub.close()
+            # zmq sockets must be closed by the thread using them
+            self.socket.close()
+
+    def shutdown(self) -> None:
+        self.running = False
@@ -5,10 +5,10 @@ from datetime import datetime
 import json
 
 import numpy as np
-from PIL import Image
 import logging
 
 from donkeycar.parts.datastore_v2 import Manifest, ManifestIterator
+from donkeycar.utilities import jpeg
 
 
 logger = logging.getLogger(__name__)
@@ -62,13 +62,14 @@ class Tub(object):
                     contents[key] = list(value)
                 elif input_type == 'image_array':
                     # Handle image array
-                    image = Image.fromarray(np.uint8(value))
                     name = Tub._image_file_name(self.manifest.current_index, key)
                     image_path = os.path.join(self.images_base_path, name)
-                    image.save(image_path)
+                    with open(image_path, 'wb') as f:
+                        f.write(jpeg.encode(np.uint8(value)))
                     contents[key] = name
                 elif input_type == 'gray16_array':
                     # save np.uint16 as a 16bit png
+                    from PIL import Image
                     image = Image.fromarray(np.uint16(value))
                     name = Tub._image_file_name(self.manifest.current_index, key, ext='.png')
                     image_path = os.path.join(self.images_base_path, name)
@@ -80,6 +81,7 @@ class Tub(object):
         contents['_index'] = self.manifest.current_index
         contents['_session_id'] = self.manifest.session_id[1]
         self.manifest.write_record(contents)
+        return contents
 
     def delete_records(self, record_indexes):
         self.manifest.delete_records(record_indexes)
@@ -121,20 +123,39 @@ class TubWriter(object):
     A Donkey part, which can write records to the datastore.
     """
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_catalog_len=1000):
+                 max_catalog_len=1000, stream_host=None, stream_port=5580):
+        """
+        :param stream_host: if given, the records are also streamed to a
+                            `donkey tub-receiver` on this host
+        :param stream_port: port of the tub receiver
+        """
         self.tub = Tub(base_path, inputs, types, metadata, max_catalog_len)
+        self.stream = None
+        self._num_deleted = 0
+        if stream_host:
+            from donkeycar.parts.tub_stream import TubStreamSender
+            self.stream = TubStreamSender(self.tub, stream_host, stream_port)
 
     def run(self, *args):
         assert len(self.tub.inputs) == len(args), \
             f'Expected {len(self.tub.inputs)} inputs but received {len(args)}'
         record = dict(zip(self.tub.inputs, args))
-        self.tub.write_record(record)
+        contents = self.tub.write_record(record)
+        if self.stream is not None:
+            self.stream.push(contents)
+            deleted = self.tub.manifest.deleted_indexes
+            if len(deleted) != self._num_deleted:
+                self._num_deleted = len(deleted)
+                self.stream.set_deleted(deleted)
         return self.tub.manifest.current_index
 
     def __iter__(self):
         return self.tub.__iter__()
 
     def close(self):
+        if self.stream is not None:
+            self.stream.shutdown()
+            self.stream = None
         self.tub.close()
 
     def shutdown(self):
@@ -0,0 +1,469 @@
+"""
+udp_control.py
+
+Drive commands over UDP. Unlike a TCP connection, a lost or late datagram
+never holds back the following ones, so on a lossy link the car always
+gets the newest command instead of a burst of stale ones.
+
+Each datagram is one fixed size command: sender id, sequence number, send
+time, steering, throttle and optional mode, recording and button changes.
+The UdpControlReceiver part on the car applies only commands newer than the
+last one it applied and falls back to zero throttle if no command arrived
+for stale_timeout seconds. The UdpControlSelector part hands control back
+to the web controller only when it sends new input after the commands
+stopped. The UdpControlSender part sends the output of a controller, e.g.
+a joystick attached to a laptop, to the car.
+
+Run this module to drive the receiver through a lossy, jittery loopback
+relay and print the statistics:
+    python -m donkeycar.parts.udp_control --loss 0.1 --jitter 0.02
+"""
+import logging
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DC'
+VERSION = 1
+# magic, version, flags, sender id, sequence number, send time, angle,
+# throttle, mode, buttons
+CONTROL_PACKET = struct.Struct('<2sBBIIdffBB')
+MODES = ('user', 'local_angle', 'local')
+NO_MODE = 0xff
+BUTTONS = ('w1', 'w2', 'w3', 'w4', 'w5')
+FLAG_RECORDING_SET = 0x01
+FLAG_RECORDING = 0x02
+
+ControlCommand = namedtuple('ControlCommand', [
+    'sender', 'seq', 'timestamp', 'angle', 'throttle', 'mode', 'recording',
+    'buttons'])
+
+
+def encode_control(sender: int, seq: int, angle: float, throttle: float,
+                   mode: Optional[str] = None,
+                   recording: Optional[bool] = None,
+                   buttons: Optional[Dict[str, bool]] = None,
+                   timestamp: Optional[float] = None) -> bytes:
+    """
+    :param sender:      random id of the sender, identifies its sequence
+    :param seq:         sequence number, incremented per command
+    :param angle:       steering in [-1, 1]
+    :param throttle:    throttle in [-1, 1]
+    :param mode:        drive mode to set or None
+    :param recording:   recording state to set or None
+    :param buttons:     pushed web buttons, w1 to w5
+    :param timestamp:   send time, defaults to now
+    :return:            datagram
+    """
+    flags = 0
+    if recording is not None:
+        flags |= FLAG_RECORDING_SET | (FLAG_RECORDING if recording else 0)
+    mode_code = NO_MODE if mode is None else MODES.index(mode)
+    button_bits = 0
+    for i, name in enumerate(BUTTONS):
+        if buttons and buttons.get(name):
+            button_bits |= 1 << i
+    return CONTROL_PACKET.pack(
+        MAGIC, VERSION, flags, sender, seq & 0xffffffff,
+        time.time() if timestamp is None else timestamp,
+        angle, throttle, mode_code, button_bits)
+
+
+def decode_control(data: bytes) -> ControlCommand:
+    """ Inverse of encode_control, raises ValueError for bad datagrams """
+    if len(data) != CONTROL_PACKET.size:
+        raise ValueError(f'Expected {CONTROL_PACKET.size} bytes, got '
+                         f'{len(data)}')
+    magic, version, flags, sender, seq, timestamp, angle, throttle, \
+        mode_code, button_bits = CONTROL_PACKET.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a control packet of this version')
+    if mode_code != NO_MODE and mode_code >= len(MODES):
+        raise ValueError(f'Unknown mode {mode_code}')
+    return ControlCommand(
+        sender, seq, timestamp, angle, throttle,
+        None if mode_code == NO_MODE else MODES[mode_code],
+        bool(flags & FLAG_RECORDING) if flags & FLAG_RECORDING_SET else None,
+        {name: True for i, name in enumerate(BUTTONS)
+         if button_bits & (1 << i)})
+
+
+def seq_newer(seq: int, last: int) -> bool:
+    """ True if seq is after last, allowing for the uint32 wrap around """
+    return 0 < ((seq - last) & 0xffffffff) < 0x80000000
+
+
+class ControlStats:
+    """
+    Statistics of the received commands. Jitter is the smoothed variation
+    of the transit time, as in RFC 3550, so it doesn't depend on the clocks
+    of sender and car being in sync.
+    """
+    def __init__(self):
+        self.received = 0
+        self.applied = 0
+        self.stale_rejected = 0
+        self.invalid = 0
+        self.lost = 0
+        self.timeouts = 0
+        self.jitter = 0.0
+        self._transit: Optional[float] = None
+
+    def arrival(self, sent: float, received: float) -> None:
+        transit = received - sent
+        if self._transit is not None:
+            self.jitter += (abs(transit - self._transit) - self.jitter) / 16.0
+        self._transit = transit
+
+    def reset_sender(self) -> None:
+        self._transit = None
+
+    def loss_rate(self) -> float:
+        expected = self.applied + self.lost
+        return self.lost / expected if expected else 0.0
+
+    def to_dict(self) -> Dict[str, Union[int, float]]:
+        return {'received': self.received,
+                'applied': self.applied,
+                'stale_rejected': self.stale_rejected,
+                'invalid': self.invalid,
+                'lost': self.lost,
+                'loss_rate': round(self.loss_rate(), 4),
+                'timeouts': self.timeouts,
+                'jitter_ms': round(self.jitter * 1000.0, 2)}
+
+
+class UdpControlReceiver:
+    """
+    Vehicle part which receives drive commands over UDP. Outputs angle,
+    throttle, mode, recording and buttons like the LocalWebController.
+    Mode and recording are passed through from the inputs unless a command
+    changes them.
+    """
+    def __init__(self, port: int = 5570, stale_timeout: float = 0.25,
+                 address: str = ''):
+        """
+        :param port:            udp port to listen on
+        :param stale_timeout:   seconds after the last command when the
+                                throttle falls back to zero
+        :param address:         address to bind to, all interfaces by
+                                default
+        """
+        self.stale_timeout = stale_timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.lock = threading.Lock()
+        self.stats = ControlStats()
+        self.sender: Optional[int] = None
+        self.last_seq: Optional[int] = None
+        self.last_received = 0.0
+        self.angle = 0.0
+        self.throttle = 0.0
+        self.mode: Optional[str] = None
+        self.recording: Optional[bool] = None
+        self.buttons: Dict[str, bool] = {}
+        self.timed_out = True
+        self.running = True
+        logger.info(f'Listening for drive commands on udp port {self.port}')
+
+    def receive(self, data: bytes, received: Optional[float] = None) -> bool:
+        """
+        Apply a datagram if it holds a newer command
+
+        :return: True if the command was applied
+        """
+        received = time.time() if received is None else received
+        with self.lock:
+            self.stats.received += 1
+            try:
+                cmd = decode_control(data)
+            except (ValueError, struct.error):
+                self.stats.invalid += 1
+                return False
+            if cmd.sender != self.sender:
+                # new or restarted sender, start a new sequence
+                if self.sender is not None:
+                    logger.info(f'New drive command sender {cmd.sender}')
+                self.sender = cmd.sender
+                self.last_seq = None
+                self.stats.reset_sender()
+            elif not seq_newer(cmd.seq, self.last_seq):
+                self.stats.stale_rejected += 1
+                return False
+            if self.last_seq is not None:
+                self.stats.lost += ((cmd.seq - self.last_seq) & 0xffffffff) - 1
+            self.last_seq = cmd.seq
+            self.stats.arrival(cmd.timestamp, received)
+            self.stats.applied += 1
+            self.last_received = received
+            self.angle = cmd.angle
+            self.throttle = cmd.throttle
+            if cmd.mode is not None:
+                self.mode = cmd.mode
+            if cmd.recording is not None:
+                self.recording = cmd.recording
+            for name in cmd.buttons:
+                self.buttons[name] = True
+            return True
+
+    def poll(self) -> None:
+        try:
+            data, _ = self.sock.recvfrom(CONTROL_PACKET.size + 1)
+        except socket.timeout:
+            return
+        except OSError:
+            # socket closed by shutdown
+            return
+        self.receive(data)
+
+    def update(self):
+        while self.running:
+            self.poll()
+
+    def active(self, now: Optional[float] = None) -> bool:
+        """ True if the last command arrived within stale_timeout """
+        now = time.time() if now is None else now
+        with self.lock:
+            return now - self.last_received <= self.stale_timeout
+
+    def run_threaded(self, mode=None, recording=None):
+        """
+        :param mode:        current user/mode, returned if no command set it
+        :param recording:   current recording state
+        :return:            angle, throttle, mode, recording, buttons
+        """
+        with self.lock:
+            now = time.time()
+            throttle = self.throttle
+            if now - self.last_received > self.stale_timeout:
+                if not self.timed_out:
+                    self.stats.timeouts += 1
+                    logger.warning(f'No drive command for '
+                                   f'{self.stale_timeout}s, stopping')
+                    self.timed_out = True
+                throttle = 0.0
+            else:
+                self.timed_out = False
+            if self.mode is not None:
+                mode = self.mode
+                self.mode = None
+            if self.recording is not None:
+                recording = self.recording
+                self.recording = None
+            buttons, self.buttons = self.buttons, {}
+        return self.angle, throttle, mode, recording, buttons
+
+    def run(self, mode=None, recording=None):
+        # non threaded use: take everything that arrived since the last call
+        self.sock.setblocking(False)
+        try:
+            while True:
+                data, _ = self.sock.recvfrom(CONTROL_PACKET.size + 1)
+                self.receive(data)
+        except (BlockingIOError, socket.timeout):
+            pass
+        finally:
+            self.sock.settimeout(0.1)
+        return self.run_threaded(mode, recording)
+
+    def shutdown(self):
+        self.running = False
+        logger.info(f'Udp control stats: {self.stats.to_dict()}')
+        self.sock.close()
+
+
+class UdpControlSelector:
+    """
+    Vehicle part which lets the udp drive commands take over from the web
+    controller. Steering and throttle of the web controller are passed
+    through until the first command arrives, so the car can be driven from
+    the web page when no udp sender is running. Once the commands stop, the
+    receiver's zero throttle is kept until the web controller sends new
+    input, because the web controller still holds its last throttle. Mode
+    and recording come from the receiver, which passes the web controller's
+    values through unless a command changed them.
+    """
+    def __init__(self, receiver: UdpControlReceiver):
+        """
+        :param receiver:    receiver of the udp commands
+        """
+        self.receiver = receiver
+        self.udp_control = False
+        # web steering and throttle while the udp commands were fresh
+        self.web_input: Optional[Tuple[float, float]] = None
+
+    def run(self, angle, throttle, udp_angle, udp_throttle, udp_mode,
+            udp_recording):
+        """
+        :return: angle, throttle, mode, recording
+        """
+        web_input = (angle, throttle)
+        if self.receiver.active():
+            self.udp_control = True
+            self.web_input = web_input
+        elif self.udp_control and web_input != self.web_input:
+            logger.info('Web controller input after the udp commands '
+                        'stopped, handing back control')
+            self.udp_control = False
+        if self.udp_control:
+            angle, throttle = udp_angle, udp_throttle
+        return angle, throttle, udp_mode, udp_recording
+
+
+class UdpControlSender:
+    """
+    Vehicle part which sends drive commands to a UdpControlReceiver. Mode
+    and recording are only sent when they change, but repeated in the
+    next few commands in case a datagram is lost.
+    """
+    def __init__(self, host: str, port: int = 5570, repeat: int = 5):
+        """
+        :param host:    address of the car
+        :param port:    udp port of the receiver
+        :param repeat:  number of commands which repeat a mode or recording
+                        change
+        """
+        self.address = (host, port)
+        self.repeat = repeat
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender = struct.unpack('<I', os.urandom(4))[0]
+        self.seq = 0
+        self.mode: Optional[str] = None
+        self.recording: Optional[bool] = None
+        self._mode_left = 0
+        self._recording_left = 0
+
+    def run(self, angle, throttle, mode=None, recording=None, buttons=None):
+        if mode is not None and mode != self.mode:
+            self.mode = mode
+            self._mode_left = self.repeat
+        if recording is not None and recording != self.recording:
+            self.recording = recording
+            self._recording_left = self.repeat
+        self.seq = (self.seq + 1) & 0xffffffff
+        data = encode_control(
+            self.sender, self.seq, angle or 0.0, throttle or 0.0,
+            self.mode if self._mode_left > 0 else None,
+            self.recording if self._recording_left > 0 else None,
+            buttons)
+        self._mode_left = max(0, self._mode_left - 1)
+        self._recording_left = max(0, self._recording_left - 1)
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError as e:
+            logger.warning(f'Could not send drive command to '
+                           f'{self.address}: {e}')
+
+    def shutdown(self):
+        self.sock.close()
+
+
+class LossyUdpRelay:
+    """
+    Test harness which forwards datagrams from its own port to a target on
+    the local host, dropping, delaying and reordering them like a bad
+    wireless link.
+    """
+    def __init__(self, target_port: int, loss: float = 0.0,
+                 delay: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        """
+        :param target_port: port to forward to
+        :param loss:        probability of dropping a datagram
+        :param delay:       base delay in seconds
+        :param jitter:      max additional random delay in seconds, which
+                            reorders datagrams sent closer than this
+        :param seed:        random seed
+        """
+        self.target = ('127.0.0.1', target_port)
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.05)
+        self.port = self.sock.getsockname()[1]
+        self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.forwarded = 0
+        self.dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._relay, daemon=True)
+        self.thread.start()
+
+    def _relay(self):
+        while self.running:
+            try:
+                data, _ = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if self.random.random() < self.loss:
+                self.dropped += 1
+                continue
+            delay = self.delay + self.random.uniform(0.0, self.jitter)
+            timer = threading.Timer(delay, self._forward, args=(data,))
+            timer.daemon = True
+            timer.start()
+
+    def _forward(self, data):
+        if self.running:
+            self.out.sendto(data, self.target)
+            self.forwarded += 1
+
+    def shutdown(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+        self.out.close()
+
+
+def loopback_test(commands: int = 500, rate: float = 50.0, loss: float = 0.0,
+                  delay: float = 0.0, jitter: float = 0.0,
+                  stale_timeout: float = 0.25) -> Dict[str, float]:
+    """
+    Send commands through a LossyUdpRelay to a receiver on the local host.
+
+    :return: receiver statistics plus the fraction of sent commands which
+             were applied
+    """
+    receiver = UdpControlReceiver(0, stale_timeout, address='127.0.0.1')
+    thread = threading.Thread(target=receiver.update, daemon=True)
+    thread.start()
+    relay = LossyUdpRelay(receiver.port, loss, delay, jitter)
+    sender = UdpControlSender('127.0.0.1', relay.port)
+    try:
+        for i in range(commands):
+            sender.run(i / commands, 0.5, 'user', False)
+            time.sleep(1.0 / rate)
+        time.sleep(delay + jitter + 0.1)
+    finally:
+        sender.shutdown()
+        relay.shutdown()
+        receiver.shutdown()
+        thread.join()
+    stats = receiver.stats.to_dict()
+    stats['applied_fraction'] = receiver.stats.applied / commands
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='udp control loopback test')
+    parser.add_argument('--commands', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=50.0)
+    parser.add_argument('--loss', type=float, default=0.05)
+    parser.add_argument('--delay', type=float, default=0.01)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    args = parser.parse_args()
+    print(loopback_test(args.commands, args.rate, args.loss, args.delay,
+                        args.jitter))
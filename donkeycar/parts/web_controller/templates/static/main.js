@@ -77,6 +77,72 @@ var driveHandler = new function() {
       }
     };
 
+    //
+    // Rolling line plot of the numeric telemetry channels
+    // which the server sends with its state updates.
+    //
+    var telemetryPlot = new function() {
+        const maxPoints = 300;
+        const colors = ['#668AED', '#ED6668', '#5CB85C', '#F0AD4E', '#9B59B6', '#333333'];
+        var series = {};
+
+        this.add = function(channels) {
+            Object.keys(channels).forEach(name => {
+                if(!series.hasOwnProperty(name)) {
+                    series[name] = [];
+                }
+                const values = series[name];
+                values.push(...channels[name]);
+                if(values.length > maxPoints) {
+                    values.splice(0, values.length - maxPoints);
+                }
+            });
+            draw();
+        };
+
+        var draw = function() {
+            const canvas = document.getElementById('telemetry-plot');
+            if(!canvas) {
+                return;
+            }
+            $('#telemetry').show();
+            const ctx = canvas.getContext('2d');
+            const names = Object.keys(series);
+            let min = -1, max = 1;
+            names.forEach(name => series[name].forEach(v => {
+                min = Math.min(min, v);
+                max = Math.max(max, v);
+            }));
+            const y = v => canvas.height * (max - v) / (max - min);
+            ctx.clearRect(0, 0, canvas.width, canvas.height);
+            ctx.strokeStyle = '#DDDDDD';
+            ctx.beginPath();
+            ctx.moveTo(0, y(0));
+            ctx.lineTo(canvas.width, y(0));
+            ctx.stroke();
+            let legend = '';
+            names.forEach((name, i) => {
+                const values = series[name];
+                const color = colors[i % colors.length];
+                const dx = canvas.width / (maxPoints - 1);
+                const x0 = canvas.width - (values.length - 1) * dx;
+                ctx.strokeStyle = color;
+                ctx.beginPath();
+                values.forEach((v, j) => {
+                    if(j === 0) {
+                        ctx.moveTo(x0, y(v));
+                    } else {
+                        ctx.lineTo(x0 + j * dx, y(v));
+                    }
+                });
+                ctx.stroke();
+                const last = values.length ? values[values.length - 1].toFixed(2) : '';
+                legend += '<span style="color:' + color + '; margin-right:1em">' + name + ' ' + last + '</span>';
+            });
+            $('#telemetry-legend').html(legend);
+        };
+    };
+
     //
     // Update a state object with the given data.
     // This will only update existing fields in 
@@ -114,8 +180,11 @@ var driveHandler = new function() {
       // if there were any changes then redraw the UI.
       //
       socket.onmessage = function (event) {
-        console.log(event.data);
         const data = JSON.parse(event.data);
+        if(data.channels) {
+            telemetryPlot.add(data.channels);
+            delete data.channels;
+        }
         if(updateState(state, data)) {
             updateUI();
         }
@@ -11,19 +11,31 @@ The client and web server needed to control a car remotely.
 import os
 import json
 import logging
+import struct
+import threading
 import time
 import asyncio
+import numbers
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
 
 import requests
-from tornado.ioloop import IOLoop
+import requests.adapters
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application, RedirectHandler, StaticFileHandler, \
     RequestHandler
 from tornado.httpserver import HTTPServer
 import tornado.gen
+import tornado.iostream
+import tornado.locks
 import tornado.websocket
 from socket import gethostname
 
 from ... import utils
+from ...utilities import jpeg
 
 logger = logging.getLogger(__name__)
 
@@ -32,79 +44,232 @@ class RemoteWebServer():
     '''
     A controller that repeatedly polls a remote webserver and expects
     the response to be angle, throttle and drive mode.
-    '''
 
-    def __init__(self, remote_url, connection_timeout=.25):
+    Polling runs in a background thread over one keep-alive connection.
+    Each poll posts the latest telemetry inputs and stores the returned
+    command, the vehicle loop only reads the latest command and never waits
+    for the network. If no command arrived for stale_timeout seconds the
+    throttle falls back to zero.
+    '''
 
+    def __init__(self, remote_url, connection_timeout=.25, poll_period=0.02,
+                 stale_timeout=1.0, telemetry_keys=None):
+        """
+        :param remote_url:          url of the control server
+        :param connection_timeout:  connect and read timeout of a request
+        :param poll_period:         min seconds between two requests
+        :param stale_timeout:       seconds after the last command when the
+                                    throttle falls back to zero
+        :param telemetry_keys:      names of the inputs of run_threaded,
+                                    which are posted to the server
+        """
         self.control_url = remote_url
+        self.connection_timeout = connection_timeout
+        self.poll_period = poll_period
+        self.stale_timeout = stale_timeout
+        self.telemetry_keys = list(telemetry_keys or [])
         self.time = 0.
         self.angle = 0.
         self.throttle = 0.
         self.mode = 'user'
         self.mode_latch = None
         self.recording = False
-        # use one session for all requests
+        self.telemetry = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.running = True
+        self.thread = None
+        # use one pooled keep-alive connection for all requests
         self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=1,
+                                                max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def poll(self):
+        """
+        Post the latest telemetry and store the returned command.
+
+        :return: True if a command was received
+        """
+        with self.lock:
+            data = dict(self.telemetry)
+        self.requests += 1
+        try:
+            response = self.session.post(self.control_url,
+                                         files={'json': json.dumps(data)},
+                                         timeout=self.connection_timeout)
+            response.raise_for_status()
+            command = json.loads(response.text)
+            angle = float(command['angle'])
+            throttle = float(command['throttle'])
+            drive_mode = str(command['drive_mode'])
+            recording = bool(command['recording'])
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.failures += 1
+            logger.debug(f'Polling {self.control_url} failed: {e}')
+            return False
+        with self.lock:
+            self.angle, self.throttle = angle, throttle
+            self.mode, self.recording = drive_mode, recording
+            self.time = time.time()
+        return True
 
     def update(self):
         '''
         Loop to run in separate thread the updates angle, throttle and
         drive mode.
         '''
-
-        while True:
-            # get latest value from server
-            self.angle, self.throttle, self.mode, self.recording = self.run()
-
-    def run_threaded(self):
+        backoff = 0.0
+        while self.running:
+            start = time.time()
+            if self.poll():
+                if backoff > 0.0:
+                    logger.info(f'Connected to {self.control_url}')
+                backoff = 0.0
+            else:
+                # retry quickly first, then every 3 seconds at most
+                if backoff == 0.0:
+                    logger.warning(f'Vehicle could not reach the server '
+                                   f'{self.control_url}. Make sure you\'ve '
+                                   f'started your server and you\'re '
+                                   f'referencing the right port.')
+                backoff = min(3.0, max(0.1, backoff * 2))
+            time.sleep(max(backoff, self.poll_period - (time.time() - start)))
+
+    def run_threaded(self, *telemetry):
         '''
         Return the last state given from the remote server.
+
+        :param telemetry: values of telemetry_keys, posted with the next
+                          request
         '''
-        return self.angle, self.throttle, self.mode, self.recording
+        with self.lock:
+            if telemetry:
+                self.telemetry = dict(zip(self.telemetry_keys, telemetry))
+            throttle = self.throttle
+            if time.time() - self.time > self.stale_timeout:
+                # Lower throttle to prevent runaways.
+                throttle = 0.0
+            return self.angle, throttle, self.mode, self.recording
 
-    def run(self):
+    def run(self, *telemetry):
         '''
-        Posts current car sensor data to webserver and returns
-        angle and throttle recommendations.
+        Non threaded use, polls in a thread which is started on the first
+        call.
         '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.update, daemon=True)
+            self.thread.start()
+        return self.run_threaded(*telemetry)
 
-        data = {}
-        response = None
-        while response is None:
-            try:
-                response = self.session.post(self.control_url,
-                                             files={'json': json.dumps(data)},
-                                             timeout=0.25)
-
-            except requests.exceptions.ReadTimeout as err:
-                print("\n Request took too long. Retrying")
-                # Lower throttle to prevent runaways.
-                return self.angle, self.throttle * .8, None
+    def shutdown(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.session.close()
+        logger.info(f'Remote web server: {self.requests} requests, '
+                    f'{self.failures} failed')
 
-            except requests.ConnectionError as err:
-                # try to reconnect every 3 seconds
-                print("\n Vehicle could not connect to server. Make sure you've " +
-                    "started your server and you're referencing the right port.")
-                time.sleep(3)
 
-        data = json.loads(response.text)
-        angle = float(data['angle'])
-        throttle = float(data['throttle'])
-        drive_mode = str(data['drive_mode'])
-        recording = bool(data['recording'])
+class StatePublisher:
+    """
+    Telemetry channel of the web controller. The vehicle thread merges state
+    changes and samples of numeric channels into a pending update. At a
+    fixed rate the IO loop takes the update, serializes it once and writes
+    it to all drive clients. State keys which changed several times since
+    the last tick are sent with their latest value only, numeric channels
+    keep all samples of the tick for plotting. A message looks like
+    {"driveMode": "user", "channels": {"pilot/angle": [0.1, 0.12]}, "t": 1.5}
+    """
+    def __init__(self, publish_hz: float = 10.0, max_samples: int = 100):
+        """
+        :param publish_hz:  updates per second sent to the clients
+        :param max_samples: max samples per channel and tick, further
+                            samples are counted as dropped
+        """
+        self.interval_ms = 1000.0 / publish_hz
+        self.max_samples = max_samples
+        self.clients: List[tornado.websocket.WebSocketHandler] = []
+        self.lock = threading.Lock()
+        self.pending: Dict[str, object] = {}
+        self.samples: Dict[str, List[float]] = {}
+        self.callback: Optional[PeriodicCallback] = None
+        self.published = 0
+        self.dropped = 0
+
+    def update(self, changes: Dict[str, object]) -> None:
+        """ Merge state changes into the pending update, thread safe """
+        with self.lock:
+            self.pending.update(changes)
+
+    def record(self, channel: str, value) -> None:
+        """ Add a sample of a numeric channel, other values are ignored """
+        if not isinstance(value, numbers.Real) or isinstance(value, bool):
+            return
+        with self.lock:
+            samples = self.samples.setdefault(channel, [])
+            if len(samples) < self.max_samples:
+                samples.append(float(value))
+            else:
+                self.dropped += 1
+
+    def start(self) -> None:
+        """ Start publishing, must be called on the IO loop """
+        self.callback = PeriodicCallback(self.publish, self.interval_ms)
+        self.callback.start()
+
+    def stop(self) -> None:
+        if self.callback is not None:
+            self.callback.stop()
+
+    def message(self) -> Optional[str]:
+        """ Take the pending update and serialize it, None if empty """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            samples, self.samples = self.samples, {}
+        if not pending and not samples:
+            return None
+        if samples:
+            pending['channels'] = samples
+        pending['t'] = round(time.time(), 3)
+        return json.dumps(pending)
+
+    def publish(self) -> None:
+        message = self.message()
+        if message is None:
+            return
+        for client in list(self.clients):
+            try:
+                client.write_message(message)
+            except tornado.websocket.WebSocketClosedError:
+                logger.debug("Dropping closed web client")
+                self.remove(client)
+        self.published += 1
 
-        return angle, throttle, drive_mode, recording
+    def add(self, client: tornado.websocket.WebSocketHandler) -> None:
+        self.clients.append(client)
 
-    def shutdown(self):
-        pass
+    def remove(self, client: tornado.websocket.WebSocketHandler) -> None:
+        if client in self.clients:
+            self.clients.remove(client)
 
 
 class LocalWebController(tornado.web.Application):
 
-    def __init__(self, port=8887, mode='user'):
+    def __init__(self, port=8887, mode='user', video_latency_target=0.15,
+                 video_max_fps=20, telemetry_hz=10, channels=None):
         """
         Create and publish variables needed on many of
         the web handlers.
+
+        :param telemetry_hz:    rate of the state updates sent to the
+                                drive clients
+        :param channels:        names of additional numeric inputs of
+                                run_threaded, like 'pilot/angle', which are
+                                sent to the drive clients for live plots
         """
         logger.info('Starting Donkey Server...')
 
@@ -117,13 +282,20 @@ class LocalWebController(tornado.web.Application):
         self.recording = False
         self.recording_latch = None
         self.buttons = {}  # latched button values for processing
+        # drive messages received since the last vehicle loop
+        self.input_lock = threading.Lock()
+        self.pending_input = {}
 
         self.port = port
 
         self.num_records = 0
-        self.wsclients = []
+        self.channels = list(channels or [])
+        self.telemetry = StatePublisher(telemetry_hz)
+        self.wsclients = self.telemetry.clients
         self.loop = None
-
+        self.video = FrameBroadcaster(
+            os.path.join(self.static_file_path, "img_placeholder.jpg"),
+            video_latency_target, video_max_fps)
 
         handlers = [
             (r"/", RedirectHandler, dict(url="/drive")),
@@ -132,6 +304,8 @@ class LocalWebController(tornado.web.Application):
             (r"/wsCalibrate", WebSocketCalibrateAPI),
             (r"/calibrate", CalibrateHandler),
             (r"/video", VideoAPI),
+            (r"/videoStats", VideoStatsAPI),
+            (r"/wsVideo", WebSocketVideoAPI),
             (r"/wsTest", WsTest),
 
             (r"/static/(.*)", StaticFileHandler,
@@ -143,33 +317,60 @@ class LocalWebController(tornado.web.Application):
         logger.info(f"You can now go to {gethostname()}.local:{port} to "
                     f"drive your car.")
 
+    @property
+    def viewers(self) -> int:
+        """ Number of clients receiving the video """
+        return self.video.subscribers
+
     def update(self):
         """ Start the tornado webserver. """
         asyncio.set_event_loop(asyncio.new_event_loop())
         self.listen(self.port)
         self.loop = IOLoop.instance()
+        self.telemetry.start()
         self.loop.start()
 
-    def update_wsclients(self, data):
-        if data:
-            for wsclient in self.wsclients:
-                try:
-                    data_str = json.dumps(data)
-                    logger.debug(f"Updating web client: {data_str}")
-                    wsclient.write_message(data_str)
-                except Exception as e:
-                    logger.warning("Error writing websocket message",
-                                   exc_info=e)
-                    pass
-
-    def run_threaded(self, img_arr=None, num_records=0, mode=None, recording=None):
+    def queue_input(self, data):
+        """
+        Merge a drive message of a web client into the input of the next
+        vehicle loop. Only the latest angle, throttle, mode and recording
+        values are kept, button pushes are latched.
+        """
+        with self.input_lock:
+            for key in ('angle', 'throttle', 'drive_mode', 'recording'):
+                if data.get(key) is not None:
+                    self.pending_input[key] = data[key]
+            if data.get('buttons') is not None:
+                latch_buttons(self.buttons, data['buttons'])
+
+    def apply_input(self):
+        """ Apply the drive messages received since the last call """
+        with self.input_lock:
+            data, self.pending_input = self.pending_input, {}
+        self.angle = data.get('angle', self.angle)
+        self.throttle = data.get('throttle', self.throttle)
+        if 'drive_mode' in data:
+            self.mode = data['drive_mode']
+            self.mode_latch = self.mode
+        if 'recording' in data:
+            self.recording = data['recording']
+            self.recording_latch = self.recording
+
+    def run_threaded(self, img_arr=None, num_records=0, mode=None,
+                     recording=None, frame_seq=None, *channel_values):
         """
         :param img_arr: current camera image or None
         :param num_records: current number of data records
         :param mode: default user/mode
         :param recording: default recording mode
+        :param frame_seq: sequence number of the camera frame or None, see
+                          FrameBroadcaster.publish
+        :param channel_values: values of the numeric channels given in the
+                               constructor
         """
+        self.apply_input()
         self.img_arr = img_arr
+        self.video.publish(img_arr, frame_seq)
         self.num_records = num_records
 
         #
@@ -200,24 +401,32 @@ class LocalWebController(tornado.web.Application):
         # get latched button presses then clear button presses
         # Next iteration will clear press in memory
         #
-        buttons = self.buttons
-        self.buttons = {}
-        for button, pressed in buttons.items():
-            if pressed:
-                self.buttons[button] = False
-
-        # if there were changes, then send to web client
-        if changes and self.loop is not None:
+        with self.input_lock:
+            buttons = self.buttons
+            self.buttons = {}
+            for button, pressed in buttons.items():
+                if pressed:
+                    self.buttons[button] = False
+
+        # the telemetry channel sends the changes with its next tick
+        if changes:
             logger.debug(str(changes))
-            self.loop.add_callback(lambda: self.update_wsclients(changes))
+            self.telemetry.update(changes)
+        for channel, value in zip(self.channels, channel_values):
+            self.telemetry.record(channel, value)
 
         return self.angle, self.throttle, self.mode, self.recording, buttons
 
-    def run(self, img_arr=None, num_records=0, mode=None, recording=None):
-        return self.run_threaded(img_arr, num_records, mode, recording)
+    def run(self, img_arr=None, num_records=0, mode=None, recording=None,
+            frame_seq=None, *channel_values):
+        return self.run_threaded(img_arr, num_records, mode, recording,
+                                 frame_seq,
+                                 *channel_values)
 
     def shutdown(self):
-        pass
+        if self.loop is not None:
+            self.loop.add_callback(self.telemetry.stop)
+        self.video.shutdown()
 
 
 class DriveAPI(RequestHandler):
@@ -281,24 +490,20 @@ class WebSocketDriveAPI(tornado.websocket.WebSocketHandler):
 
     def open(self):
         logger.info("New client connected")
-        self.application.wsclients.append(self)
+        self.application.telemetry.add(self)
 
     def on_message(self, message):
-        data = json.loads(message)
-        self.application.angle = data.get('angle', self.application.angle)
-        self.application.throttle = data.get('throttle', self.application.throttle)
-        if data.get('drive_mode') is not None:
-            self.application.mode = data['drive_mode']
-            self.application.mode_latch = self.application.mode
-        if data.get('recording') is not None:
-            self.application.recording = data['recording']
-            self.application.recording_latch = self.application.recording
-        if data.get('buttons') is not None:
-            latch_buttons(self.application.buttons, data['buttons'])
+        try:
+            data = json.loads(message)
+        except ValueError:
+            logger.warning(f"Ignoring malformed drive message {message!r}")
+            return
+        if isinstance(data, dict):
+            self.application.queue_input(data)
 
     def on_close(self):
         logger.info("Client disconnected")
-        self.application.wsclients.remove(self)
+        self.application.telemetry.remove(self)
 
 
 class WebSocketCalibrateAPI(tornado.websocket.WebSocketHandler):
@@ -350,45 +555,390 @@ class WebSocketCalibrateAPI(tornado.websocket.WebSocketHandler):
         logger.info("Client disconnected")
 
 
+# (quality, downscale factor) levels of the video stream, best first
+VIDEO_LEVELS = ((90, 1.0), (75, 1.0), (60, 1.0), (50, 0.75), (40, 0.5),
+                (30, 0.5))
+# same jpeg quality as utils.arr_to_binary
+DEFAULT_VIDEO_LEVEL = 1
+
+
+def encode_jpeg(img_arr, quality: int = 75, scale: float = 1.0) -> bytes:
+    """
+    :param img_arr:     image array
+    :param quality:     jpeg quality
+    :param scale:       downscale factor
+    :return:            jpeg bytes
+    """
+    if scale != 1.0:
+        img = utils.arr_to_img(img_arr)
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img_arr = np.asarray(img.resize(size, Image.BILINEAR))
+    return jpeg.encode(np.uint8(img_arr), quality)
+
+
+class AdaptiveStream:
+    """
+    Per client rate and quality control of the video stream. Measured send
+    latencies drive jpeg quality, downscale factor and frame rate towards
+    the latency target: if the client falls behind, quality drops first,
+    then the frame rate. If the latency stays well below the target, frame
+    rate is restored first and then quality.
+    """
+    def __init__(self, client_id: Optional[str] = None,
+                 latency_target: float = 0.15, max_fps: float = 20.0,
+                 min_fps: float = 2.0, smoothing: float = 0.3):
+        """
+        :param client_id:       id which the page uses to query its settings
+        :param latency_target:  target for the send latency in seconds
+        :param max_fps:         max frame rate sent to the client
+        :param min_fps:         min frame rate sent to the client
+        :param smoothing:       weight of a new sample in the moving average
+        """
+        self.client_id = client_id
+        self.latency_target = latency_target
+        self.max_fps = max_fps
+        self.min_fps = min_fps
+        self.smoothing = smoothing
+        self.level = DEFAULT_VIDEO_LEVEL
+        self.fps = max_fps
+        self.latency: Optional[float] = None
+        self.frames = 0
+        self.sent_at: Dict[int, float] = {}
+        self._good = 0
+        self._cooldown = 0
+
+    def interval(self) -> float:
+        return 1.0 / self.fps
+
+    def frame_sent(self, seq: int, seconds: float) -> None:
+        """
+        :param seq:     sequence number of the frame
+        :param seconds: time it took to hand the frame to the socket, this
+                        grows with the send queue of the connection
+        """
+        self.frames += 1
+        self.sent_at[seq] = time.time()
+        # forget frames the client doesn't acknowledge
+        while len(self.sent_at) > 10:
+            self.sent_at.pop(next(iter(self.sent_at)))
+        self.update(seconds)
+
+    def ack(self, seq: int) -> None:
+        """ Round trip measured by a client acknowledging a frame """
+        sent = self.sent_at.pop(seq, None)
+        if sent is not None:
+            self.update(time.time() - sent)
+
+    def update(self, latency: float) -> None:
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        # give a change some frames to show its effect
+        if self._cooldown > 0:
+            self._cooldown -= 1
+            return
+        if self.latency > self.latency_target:
+            self._good = 0
+            if self.level < len(VIDEO_LEVELS) - 1:
+                self.level += 1
+            elif self.fps > self.min_fps:
+                self.fps = max(self.min_fps, self.fps * 0.75)
+            else:
+                return
+            self._cooldown = 3
+        elif self.latency < self.latency_target / 2:
+            self._good += 1
+            if self._good < 10:
+                return
+            self._good = 0
+            if self.fps < self.max_fps:
+                self.fps = min(self.max_fps, self.fps * 1.25)
+            elif self.level > 0:
+                self.level -= 1
+            self._cooldown = 3
+
+    def settings(self) -> Dict[str, Union[str, int, float, None]]:
+        quality, scale = VIDEO_LEVELS[self.level]
+        return {'client': self.client_id,
+                'quality': quality,
+                'scale': scale,
+                'fps': round(self.fps, 1),
+                'latency_ms': None if self.latency is None
+                else round(self.latency * 1000, 1),
+                'frames': self.frames}
+
+
+class FrameBroadcaster:
+    """
+    Encodes each new camera frame once per quality level in use and hands
+    the shared jpeg bytes to all connected video clients. Encoding runs in
+    a worker thread, off the tornado IO loop. If frames arrive faster than
+    they can be encoded, or a client is slower than the camera, intermediate
+    frames are dropped and only the latest frame is delivered.
+    """
+    def __init__(self, placeholder_path: str, latency_target: float = 0.15,
+                 max_fps: float = 20.0):
+        """
+        :param placeholder_path:    image which is served until the first
+                                    camera frame arrives
+        :param latency_target:      per client send latency target in
+                                    seconds, see AdaptiveStream
+        :param max_fps:             max frame rate per client
+        """
+        self.placeholder_path = placeholder_path
+        self.latency_target = latency_target
+        self.max_fps = max_fps
+        self.placeholder = None
+        self.seq = 0
+        self.img_arr = None
+        self.frames: Dict[int, bytes] = {}
+        # (seq, level) -> future of an encoding requested by a client
+        self.encoding: Dict[Tuple[int, int], asyncio.Future] = {}
+        self.encoded_frames = 0
+        self.streams: List[AdaptiveStream] = []
+        self.loop: Optional[IOLoop] = None
+        self.condition = tornado.locks.Condition()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._last_arr = None
+        self._last_seq = None
+        self._pending_arr = None
+        self._encoding = False
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.streams)
+
+    def publish(self, img_arr, frame_seq: Optional[int] = None) -> None:
+        """
+        Called from the vehicle loop with the current camera image. Only new
+        images are encoded, and only if somebody is watching. Cameras and
+        image parts reuse their buffers, so a new image can't be told by
+        identity and is copied before it is kept past this call.
+
+        :param img_arr:     camera image or None
+        :param frame_seq:   sequence number of the camera frame, see
+                            BaseCamera.frame_metadata. Without it, an image
+                            equal to the last one is taken as a repeat.
+        """
+        if img_arr is None or self.subscribers == 0:
+            return
+        if frame_seq is not None:
+            if frame_seq == self._last_seq:
+                return
+        elif self._last_arr is not None \
+                and np.array_equal(img_arr, self._last_arr):
+            return
+        self._last_seq = frame_seq
+        img_arr = np.array(img_arr)
+        self._last_arr = img_arr
+        with self.lock:
+            self._pending_arr = img_arr
+            if self._encoding:
+                return
+            self._encoding = True
+        self.executor.submit(self._encode_pending)
+
+    def _encode_pending(self) -> None:
+        while True:
+            with self.lock:
+                img_arr = self._pending_arr
+                self._pending_arr = None
+                if img_arr is None:
+                    self._encoding = False
+                    return
+            # only the levels the clients currently use
+            levels = {s.level for s in list(self.streams)} \
+                or {DEFAULT_VIDEO_LEVEL}
+            try:
+                frames = {level: encode_jpeg(img_arr, *VIDEO_LEVELS[level])
+                          for level in sorted(levels)}
+            except Exception as e:
+                logger.error(f"Failed to encode video frame: {e}")
+                continue
+            with self.lock:
+                self.seq += 1
+                self.img_arr = img_arr
+                self.frames = frames
+                self.encoded_frames += len(frames)
+            if self.loop is not None:
+                self.loop.add_callback(self.condition.notify_all)
+
+    def _encode_level(self, seq: int, img_arr, level: int) -> bytes:
+        with self.lock:
+            jpg = self.frames.get(level) if self.seq == seq else None
+        if jpg is not None:
+            return jpg
+        jpg = encode_jpeg(img_arr, *VIDEO_LEVELS[level])
+        with self.lock:
+            self.encoded_frames += 1
+            if self.seq == seq:
+                self.frames[level] = jpg
+        return jpg
+
+    def get_placeholder(self) -> bytes:
+        if self.placeholder is None:
+            img = utils.load_image_sized(self.placeholder_path, 160, 120, 3)
+            self.placeholder = utils.arr_to_binary(img)
+        return self.placeholder
+
+    def subscribe(self, client_id: Optional[str] = None) -> AdaptiveStream:
+        """ Register a client, must be called from the IO loop """
+        self.loop = IOLoop.current()
+        stream = AdaptiveStream(client_id, self.latency_target, self.max_fps)
+        self.streams.append(stream)
+        return stream
+
+    def unsubscribe(self, stream: AdaptiveStream) -> None:
+        self.streams.remove(stream)
+
+    def stats(self, client_id: Optional[str] = None) \
+            -> List[Dict[str, Union[str, int, float, None]]]:
+        return [s.settings() for s in self.streams
+                if client_id is None or s.client_id == client_id]
+
+    async def next_frame(self, last_seq: int,
+                         level: int = DEFAULT_VIDEO_LEVEL,
+                         timeout: float = 1.0) -> Tuple[int, bytes]:
+        """
+        Wait for a frame newer than last_seq. If no camera frame arrives in
+        time, the latest frame or the placeholder is returned again, so
+        clients see the stream is alive.
+
+        :param last_seq:    sequence number of the frame the client has
+        :param level:       index into VIDEO_LEVELS
+        :param timeout:     max seconds to wait for a new frame
+        :return:            tuple of sequence number and jpeg bytes
+        """
+        if self.seq <= last_seq:
+            await self.condition.wait(timeout=self.loop.time() + timeout)
+        with self.lock:
+            seq, img_arr, frame = self.seq, self.img_arr, \
+                self.frames.get(level)
+        if img_arr is None:
+            return 0, self.get_placeholder()
+        if frame is None:
+            # first client on this level for this frame encodes it, the
+            # others wait for its result
+            key = (seq, level)
+            future = self.encoding.get(key)
+            if future is None:
+                future = self.loop.run_in_executor(
+                    self.executor, self._encode_level, seq, img_arr, level)
+                self.encoding[key] = future
+            try:
+                frame = await future
+            finally:
+                if self.encoding.get(key) is future:
+                    del self.encoding[key]
+        return seq, frame
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
 class VideoAPI(RequestHandler):
     '''
     Serves a MJPEG of the images posted from the vehicle.
     '''
 
     async def get(self):
-        placeholder_image = utils.load_image_sized(
-                        os.path.join(self.application.static_file_path,
-                                     "img_placeholder.jpg"), 160, 120, 3)
-
+        broadcaster = self.application.video
         self.set_header("Content-type",
                         "multipart/x-mixed-replace;boundary=--boundarydonotcross")
 
-        served_image_timestamp = time.time()
         my_boundary = "--boundarydonotcross\n"
-        while True:
-
-            interval = .005
-            if served_image_timestamp + interval < time.time():
-                #
-                # if we have an image, then use it.
-                # otherwise show placeholder
-                #
-                if hasattr(self.application, 'img_arr') and self.application.img_arr is not None:
-                    img = utils.arr_to_binary(self.application.img_arr)
-                else:
-                    img = utils.arr_to_binary(placeholder_image)
-
+        seq = -1
+        stream = broadcaster.subscribe(self.get_argument('client', None))
+        last_sent = 0.0
+        try:
+            while True:
+                # limit frame rate to what the client can take
+                wait = last_sent + stream.interval() - time.time()
+                if wait > 0:
+                    await tornado.gen.sleep(wait)
+                seq, img = await broadcaster.next_frame(seq, stream.level)
+                last_sent = time.time()
                 self.write(my_boundary)
                 self.write("Content-type: image/jpeg\r\n")
+                self.write("X-Frame-Seq: %s\r\n" % seq)
                 self.write("Content-length: %s\r\n\r\n" % len(img))
                 self.write(img)
-                served_image_timestamp = time.time()
-                try:
-                    await self.flush()
-                except tornado.iostream.StreamClosedError:
-                    pass
-            else:
-                await tornado.gen.sleep(interval)
+                # waits until the client took the frame, frames encoded in
+                # the meantime are skipped
+                await self.flush()
+                stream.frame_sent(seq, time.time() - last_sent)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            broadcaster.unsubscribe(stream)
+
+
+class VideoStatsAPI(RequestHandler):
+    """
+    Returns the stream settings and measured latency of the video clients
+    as json, or only of the client given by the client argument.
+    """
+    def get(self):
+        stats = self.application.video.stats(self.get_argument('client', None))
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(stats))
+
+
+class WebSocketVideoAPI(tornado.websocket.WebSocketHandler):
+    """
+    Serves the images posted from the vehicle as binary websocket messages.
+    Each message is the frame sequence number as 4 byte unsigned big endian
+    integer followed by the jpeg. Clients should answer with a text message
+    {"ack": seq} to report the round trip time. Once a second a text message
+    with the current stream settings is sent.
+    """
+    def check_origin(self, origin):
+        return True
+
+    def open(self):
+        logger.info("New video client connected")
+        self.stream_settings = self.application.video.subscribe(
+            self.get_argument('client', None))
+        IOLoop.current().spawn_callback(self.stream)
+
+    async def stream(self):
+        broadcaster = self.application.video
+        stream = self.stream_settings
+        seq = -1
+        last_sent = 0.0
+        last_settings = 0.0
+        try:
+            while self.ws_connection is not None:
+                wait = last_sent + stream.interval() - time.time()
+                if wait > 0:
+                    await tornado.gen.sleep(wait)
+                seq, img = await broadcaster.next_frame(seq, stream.level)
+                last_sent = time.time()
+                await self.write_message(struct.pack('!I', seq) + img,
+                                         binary=True)
+                stream.frame_sent(seq, time.time() - last_sent)
+                if last_sent - last_settings > 1.0:
+                    last_settings = last_sent
+                    await self.write_message(json.dumps(stream.settings()))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_message(self, message):
+        try:
+            data = json.loads(message)
+            seq = int(data['ack']) if isinstance(data, dict) \
+                and 'ack' in data else None
+        except (ValueError, TypeError):
+            logger.warning(f"Ignoring malformed video message {message!r}")
+            return
+        if seq is not None:
+            self.stream_settings.ack(seq)
+
+    def on_close(self):
+        logger.info("Video client disconnected")
+        self.application.video.unsubscribe(self.stream_settings)
 
 
 class BaseHandler(RequestHandler):
@@ -407,7 +957,7 @@ class WebFpv(Application):
     faster than a pure python application based on open cv or similar.
     """
 
-    def __init__(self, port=8890):
+    def __init__(self, port=8890, latency_target=0.15, max_fps=20):
         self.port = port
         this_dir = os.path.dirname(os.path.realpath(__file__))
         self.static_file_path = os.path.join(this_dir, 'templates', 'static')
@@ -416,12 +966,17 @@ class WebFpv(Application):
         handlers = [
             (r"/", BaseHandler),
             (r"/video", VideoAPI),
+            (r"/videoStats", VideoStatsAPI),
+            (r"/wsVideo", WebSocketVideoAPI),
             (r"/static/(.*)", StaticFileHandler,
              {"path": self.static_file_path})
         ]
 
         settings = {'debug': True}
         self.img_arr = None
+        self.video = FrameBroadcaster(
+            os.path.join(self.static_file_path, "img_placeholder.jpg"),
+            latency_target, max_fps)
         super().__init__(handlers, **settings)
         logger.info(f"Started Web FPV server. You can now go to "
                     f"{gethostname()}.local:{self.port} to view the car camera")
@@ -432,13 +987,14 @@ class WebFpv(Application):
         self.listen(self.port)
         IOLoop.instance().start()
 
-    def run_threaded(self, img_arr=None):
+    def run_threaded(self, img_arr=None, frame_seq=None):
         self.img_arr = img_arr
+        self.video.publish(img_arr, frame_seq)
 
-    def run(self, img_arr=None):
-        self.img_arr = img_arr
+    def run(self, img_arr=None, frame_seq=None):
+        self.run_threaded(img_arr, frame_seq)
 
     def shutdown(self):
-        pass
+        self.video.shutdown()
 
 
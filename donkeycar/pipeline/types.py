@@ -6,8 +6,8 @@ import logging
 import numpy as np
 from donkeycar.config import Config
 from donkeycar.parts.tub_v2 import Tub
-from donkeycar.utils import load_image, load_pil_image, binary_to_img, \
-    img_to_arr, img_to_binary, arr_to_binary
+from donkeycar.utils import load_image, load_pil_image, binary_to_arr, \
+    img_to_binary, arr_to_binary
 from typing_extensions import TypedDict
 
 
@@ -96,7 +96,7 @@ class TubRecord(object):
         elif self._cache_policy == CachePolicy.ARRAY:
             return self._image
         elif self._cache_policy == CachePolicy.BINARY:
-            return img_to_arr(binary_to_img(self._image))
+            return binary_to_arr(self._image)
         else:
             raise RuntimeError(f"Unhandled cache policy {self._cache_policy}")
 
@@ -113,7 +113,7 @@ class TubRecord(object):
             with open(img_path, 'rb') as f:
                 _image = f.read()
                 self._image = _image
-                _image = img_to_arr(binary_to_img(_image))
+                _image = binary_to_arr(_image)
         return _image
 
     def _load_pil_image_and_cache(self, img_path):
@@ -30,6 +30,9 @@ IMAGE_W = 160
 IMAGE_H = 120
 IMAGE_DEPTH = 3         # default RGB=3, make 1 for mono
 CAMERA_FRAMERATE = DRIVE_LOOP_HZ
+CAMERA_FRAME_METADATA = False  # true to output the sequence number and capture time of each frame
+                               # as 'cam/frame_seq' and 'cam/frame_time', and the frame age as
+                               # 'cam/frame_latency', dropped and duplicate frames are logged at exit
 CAMERA_VFLIP = False
 CAMERA_HFLIP = False
 CAMERA_INDEX = 0  # used for 'WEBCAM' and 'CVCAM' when there is more than one camera connected 
@@ -385,6 +388,7 @@ CREATE_TF_LITE = True           # automatically create tflite model in training
 CREATE_TENSOR_RT = False        # automatically create tensorrt model in training
 SAVE_MODEL_AS_H5 = False        # if old keras format should be used instead of savedmodel
 CACHE_POLICY = 'ARRAY'          # if images are cached as array in training other options are 'NOCACHE' and 'BINARY'
+IMAGE_DCT_SCALING = False       # True to decode tub images which are at least twice IMAGE_W x IMAGE_H at 1/2, 1/4 or 1/8 size before resizing. Loading is up to ~4x faster, but pixels differ by ~2 grey levels on average from a full size decode, so models train on slightly different pixels
 
 PRUNE_CNN = False               #This will remove weights from your model. The primary goal is to increase performance.
 PRUNE_PERCENT_TARGET = 75       # The desired percentage of pruning.
@@ -512,6 +516,9 @@ ROI_CROP_TOP = 45               # the number of rows of pixels to ignore on the
 ROI_CROP_BOTTOM = 0             # the number of rows of pixels to ignore on the bottom of the image
 ROI_CROP_RIGHT = 0              # the number of rows of pixels to ignore on the right of the image
 ROI_CROP_LEFT = 0               # the number of rows of pixels to ignore on the left of the image
+ROI_CROP_MODE = 'mask'          # 'mask' fills the borders and keeps the image size, 'crop' cuts them off,
+                                # so the model input is smaller and faster. Models trained with one mode
+                                # need the same mode for driving.
 
 # "TRAPEZE" tranformation
 # Apply mask to borders of image
@@ -570,6 +577,13 @@ NETWORK_JS_SERVER_IP = None         #when listening for network joystick control
 JOYSTICK_DEADZONE = 0.01            # when non zero, this is the smallest throttle before recording triggered.
 JOYSTICK_THROTTLE_DIR = -1.0         # use -1.0 to flip forward/backward, use 1.0 to use joystick's natural forward/backward
 USE_FPV = False                     # send camera data to FPV webserver
+WEB_VIDEO_LATENCY_TARGET = 0.15     # seconds, jpeg quality, size and frame rate of the web video are reduced per client to stay below this send latency
+WEB_VIDEO_MAX_FPS = 20              # max frame rate of the web video per client
+WEB_TELEMETRY_HZ = 10               # rate of the state and telemetry updates sent to the web ui
+WEB_TELEMETRY_CHANNELS = ['user/angle', 'user/throttle', 'pilot/angle', 'pilot/throttle']  # numeric vehicle memory values plotted live in the web ui
+USE_UDP_CONTROL = False             # receive drive commands over udp, see donkeycar/parts/udp_control.py
+UDP_CONTROL_PORT = 5570             # udp port of the drive commands
+UDP_CONTROL_STALE_TIMEOUT = 0.25    # seconds without a udp drive command after which the throttle drops to zero until the web controller sends new input
 JOYSTICK_DEVICE_FILE = "/dev/input/js0" # this is the unix file use to access the joystick.
 
 #For the categorical model, this limits the upper bound of the learned throttle
@@ -636,13 +650,27 @@ TELEMETRY_LOGGING_LEVEL = 'INFO' # (Python logging level) 'NOTSET' / 'DEBUG' / '
 TELEMETRY_LOGGING_FORMAT = '%(message)s'  # (Python logging format - https://docs.python.org/3/library/logging.html#formatter-objects
 TELEMETRY_DEFAULT_INPUTS = 'pilot/angle,pilot/throttle,recording'
 TELEMETRY_DEFAULT_TYPES = 'float,float'
+TELEMETRY_BUFFER_SIZE = 10000     # max samples kept in memory, the oldest are dropped when it is full
+TELEMETRY_BATCH_SIZE = 500        # max samples per published message
+TELEMETRY_RATE_LIMITS = {}        # max samples per second of a key, e.g. {'pilot/angle': 5}; other keys are not limited
+TELEMETRY_SPOOL_PATH = os.path.join(CAR_PATH, 'telemetry.spool')  # batches are appended here while the broker is unreachable and replayed on reconnect, None to drop them
+TELEMETRY_SPOOL_MAX_BYTES = 50 * 1024 * 1024  # max size of the spool file
 
 # PERF MONITOR
 HAVE_PERFMON = False
 
+# LATENCY TRACING
+TRACE_LATENCY = False           # true to trace each camera frame through the pilot to the motors, the capture, inference
+                                # and actuation latencies are logged at exit and written to 'latency/capture_inference',
+                                # 'latency/inference_actuation' and 'latency/capture_actuation' in ms. Set
+                                # CAMERA_FRAME_METADATA to measure from the capture time of the frame
+RECORD_LATENCY = False          # true to record the latencies in the tub when TRACE_LATENCY is enabled
+
 #RECORD OPTIONS
 RECORD_DURING_AI = False        #normally we do not record during ai mode. Set this to true to get image and steering records for your Ai. Be careful not to use them to train.
 AUTO_CREATE_NEW_TUB = False     #create a new tub (tub_YY_MM_DD) directory when recording or append records to data directory directly
+TUB_STREAM_HOST = None          #host running `donkey tub-receiver` to stream the recorded records to while driving, None to disable
+TUB_STREAM_PORT = 5580          #port of the tub receiver
 
 #LED
 HAVE_RGB_LED = False            #do you have an RGB LED like https://www.amazon.com/dp/B07BNRZWNF
@@ -35,6 +35,9 @@ IMAGE_W = 320
 IMAGE_H = 240
 IMAGE_DEPTH = 3         # default RGB=3, make 1 for mono
 CAMERA_FRAMERATE = DRIVE_LOOP_HZ
+CAMERA_FRAME_METADATA = False  # true to output the sequence number and capture time of each frame
+                               # as 'cam/frame_seq' and 'cam/frame_time', and the frame age as
+                               # 'cam/frame_latency', dropped and duplicate frames are logged at exit
 CAMERA_VFLIP = False
 CAMERA_HFLIP = False
 CAMERA_INDEX = 0  # used for 'WEBCAM' and 'CVCAM' when there is more than one camera connected
@@ -372,6 +375,13 @@ NETWORK_JS_SERVER_IP = None         #when listening for network joystick control
 JOYSTICK_DEADZONE = 0.01            # when non zero, this is the smallest throttle before recording triggered.
 JOYSTICK_THROTTLE_DIR = -1.0         # use -1.0 to flip forward/backward, use 1.0 to use joystick's natural forward/backward
 USE_FPV = False                     # send camera data to FPV webserver
+WEB_VIDEO_LATENCY_TARGET = 0.15     # seconds, jpeg quality, size and frame rate of the web video are reduced per client to stay below this send latency
+WEB_VIDEO_MAX_FPS = 20              # max frame rate of the web video per client
+WEB_TELEMETRY_HZ = 10               # rate of the state and telemetry updates sent to the web ui
+WEB_TELEMETRY_CHANNELS = ['user/steering', 'user/throttle', 'pilot/steering', 'pilot/throttle']  # numeric vehicle memory values plotted live in the web ui
+USE_UDP_CONTROL = False             # receive drive commands over udp, see donkeycar/parts/udp_control.py
+UDP_CONTROL_PORT = 5570             # udp port of the drive commands
+UDP_CONTROL_STALE_TIMEOUT = 0.25    # seconds without a udp drive command after which the throttle drops to zero until the web controller sends new input
 JOYSTICK_DEVICE_FILE = "/dev/input/js0" # this is the unix file use to access the joystick.
 
 
@@ -430,6 +440,11 @@ TELEMETRY_LOGGING_LEVEL = 'INFO' # (Python logging level) 'NOTSET' / 'DEBUG' / '
 TELEMETRY_LOGGING_FORMAT = '%(message)s'  # (Python logging format - https://docs.python.org/3/library/logging.html#formatter-objects
 TELEMETRY_DEFAULT_INPUTS = 'pilot/angle,pilot/throttle,recording'
 TELEMETRY_DEFAULT_TYPES = 'float,float'
+TELEMETRY_BUFFER_SIZE = 10000     # max samples kept in memory, the oldest are dropped when it is full
+TELEMETRY_BATCH_SIZE = 500        # max samples per published message
+TELEMETRY_RATE_LIMITS = {}        # max samples per second of a key, e.g. {'pilot/angle': 5}; other keys are not limited
+TELEMETRY_SPOOL_PATH = os.path.join(CAR_PATH, 'telemetry.spool')  # batches are appended here while the broker is unreachable and replayed on reconnect, None to drop them
+TELEMETRY_SPOOL_MAX_BYTES = 50 * 1024 * 1024  # max size of the spool file
 
 
 #
@@ -437,12 +452,21 @@ TELEMETRY_DEFAULT_TYPES = 'float,float'
 #
 HAVE_PERFMON = False
 
+# LATENCY TRACING
+TRACE_LATENCY = False           # true to trace each camera frame through the pilot to the motors, the capture, inference
+                                # and actuation latencies are logged at exit and written to 'latency/capture_inference',
+                                # 'latency/inference_actuation' and 'latency/capture_actuation' in ms. Set
+                                # CAMERA_FRAME_METADATA to measure from the capture time of the frame
+RECORD_LATENCY = False          # true to record the latencies in the tub when TRACE_LATENCY is enabled
+
 
 #
 # RECORD OPTIONS
 #
 RECORD_DURING_AI = False        #normally we do not record during ai mode. Set this to true to get image and steering records for your Ai. Be careful not to use them to train.
 AUTO_CREATE_NEW_TUB = False     #create a new tub (tub_YY_MM_DD) directory when recording or append records to data directory directly
+TUB_STREAM_HOST = None          #host running `donkey tub-receiver` to stream the recorded records to while driving, None to disable
+TUB_STREAM_PORT = 5580          #port of the tub receiver
 
 
 #
@@ -562,6 +586,8 @@ CV_CONTROLLER_CONDITION = "run_pilot"
 # LineFollower - line color and detection area
 SCAN_Y = 100          # num pixels from the top to start horiz scan
 SCAN_HEIGHT = 20      # num pixels high to grab from horiz scan
+SCAN_ROWS = 5         # num rows sampled evenly from the horiz scan; the line position is found in each row
+LINE_WIDTH = 20       # num pixels of the window around the line in a row whose centroid is the line position
 COLOR_THRESHOLD_LOW  = (0, 50, 50)    # HSV dark yellow (opencv HSV hue value is 0..179, saturation and value are both 0..255)
 COLOR_THRESHOLD_HIGH = (50, 255, 255) # HSV light yellow (opencv HSV hue value is 0..179, saturation and value are both 0..255)
 
@@ -573,12 +599,12 @@ TARGET_PIXEL = None   # In not None, then this is the expected horizontal positi
 TARGET_THRESHOLD = 10 # number of pixels from TARGET_PIXEL that vehicle must be pointing
                       # before a steering change will be made; this prevents algorithm
                       # from being too twitchy when it is on or near the line.
-CONFIDENCE_THRESHOLD = 0.0015   # The fraction of total sampled pixels that must be yellow in the sample slice.
-                                # The sample slice will have SCAN_HEIGHT pixels and the total number
-                                # of sampled pixels is IMAGE_W x SCAN_HEIGHT, so if you want to make sure
-                                # that all the pixels in the sample slice are yellow, then the confidence
-                                # threshold should be SCAN_HEIGHT / (IMAGE_W x SCAN_HEIGHT) or (1 / IMAGE_W).
-                                # if you want half of the pixels in the slice to match hten (1 / IMAGE_W) / 2.
+CONFIDENCE_THRESHOLD = 0.0015   # The fraction of total sampled pixels that must be yellow in the line windows.
+                                # The sample has SCAN_ROWS rows and the total number of sampled pixels
+                                # is IMAGE_W x SCAN_ROWS, so if you want to make sure that a line of one
+                                # pixel width is yellow in all the rows, then the confidence
+                                # threshold should be SCAN_ROWS / (IMAGE_W x SCAN_ROWS) or (1 / IMAGE_W).
+                                # if you want half of the rows to match then (1 / IMAGE_W) / 2.
                                 # If you keep getting `No line detected` logs in the console then you
                                 # may want to lower the threshold.
 
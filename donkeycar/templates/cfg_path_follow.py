@@ -36,6 +36,9 @@ IMAGE_W = 160
 IMAGE_H = 120
 IMAGE_DEPTH = 3         # default RGB=3, make 1 for mono
 CAMERA_FRAMERATE = DRIVE_LOOP_HZ
+CAMERA_FRAME_METADATA = False  # true to output the sequence number and capture time of each frame
+                               # as 'cam/frame_seq' and 'cam/frame_time', and the frame age as
+                               # 'cam/frame_latency', dropped and duplicate frames are logged at exit
 CAMERA_VFLIP = False
 CAMERA_HFLIP = False
 CAMERA_INDEX = 0  # used for 'WEBCAM' and 'CVCAM' when there is more than one camera connected
@@ -434,6 +437,13 @@ NETWORK_JS_SERVER_IP = None         #when listening for network joystick control
 JOYSTICK_DEADZONE = 0.01            # when non zero, this is the smallest throttle before recording triggered.
 JOYSTICK_THROTTLE_DIR = -1.0         # use -1.0 to flip forward/backward, use 1.0 to use joystick's natural forward/backward
 USE_FPV = False                     # send camera data to FPV webserver
+WEB_VIDEO_LATENCY_TARGET = 0.15     # seconds, jpeg quality, size and frame rate of the web video are reduced per client to stay below this send latency
+WEB_VIDEO_MAX_FPS = 20              # max frame rate of the web video per client
+WEB_TELEMETRY_HZ = 10               # rate of the state and telemetry updates sent to the web ui
+WEB_TELEMETRY_CHANNELS = ['user/steering', 'user/throttle', 'pilot/steering', 'pilot/throttle', 'cte/error']  # numeric vehicle memory values plotted live in the web ui
+USE_UDP_CONTROL = False             # receive drive commands over udp, see donkeycar/parts/udp_control.py
+UDP_CONTROL_PORT = 5570             # udp port of the drive commands
+UDP_CONTROL_STALE_TIMEOUT = 0.25    # seconds without a udp drive command after which the throttle drops to zero until the web controller sends new input
 JOYSTICK_DEVICE_FILE = "/dev/input/js0" # this is the unix file use to access the joystick.
 
 
@@ -492,6 +502,11 @@ TELEMETRY_LOGGING_LEVEL = 'INFO' # (Python logging level) 'NOTSET' / 'DEBUG' / '
 TELEMETRY_LOGGING_FORMAT = '%(message)s'  # (Python logging format - https://docs.python.org/3/library/logging.html#formatter-objects
 TELEMETRY_DEFAULT_INPUTS = 'pilot/angle,pilot/throttle,recording'
 TELEMETRY_DEFAULT_TYPES = 'float,float'
+TELEMETRY_BUFFER_SIZE = 10000     # max samples kept in memory, the oldest are dropped when it is full
+TELEMETRY_BATCH_SIZE = 500        # max samples per published message
+TELEMETRY_RATE_LIMITS = {}        # max samples per second of a key, e.g. {'pilot/angle': 5}; other keys are not limited
+TELEMETRY_SPOOL_PATH = os.path.join(CAR_PATH, 'telemetry.spool')  # batches are appended here while the broker is unreachable and replayed on reconnect, None to drop them
+TELEMETRY_SPOOL_MAX_BYTES = 50 * 1024 * 1024  # max size of the spool file
 
 
 #
@@ -16,21 +16,11 @@ Options:
 """
 from docopt import docopt
 
-#
-# import cv2 early to avoid issue with importing after tensorflow
-# see https://github.com/opencv/opencv/issues/14884#issuecomment-599852128
-#
-try:
-    import cv2
-except:
-    pass
-
-
 import donkeycar as dk
 from donkeycar.parts.transform import TriggeredCallback, DelayedTrigger
 from donkeycar.parts.tub_v2 import TubWriter
 from donkeycar.parts.datastore import TubHandler
-from donkeycar.parts.controller import LocalWebController, WebFpv, JoystickController
+from donkeycar.parts.controller import JoystickController
 from donkeycar.parts.throttle_filter import ThrottleFilter
 from donkeycar.parts.behavior import BehaviorPart
 from donkeycar.parts.file_watcher import FileWatcher
@@ -271,7 +261,11 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None,
 
     # Use the FPV preview, which will show the cropped image output, or the full frame.
     if cfg.USE_FPV:
-        V.add(WebFpv(), inputs=['cam/image_array'], threaded=True)
+        from donkeycar.parts.controller import WebFpv
+        V.add(WebFpv(
+                latency_target=getattr(cfg, 'WEB_VIDEO_LATENCY_TARGET', 0.15),
+                max_fps=getattr(cfg, 'WEB_VIDEO_MAX_FPS', 20)),
+              inputs=['cam/image_array', 'cam/frame_seq'], threaded=True)
 
     def load_model(kl, model_path):
         start = time.time()
@@ -306,6 +300,18 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None,
     # load and configure model for inference
     #
     if model_path:
+        #
+        # import cv2 before tensorflow to avoid issue with importing after
+        # tensorflow, see
+        # https://github.com/opencv/opencv/issues/14884#issuecomment-599852128
+        # This is only done when driving with a model, so user mode does not
+        # pay the import cost.
+        #
+        try:
+            import cv2
+        except:
+            pass
+
         # If we have a model, create an appropriate Keras part
         kl = dk.utils.get_model_by_type(model_type, cfg)
 
@@ -412,7 +418,8 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None,
                   inputs=['cam/image_array'], outputs=['cam/image_array_trans'])
             inputs = ['cam/image_array_trans'] + inputs[1:]
 
-        V.add(kl, inputs=inputs, outputs=outputs, run_condition='run_pilot')
+        V.add(kl, inputs=inputs, outputs=outputs, run_condition='run_pilot',
+              stage='inference' if getattr(cfg, 'TRACE_LATENCY', False) else None)
 
     #
     # stop at a stop sign
@@ -533,13 +540,21 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None,
         types += ['float', 'float', 'float']
         V.add(mon, inputs=[], outputs=perfmon_outputs, threaded=True)
 
+    if getattr(cfg, 'TRACE_LATENCY', False) \
+            and getattr(cfg, 'RECORD_LATENCY', False):
+        inputs += ['latency/capture_inference', 'latency/inference_actuation',
+                   'latency/capture_actuation']
+        types += ['float', 'float', 'float']
+
     #
     # Create data storage part
     #
     tub_path = TubHandler(path=cfg.DATA_PATH).create_tub_path() if \
         cfg.AUTO_CREATE_NEW_TUB else cfg.DATA_PATH
     meta += getattr(cfg, 'METADATA', [])
-    tub_writer = TubWriter(tub_path, inputs=inputs, types=types, metadata=meta)
+    tub_writer = TubWriter(tub_path, inputs=inputs, types=types, metadata=meta,
+                           stream_host=getattr(cfg, 'TUB_STREAM_HOST', None),
+                           stream_port=getattr(cfg, 'TUB_STREAM_PORT', 5580))
     V.add(tub_writer, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
 
     # Telemetry (we add the same metrics added to the TubHandler
@@ -694,12 +709,38 @@ def add_user_controller(V, cfg, use_joystick, input_image='ui/image_array'):
     # This web controller will create a web server that is capable
     # of managing steering, throttle, and modes, and more.
     #
-    ctr = LocalWebController(port=cfg.WEB_CONTROL_PORT, mode=cfg.WEB_INIT_MODE)
+    from donkeycar.parts.controller import LocalWebController
+    channels = getattr(cfg, 'WEB_TELEMETRY_CHANNELS', [])
+    ctr = LocalWebController(port=cfg.WEB_CONTROL_PORT, mode=cfg.WEB_INIT_MODE,
+                             video_latency_target=getattr(
+                                 cfg, 'WEB_VIDEO_LATENCY_TARGET', 0.15),
+                             video_max_fps=getattr(cfg, 'WEB_VIDEO_MAX_FPS', 20),
+                             telemetry_hz=getattr(cfg, 'WEB_TELEMETRY_HZ', 10),
+                             channels=channels)
     V.add(ctr,
-          inputs=[input_image, 'tub/num_records', 'user/mode', 'recording'],
+          inputs=[input_image, 'tub/num_records', 'user/mode', 'recording',
+                  'cam/frame_seq'] + channels,
           outputs=['user/steering', 'user/throttle', 'user/mode', 'recording', 'web/buttons'],
           threaded=True)
 
+    #
+    # drive commands over udp, e.g. from a joystick on a laptop,
+    # override the web controller while they keep coming
+    #
+    if getattr(cfg, 'USE_UDP_CONTROL', False):
+        from donkeycar.parts.udp_control import UdpControlReceiver, \
+            UdpControlSelector
+        udp = UdpControlReceiver(
+            port=getattr(cfg, 'UDP_CONTROL_PORT', 5570),
+            stale_timeout=getattr(cfg, 'UDP_CONTROL_STALE_TIMEOUT', 0.25))
+        V.add(udp, inputs=['user/mode', 'recording'],
+              outputs=['udp/steering', 'udp/throttle', 'udp/mode', 'udp/recording', 'udp/buttons'],
+              threaded=True)
+        V.add(UdpControlSelector(udp),
+              inputs=['user/steering', 'user/throttle', 'udp/steering',
+                      'udp/throttle', 'udp/mode', 'udp/recording'],
+              outputs=['user/steering', 'user/throttle', 'user/mode', 'recording'])
+
     #
     # also add a physical controller if one is configured
     #
@@ -789,37 +830,32 @@ def add_simulator(V, cfg):
 
 def get_camera(cfg):
     """
-    Get the configured camera part
+    Get the configured camera part. The camera module is only imported
+    when its type is configured, see donkeycar.parts.registry.
     """
+    from donkeycar.parts.registry import cameras
+
     cam = None
     if not cfg.DONKEY_GYM:
         if cfg.CAMERA_TYPE == "PICAM":
-            from donkeycar.parts.camera import PiCamera
-            cam = PiCamera(image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH,
-                           vflip=cfg.CAMERA_VFLIP, hflip=cfg.CAMERA_HFLIP)
+            cam = cameras.create("PICAM", image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH,
+                                 vflip=cfg.CAMERA_VFLIP, hflip=cfg.CAMERA_HFLIP)
         elif cfg.CAMERA_TYPE == "WEBCAM":
-            from donkeycar.parts.camera import Webcam
-            cam = Webcam(image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH)
+            cam = cameras.create("WEBCAM", image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH)
         elif cfg.CAMERA_TYPE == "CVCAM":
-            from donkeycar.parts.cv import CvCam
-            cam = CvCam(image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH)
+            cam = cameras.create("CVCAM", image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH)
         elif cfg.CAMERA_TYPE == "CSIC":
-            from donkeycar.parts.camera import CSICamera
-            cam = CSICamera(image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH,
-                            capture_width=cfg.IMAGE_W, capture_height=cfg.IMAGE_H,
-                            framerate=cfg.CAMERA_FRAMERATE, gstreamer_flip=cfg.CSIC_CAM_GSTREAMER_FLIP_PARM)
+            cam = cameras.create("CSIC", image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH,
+                                 capture_width=cfg.IMAGE_W, capture_height=cfg.IMAGE_H,
+                                 framerate=cfg.CAMERA_FRAMERATE, gstreamer_flip=cfg.CSIC_CAM_GSTREAMER_FLIP_PARM)
         elif cfg.CAMERA_TYPE == "V4L":
-            from donkeycar.parts.camera import V4LCamera
-            cam = V4LCamera(image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH, framerate=cfg.CAMERA_FRAMERATE)
+            cam = cameras.create("V4L", image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH, framerate=cfg.CAMERA_FRAMERATE)
         elif cfg.CAMERA_TYPE == "IMAGE_LIST":
-            from donkeycar.parts.camera import ImageListCamera
-            cam = ImageListCamera(path_mask=cfg.PATH_MASK)
+            cam = cameras.create("IMAGE_LIST", path_mask=cfg.PATH_MASK)
         elif cfg.CAMERA_TYPE == "LEOPARD":
-            from donkeycar.parts.leopard_imaging import LICamera
-            cam = LICamera(width=cfg.IMAGE_W, height=cfg.IMAGE_H, fps=cfg.CAMERA_FRAMERATE)
+            cam = cameras.create("LEOPARD", width=cfg.IMAGE_W, height=cfg.IMAGE_H, fps=cfg.CAMERA_FRAMERATE)
         elif cfg.CAMERA_TYPE == "MOCK":
-            from donkeycar.parts.camera import MockCamera
-            cam = MockCamera(image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH)
+            cam = cameras.create("MOCK", image_w=cfg.IMAGE_W, image_h=cfg.IMAGE_H, image_d=cfg.IMAGE_DEPTH)
         else:
             raise(Exception("Unkown camera type: %s" % cfg.CAMERA_TYPE))
     return cam
@@ -862,8 +898,9 @@ def add_camera(V, cfg, camera_type):
             V.add(ImgBGR2RGB(), inputs=["cam/image_array_b"], outputs=["cam/image_array_b"])
 
     elif cfg.CAMERA_TYPE == "D435":
-        from donkeycar.parts.realsense435i import RealSense435i
-        cam = RealSense435i(
+        from donkeycar.parts.registry import cameras
+        cam = cameras.create(
+            "D435",
             enable_rgb=cfg.REALSENSE_D435_RGB,
             enable_depth=cfg.REALSENSE_D435_DEPTH,
             enable_imu=cfg.REALSENSE_D435_IMU,
@@ -878,8 +915,24 @@ def add_camera(V, cfg, camera_type):
         outputs = ['cam/image_array']
         threaded = True
         cam = get_camera(cfg)
+        frame_metadata = cam is not None \
+            and getattr(cfg, 'CAMERA_FRAME_METADATA', False) \
+            and hasattr(cam, 'frame_metadata')
+        if frame_metadata:
+            cam.frame_metadata = True
+            outputs += ['cam/frame_seq', 'cam/frame_time']
         if cam:
-            V.add(cam, inputs=inputs, outputs=outputs, threaded=threaded)
+            stage = stage_time = None
+            if getattr(cfg, 'TRACE_LATENCY', False):
+                stage = 'capture'
+                if frame_metadata:
+                    stage_time = 'cam/frame_time'
+            V.add(cam, inputs=inputs, outputs=outputs, threaded=threaded,
+                  stage=stage, stage_time=stage_time)
+        if frame_metadata:
+            from donkeycar.parts.camera import FrameMonitor
+            V.add(FrameMonitor(), inputs=['cam/frame_seq', 'cam/frame_time'],
+                  outputs=['cam/frame_latency'])
         if cfg.BGR2RGB:
             from donkeycar.parts.cv import ImgBGR2RGB
             V.add(ImgBGR2RGB(), inputs=["cam/image_array"], outputs=["cam/image_array"])
@@ -925,13 +978,12 @@ def add_imu(V, cfg):
 # Drive train setup
 #
 def add_drivetrain(V, cfg):
+    first_part = len(V.parts)
 
     if (not cfg.DONKEY_GYM) and cfg.DRIVE_TRAIN_TYPE != "MOCK":
         from donkeycar.parts import actuator, pins
         from donkeycar.parts.actuator import TwoWheelSteeringThrottle
 
-         # 导入四电机控制器
-        from donkeycar.parts.quad_motor_pca9685 import QuadMotorController
         #
         # To make differential drive steer,
         # divide throttle between motors based on the steering value
@@ -976,6 +1028,8 @@ def add_drivetrain(V, cfg):
             V.add(throttle, inputs=['throttle'], threaded=True)
         # 新增四电机PCA9685差速驱动支持
         elif cfg.DRIVE_TRAIN_TYPE == "DC_QUAD_WHEEL_PCA9685":
+            from donkeycar.parts.quad_motor_pca9685 import QuadMotorController
+
             dt = cfg.DC_QUAD_WHEEL_PCA9685
             
             quad_motor = QuadMotorController(
@@ -1172,6 +1226,12 @@ def add_drivetrain(V, cfg):
                         )
             V.add(vesc, inputs=['steering', 'throttle'])
 
+    if getattr(cfg, 'TRACE_LATENCY', False):
+        # the parts without outputs write to the motors and servos
+        for entry in V.parts[first_part:]:
+            if not entry['outputs']:
+                V.set_stage(entry['part'], 'actuation')
+
 
 if __name__ == '__main__':
     args = docopt(__doc__)
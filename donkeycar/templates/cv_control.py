@@ -101,12 +101,21 @@ def drive(cfg, use_joystick=False, camera_type='single', meta=[]):
     #
     # Computer Vision Controller
     #
-    add_cv_controller(V, cfg, pid,
-                      cfg.CV_CONTROLLER_MODULE,
-                      cfg.CV_CONTROLLER_CLASS,
-                      cfg.CV_CONTROLLER_INPUTS,
-                      cfg.CV_CONTROLLER_OUTPUTS,
-                      cfg.CV_CONTROLLER_CONDITION)
+    cv_controller = add_cv_controller(V, cfg, pid,
+                                      cfg.CV_CONTROLLER_MODULE,
+                                      cfg.CV_CONTROLLER_CLASS,
+                                      cfg.CV_CONTROLLER_INPUTS,
+                                      cfg.CV_CONTROLLER_OUTPUTS,
+                                      cfg.CV_CONTROLLER_CONDITION)
+
+    #
+    # only draw the overlay while the web ui shows the video
+    #
+    if hasattr(cv_controller, 'has_viewer'):
+        from donkeycar.parts.controller import LocalWebController
+        web = next(entry['part'] for entry in V.parts
+                   if isinstance(entry['part'], LocalWebController))
+        cv_controller.has_viewer = lambda: web.viewers > 0
 
     recording_control = ToggleRecording(cfg.AUTO_RECORD_ON_THROTTLE, cfg.RECORD_DURING_AI)
     V.add(recording_control, inputs=['user/mode', "recording"], outputs=["recording"])
@@ -193,13 +202,21 @@ def drive(cfg, use_joystick=False, camera_type='single', meta=[]):
     types=['image_array',
            'float', 'float']
 
+    if getattr(cfg, 'TRACE_LATENCY', False) \
+            and getattr(cfg, 'RECORD_LATENCY', False):
+        inputs += ['latency/capture_inference', 'latency/inference_actuation',
+                   'latency/capture_actuation']
+        types += ['float', 'float', 'float']
+
     #
     # Create data storage part
     #
     tub_path = TubHandler(path=cfg.DATA_PATH).create_tub_path() if \
         cfg.AUTO_CREATE_NEW_TUB else cfg.DATA_PATH
     meta += getattr(cfg, 'METADATA', [])
-    tub_writer = TubWriter(tub_path, inputs=inputs, types=types, metadata=meta)
+    tub_writer = TubWriter(tub_path, inputs=inputs, types=types, metadata=meta,
+                           stream_host=getattr(cfg, 'TUB_STREAM_HOST', None),
+                           stream_port=getattr(cfg, 'TUB_STREAM_PORT', 5580))
     V.add(tub_writer, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
 
     if cfg.DONKEY_GYM:
@@ -240,10 +257,13 @@ def add_cv_controller(
         my_class = getattr(module, class_name)
 
         # add instance of class to vehicle
-        V.add(my_class(pid, cfg),
+        controller = my_class(pid, cfg)
+        V.add(controller,
               inputs=inputs,
               outputs=outputs,
-              run_condition=run_condition)
+              run_condition=run_condition,
+              stage='inference' if getattr(cfg, 'TRACE_LATENCY', False) else None)
+        return controller
 
 
 if __name__ == '__main__':
@@ -0,0 +1,43 @@
+import pytest
+
+from donkeycar.config import Config
+from donkeycar.management.benchmark import benchmark_models, split_model_type
+from .setup import create_sample_tub, tub_path
+
+
+@pytest.fixture
+def cfg() -> Config:
+    cfg = Config()
+    cfg.IMAGE_H = 120
+    cfg.IMAGE_W = 160
+    cfg.IMAGE_DEPTH = 3
+    cfg.DEFAULT_MODEL_TYPE = 'linear'
+    cfg.SEQUENCE_LENGTH = 3
+    return cfg
+
+
+def test_split_model_type():
+    assert split_model_type('tflite_linear') == ('tflite_', 'linear')
+    assert split_model_type('rnn') == ('', 'rnn')
+
+
+def test_benchmark_keras_and_tflite(cfg, tub_path):
+    create_sample_tub(tub_path, records=5)
+    report = benchmark_models(cfg, ['linear', 'tflite_linear', 'rnn'],
+                              tub_path=tub_path, warmup=1, iterations=3,
+                              batch_sizes=[1, 2], threads=[1, 2])
+    assert report['settings']['frames'] == 'tub'
+    linear, tflite, rnn = report['results']
+    for r in report['results']:
+        assert 'error' not in r, r.get('error')
+        assert r['latency']['p50_ms'] > 0
+    assert set(linear['throughput'].keys()) == {'1', '2'}
+    assert linear['thread_scaling_p50_ms'] == {}
+    assert tflite['throughput'] == {}
+    assert set(tflite['thread_scaling_p50_ms'].keys()) == {'1', '2'}
+    assert rnn['throughput']['2'] > 0
+
+
+def test_benchmark_reports_failure(cfg):
+    report = benchmark_models(cfg, ['fastai_linear'], warmup=1, iterations=1)
+    assert 'error' in report['results'][0]
@@ -0,0 +1,82 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from donkeycar.parts.camera import BaseCamera, FrameMonitor, FrameRing
+from donkeycar.parts.cv import CvCam
+
+
+def test_frame_ring():
+    ring = FrameRing((2, 3), slots=3)
+    assert ring.latest() == (None, -1, None)
+    slot = ring.next_slot()
+    slot[:] = 7
+    assert ring.publish(timestamp=1.5) == 0
+    frame, seq, timestamp = ring.latest()
+    assert frame is slot and seq == 0 and timestamp == 1.5
+    # slots are only reused after slots - 1 newer frames
+    kept = frame
+    for i in range(2):
+        assert ring.next_slot() is not kept
+        ring.put(np.full((2, 3), i, dtype=np.uint8))
+    assert (kept == 7).all()
+    assert ring.next_slot() is kept
+    with pytest.raises(ValueError):
+        FrameRing((2, 3), slots=1)
+
+
+def test_store_frame_copies_and_resizes():
+    cam = BaseCamera()
+    cam.frame_slots = 2
+    frame = np.arange(24, dtype=np.uint8).reshape(2, 4, 3)
+    cam.store_frame(frame, 1.0)
+    assert cam.run_threaded() is cam.frame
+    np.testing.assert_array_equal(cam.frame, frame)
+    assert not np.shares_memory(cam.frame, frame)
+    cam.store_frame(np.zeros((4, 8, 3), dtype=np.uint8), 2.0)
+    assert cam.frame.shape == (2, 4, 3)
+    cam.frame_metadata = True
+    frame, seq, timestamp = cam.run_threaded()
+    assert seq == 1 and timestamp == 2.0
+
+
+def test_frame_monitor():
+    monitor = FrameMonitor()
+    assert monitor.run(None, None) is None
+    now = time.time()
+    for seq in [0, 1, 1, 4, 5]:
+        assert monitor.run(seq, now - 0.01) >= 0.01
+    stats = monitor.stats()
+    assert stats['frames'] == 4
+    assert stats['duplicates'] == 1
+    assert stats['dropped'] == 2
+    assert stats['p50_ms'] >= 10
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / 'video.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 20,
+                             (160, 120))
+    for i in range(12):
+        writer.write(np.full((120, 160, 3), i * 20, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+@pytest.mark.parametrize('size', [(160, 120), (80, 60)])
+def test_cvcam_reads_into_ring(video, size):
+    cam = CvCam(image_w=size[0], image_h=size[1], iCam=video, warming_secs=1)
+    cam.frame_metadata = True
+    first, seq, timestamp = cam.run()
+    assert first.shape == (size[1], size[0], 3)
+    assert timestamp is not None
+    # captured in place into the ring
+    assert any(first is view for view in cam.ring.views)
+    frame, next_seq, _ = cam.run()
+    assert next_seq == seq + 1
+    assert frame is not first
+    assert frame.mean() > first.mean()
+    cam.shutdown()
@@ -1,7 +1,8 @@
 import unittest
+import numpy as np
 import pytest
 
-from donkeycar.utilities.circular_buffer import CircularBuffer
+from donkeycar.utilities.circular_buffer import CircularBuffer, ArrayRingBuffer
 
 class TestCircularBuffer(unittest.TestCase):
 
@@ -122,3 +123,27 @@ class TestCircularBuffer(unittest.TestCase):
         for i in range(array.count):
             array.set(i, array.count-i)
             self.assertEqual(array.count-i, array.get(i))
+
+
+class TestArrayRingBuffer(unittest.TestCase):
+
+    def test_array_ring_buffer_window(self):
+        """
+        window is a contiguous view from oldest to newest entry
+        """
+        ring = ArrayRingBuffer(3, (2,))
+        ring.fill([0, 0])
+        self.assertEqual(3, ring.count)
+        expected = [[0, 0]] * 3
+        for i in range(1, 6):
+            ring.push([i, -i])
+            expected = expected[1:] + [[i, -i]]
+            window = ring.window()
+            self.assertTrue(window.flags['C_CONTIGUOUS'])
+            np.testing.assert_array_equal(expected, window)
+            np.testing.assert_array_equal([i, -i], ring.head())
+
+        ring.clear()
+        self.assertEqual(0, ring.count)
+        with self.assertRaises(ValueError):
+            ArrayRingBuffer(0, (2,))
@@ -0,0 +1,80 @@
+import time
+
+import numpy as np
+import pytest
+from pytest import approx
+
+from donkeycar.parts.ensemble import EnsemblePilot
+
+
+class FakePilot:
+    def __init__(self, angle, throttle, delay=0.0, confidence=None):
+        self.out = (angle, throttle)
+        self.delay = delay
+        self.confidence = confidence
+        self.calls = 0
+
+    def run(self, img_arr, *other_arr):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return self.out
+
+    def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def img():
+    return np.zeros((120, 160, 3), dtype=np.uint8)
+
+
+def test_average(img):
+    ensemble = EnsemblePilot([FakePilot(0.0, 0.2), FakePilot(0.5, 0.4)],
+                             policy='average', weights=[1.0, 3.0])
+    assert ensemble.run(img) == approx((0.375, 0.35))
+    ensemble.shutdown()
+
+
+def test_vote(img):
+    ensemble = EnsemblePilot([FakePilot(0.1, 0.3), FakePilot(0.2, 0.3),
+                              FakePilot(-1.0, 0.0)], policy='vote')
+    assert ensemble.run(img) == approx((0.1, 0.3))
+    ensemble.shutdown()
+
+
+def test_deadline_falls_back_to_fast_model(img):
+    fast = FakePilot(0.1, 0.2)
+    slow = FakePilot(0.9, 0.9, delay=0.2)
+    ensemble = EnsemblePilot([fast, slow], policy='average', deadline=0.02)
+    assert ensemble.run(img) == approx((0.1, 0.2))
+    # slow model is still busy, so the frame is not queued
+    assert ensemble.run(img) == approx((0.1, 0.2))
+    ensemble.shutdown()
+    assert slow.calls == 1
+    stats = ensemble.stats()
+    assert stats['frames'] == 2
+    assert stats['models'][1]['missed'] == 2
+    # late answer is still recorded for the latency statistics
+    assert stats['models'][1]['count'] == 1
+
+
+def test_cascade_uses_confidence(img):
+    fast = FakePilot(0.1, 0.2, confidence=0.9)
+    slow = FakePilot(0.5, 0.5)
+    ensemble = EnsemblePilot([fast, slow], policy='cascade',
+                             confidence_threshold=0.8)
+    assert ensemble.run(img) == approx((0.1, 0.2))
+    assert slow.calls == 0
+    fast.confidence = 0.3
+    assert ensemble.run(img) == approx((0.5, 0.5))
+    ensemble.shutdown()
+    models = ensemble.stats()['models']
+    assert models[0]['used'] == 1
+    assert models[1]['used'] == 1
+    assert models[0]['mean_abs_deviation'] == approx([0.2, 0.15])
+
+
+def test_bad_policy():
+    with pytest.raises(ValueError):
+        EnsemblePilot([FakePilot(0, 0)], policy='majority')
@@ -0,0 +1,81 @@
+import cv2
+import numpy as np
+import pytest
+
+from donkeycar.parts.fast_stretch import C, Epsilon, FastStretch, Mx, T, \
+    Tr, Ts, fast_stretch
+
+
+def reference_stretch(image):
+    """ The original loop based implementation """
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    (h, s, v) = cv2.split(hsv)
+    size = v.shape[0] * v.shape[1]
+    mean = np.mean(v)
+    t = (mean - Mx) / Mx
+    if t <= 0:
+        Sl = C
+        Sh = C - (Ts * t)
+    else:
+        Sl = C + (Ts * t)
+        Sh = C
+    gamma = 1.
+    if t <= T:
+        gamma = max((1 + (t - T)), Tr)
+    histogram = cv2.calcHist([v], [0], None, [256], [0, 256])
+    Xl = 0
+    Xh = 255
+    count = histogram[Xl]
+    while count < Sl * size:
+        count += histogram[Xl]
+        Xl += 1
+    count = histogram[Xh]
+    while count < Sh * size:
+        count += histogram[Xh]
+        Xh -= 1
+    output = np.where(v <= Xl, 0, v)
+    output = np.where(output >= Xh, 255, output)
+    output = np.where(np.logical_and(output > Xl, output < Xh), np.multiply(
+        255, np.power(np.divide(np.subtract(output, Xl),
+                                np.max([np.subtract(Xh, Xl), Epsilon])),
+                      gamma)), output)
+    output = np.where(output > 255., 255., output)
+    output = np.asarray(output, dtype='uint8')
+    output = cv2.merge((h, s, output))
+    return cv2.cvtColor(output, cv2.COLOR_HSV2RGB)
+
+
+def images():
+    rng = np.random.default_rng(1)
+    yield rng.integers(0, 256, size=(120, 160, 3), dtype=np.uint8)
+    # dark image, which gets a gamma boost
+    yield rng.integers(0, 60, size=(120, 160, 3), dtype=np.uint8)
+    # bright image
+    yield rng.integers(180, 256, size=(120, 160, 3), dtype=np.uint8)
+    # smooth gradient
+    row = np.linspace(0, 255, 160).astype(np.uint8)
+    yield np.dstack([np.tile(row, (120, 1))] * 3)
+
+
+@pytest.mark.parametrize('image', list(images()))
+def test_fast_stretch_matches_reference(image):
+    expected = reference_stretch(image)
+    np.testing.assert_array_equal(fast_stretch(image), expected)
+    np.testing.assert_array_equal(FastStretch().run(image), expected)
+
+
+def test_fast_stretch_part_buffers():
+    dark, bright = list(images())[1:3]
+    part = FastStretch(interval=2)
+    out = np.empty_like(dark)
+    assert part.run(dark, out=out) is out
+    np.testing.assert_array_equal(out, reference_stretch(dark))
+    # the second frame uses the table of the first
+    lut = part.lut.copy()
+    part.run(bright)
+    np.testing.assert_array_equal(part.lut, lut)
+    np.testing.assert_array_equal(part.run(bright), reference_stretch(bright))
+    assert part.run(None) is None
+    with pytest.raises(ValueError):
+        FastStretch(interval=0)
+
@@ -0,0 +1,267 @@
+import cv2
+import numpy as np
+import pytest
+
+from donkeycar.config import Config
+from donkeycar.parts import cv as cv_parts
+from donkeycar.parts.image_transformations import ImageTransformations, \
+    ImgTransformList, MaskStep, benchmark_chain, compile_transformations, \
+    img_transform_list_from_json, transformed_image_shape
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, size=(120, 160, 3), dtype=np.uint8)
+
+
+CHAINS = [
+    [["CROP", {"left": 10, "top": 40, "right": 5, "bottom": 8}]],
+    [["CROP", {"left": 0, "top": 45, "right": 0, "bottom": 0}],
+     ["TRAPEZE_EDGE", {"upper_left": 50, "upper_right": 50, "lower_left": 0,
+                       "lower_right": 0, "top": 30, "bottom": 0}],
+     ["RGB2HSV"],
+     ["GBLUR", {"kernel_size": 5}],
+     ["RESIZE", {"width": 80, "height": 60}]],
+    [["RGB2GRAY"],
+     ["BLUR", {}],
+     ["CANNY", {}],
+     ["CROP", {"left": 0, "top": 45, "right": 0, "bottom": 0}],
+     ["GRAY2RGB"]],
+    [["TRAPEZE_EDGE", {"upper_left": 40, "upper_right": 40, "lower_left": 0,
+                       "lower_right": 0, "top": 20, "bottom": 10,
+                       "fill": [255, 0, 255]}],
+     ["BGR2RGB"]],
+]
+
+
+@pytest.mark.parametrize('chain', CHAINS)
+def test_fused_chain_is_identical(chain, image):
+    parts = img_transform_list_from_json(chain)
+    fused = compile_transformations(parts)
+    for frame in (image, np.flipud(image).copy(), image):
+        expected = fused.run_parts(frame)
+        actual = fused.run(frame)
+        assert actual.dtype == expected.dtype
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_fused_masks_are_merged(image):
+    parts = img_transform_list_from_json(CHAINS[1])
+    fused = compile_transformations(parts)
+    assert isinstance(fused.steps[0], MaskStep)
+    assert len(fused.steps) == 4
+
+
+def test_fused_output_is_not_reused(image):
+    parts = img_transform_list_from_json(CHAINS[1])
+    fused = compile_transformations(parts)
+    first = fused.run(image)
+    kept = first.copy()
+    second = fused.run(np.zeros_like(image))
+    assert second is not first
+    np.testing.assert_array_equal(first, kept)
+
+
+def test_fused_crop_of_float_image(image):
+    parts = [cv_parts.ImgCropMask(0, 30, 0, 0)]
+    fused = compile_transformations(parts)
+    frame = image.astype(np.float32)
+    frame[0, 0, 0] = np.nan
+    np.testing.assert_array_equal(fused.run(frame), fused.run_parts(frame))
+
+
+def test_fused_keeps_none_and_errors(image):
+    fused = compile_transformations([cv_parts.ImgRGB2HSV(),
+                                     cv_parts.ImgHSV2GRAY()])
+    assert fused.run(None) is None
+    assert fused.run(image) is None
+
+
+def test_image_transformations_fused(image):
+    cfg = Config()
+    cfg.TRANSFORMATIONS = ['CROP', 'RGB2HSV']
+    cfg.POST_TRANSFORMATIONS = ['RESIZE']
+    cfg.ROI_CROP_LEFT = 0
+    cfg.ROI_CROP_TOP = 40
+    cfg.ROI_CROP_RIGHT = 0
+    cfg.ROI_CROP_BOTTOM = 0
+    cfg.RESIZE_WIDTH = 80
+    cfg.RESIZE_HEIGHT = 60
+    fused = ImageTransformations(cfg, 'TRANSFORMATIONS')
+    plain = ImageTransformations(cfg, 'TRANSFORMATIONS', fused=False)
+    np.testing.assert_array_equal(fused.run(image), plain.run(image))
+    transforms = ImgTransformList(plain.transformations)
+    np.testing.assert_array_equal(transforms.run(image), plain.run(image))
+
+
+def test_benchmark_chain(image):
+    parts = img_transform_list_from_json(CHAINS[1])
+    result = benchmark_chain(parts, image, iterations=5, warmup=1)
+    assert result['identical']
+    assert result['sequential_ms'] > 0 and result['fused_ms'] > 0
+
+
+def test_crop_mode_returns_view(image):
+    crop = cv_parts.ImgCropMask(left=10, top=45, right=5, bottom=8, crop=True)
+    cropped = crop.run(image)
+    assert cropped.shape == (120 - 45 - 8, 160 - 10 - 5, 3)
+    assert crop.cropped_shape(120, 160) == cropped.shape[:2]
+    assert np.shares_memory(cropped, image)
+    np.testing.assert_array_equal(cropped, image[45:112, 10:155])
+    with pytest.raises(ValueError):
+        cv_parts.ImgCropMask(top=60, bottom=60, crop=True).run(image)
+
+
+def crop_config(mode):
+    cfg = Config()
+    cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH = 120, 160, 3
+    cfg.TRANSFORMATIONS = ['CROP']
+    cfg.POST_TRANSFORMATIONS = ['BGR2RGB']
+    cfg.ROI_CROP_LEFT, cfg.ROI_CROP_TOP = 0, 45
+    cfg.ROI_CROP_RIGHT, cfg.ROI_CROP_BOTTOM = 0, 0
+    cfg.ROI_CROP_MODE = mode
+    return cfg
+
+
+def test_crop_mode_fused(image):
+    transformation = ImageTransformations(crop_config('crop'),
+                                          'TRANSFORMATIONS',
+                                          'POST_TRANSFORMATIONS')
+    expected = transformation.fused.run_parts(image)
+    assert expected.shape == (75, 160, 3)
+    np.testing.assert_array_equal(transformation.run(image), expected)
+
+
+def test_transformed_image_shape():
+    cfg = crop_config('crop')
+    assert transformed_image_shape(cfg) == (75, 160)
+    # building the transformations must not change the config
+    assert cfg.TRANSFORMATIONS == ['CROP']
+    assert transformed_image_shape(crop_config('mask')) == (120, 160)
+    cfg.TRANSFORMATIONS = []
+    cfg.POST_TRANSFORMATIONS = []
+    assert transformed_image_shape(cfg) == (120, 160)
+    with pytest.raises(ValueError):
+        transformed_image_shape(crop_config('cut'))
+
+
+BATCH_CHAINS = CHAINS + [
+    [["RGB2GRAY"], ["GBLUR", {"kernel_size": 3}],
+     ["RESIZE", {"width": 40, "height": 30}], ["GRAY2BGR"]],
+    [["CROP", {"left": 0, "top": 45, "right": 0, "bottom": 0, "crop": True}],
+     ["SCALE", {"scale": 0.5}], ["RGB2HSV"]],
+]
+
+
+@pytest.mark.parametrize('n', [6, 7])
+@pytest.mark.parametrize('chain', BATCH_CHAINS)
+def test_run_batch_is_identical(chain, n):
+    rng = np.random.default_rng(3)
+    images = rng.integers(0, 256, size=(n, 120, 160, 3), dtype=np.uint8)
+    parts = img_transform_list_from_json(chain)
+    fused = compile_transformations(parts)
+    expected = np.stack([fused.run_parts(image) for image in images])
+    actual = fused.run_batch(images)
+    assert actual.dtype == expected.dtype
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_run_batch_in_chunks():
+    rng = np.random.default_rng(4)
+    images = rng.integers(0, 256, size=(200, 24, 32, 3), dtype=np.uint8)
+    transforms = ImgTransformList(img_transform_list_from_json(
+        [["RESIZE", {"width": 16, "height": 12}]]))
+    expected = np.stack([transforms.run(image) for image in images])
+    np.testing.assert_array_equal(transforms.run_batch(images), expected)
+    np.testing.assert_array_equal(
+        transforms.fused.run_batch(images, chunk_size=7), expected)
+    plain = ImgTransformList(transforms.transforms, fused=False)
+    np.testing.assert_array_equal(plain.run_batch(images), expected)
+
+
+def test_run_batch_edge_cases(image):
+    fused = compile_transformations([cv_parts.ImgRGB2HSV(),
+                                     cv_parts.ImgHSV2GRAY()])
+    assert fused.run_batch(None) is None
+    assert fused.run_batch(np.stack([image, image])) is None
+    empty = np.zeros((0, 120, 160, 3), dtype=np.uint8)
+    assert fused.run_batch(empty).shape == empty.shape
+    crop = compile_transformations([cv_parts.ImgCropMask(top=20, crop=True)])
+    batch = np.stack([image, image])
+    cropped = crop.run_batch(batch)
+    assert cropped.shape == (2, 100, 160, 3)
+    assert np.shares_memory(cropped, batch)
+
+
+def reference_mask(image, points, fill):
+    """ the masks as the parts computed them before they were shared """
+    mask = np.zeros(image.shape, dtype=np.int32)
+    cv2.fillConvexPoly(mask, np.array(points, dtype=np.int32), fill)
+    return np.multiply(image, np.asarray(mask, dtype='bool'))
+
+
+@pytest.mark.parametrize('fill', [[255, 255, 255], [255, 0, 255], [0, 0, 0]])
+@pytest.mark.parametrize('shape', [(120, 160), (120, 160, 1), (120, 160, 3),
+                                   (120, 160, 4)])
+@pytest.mark.parametrize('dtype', [np.uint8, np.float32])
+def test_masks_match_reference(shape, dtype, fill):
+    rng = np.random.default_rng(5)
+    image = (rng.random(shape) * 255).astype(dtype)
+    parts = [(cv_parts.ImgTrapezoidalMask(40, 120, -5, 170, 30, 110, fill),
+              [[40, 30], [120, 30], [170, 110], [-5, 110]]),
+             (cv_parts.ImgTrapezoidalEdgeMask(50, 50, 0, 0, 60, 0, fill),
+              [[50, 60], [110, 60], [160, 120], [0, 120]]),
+             (cv_parts.ImgCropMask(10, 45, 5, 8, fill),
+              [[10, 45], [155, 45], [155, 112], [10, 112]])]
+    for part, points in parts:
+        expected = reference_mask(image, points, fill)
+        for _ in range(2):
+            actual = part.run(image)
+            assert actual.dtype == expected.dtype
+            np.testing.assert_array_equal(actual, expected)
+
+
+def test_masks_are_shared(image):
+    cv_parts.clear_image_masks()
+    edge = cv_parts.ImgTrapezoidalEdgeMask(50, 50, 0, 0, 60, 0)
+    trapezoid = cv_parts.ImgTrapezoidalMask(50, 110, 0, 160, 60, 120)
+    mask = edge.image_mask(image.shape)
+    assert trapezoid.image_mask(image.shape) is mask
+    assert mask.mask.dtype == np.uint8 and not mask.mask.flags.writeable
+    assert mask.rows == slice(60, 120) and mask.rect is None
+    crop = cv_parts.ImgCropMask(10, 45, 5, 8).image_mask(image.shape)
+    assert crop.rect == (slice(45, 113), slice(10, 156))
+    batch = np.stack([image, image[::-1].copy()])
+    for m in (mask, crop):
+        np.testing.assert_array_equal(m.apply_batch(batch),
+                                      np.stack([m.apply(i) for i in batch]))
+
+
+class PassThrough:
+    """ custom part returning its input """
+    def run(self, image):
+        return image
+
+
+@pytest.mark.parametrize('parts', [
+    [cv_parts.ImgSimpleBlur(3), PassThrough()],
+    [cv_parts.ImgRGB2HSV(), PassThrough(), PassThrough()],
+    [cv_parts.ImgTrapezoidalEdgeMask(50, 50, 0, 0, 60, 0), PassThrough()]])
+def test_successive_outputs_are_independent(parts, image):
+    fused = compile_transformations(parts)
+    first = fused.run(image)
+    kept = first.copy()
+    second = fused.run(np.flipud(image).copy())
+    assert not np.shares_memory(first, second)
+    np.testing.assert_array_equal(first, kept)
+
+
+def test_crop_mode_after_buffered_step(image):
+    # sequence models collect several transformed frames
+    fused = compile_transformations([cv_parts.ImgSimpleBlur(3),
+                                     cv_parts.ImgCropMask(top=10, crop=True)])
+    frames = [image, np.flipud(image).copy(), np.fliplr(image).copy()]
+    results = [fused.run(frame) for frame in frames]
+    for frame, result in zip(frames, results):
+        np.testing.assert_array_equal(result, fused.run_parts(frame))
@@ -0,0 +1,154 @@
+import os
+import tarfile
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from donkeycar.config import Config
+from donkeycar.utilities import jpeg
+from donkeycar.utils import binary_to_arr, load_image, load_image_sized, \
+    load_pil_image
+
+
+@pytest.fixture
+def image():
+    y, x = np.mgrid[0:120, 0:160]
+    rng = np.random.default_rng(0)
+    img = np.stack([x, y * 2, (x + y) % 256], axis=-1) \
+        + rng.integers(0, 8, (120, 160, 3))
+    return img.clip(0, 255).astype(np.uint8)
+
+
+@pytest.fixture(scope='module')
+def tub_images():
+    path = os.path.join(os.path.dirname(__file__), 'tub', 'tub.tar.gz')
+    with tarfile.open(path) as tar:
+        members = [m for m in tar.getmembers() if m.name.endswith('.jpg')]
+        return [tar.extractfile(m).read() for m in members[:20]]
+
+
+def pil_encode(img_arr, quality=75):
+    f = BytesIO()
+    Image.fromarray(img_arr).save(f, format='jpeg', quality=quality)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('name', jpeg.available_backends())
+def test_round_trip(name, image):
+    backend = jpeg.get_backend(name)
+    data = backend.encode(image)
+    assert jpeg.is_jpeg(data)
+    assert jpeg.jpeg_info(data) == (160, 120, 3)
+    decoded = backend.decode(data)
+    assert decoded.shape == image.shape and decoded.dtype == np.uint8
+    assert np.abs(decoded.astype(int) - image).mean() < 3
+    gray = image[:, :, 0]
+    data = backend.encode(gray[:, :, np.newaxis])
+    assert jpeg.jpeg_info(data) == (160, 120, 1)
+    assert backend.decode(data).shape == gray.shape
+
+
+@pytest.mark.parametrize('name', jpeg.available_backends())
+def test_matches_pil(name, image, tub_images):
+    backend = jpeg.get_backend(name)
+    # decoding with the same libjpeg settings gives the same pixels
+    np.testing.assert_array_equal(backend.decode(pil_encode(image)),
+                                  np.asarray(Image.open(
+                                      BytesIO(pil_encode(image)))))
+    for data in tub_images:
+        np.testing.assert_array_equal(backend.decode(data),
+                                      np.asarray(Image.open(BytesIO(data))))
+
+
+@pytest.mark.parametrize('name', jpeg.available_backends())
+@pytest.mark.parametrize('scale', jpeg.DCT_SCALES)
+def test_scaled_decode_into_buffer(name, scale, image):
+    backend = jpeg.get_backend(name)
+    data = backend.encode(image[:117, :157])
+    width, height = jpeg.scaled_size(157, 117, scale)
+    decoded = backend.decode(data, scale)
+    assert decoded.shape == (height, width, 3)
+    out = np.empty_like(decoded)
+    assert backend.decode(data, scale, out=out) is out
+    np.testing.assert_array_equal(out, decoded)
+
+
+def test_dct_scale():
+    assert jpeg.dct_scale(640, 480, 160, 120) == 4
+    assert jpeg.dct_scale(640, 480, 161, 120) == 2
+    assert jpeg.dct_scale(160, 120, 160, 120) == 1
+    assert jpeg.dct_scale(1280, 960, 100, 60) == 8
+    with pytest.raises(ValueError):
+        jpeg.jpeg_info(b'\x89PNG')
+
+
+def test_utils_use_codec(image, tmp_path):
+    data = jpeg.encode(image)
+    np.testing.assert_array_equal(binary_to_arr(data), jpeg.decode(data))
+    assert binary_to_arr(b'') is None
+    assert binary_to_arr(b'\xff\xd8garbage') is None
+    png = BytesIO()
+    Image.fromarray(image).save(png, format='png')
+    np.testing.assert_array_equal(binary_to_arr(png.getvalue()), image)
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(data)
+    img = Image.open(path)
+    expected = np.asarray(img.resize((80, 60)).convert('L'))
+    actual = load_image_sized(str(path), 80, 60, 1)
+    np.testing.assert_array_equal(actual, expected[:, :, np.newaxis])
+
+
+def test_benchmark_backends(image):
+    results = jpeg.benchmark_backends(image, iterations=2)
+    assert [r['backend'] for r in results] == jpeg.available_backends()
+    assert all(r['decode'] > 0 and r['bytes'] > 0 for r in results)
+
+
+@pytest.fixture(scope='module')
+def tub_files(tub_images, tmp_path_factory):
+    path = tmp_path_factory.mktemp('images')
+    files = []
+    for i, data in enumerate(tub_images):
+        files.append(str(path / f'{i}_cam_image_array_.jpg'))
+        with open(files[-1], 'wb') as f:
+            f.write(data)
+    return files
+
+
+def image_config(width, height, depth, dct_scaling):
+    cfg = Config()
+    cfg.IMAGE_W, cfg.IMAGE_H, cfg.IMAGE_DEPTH = width, height, depth
+    cfg.IMAGE_DCT_SCALING = dct_scaling
+    return cfg
+
+
+@pytest.mark.parametrize('size', [(160, 120), (80, 60), (40, 30), (64, 48)])
+@pytest.mark.parametrize('depth', [1, 3])
+def test_dct_scaled_loading_parity(tub_files, size, depth):
+    # the tub images are 160x120
+    scaled_cfg = image_config(*size, depth, True)
+    full_cfg = image_config(*size, depth, False)
+    for path in tub_files:
+        scaled = load_image(path, scaled_cfg)
+        full = load_image(path, full_cfg)
+        assert scaled.shape == full.shape == (size[1], size[0], depth)
+        diff = np.abs(scaled.astype(int) - full).mean()
+        if size == (160, 120):
+            assert diff == 0
+        else:
+            assert diff < 3
+        pil = np.asarray(load_pil_image(path, scaled_cfg))
+        np.testing.assert_array_equal(pil.reshape(scaled.shape), scaled)
+
+
+def test_dct_scaled_loading_of_large_image(image, tmp_path):
+    path = tmp_path / 'large.jpg'
+    large = np.asarray(Image.fromarray(image).resize((640, 480)))
+    path.write_bytes(jpeg.encode(large))
+    # 1/4 scale decodes straight to the target size
+    scaled = load_image_sized(str(path), 160, 120, 3, dct_scaling=True)
+    np.testing.assert_array_equal(scaled, jpeg.decode_file(str(path), 4))
+    full = load_image_sized(str(path), 160, 120, 3)
+    assert np.abs(scaled.astype(int) - full).mean() < 3
@@ -83,3 +83,25 @@ def test_keras_vs_tflite_and_tensorrt(keras_pilot, tmp_dir):
 
 
 
+
+
+@pytest.mark.parametrize('keras_pilot', [KerasLSTM, Keras3D_CNN])
+def test_sequence_caching(keras_pilot):
+    """ Cached sequence inference matches inference on the full sequence """
+    interpreter = KerasInterpreter()
+    pilot = keras_pilot(interpreter=interpreter)
+    if keras_pilot is KerasLSTM:
+        pilot.run(get_test_img(pilot))
+        assert pilot.encoder is not None
+        pilot.feature_seq.clear()
+    pilot.img_seq.clear()
+    frames = [np.random.randint(0, 255, size=(120, 160, 3), dtype=np.uint8)
+              for _ in range(5)]
+    full_seq = [frames[0]] * pilot.seq_length
+    for frame in frames:
+        out = pilot.run(frame)
+        full_seq = full_seq[1:] + [frame]
+        img_in = normalize_image(np.array(full_seq))
+        expected = interpreter.model(img_in[np.newaxis], training=False)
+        assert out == approx(expected.numpy()[0], rel=TOLERANCE,
+                             abs=TOLERANCE)
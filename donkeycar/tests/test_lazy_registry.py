@@ -0,0 +1,37 @@
+import sys
+
+import pytest
+
+from donkeycar.utilities.lazy_registry import LazyRegistry, startup_timings
+
+
+def test_registry_imports_on_demand():
+    registry = LazyRegistry('test')
+    registry.register('buffer',
+                      'donkeycar.utilities.circular_buffer:CircularBuffer')
+    sys.modules.pop('donkeycar.utilities.circular_buffer', None)
+    assert 'buffer' in registry
+    assert 'donkeycar.utilities.circular_buffer' not in sys.modules
+    buffer = registry.create('buffer', 3)
+    assert 'donkeycar.utilities.circular_buffer' in sys.modules
+    assert buffer.capacity == 3
+    timings = registry.timings()
+    assert len(timings) == 1
+    name, key, import_s, construct_s = timings[0]
+    assert (name, key) == ('test', 'buffer')
+    assert import_s >= 0 and construct_s >= 0
+    assert timings[0] in startup_timings()
+
+
+def test_registry_module_target():
+    registry = LazyRegistry('test')
+    registry.register('utils', 'donkeycar.utils')
+    module = registry.resolve('utils')
+    assert module.clamp(5, 0, 1) == 1
+
+
+def test_registry_unknown_key():
+    registry = LazyRegistry('test')
+    registry.register('known', 'donkeycar.utils')
+    with pytest.raises(ValueError):
+        registry.resolve('unknown')
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from simple_pid import PID
+
+from donkeycar.config import Config
+from donkeycar.parts.line_follower import LineFollower
+
+YELLOW = (255, 220, 0)
+
+
+def follower(**kwargs):
+    cfg = Config()
+    cfg.OVERLAY_IMAGE = True
+    cfg.SCAN_Y = 60
+    cfg.SCAN_HEIGHT = 20
+    cfg.SCAN_ROWS = 5
+    cfg.LINE_WIDTH = 20
+    cfg.COLOR_THRESHOLD_LOW = (0, 50, 50)
+    cfg.COLOR_THRESHOLD_HIGH = (50, 255, 255)
+    cfg.TARGET_PIXEL = None
+    cfg.TARGET_THRESHOLD = 10
+    cfg.CONFIDENCE_THRESHOLD = 0.0015
+    cfg.THROTTLE_INITIAL = 0.15
+    cfg.THROTTLE_STEP = 0.05
+    cfg.THROTTLE_MAX = 0.3
+    cfg.THROTTLE_MIN = 0.15
+    for key, value in kwargs.items():
+        setattr(cfg, key, value)
+    return LineFollower(PID(Kp=-0.01, Ki=0.0, Kd=-0.0001), cfg)
+
+
+def image_with_line(columns):
+    """ gray image with a yellow line starting at the given column per row """
+    img = np.full((120, 160, 3), 100, dtype=np.uint8)
+    for row, col in enumerate(columns):
+        img[row, col:col + 6] = YELLOW
+    return img
+
+
+def test_subpixel_position():
+    lf = follower()
+    img = image_with_line([40] * 120)
+    # a distractor pixel outside of the line window
+    img[70, 120] = YELLOW
+    position, confidence, mask = lf.get_i_color(img)
+    assert position == pytest.approx(42.5)
+    assert confidence == pytest.approx(6 / 160)
+    assert mask.shape == (5, 160)
+    assert list(lf.rows) == [60, 65, 70, 74, 79]
+    np.testing.assert_allclose(lf.centroids, 42.5)
+
+
+def test_rows_follow_a_slanted_line():
+    lf = follower()
+    img = image_with_line(list(range(120)))
+    lf.get_i_color(img)
+    np.testing.assert_allclose(lf.centroids, lf.rows + 2.5)
+    np.testing.assert_allclose(lf.confidences, 6 / 160)
+
+
+def test_no_line():
+    lf = follower()
+    img = image_with_line([])
+    position, confidence, _ = lf.get_i_color(img)
+    assert position is None and confidence == 0
+    assert np.isnan(lf.centroids).all()
+    steering, throttle, out = lf.run(img)
+    assert lf.target_pixel is None
+    assert (steering, throttle) == (0.0, 0.15)
+    # also without a confidence threshold
+    lf = follower(CONFIDENCE_THRESHOLD=0)
+    assert lf.run(np.zeros((240, 320, 3), dtype=np.uint8))[:2] == (0.0, 0.15)
+    assert lf.target_pixel is None
+
+
+def test_overlay_only_with_viewer():
+    lf = follower()
+    img = image_with_line([40] * 120)
+    viewers = [0]
+    lf.has_viewer = lambda: viewers[0] > 0
+    _, _, out = lf.run(img)
+    assert out is img
+    assert lf.target_pixel == pytest.approx(42.5)
+    viewers[0] = 1
+    _, _, out = lf.run(img)
+    assert out is not img
+    # the sampled rows show the mask
+    assert (out[lf.rows, :30] == 0).all()
+    assert (out[lf.rows, 130:] == 0).all()
+    np.testing.assert_array_equal(out[90:], img[90:])
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 import pytest
-from donkeycar.memory import Memory
+from donkeycar.memory import Memory, Trace
 
 class TestMemory(unittest.TestCase):
 
@@ -66,3 +66,23 @@ class TestMemory(unittest.TestCase):
         mem.put(['myitem'], 888)
         
         assert dict(mem.items()) == {'myitem': 888}
+
+
+def test_trace_marks_stages_once():
+    trace = Trace('capture', 1.0)
+    assert trace.mark('inference', 1.5)
+    assert not trace.mark('inference', 2.0)
+    assert trace.stages == ['capture', 'inference']
+    assert trace.origin == 1.0
+    assert trace.latency('capture', 'inference') == 0.5
+
+
+def test_traces_of_channels():
+    mem = Memory()
+    old, new = Trace('capture', 1.0), Trace('capture', 2.0)
+    mem.set_trace(['a', 'b'], old)
+    mem.set_trace(['c'], new)
+    assert mem.get_trace(['a', 'b']) is old
+    assert mem.get_trace(['a', 'c', 'd']) is new
+    mem.set_trace(['c'], None)
+    assert mem.get_trace(['c', 'd']) is None
@@ -0,0 +1,103 @@
+import pickle
+import socket
+import time
+import zlib
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from donkeycar.parts.network import ZMQValuePub, ZMQValueSub, \
+    TCPServeValue, TCPClientValue, UDPValuePub, UDPValueSub, \
+    split_datagrams, MAX_DATAGRAM_PAYLOAD
+from donkeycar.utilities.serialization import BinaryCodec
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def test_zmq_pub_sub():
+    port = free_port()
+    pub = ZMQValuePub('scan', port=port)
+    sub = ZMQValueSub('scan', ip='localhost', port=port, return_last=False)
+    scan = np.random.rand(360, 2).astype(np.float32)
+    res = None
+    for _ in range(100):
+        pub.run((scan, 3))
+        time.sleep(0.01)
+        res = sub.run()
+        if res is not None:
+            break
+    assert res is not None
+    np.testing.assert_array_equal(res[0], scan)
+    assert res[1] == 3
+
+
+@pytest.mark.parametrize('codec', ['binary', 'pickle'])
+def test_tcp_serve_client(codec):
+    port = free_port()
+    server = TCPServeValue('camera', port=port, codec=codec)
+    client = TCPClientValue('camera', 'localhost', port=port, codec=codec)
+    img = np.random.randint(0, 255, (120, 160, 3), dtype=np.uint8)
+    res = None
+    for _ in range(100):
+        server.run(img)
+        res = client.run()
+        if res is not None:
+            break
+    assert res is not None
+    np.testing.assert_array_equal(res, img)
+    client.shutdown()
+    server.shutdown()
+
+
+def test_udp_chunked_message():
+    port = free_port()
+    sub = UDPValueSub('camera', port=port)
+    img = np.random.randint(0, 255, (240, 320, 3), dtype=np.uint8)
+    data = BinaryCodec().encode_bytes('camera', img)
+    datagrams = split_datagrams(data, 7)
+    assert len(datagrams) == -(-len(data) // MAX_DATAGRAM_PAYLOAD) > 1
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        # out of order is fine
+        for d in reversed(datagrams):
+            s.sendto(d, ('127.0.0.1', port))
+            sub.poll()
+    np.testing.assert_array_equal(sub.last, img)
+    sub.shutdown()
+
+
+def test_pickle_is_the_former_wire_format():
+    port = free_port()
+    sub = UDPValueSub('steering', port=port, codec='pickle')
+    # a datagram as sent by older cars
+    data = zlib.compress(pickle.dumps({'name': 'steering', 'val': 0.5}))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.sendto(data, ('127.0.0.1', port))
+    sub.poll()
+    assert sub.last == 0.5
+    sub.shutdown()
+    pub = UDPValuePub('steering', port=port, codec='pickle')
+    pub.sock.close()
+    pub.sock = mock.Mock()
+    pub.run(0.25)
+    pub.sock.sendto.assert_called_once()
+    data = pub.sock.sendto.call_args[0][0]
+    assert pickle.loads(zlib.decompress(data)) \
+        == {'name': 'steering', 'val': 0.25}
+
+
+def test_zmq_bad_message():
+    port = free_port()
+    pub = ZMQValuePub('scan', port=port)
+    sub = ZMQValueSub('scan', ip='localhost', port=port)
+    sub.last = 1
+    res = None
+    for _ in range(100):
+        pub.socket.send(b'garbage')
+        time.sleep(0.01)
+        res = sub.run()
+    assert res == 1
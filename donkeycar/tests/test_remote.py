@@ -0,0 +1,107 @@
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from donkeycar.parts.remote import PartServer, RemotePart
+
+
+class SlowPilot:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def run(self, img_arr, speed):
+        if self.delay:
+            time.sleep(self.delay)
+        return float(img_arr.mean()), speed * 2
+
+
+class FallbackPilot:
+    def run(self, img_arr, speed):
+        return 0.0, 0.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(part):
+        server = PartServer(part, port=free_port())
+        thread = threading.Thread(target=server.serve, daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        return server
+
+    yield start
+    for server, thread in servers:
+        server.shutdown()
+        thread.join()
+
+
+def test_blocking_round_trip(server):
+    s = server(SlowPilot())
+    part = RemotePart('localhost', s.port, deadline=1.0, pipelined=False,
+                      num_outputs=2)
+    img = np.full((120, 160, 3), 3, dtype=np.uint8)
+    assert part.run(img, 0.5) == (3.0, 1.0)
+    assert part.run(img, 0.25) == (3.0, 0.5)
+    stats = part.stats.to_dict()
+    assert stats['requests'] == stats['responses'] == 2
+    assert stats['fallbacks'] == 0
+    part.shutdown()
+
+
+def test_pipelined_uses_fallback_then_remote(server):
+    s = server(SlowPilot(delay=0.02))
+    part = RemotePart('localhost', s.port, deadline=0.1,
+                      fallback=FallbackPilot())
+    img = np.ones((120, 160, 3), dtype=np.uint8)
+    # no answer yet, the local fallback pilot is used
+    assert part.run(img, 1.0) == (0.0, 0.0)
+    out = None
+    for _ in range(50):
+        time.sleep(0.01)
+        out = part.run(img, 1.0)
+        if out != (0.0, 0.0):
+            break
+    assert out == (1.0, 2.0)
+    assert part.stats.fallbacks >= 1
+    part.shutdown()
+
+
+def test_server_down_returns_fallback():
+    part = RemotePart('localhost', free_port(), deadline=0.01,
+                      pipelined=False, num_outputs=2, timeout=0.05,
+                      max_in_flight=1)
+    img = np.ones((120, 160, 3), dtype=np.uint8)
+    assert part.run(img, 1.0) == (None, None)
+    time.sleep(0.1)
+    assert part.run(img, 1.0) == (None, None)
+    assert part.stats.lost == 1
+    part.shutdown()
+
+
+def test_server_skips_stale_requests():
+    s = PartServer(SlowPilot(), port=free_port())
+    part = RemotePart('localhost', s.port, deadline=1.0, max_in_flight=5)
+    img = np.ones((120, 160, 3), dtype=np.uint8)
+    for speed in range(3):
+        part.run(img, float(speed))
+    time.sleep(0.1)
+    s.serve_once(timeout_ms=100)
+    time.sleep(0.1)
+    # only the newest request was run, the others were skipped
+    assert part.run(img, 0.0) == (1.0, 4.0)
+    assert s.served == 1
+    assert part.stats.server_status['skipped'] == 2
+    s.shutdown()
+    s.socket.close()
+    part.shutdown()
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from pytest import approx
+
+from donkeycar.parts.keras import KerasCategorical, KerasLinear
+from donkeycar.parts.salient import ModelIntrospector, SalientVis
+
+
+def eager_saliency(model, img):
+    """ Saliency of a single image computed with the model as is """
+    images = tf.Variable(img[np.newaxis], dtype=tf.float32)
+    with tf.GradientTape(persistent=True) as tape:
+        outputs = model(images, training=False)
+        targets = [tf.reduce_max(o[0]) for o in outputs]
+    grads = sum(tf.square(tape.gradient(t, images)) for t in targets)
+    grads = np.sum(np.sqrt(grads), axis=-1)[0]
+    return (grads - grads.min()) / (grads.max() - grads.min() + 1e-7)
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(0)
+    return rng.random((5, 120, 160, 3), dtype=np.float32)
+
+
+def test_saliency_batch_matches_eager(images):
+    pilot = KerasLinear()
+    introspector = ModelIntrospector(pilot.interpreter.model, batch_size=2)
+    masks = introspector.saliency(images)
+    assert masks.shape == (5, 120, 160)
+    for img, mask in zip(images, masks):
+        expected = eager_saliency(pilot.interpreter.model, img)
+        assert mask == approx(expected, abs=1e-4)
+
+
+def test_saliency_categorical_uses_linear_outputs(images):
+    pilot = KerasCategorical()
+    model = pilot.interpreter.model
+    introspector = ModelIntrospector(model)
+    masks = introspector.saliency(images[:2])
+    assert masks.shape == (2, 120, 160)
+    assert masks.min() >= 0.0 and masks.max() == approx(1.0, abs=1e-4)
+    # the original model keeps its softmax outputs
+    assert model.get_layer('angle_out').activation \
+        is tf.keras.activations.softmax
+
+
+def test_cache_and_sharing(images):
+    pilot = KerasLinear()
+    model = pilot.interpreter.model
+    introspector = ModelIntrospector.for_model(model)
+    assert ModelIntrospector.for_model(model) is introspector
+    ids = list(range(5))
+    first = introspector.saliency(images, ids)
+    assert introspector.cache_info()['misses'] == 5
+    second = introspector.submit_saliency(images, ids).result()
+    assert introspector.cache_info()['hits'] == 5
+    np.testing.assert_array_equal(first, second)
+
+
+def test_activations(images):
+    pilot = KerasLinear()
+    introspector = ModelIntrospector(pilot.interpreter.model)
+    activations = introspector.activations(images[:3], ids=['a', 'b', 'c'])
+    assert len(activations) == len(introspector.conv_layers) == 5
+    assert all(a.shape[0] == 3 for a in activations)
+    assert activations[0].shape[-1] == 24
+
+
+def test_salient_vis():
+    vis = SalientVis(KerasLinear())
+    img = np.random.randint(0, 255, size=(120, 160, 3), dtype=np.uint8)
+    out = vis.run(img)
+    assert out.shape == img.shape and out.dtype == np.uint8
+    assert vis.run(None) is None
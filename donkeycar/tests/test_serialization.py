@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from donkeycar.utilities.serialization import BinaryCodec, PickleCodec, \
+    benchmark_codecs, get_codec, pack_frames, unpack_frames
+
+
+@pytest.fixture
+def value():
+    return {'angle': 0.25, 'throttle': -1, 'mode': 'user', 'rec': True,
+            'none': None, 'jpg': b'\xff\xd8\x00',
+            'scan': np.arange(12, dtype=np.float32).reshape(6, 2),
+            'nested': [1, (2.5, 'x'), {'a': np.uint16(7)}]}
+
+
+@pytest.mark.parametrize('codec', ['binary', 'binary_zlib', 'pickle'])
+def test_round_trip(codec, value):
+    codec = get_codec(codec)
+    name, out = codec.decode_bytes(codec.encode_bytes('car', value))
+    assert name == 'car'
+    np.testing.assert_array_equal(out.pop('scan'), value.pop('scan'))
+    assert out['nested'][2]['a'] == 7
+    assert out == value
+
+
+def test_arrays_are_not_copied():
+    codec = BinaryCodec()
+    img = np.zeros((120, 160, 3), dtype=np.uint8)
+    frames = codec.encode('cam', img)
+    assert len(frames) == 2
+    assert np.shares_memory(frames[1], img)
+    _, out = codec.decode(frames)
+    assert np.shares_memory(out, img)
+    assert out.shape == img.shape and out.dtype == img.dtype
+    # same when sent as one buffer
+    data = pack_frames(frames)
+    _, out = codec.decode(unpack_frames(data))
+    assert out.base is not None and not out.flags.writeable
+
+
+def test_compression_is_smaller():
+    scan = np.zeros(1000, dtype=np.float64)
+    plain = BinaryCodec().encode_bytes('lidar', scan)
+    compressed = BinaryCodec(compress=True).encode_bytes('lidar', scan)
+    assert len(compressed) < len(plain) / 10
+
+
+def test_bad_messages():
+    codec = BinaryCodec()
+    frames = codec.encode('x', 1.0)
+    header = bytearray(frames[0])
+    header[2] = 99
+    with pytest.raises(ValueError, match='version'):
+        codec.decode([bytes(header)])
+    with pytest.raises(ValueError):
+        codec.decode([PickleCodec().encode_bytes('x', 1.0)])
+    with pytest.raises(TypeError):
+        codec.encode('x', object())
+    with pytest.raises(ValueError):
+        get_codec('json')
+
+
+def test_benchmark():
+    results = benchmark_codecs(iterations=2)
+    assert {r['codec'] for r in results} == {'pickle', 'binary', 'binary_zlib'}
+    assert all(r['us'] > 0 for r in results)
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import json
+import os
 import time
 from unittest import mock
+
+import numpy as np
+import pytest
 from paho.mqtt.client import Client
 from paho.mqtt.enums import CallbackAPIVersion
 
 import donkeycar.templates.cfg_complete as cfg
-from donkeycar.parts.telemetry import MqttTelemetry
+from donkeycar.config import Config
+from donkeycar.parts.telemetry import LocalBroker, MqttTelemetry, \
+    decode_batch
 from random import randint
 
 
@@ -45,3 +52,85 @@ def test_mqtt_telemetry():
     res = str.encode('[{"ts": %s, "values": {"my/speed": 16, "my/voltage": 11.1, "pilot/angle": 33.3, '
                      '"pilot/throttle": 22.2}}]' % timestamp)
     assert on_message_mock.call_args_list[0][0][2].payload == res
+
+
+@pytest.fixture
+def local_cfg(tmp_path):
+    local = Config()
+    local.from_object(cfg)
+    local.TELEMETRY_DEFAULT_INPUTS = 'pilot/angle,pilot/throttle'
+    local.TELEMETRY_MQTT_JSON_ENABLE = False
+    local.TELEMETRY_LOGGING_ENABLE = False
+    local.TELEMETRY_SPOOL_PATH = str(tmp_path / 'telemetry.spool')
+    return local
+
+
+def test_binary_batches(local_cfg):
+    local_cfg.TELEMETRY_BATCH_SIZE = 3
+    broker = LocalBroker()
+    t = MqttTelemetry(local_cfg, broker=broker)
+    for i in range(5):
+        t.run_threaded(0.1 * i, 0.5)
+    t.report({'my/mode': 'user'})
+    t.publish()
+    assert t.qsize == 0
+    assert len(broker.messages) == 2
+    topic, payload = broker.messages[0]
+    assert topic == 'donkey/%s/telemetry' % local_cfg.TELEMETRY_DONKEY_NAME
+    ts, values = decode_batch(payload)
+    assert len(ts) == 3
+    np.testing.assert_allclose(values['pilot/angle'], [0.0, 0.1, 0.2])
+    ts, values = decode_batch(broker.messages[1][1])
+    assert np.isnan(values['pilot/angle'][2])
+    assert values['my/mode'] == [None, None, 'user']
+    assert t.counters['published'] == 6 and t.counters['batches'] == 2
+
+
+def test_bounded_buffer_and_rate_limit(local_cfg):
+    local_cfg.TELEMETRY_BUFFER_SIZE = 4
+    local_cfg.TELEMETRY_RATE_LIMITS = {'my/voltage': 1}
+    t = MqttTelemetry(local_cfg, broker=LocalBroker())
+    for i in range(6):
+        t.run_threaded(0.1 * i, 0.5)
+    assert t.qsize == 4
+    assert t.counters['dropped'] == 2
+    t.report({'my/voltage': 12.0})
+    t.report({'my/voltage': 11.9})
+    assert t.counters['rate_limited'] == 1
+    assert t.qsize == 4
+
+
+def test_spool_and_replay(local_cfg):
+    local_cfg.TELEMETRY_MQTT_JSON_ENABLE = True
+    broker = LocalBroker()
+    broker.connected = False
+    t = MqttTelemetry(local_cfg, broker=broker)
+    t.report({'my/speed': 1})
+    t.publish()
+    t.report({'my/speed': 2})
+    t.publish()
+    assert t.counters['spooled'] == 2
+    assert os.path.exists(local_cfg.TELEMETRY_SPOOL_PATH)
+    broker.connected = True
+    t.report({'my/speed': 3})
+    t.publish()
+    speeds = [json.loads(p)[0]['values']['my/speed']
+              for _, p in broker.messages]
+    assert speeds == [1, 2, 3]
+    assert t.counters['replayed'] == 2
+    assert not os.path.exists(local_cfg.TELEMETRY_SPOOL_PATH)
+
+
+def test_config_without_new_keys(local_cfg, tmp_path):
+    # configs of cars created before these settings were added
+    for key in ('TELEMETRY_BUFFER_SIZE', 'TELEMETRY_BATCH_SIZE',
+                'TELEMETRY_RATE_LIMITS', 'TELEMETRY_SPOOL_PATH',
+                'TELEMETRY_SPOOL_MAX_BYTES'):
+        delattr(local_cfg, key)
+    local_cfg.CAR_PATH = str(tmp_path)
+    broker = LocalBroker()
+    t = MqttTelemetry(local_cfg, broker=broker)
+    t.run_threaded(0.1, 0.5)
+    t.publish()
+    assert t.counters['published'] == 1 and len(broker.messages) == 1
+    assert t._spool_path == str(tmp_path / 'telemetry.spool')
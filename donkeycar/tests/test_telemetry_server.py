@@ -0,0 +1,116 @@
+import json
+import time
+
+import numpy as np
+import pytest
+from tornado import testing
+
+from donkeycar.management.telemetry_server import TelemetryAggregator, \
+    downsample, make_app
+from donkeycar.parts.telemetry import encode_batch
+
+
+def batch(t0, n, dt=0.02, angle=0.5):
+    return encode_batch([(t0 + i * dt, {'pilot/angle': angle,
+                                        'user/mode': 'user'})
+                         for i in range(n)])
+
+
+@pytest.fixture
+def aggregator(tmp_path):
+    return TelemetryAggregator(str(tmp_path), 'donkey/%s/telemetry',
+                               interval=0.1, session_gap=60.0)
+
+
+def test_downsample():
+    ts = np.array([0.0, 0.05, 0.1, 0.12, 0.31])
+    columns = {'x': np.array([1.0, 3.0, np.nan, 4.0, 5.0]),
+               's': ['a', None, 'b', None, 'c']}
+    out_ts, out = downsample(ts, columns, 0.1)
+    np.testing.assert_allclose(out_ts, [0.0, 0.1, 0.3])
+    np.testing.assert_allclose(out['x'], [2.0, 4.0, 5.0])
+    assert out['s'] == ['a', 'b', 'c']
+
+
+def test_topics(aggregator):
+    assert aggregator.subscription() == 'donkey/+/telemetry'
+    assert aggregator.car_from_topic('donkey/car1/telemetry') == 'car1'
+    assert aggregator.car_from_topic('donkey/car1/telemetry/x') is None
+    assert aggregator.ingest('other/topic', batch(0, 2)) == 0
+    assert aggregator.rejected == 1
+
+
+def test_ingest_store_and_query(aggregator):
+    t0 = 1000.0
+    assert aggregator.ingest('donkey/car1/telemetry', batch(t0, 50)) == 50
+    aggregator.ingest('donkey/car2/telemetry', batch(t0, 10, angle=-0.5))
+    # legacy json batches are accepted too
+    aggregator.ingest('donkey/car2/telemetry', json.dumps(
+        [{'ts': int(t0) + 1, 'values': {'pilot/angle': 0.25}}]).encode())
+    # a gap longer than session_gap starts a new session
+    aggregator.ingest('donkey/car1/telemetry', batch(t0 + 100, 5))
+    assert aggregator.flush() > 0
+    assert aggregator.flush() == 0
+
+    summary = {s['car']: s for s in aggregator.summary()}
+    assert summary['car1']['samples'] == 55
+    assert summary['car1']['loop_hz'] == pytest.approx(50)
+    assert summary['car2']['values']['pilot/angle'] == 0.25
+
+    sessions = aggregator.sessions('car1')
+    assert len(sessions) == 2
+    ts, values = aggregator.query('car1', sessions[0])
+    # 50 samples at 50Hz downsampled to 10Hz
+    assert len(ts) == 10
+    np.testing.assert_allclose(values['pilot/angle'], 0.5)
+    assert values['user/mode'][0] == 'user'
+    ts, values = aggregator.query('car2', keys=['pilot/angle'],
+                                  start=t0 + 0.5)
+    assert list(values) == ['pilot/angle']
+    np.testing.assert_allclose(values['pilot/angle'], [0.25])
+    with pytest.raises(KeyError):
+        aggregator.query('car3')
+
+
+@pytest.mark.parametrize('car, session', [('..', None), ('car1', '../car1'),
+                                          ('a/b', None), ('car1', '..')])
+def test_query_outside_storage(aggregator, car, session):
+    aggregator.ingest('donkey/car1/telemetry', batch(1000.0, 5))
+    aggregator.flush()
+    with pytest.raises(KeyError):
+        aggregator.query(car, session)
+    with pytest.raises(KeyError):
+        aggregator.sessions(car if car != 'car1' else session)
+    assert aggregator.ingest('donkey/../telemetry', batch(1000.0, 5)) == 0
+
+
+class TelemetryApiTest(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.aggregator = TelemetryAggregator(self.tmp.name)
+        now = time.time()
+        self.aggregator.ingest('donkey/car1/telemetry', batch(now, 20))
+        self.aggregator.flush()
+        return make_app(self.aggregator)
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp.cleanup()
+
+    def test_api(self):
+        cars = json.loads(self.fetch('/api/cars').body)
+        assert [c['car'] for c in cars] == ['car1']
+        sessions = json.loads(self.fetch('/api/cars/car1/sessions').body)
+        assert len(sessions) == 1
+        data = json.loads(self.fetch(
+            '/api/cars/car1/query?keys=pilot/angle').body)
+        assert list(data['values']) == ['pilot/angle']
+        assert len(data['ts']) == len(data['values']['pilot/angle']) > 0
+        assert self.fetch('/api/cars/nocar/query').code == 404
+        assert self.fetch('/api/cars/../sessions').code == 404
+        assert self.fetch('/api/cars/%2E%2E/sessions').code == 404
+        assert self.fetch('/api/cars/car1/query?session=..%2Fcar1').code \
+            == 404
+        assert b'Fleet Telemetry' in self.fetch('/').body
@@ -232,3 +232,19 @@ def test_training_pipeline(config: Config, model_type: str,
             for k, v in batch.items():
                 assert np.isclose(v, np_dict[k]).all()
 
+
+
+def test_training_pipeline_crop_mode(config: Config) -> None:
+    """ With ROI_CROP_MODE = 'crop' model and batches use the cropped size """
+    cfg = copy(config)
+    add_transformation_to_config(cfg)
+    cfg.ROI_CROP_MODE = 'crop'
+    kl = get_model_by_type('linear', cfg)
+    assert tuple(kl.get_input_shape('img_in')[1:]) == (75, 160, 3)
+    dataset = TubDataset(cfg, [cfg.DATA_PATH], seq_size=kl.seq_size())
+    records = dataset.get_records()[:cfg.BATCH_SIZE]
+    full = copy(records[0]).image()
+    seq = BatchSequence(kl, cfg, records, False)
+    x, _ = next(seq.create_tf_data().as_numpy_iterator())
+    assert x['img_in'].shape == (cfg.BATCH_SIZE, 75, 160, 3)
+    assert np.isclose(x['img_in'][0], normalize_image(full[45:])).all()
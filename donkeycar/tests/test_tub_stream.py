@@ -0,0 +1,104 @@
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from donkeycar.parts.tub_stream import TubStreamReceiver
+from donkeycar.parts.tub_v2 import Tub, TubWriter
+
+INPUTS = ['cam/image_array', 'user/angle', 'user/throttle']
+TYPES = ['image_array', 'float', 'float']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_receiver(path, port):
+    receiver = TubStreamReceiver(str(path), port)
+    thread = threading.Thread(target=receiver.serve, daemon=True)
+    thread.start()
+    return receiver, thread
+
+
+def stop_receiver(receiver, thread):
+    receiver.shutdown()
+    thread.join()
+
+
+def write_records(writer, start, count):
+    rng = np.random.default_rng(start)
+    for i in range(start, start + count):
+        img = rng.integers(0, 255, (60, 80, 3), dtype=np.uint8)
+        writer.run(img, i / 100, 0.5)
+
+
+def wait_for(condition, timeout=10.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.02)
+    return condition()
+
+
+def test_stream_resume_and_valid_tub(tmp_path):
+    port = free_port()
+    car_path = tmp_path / 'car' / 'tub_1'
+    base_path = tmp_path / 'base'
+    receiver, thread = start_receiver(base_path, port)
+    writer = TubWriter(str(car_path), INPUTS, TYPES,
+                       metadata=['location:track'], stream_host='127.0.0.1',
+                       stream_port=port)
+    writer.stream.ack_timeout = 0.5
+    try:
+        write_records(writer, 0, 30)
+        assert wait_for(lambda: writer.stream.acked == 29)
+        # receiver goes away, the car keeps recording
+        stop_receiver(receiver, thread)
+        write_records(writer, 30, 25)
+        writer.tub.delete_records([3, 4])
+        write_records(writer, 55, 1)
+        time.sleep(0.3)
+        assert writer.stream.acked == 29
+        receiver, thread = start_receiver(base_path, port)
+        assert wait_for(lambda: writer.stream.acked == 55)
+        assert writer.stream.resumes >= 1
+    finally:
+        writer.close()
+        stop_receiver(receiver, thread)
+
+    car = Tub(str(car_path), read_only=True)
+    base = Tub(str(base_path / 'tub_1'), read_only=True)
+    assert len(base) == len(car) == 54
+    assert base.manifest.deleted_indexes == {3, 4}
+    assert base.manifest.metadata == {'location': 'track'}
+    for car_record, base_record in zip(car, base):
+        assert car_record == base_record
+        name = base_record['cam/image_array']
+        with open(os.path.join(base.images_base_path, name), 'rb') as f, \
+                open(os.path.join(car.images_base_path, name), 'rb') as g:
+            assert f.read() == g.read()
+    car.close()
+    base.close()
+
+
+def test_receiver_behind_start_stops_stream(tmp_path):
+    port = free_port()
+    car_path = tmp_path / 'car' / 'tub_1'
+    writer = TubWriter(str(car_path), INPUTS, TYPES)
+    write_records(writer, 0, 5)
+    writer.close()
+    receiver, thread = start_receiver(tmp_path / 'base', port)
+    writer = TubWriter(str(car_path), INPUTS, TYPES, stream_host='127.0.0.1',
+                       stream_port=port)
+    try:
+        assert wait_for(lambda: writer.stream.failed)
+        write_records(writer, 5, 2)
+    finally:
+        writer.close()
+        stop_receiver(receiver, thread)
+    assert receiver.received == 0
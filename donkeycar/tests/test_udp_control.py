@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from donkeycar.parts.udp_control import UdpControlReceiver, \
+    UdpControlSelector, UdpControlSender, decode_control, encode_control, \
+    loopback_test, seq_newer
+
+
+@pytest.fixture
+def receiver():
+    receiver = UdpControlReceiver(0, stale_timeout=0.2, address='127.0.0.1')
+    yield receiver
+    receiver.shutdown()
+
+
+def test_encode_decode():
+    data = encode_control(7, 42, 0.25, -0.5, 'local_angle', True,
+                          {'w2': True, 'w3': False}, timestamp=12.5)
+    cmd = decode_control(data)
+    assert (cmd.sender, cmd.seq, cmd.timestamp) == (7, 42, 12.5)
+    assert (cmd.angle, cmd.throttle) == (0.25, -0.5)
+    assert (cmd.mode, cmd.recording, cmd.buttons) \
+        == ('local_angle', True, {'w2': True})
+    cmd = decode_control(encode_control(7, 43, 0.0, 0.0))
+    assert cmd.mode is None and cmd.recording is None
+    with pytest.raises(ValueError):
+        decode_control(data[:-1])
+
+
+def test_seq_newer():
+    assert seq_newer(2, 1)
+    assert not seq_newer(1, 1)
+    assert not seq_newer(1, 2)
+    assert seq_newer(0, 0xffffffff)
+
+
+def test_newest_command_wins(receiver):
+    now = time.time()
+    assert receiver.receive(encode_control(1, 1, 0.1, 0.5, timestamp=now))
+    assert receiver.receive(encode_control(1, 4, 0.4, 0.5, 'local',
+                                           timestamp=now))
+    # late packets of the same sender are rejected
+    assert not receiver.receive(encode_control(1, 3, 0.3, 0.5,
+                                               timestamp=now))
+    assert not receiver.receive(b'garbage')
+    angle, throttle, mode, recording, buttons = \
+        receiver.run_threaded('user', False)
+    assert (angle, throttle) == (pytest.approx(0.4), 0.5)
+    assert (mode, recording) == ('local', False)
+    # mode change is applied once, then the input is passed through
+    assert receiver.run_threaded('user', False)[2] == 'user'
+    stats = receiver.stats.to_dict()
+    assert stats['applied'] == 2 and stats['stale_rejected'] == 1
+    assert stats['lost'] == 2 and stats['invalid'] == 1
+    # a restarted sender starts a new sequence
+    assert receiver.receive(encode_control(2, 1, -0.1, 0.2, timestamp=now))
+
+
+def test_stale_timeout_stops(receiver):
+    receiver.receive(encode_control(1, 1, 0.1, 0.7))
+    assert receiver.run_threaded()[1] == pytest.approx(0.7)
+    time.sleep(0.3)
+    angle, throttle, *_ = receiver.run_threaded()
+    assert (angle, throttle) == (pytest.approx(0.1), 0.0)
+    assert receiver.stats.timeouts == 1
+
+
+def test_selector_falls_back_to_web(receiver):
+    selector = UdpControlSelector(receiver)
+    # no udp commands, web steering and throttle pass through
+    udp = receiver.run_threaded('user', True)
+    assert selector.run(0.2, 0.3, *udp[:4]) == (0.2, 0.3, 'user', True)
+    receiver.receive(encode_control(1, 1, -0.4, 0.6, 'local_angle'))
+    udp = receiver.run_threaded('user', True)
+    assert selector.run(0.2, 0.3, *udp[:4]) \
+        == (pytest.approx(-0.4), pytest.approx(0.6), 'local_angle', True)
+    time.sleep(0.3)
+    # the web controller still holds its old throttle, the car stops
+    udp = receiver.run_threaded('local_angle', False)
+    assert selector.run(0.2, 0.3, *udp[:4]) \
+        == (pytest.approx(-0.4), 0.0, 'local_angle', False)
+    assert selector.run(0.2, 0.3, *udp[:4])[1] == 0.0
+    # new web input takes over again
+    assert selector.run(0.1, 0.25, *udp[:4]) \
+        == (0.1, 0.25, 'local_angle', False)
+
+
+def test_sender_to_receiver(receiver):
+    sender = UdpControlSender('127.0.0.1', receiver.port, repeat=2)
+    thread = threading.Thread(target=receiver.update, daemon=True)
+    thread.start()
+    try:
+        sender.run(0.3, 0.6, 'local_angle', True, {'w1': True})
+        deadline = time.time() + 2.0
+        while receiver.stats.applied == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert receiver.run_threaded('user', False) \
+            == (pytest.approx(0.3), pytest.approx(0.6), 'local_angle', True,
+                {'w1': True})
+    finally:
+        receiver.running = False
+        thread.join()
+        sender.shutdown()
+
+
+def test_loopback_with_loss():
+    stats = loopback_test(commands=100, rate=200, loss=0.2, jitter=0.01)
+    assert stats['invalid'] == 0
+    # lost and reordered commands are never applied
+    assert stats['applied'] + stats['lost'] <= 100
+    assert 0.5 < stats['applied_fraction'] < 0.95
+    assert stats['loss_rate'] > 0.05
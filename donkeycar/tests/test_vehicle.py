@@ -54,4 +54,43 @@ def test_should_raise_assertion_on_non_boolean_threaded_for_add_part():
     threaded = 'non_boolean'
     with pytest.raises(AssertionError):
         vehicle.add(_get_sample_lambda(), threaded=threaded)
-        pytest.fail("threaded is not a boolean: %r" % threaded)
\ No newline at end of file
+        pytest.fail("threaded is not a boolean: %r" % threaded)
+
+def test_latency_tracing():
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: (0, 100.0)), outputs=['image', 'time'],
+          stage='capture', stage_time='time')
+    v.add(Lambda(lambda: 1), outputs=['user'])
+    pilot = Lambda(lambda image: 0.5)
+    v.add(pilot, inputs=['image'], outputs=['pilot'])
+    v.set_stage(pilot, 'inference')
+    v.add(Lambda(lambda user, pilot: pilot), inputs=['user', 'pilot'],
+          outputs=['steering'])
+    v.add(Lambda(lambda steering: None), inputs=['steering'],
+          stage='actuation')
+    v.update_parts()
+    v.update_parts()
+    latencies = v.profiler.latencies
+    assert set(latencies) == {'capture_inference', 'inference_actuation',
+                              'capture_actuation'}
+    assert all(len(arr) == 2 for arr in latencies.values())
+    assert v.mem['latency/capture_actuation'] > \
+        v.mem['latency/inference_actuation']
+    assert v.mem.get_trace(['user']) is None
+    counts, edges = v.profiler.latency_histogram('capture_actuation')
+    assert counts.sum() == 2 and counts[-1] == 2
+    with pytest.raises(ValueError):
+        v.set_stage(_get_sample_lambda(), 'inference')
+
+
+def test_stale_trace_is_not_measured_again():
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: 0), outputs=['image'], stage='capture')
+    v.add(Lambda(lambda image: 0.5), inputs=['image'], outputs=['pilot'],
+          stage='inference', run_condition='run_pilot')
+    v.add(Lambda(lambda pilot: None), inputs=['pilot'], stage='actuation')
+    v.mem['run_pilot'] = True
+    v.update_parts()
+    v.mem['run_pilot'] = False
+    v.update_parts()
+    assert len(v.profiler.latencies['capture_actuation']) == 1
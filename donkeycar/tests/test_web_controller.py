@@ -2,7 +2,16 @@
 import pytest
 import json
 import os
-from donkeycar.parts.web_controller.web import LocalWebController
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tornado.gen
+import tornado.websocket
+from tornado import testing
+
+from donkeycar.parts.web_controller.web import LocalWebController, \
+    RemoteWebServer, StatePublisher
 import donkeycar.templates.cfg_complete as cfg
 from importlib import reload
 
@@ -30,3 +39,146 @@ def test_web_control_user_defined_port():
     
     assert server.port == 12345
 
+
+
+def test_state_publisher_coalesces():
+    publisher = StatePublisher(publish_hz=10, max_samples=3)
+    assert publisher.message() is None
+    publisher.update({'driveMode': 'user', 'recording': True})
+    publisher.update({'driveMode': 'local'})
+    for v in [0.1, 0.2, 0.3, 0.4]:
+        publisher.record('pilot/angle', v)
+    publisher.record('pilot/angle', None)
+    publisher.record('pilot/mode', 'local')
+    message = json.loads(publisher.message())
+    assert message['driveMode'] == 'local'
+    assert message['recording'] is True
+    assert message['channels'] == {'pilot/angle': [0.1, 0.2, 0.3]}
+    assert publisher.dropped == 1
+    assert publisher.message() is None
+
+
+class WebDriveTest(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.app = LocalWebController(port=self.get_http_port(),
+                                      channels=['pilot/angle'])
+        return self.app
+
+    def get_ws_url(self):
+        return "ws://localhost:" + str(self.get_http_port()) + "/wsDrive"
+
+    @tornado.testing.gen_test
+    def test_telemetry_sent_once_per_tick(self):
+        client_1 = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        client_2 = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        # wait until the server has registered both clients
+        while len(self.app.telemetry.clients) < 2:
+            yield tornado.gen.sleep(0.01)
+        self.app.run_threaded(None, 0, 'user', None, None, 0.5)
+        self.app.run_threaded(None, 0, 'local', None, None, -0.5)
+        self.app.telemetry.publish()
+        for client in (client_1, client_2):
+            message = json.loads((yield client.read_message()))
+            assert message['driveMode'] == 'local'
+            assert message['channels'] == {'pilot/angle': [0.5, -0.5]}
+        assert self.app.telemetry.published == 1
+        client_1.close()
+        client_2.close()
+
+    @tornado.testing.gen_test
+    def test_drive_messages_coalesced(self):
+        client = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        for angle in (0.1, 0.2, 0.3):
+            yield client.write_message(json.dumps(
+                {'angle': angle, 'throttle': 0.5, 'buttons': {'w1': True}}))
+        yield client.write_message('not json')
+        yield client.write_message(json.dumps({'drive_mode': 'local_angle'}))
+        while 'drive_mode' not in self.app.pending_input:
+            yield tornado.gen.sleep(0.01)
+        angle, throttle, mode, recording, buttons = self.app.run_threaded()
+        assert (angle, throttle, mode) == (0.3, 0.5, 'local_angle')
+        assert buttons == {'w1': True}
+        # the button push is cleared in the next loop
+        assert self.app.run_threaded()[4] == {'w1': False}
+        client.close()
+
+
+class ControlServer(ThreadingHTTPServer):
+    """ Control server answering a fixed command, optionally slowly """
+    def __init__(self, delay=0.0):
+        server = self
+        self.delay = delay
+        self.peers = set()
+        self.posted = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                server.peers.add(self.client_address)
+                server.posted.append(body)
+                time.sleep(server.delay)
+                reply = json.dumps({'angle': 0.2, 'throttle': 0.4,
+                                    'drive_mode': 'local_angle',
+                                    'recording': True}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+
+def test_remote_web_server_keep_alive():
+    server = ControlServer()
+    remote = RemoteWebServer(server.url, poll_period=0.01,
+                             telemetry_keys=['pilot/angle'])
+    try:
+        assert remote.run_threaded(0.5) == (0., 0., 'user', False)
+        for _ in range(5):
+            assert remote.poll()
+        assert remote.run_threaded() == (0.2, 0.4, 'local_angle', True)
+        # all requests share one connection
+        assert len(server.peers) == 1
+        assert b'"pilot/angle": 0.5' in server.posted[-1]
+    finally:
+        remote.shutdown()
+        server.shutdown()
+
+
+def test_remote_web_server_never_blocks():
+    server = ControlServer(delay=0.5)
+    remote = RemoteWebServer(server.url, connection_timeout=2.0,
+                             stale_timeout=0.2)
+    try:
+        start = time.time()
+        remote.run()
+        assert time.time() - start < 0.1
+        deadline = time.time() + 2.0
+        while remote.time == 0. and time.time() < deadline:
+            time.sleep(0.01)
+        assert remote.run()[1] == 0.4
+        # the next answer takes longer than stale_timeout
+        time.sleep(0.3)
+        assert remote.run()[1] == 0.0
+    finally:
+        remote.shutdown()
+        server.shutdown()
+
+
+def test_remote_web_server_unreachable():
+    remote = RemoteWebServer('http://127.0.0.1:1/', connection_timeout=0.1)
+    assert not remote.poll()
+    assert remote.failures == 1
+    assert remote.run_threaded()[1] == 0.0
+    remote.shutdown()
@@ -0,0 +1,166 @@
+import json
+import struct
+
+import numpy as np
+import tornado.gen
+import tornado.websocket
+from tornado import testing
+from tornado.ioloop import IOLoop
+
+from donkeycar.parts.web_controller.web import WebFpv, AdaptiveStream, \
+    VIDEO_LEVELS, DEFAULT_VIDEO_LEVEL
+
+
+class WebVideoTest(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.app = WebFpv(port=self.get_http_port())
+        return self.app
+
+    def get_ws_url(self):
+        return "ws://localhost:" + str(self.get_http_port()) + "/wsVideo"
+
+    @staticmethod
+    def parse(message):
+        seq = struct.unpack('!I', message[:4])[0]
+        return seq, message[4:]
+
+    async def read_frame(self, client, min_seq=0):
+        """ Read frames until min_seq, skipping the settings messages """
+        while True:
+            message = await client.read_message()
+            if isinstance(message, bytes):
+                seq, jpg = self.parse(message)
+                if seq >= min_seq:
+                    return seq, jpg
+
+    @tornado.testing.gen_test
+    def test_encode_once_for_all_clients(self):
+        client_1 = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        client_2 = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        # no camera frame yet, clients get the placeholder
+        seq, jpg = yield self.read_frame(client_1)
+        assert seq == 0 and jpg[:2] == b'\xff\xd8'
+        seq, _ = yield self.read_frame(client_2)
+        assert seq == 0
+
+        img = np.random.randint(0, 255, size=(120, 160, 3), dtype=np.uint8)
+        self.app.run_threaded(img)
+        # same image again is not encoded again
+        self.app.run_threaded(img)
+        seq_1, jpg_1 = yield self.read_frame(client_1)
+        seq_2, jpg_2 = yield self.read_frame(client_2)
+        assert seq_1 == seq_2 == 1
+        assert jpg_1 == jpg_2
+        assert self.app.video.encoded_frames == 1
+        assert self.app.video.subscribers == 2
+        client_1.close()
+        client_2.close()
+
+    @tornado.testing.gen_test
+    def test_levels_and_stats(self):
+        url = self.get_ws_url() + "?client=slow"
+        client_1 = yield tornado.websocket.websocket_connect(url)
+        client_2 = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        slow = self.app.video.streams[0]
+        slow.level = len(VIDEO_LEVELS) - 1
+        img = np.random.randint(0, 255, size=(120, 160, 3), dtype=np.uint8)
+        self.app.run_threaded(img)
+        _, jpg_1 = yield self.read_frame(client_1, min_seq=1)
+        _, jpg_2 = yield self.read_frame(client_2, min_seq=1)
+        # low level for the slow client and the default level for the other
+        assert len(jpg_1) < len(jpg_2)
+        assert self.app.video.encoded_frames == 2
+        response = yield self.http_client.fetch(
+            self.get_url('/videoStats?client=slow'))
+        stats = json.loads(response.body)
+        assert len(stats) == 1
+        assert stats[0]['quality'] == VIDEO_LEVELS[-1][0]
+        client_1.close()
+        client_2.close()
+
+    @tornado.testing.gen_test
+    def test_only_used_levels_encoded(self):
+        client_1 = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        client_2 = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        while self.app.video.subscribers < 2:
+            yield tornado.gen.sleep(0.01)
+        for stream in self.app.video.streams:
+            stream.level = 3
+        # malformed messages are ignored
+        yield client_1.write_message('not json')
+        yield client_1.write_message(json.dumps({'ack': 'x'}))
+        yield client_1.write_message(json.dumps([1]))
+        img = np.random.randint(0, 255, size=(120, 160, 3), dtype=np.uint8)
+        self.app.run_threaded(img)
+        _, jpg_1 = yield self.read_frame(client_1, min_seq=1)
+        _, jpg_2 = yield self.read_frame(client_2, min_seq=1)
+        assert jpg_1 == jpg_2
+        assert list(self.app.video.frames) == [3]
+        assert self.app.video.encoded_frames == 1
+        client_1.close()
+        client_2.close()
+
+    @tornado.testing.gen_test
+    def test_level_encoded_once_for_concurrent_clients(self):
+        video = self.app.video
+        video.loop = IOLoop.current()
+        img = np.random.randint(0, 255, size=(120, 160, 3), dtype=np.uint8)
+        with video.lock:
+            video.seq, video.img_arr = 1, img
+            video.frames = {}
+        frames = yield [video.next_frame(0, 4), video.next_frame(0, 4)]
+        assert frames[0] == frames[1]
+        assert video.encoded_frames == 1
+        assert not video.encoding
+
+    @tornado.testing.gen_test
+    def test_reused_frame_buffer(self):
+        client = yield tornado.websocket.websocket_connect(self.get_ws_url())
+        while self.app.video.subscribers < 1:
+            yield tornado.gen.sleep(0.01)
+        # cameras capture into a ring of reused slots
+        slot = np.random.randint(0, 255, size=(120, 160, 3), dtype=np.uint8)
+        first = slot.copy()
+        self.app.run_threaded(slot, 7)
+        seq, _ = yield self.read_frame(client, min_seq=1)
+        assert seq == 1
+        slot[:] = 255 - first
+        # a new frame in the same slot
+        self.app.run_threaded(slot, 8)
+        self.app.run_threaded(slot, 8)
+        seq, _ = yield self.read_frame(client, min_seq=2)
+        assert seq == 2 and self.app.video.encoded_frames == 2
+        # the kept frame is a copy, not the slot the camera overwrites
+        slot[:] = 0
+        np.testing.assert_array_equal(self.app.video.img_arr, 255 - first)
+        # without sequence numbers a repeat is recognised by content
+        self.app.run_threaded(slot)
+        self.app.run_threaded(slot)
+        seq, _ = yield self.read_frame(client, min_seq=3)
+        assert seq == 3 and self.app.video.encoded_frames == 3
+        client.close()
+
+    @tornado.testing.gen_test
+    def test_no_encoding_without_clients(self):
+        img = np.zeros((120, 160, 3), dtype=np.uint8)
+        self.app.run_threaded(img)
+        assert self.app.video.encoded_frames == 0
+
+
+def test_adaptive_stream():
+    stream = AdaptiveStream(latency_target=0.1, max_fps=20, min_fps=2)
+    assert stream.level == DEFAULT_VIDEO_LEVEL
+    # slow link: quality goes down first, then frame rate
+    for i in range(40):
+        stream.frame_sent(i, 0.5)
+    assert stream.level == len(VIDEO_LEVELS) - 1
+    assert stream.fps < 20
+    # fast link: frame rate comes back first, then quality
+    for i in range(40, 400):
+        stream.frame_sent(i, 0.01)
+        if stream.fps < 20:
+            assert stream.level == len(VIDEO_LEVELS) - 1
+    assert stream.fps == 20
+    assert stream.level == 0
+    assert stream.settings()['latency_ms'] < 50
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 
 class CircularBuffer:
     """
@@ -141,3 +144,54 @@ class CircularBuffer:
         self.count = count
         self.tailIndex = (self.tailIndex + count) % self.capacity
 
+
+class ArrayRingBuffer:
+    """
+    Fixed length ring buffer of equally shaped numpy arrays, stored in a
+    single preallocated array. Every entry is written twice, so the last
+    `length` entries are always available as one contiguous view, ordered
+    from oldest to newest, without copying.
+    """
+    def __init__(self, length:int, shape:tuple, dtype=np.float32) -> None:
+        if length <= 0:
+            raise ValueError("length must be greater than zero")
+        self.length:int = length
+        self.buffer:np.ndarray = np.zeros((2 * length, *shape), dtype=dtype)
+        self.index:int = 0   # slot of the next write
+        self.count:int = 0
+
+    def push(self, value) -> None:
+        """
+        Write value as the newest entry, dropping the oldest one
+        if the buffer is full.
+        """
+        i = self.index
+        self.buffer[i] = value
+        self.buffer[i + self.length] = value
+        self.index = (i + 1) % self.length
+        self.count = min(self.count + 1, self.length)
+
+    def fill(self, value) -> None:
+        """
+        Set all entries to value, so the buffer is full
+        """
+        self.buffer[...] = value
+        self.index = 0
+        self.count = self.length
+
+    def clear(self) -> None:
+        self.index = 0
+        self.count = 0
+
+    def head(self) -> np.ndarray:
+        """
+        return: view of the newest entry
+        """
+        return self.buffer[(self.index - 1) % self.length]
+
+    def window(self) -> np.ndarray:
+        """
+        return: view of the last `length` entries from oldest to newest.
+                The view changes with the next push.
+        """
+        return self.buffer[self.index:self.index + self.length]
@@ -0,0 +1,385 @@
+"""
+jpeg.py
+
+JPEG encoding and decoding of uint8 image arrays, RGB with shape (H, W, 3)
+or greyscale with shape (H, W) or (H, W, 1). The backend is chosen at
+runtime, the first one installed of libjpeg-turbo through simplejpeg or
+PyTurboJPEG, OpenCV and PIL. All of them use libjpeg with the default
+settings of PIL, quality 75 and 4:2:0 chroma subsampling, so tub images
+don't depend on the backend which wrote them.
+
+Decoding can use the DCT scaling of libjpeg, which decodes an image at
+1/2, 1/4 or 1/8 of its size for a fraction of the work, see
+dct_scale(), and can write into an array supplied by the caller.
+
+Run this module to compare the installed backends.
+"""
+from abc import ABC, abstractmethod
+import logging
+import time
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUALITY = 75
+# DCT scale denominators libjpeg can decode to
+DCT_SCALES = (1, 2, 4, 8)
+# the SOF markers hold the image size
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB,
+                0xCD, 0xCE, 0xCF}
+
+
+def is_jpeg(data) -> bool:
+    """ True if the bytes start with the JPEG start of image marker """
+    return bytes(data[:2]) == b'\xff\xd8'
+
+
+def jpeg_info(data) -> Tuple[int, int, int]:
+    """
+    Read the size of a JPEG from its header.
+
+    :param data:    JPEG bytes
+    :return:        tuple of width, height and number of color components
+    """
+    view = memoryview(data)
+    if view[:2] != b'\xff\xd8':
+        raise ValueError('Not a JPEG')
+    offset = 2
+    while offset + 4 <= len(view):
+        if view[offset] != 0xFF:
+            raise ValueError(f'Bad JPEG marker at {offset}')
+        marker = view[offset + 1]
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        length = (view[offset + 2] << 8) | view[offset + 3]
+        if marker in _SOF_MARKERS:
+            if offset + 10 > len(view):
+                break
+            height = (view[offset + 5] << 8) | view[offset + 6]
+            width = (view[offset + 7] << 8) | view[offset + 8]
+            return width, height, view[offset + 9]
+        offset += 2 + length
+    raise ValueError('JPEG without frame header')
+
+
+def scaled_size(width: int, height: int, scale: int) -> Tuple[int, int]:
+    """ Size of an image decoded at 1/scale, as libjpeg rounds it """
+    return -(-width // scale), -(-height // scale)
+
+
+def dct_scale(width: int, height: int, target_width: int,
+              target_height: int) -> int:
+    """
+    Largest DCT scale denominator which decodes an image to at least the
+    target size.
+
+    :return:    1, 2, 4 or 8
+    """
+    scale = 1
+    for s in DCT_SCALES:
+        w, h = scaled_size(width, height, s)
+        if w >= target_width and h >= target_height:
+            scale = s
+    return scale
+
+
+def _as_rgb_or_gray(img_arr: np.ndarray) -> np.ndarray:
+    img_arr = np.ascontiguousarray(img_arr, dtype=np.uint8)
+    if img_arr.ndim == 3 and img_arr.shape[2] == 1:
+        img_arr = img_arr.reshape(img_arr.shape[:2])
+    if img_arr.ndim == 3 and img_arr.shape[2] != 3 or img_arr.ndim not in (2, 3):
+        raise ValueError(f'Can not encode image of shape {img_arr.shape} as '
+                         f'JPEG, use (H, W, 3), (H, W, 1) or (H, W)')
+    return img_arr
+
+
+def _into(out: Optional[np.ndarray], img_arr: np.ndarray) -> np.ndarray:
+    if out is None:
+        return img_arr
+    np.copyto(out, img_arr.reshape(out.shape))
+    return out
+
+
+class JpegBackend(ABC):
+    """
+    Interface of the JPEG backends.
+    """
+    name = None
+
+    @abstractmethod
+    def encode(self, img_arr: np.ndarray,
+               quality: int = DEFAULT_QUALITY) -> bytes:
+        """
+        :param img_arr: uint8 array, (H, W, 3) RGB, (H, W) or (H, W, 1)
+                        greyscale
+        :param quality: JPEG quality
+        :return:        JPEG bytes
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, data, scale: int = 1,
+               out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        :param data:    JPEG bytes
+        :param scale:   DCT scale denominator, 1, 2, 4 or 8
+        :param out:     optional uint8 array of the decoded size to write
+                        into, (H, W, 3) for color or (H, W) for greyscale
+                        JPEGs
+        :return:        uint8 array, (H, W, 3) RGB for color JPEGs and
+                        (H, W) for greyscale JPEGs
+        """
+        pass
+
+
+class PilJpeg(JpegBackend):
+    name = 'pil'
+
+    def __init__(self):
+        from PIL import Image
+        self.Image = Image
+
+    def encode(self, img_arr, quality=DEFAULT_QUALITY):
+        f = BytesIO()
+        self.Image.fromarray(_as_rgb_or_gray(img_arr)).save(
+            f, format='jpeg', quality=quality)
+        return f.getvalue()
+
+    def decode(self, data, scale=1, out=None):
+        img = self.Image.open(BytesIO(data))
+        if scale != 1:
+            # PIL picks the largest scale which keeps the requested size
+            img.draft(img.mode, (max(1, img.width // scale),
+                                 max(1, img.height // scale)))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        return _into(out, np.asarray(img))
+
+
+class OpenCvJpeg(JpegBackend):
+    name = 'opencv'
+
+    def __init__(self):
+        import cv2
+        self.cv2 = cv2
+        # images are decoded as stored, like PIL does
+        self.color = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                      4: cv2.IMREAD_REDUCED_COLOR_4,
+                      8: cv2.IMREAD_REDUCED_COLOR_8}
+        self.gray = {1: cv2.IMREAD_GRAYSCALE,
+                     2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                     4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+    def encode(self, img_arr, quality=DEFAULT_QUALITY):
+        cv2 = self.cv2
+        img_arr = _as_rgb_or_gray(img_arr)
+        if img_arr.ndim == 3:
+            img_arr = cv2.cvtColor(img_arr, cv2.COLOR_RGB2BGR)
+        ok, buf = cv2.imencode('.jpg', img_arr,
+                               [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError('OpenCV failed to encode the image')
+        return buf.tobytes()
+
+    def decode(self, data, scale=1, out=None):
+        cv2 = self.cv2
+        components = jpeg_info(data)[2]
+        flags = (self.gray if components == 1 else self.color)[scale] \
+            | cv2.IMREAD_IGNORE_ORIENTATION
+        img_arr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+        if img_arr is None:
+            raise ValueError('OpenCV failed to decode the image')
+        if components == 1:
+            return _into(out, img_arr)
+        return cv2.cvtColor(img_arr, cv2.COLOR_BGR2RGB, dst=out)
+
+
+class SimpleJpeg(JpegBackend):
+    name = 'simplejpeg'
+
+    def __init__(self):
+        import simplejpeg
+        self.simplejpeg = simplejpeg
+
+    def encode(self, img_arr, quality=DEFAULT_QUALITY):
+        img_arr = _as_rgb_or_gray(img_arr)
+        if img_arr.ndim == 2:
+            return self.simplejpeg.encode_jpeg(
+                img_arr[:, :, np.newaxis], quality=quality, colorspace='GRAY',
+                fastdct=False)
+        return self.simplejpeg.encode_jpeg(
+            img_arr, quality=quality, colorspace='RGB',
+            colorsubsampling='420', fastdct=False)
+
+    def decode(self, data, scale=1, out=None):
+        width, height, components = jpeg_info(data)
+        width, height = scaled_size(width, height, scale)
+        colorspace = 'GRAY' if components == 1 else 'RGB'
+        img_arr = self.simplejpeg.decode_jpeg(
+            data, colorspace=colorspace, fastdct=False, fastupsample=False,
+            min_height=height, min_width=width, buffer=out)
+        if components == 1:
+            img_arr = img_arr.reshape(img_arr.shape[:2])
+        return img_arr if out is None else out
+
+
+class TurboJpeg(JpegBackend):
+    name = 'turbojpeg'
+
+    def __init__(self):
+        import turbojpeg
+        self.turbojpeg = turbojpeg
+        self.jpeg = turbojpeg.TurboJPEG()
+
+    def encode(self, img_arr, quality=DEFAULT_QUALITY):
+        tj = self.turbojpeg
+        img_arr = _as_rgb_or_gray(img_arr)
+        if img_arr.ndim == 2:
+            return self.jpeg.encode(img_arr[:, :, np.newaxis],
+                                    quality=quality,
+                                    pixel_format=tj.TJPF_GRAY,
+                                    jpeg_subsample=tj.TJSAMP_GRAY)
+        return self.jpeg.encode(img_arr, quality=quality,
+                                pixel_format=tj.TJPF_RGB,
+                                jpeg_subsample=tj.TJSAMP_420)
+
+    def decode(self, data, scale=1, out=None):
+        tj = self.turbojpeg
+        components = jpeg_info(data)[2]
+        pixel_format = tj.TJPF_GRAY if components == 1 else tj.TJPF_RGB
+        img_arr = self.jpeg.decode(
+            data, pixel_format=pixel_format,
+            scaling_factor=None if scale == 1 else (1, scale))
+        if components == 1:
+            img_arr = img_arr.reshape(img_arr.shape[:2])
+        return _into(out, img_arr)
+
+
+# fastest first
+BACKENDS = {
+    'simplejpeg': SimpleJpeg,
+    'turbojpeg': TurboJpeg,
+    'opencv': OpenCvJpeg,
+    'pil': PilJpeg,
+}
+
+_backends: Dict[str, JpegBackend] = {}
+_default: Optional[JpegBackend] = None
+
+
+def available_backends() -> List[str]:
+    """ Names of the backends which can be used, fastest first """
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+            names.append(name)
+        except Exception:
+            pass
+    return names
+
+
+def get_backend(name: Optional[str] = None) -> JpegBackend:
+    """
+    :param name:    one of the names in BACKENDS, None selects the fastest
+                    one which is installed
+    :return:        backend instance
+    """
+    global _default
+    if name is None:
+        if _default is None:
+            for candidate in BACKENDS:
+                try:
+                    _default = get_backend(candidate)
+                    break
+                except Exception as e:
+                    logger.debug(f'JPEG backend {candidate} unavailable: {e}')
+            logger.info(f'Using JPEG backend {_default.name}')
+        return _default
+    backend = _backends.get(name)
+    if backend is None:
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown JPEG backend {name}, use one of "
+                             f"{', '.join(BACKENDS)}")
+        backend = BACKENDS[name]()
+        _backends[name] = backend
+    return backend
+
+
+def set_backend(name: Optional[str]) -> JpegBackend:
+    """ Select the backend of encode() and decode(), None for the fastest """
+    global _default
+    _default = None if name is None else get_backend(name)
+    return get_backend()
+
+
+def encode(img_arr: np.ndarray, quality: int = DEFAULT_QUALITY) -> bytes:
+    """ Encode an image array with the selected backend """
+    return get_backend().encode(img_arr, quality)
+
+
+def decode(data, scale: int = 1,
+           out: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Decode a JPEG with the selected backend, see JpegBackend.decode """
+    return get_backend().decode(data, scale, out)
+
+
+def decode_file(path: str, scale: int = 1,
+                out: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Decode a JPEG file with the selected backend """
+    with open(path, 'rb') as f:
+        return decode(f.read(), scale, out)
+
+
+def benchmark_backends(image: Optional[np.ndarray] = None,
+                       iterations: int = 200) -> List[dict]:
+    """
+    Encode and decode times of the installed backends.
+
+    :param image:       RGB image, defaults to a synthetic 320x240 image
+    :param iterations:  encodes and decodes per backend
+    :return:            list of dicts with backend, bytes and microseconds
+                        to encode, decode and decode at 1/2 and 1/4 size
+    """
+    if image is None:
+        # smooth image with some noise, compresses like a camera image
+        y, x = np.mgrid[0:240, 0:320]
+        rng = np.random.default_rng(0)
+        image = np.stack([x * 255 // 320, y * 255 // 240, (x + y) % 256],
+                         axis=-1) + rng.integers(0, 16, (240, 320, 3))
+        image = image.clip(0, 255).astype(np.uint8)
+    results = []
+    for name in available_backends():
+        backend = get_backend(name)
+        data = backend.encode(image)
+        result = {'backend': name, 'bytes': len(data)}
+        runs = {'encode': lambda: backend.encode(image),
+                'decode': lambda: backend.decode(data),
+                'decode 1/2': lambda: backend.decode(data, 2),
+                'decode 1/4': lambda: backend.decode(data, 4)}
+        for run_name, run in runs.items():
+            run()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                run()
+            result[run_name] = 1e6 * (time.perf_counter() - start) \
+                / iterations
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    from prettytable import PrettyTable
+    table = PrettyTable()
+    columns = ['encode', 'decode', 'decode 1/2', 'decode 1/4']
+    table.field_names = ['backend', 'bytes'] + [c + ' us' for c in columns]
+    for r in benchmark_backends():
+        table.add_row([r['backend'], r['bytes']]
+                      + [f'{r[c]:.1f}' for c in columns])
+    print(table)
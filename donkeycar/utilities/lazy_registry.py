@@ -0,0 +1,101 @@
+"""
+lazy_registry.py
+
+Registry of part factories which are only imported when they are first
+used. A vehicle therefore only pays the import cost of the parts it is
+actually configured with, and the time spent importing and constructing
+each part is recorded so it can be reported by `donkey startup-profile`.
+"""
+import importlib
+import logging
+import time
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# all registries created in this process, used to build the startup report
+_registries: List['LazyRegistry'] = []
+
+
+class LazyRegistry:
+    """
+    Maps a key to a target of the form 'package.module:Attribute' or
+    'package.module'. The target is only imported when it is resolved for
+    the first time.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._targets: Dict[str, str] = {}
+        self._resolved: Dict[str, Any] = {}
+        self.import_times: Dict[str, float] = {}
+        self.construct_times: Dict[str, float] = {}
+        _registries.append(self)
+
+    def register(self, key: str, target: str) -> None:
+        """
+        Register a target under the given key
+        :param key:     name used to look up the factory, like 'PICAM'
+        :param target:  'package.module:Attribute' or just 'package.module'
+        """
+        self._targets[key] = target
+        self._resolved.pop(key, None)
+
+    def keys(self) -> List[str]:
+        return list(self._targets.keys())
+
+    def target(self, key: str) -> str:
+        return self._targets[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._targets
+
+    def resolve(self, key: str) -> Any:
+        """
+        Import the target registered under key and return it. Imports are
+        only done once, subsequent calls return the cached object.
+        """
+        if key in self._resolved:
+            return self._resolved[key]
+        if key not in self._targets:
+            raise ValueError(f"Unknown {self.name} type {key}, supported types "
+                             f"are {', '.join(self._targets.keys())}")
+        module_name, _, attr = self._targets[key].partition(':')
+        start = time.perf_counter()
+        obj = importlib.import_module(module_name)
+        if attr:
+            obj = getattr(obj, attr)
+        self.import_times[key] = time.perf_counter() - start
+        logger.debug(f'Imported {self.name} {key} from {self._targets[key]} '
+                     f'in {self.import_times[key]:.3f}s')
+        self._resolved[key] = obj
+        return obj
+
+    def create(self, key: str, *args, **kwargs) -> Any:
+        """
+        Resolve the factory registered under key and call it with the given
+        arguments. The construction time is recorded.
+        """
+        factory = self.resolve(key)
+        start = time.perf_counter()
+        part = factory(*args, **kwargs)
+        self.construct_times[key] = time.perf_counter() - start
+        logger.debug(f'Created {self.name} {key} in '
+                     f'{self.construct_times[key]:.3f}s')
+        return part
+
+    def timings(self) -> List[Tuple[str, str, float, float]]:
+        """
+        :return: list of (registry name, key, import seconds, construction
+                 seconds) for every key which has been resolved
+        """
+        return [(self.name, key, self.import_times.get(key, 0.0),
+                 self.construct_times.get(key, 0.0))
+                for key in self._resolved]
+
+
+def startup_timings() -> List[Tuple[str, str, float, float]]:
+    """
+    :return: the timings of all registries in this process, see
+             LazyRegistry.timings()
+    """
+    return [t for registry in _registries for t in registry.timings()]
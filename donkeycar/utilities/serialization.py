@@ -0,0 +1,361 @@
+"""
+serialization.py
+
+Codecs for the values which the network parts send between hosts. A value
+is encoded into a list of frames: a compact binary header which describes
+the value, followed by the raw buffers of all numpy arrays and bytes in the
+value. Transports with multipart messages, like zmq, send the frames as they
+are, so arrays are neither copied on send nor on receive. Datagram and
+stream transports send them joined with pack_frames().
+
+Decoded arrays are read only views into the received buffers. Copy them,
+e.g. with np.array(arr), before modifying them in place.
+
+Supported values are None, bool, int, float, str, bytes, numpy arrays and
+lists, tuples and str keyed dicts of those. Unlike pickle, decoding never
+creates other objects, so it is safe to decode data from the network.
+
+Header layout, all little endian:
+    magic 'DK', version (uint8), flags (uint8), name length (uint16),
+    number of buffers (uint16), name (utf8), value
+where the value is a type tag byte followed by:
+    N, T, F     none, true, false: nothing
+    i           int64
+    f           float64
+    s           uint32 length, utf8
+    b           uint32 buffer index
+    a           uint8 dtype length, dtype str, uint8 ndim, uint32 * ndim
+                shape, uint32 buffer index
+    l, t        uint32 length, values
+    d           uint32 length, (uint32 key length, utf8 key, value) pairs
+"""
+from abc import ABC, abstractmethod
+import logging
+import pickle
+import struct
+import time
+import zlib
+from typing import Any, List, Sequence, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DK'
+VERSION = 1
+FLAG_COMPRESSED = 0x01
+
+_PREFIX = struct.Struct('<2sBBHH')
+_U8 = struct.Struct('<B')
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+
+Frame = Union[bytes, bytearray, memoryview]
+
+
+class Codec(ABC):
+    """
+    Interface of the value codecs.
+    """
+    # False for the former wire format, which the network parts send
+    # without chunk header or length prefix
+    framed = True
+
+    @abstractmethod
+    def encode(self, name: str, value: Any) -> List[Frame]:
+        """
+        :param name:    name of the value, e.g. the channel name
+        :param value:   value to encode
+        :return:        list of frames
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, frames: Sequence[Frame]) -> Tuple[str, Any]:
+        """
+        :param frames:  frames as returned by encode
+        :return:        tuple of name and value, arrays in the value may
+                        be read only
+        """
+        pass
+
+    def encode_bytes(self, name: str, value: Any) -> bytes:
+        """ Encode into a single buffer, for datagram and stream transports """
+        return pack_frames(self.encode(name, value))
+
+    def decode_bytes(self, data: Frame) -> Tuple[str, Any]:
+        return self.decode(unpack_frames(data))
+
+
+class BinaryCodec(Codec):
+    """
+    Binary codec described in the module documentation.
+    """
+    def __init__(self, compress: bool = False, level: int = 1):
+        """
+        :param compress:    zlib compress the header and buffers. Saves
+                            bandwidth on compressible data like lidar scans,
+                            but costs a copy and cpu, so it is off by default
+        :param level:       zlib compression level
+        """
+        self.compress = compress
+        self.level = level
+
+    def encode(self, name: str, value: Any) -> List[Frame]:
+        buffers: List[Frame] = []
+        body = bytearray()
+        _encode_value(value, body, buffers)
+        name_b = name.encode('utf8')
+        flags = FLAG_COMPRESSED if self.compress else 0
+        header = _PREFIX.pack(MAGIC, VERSION, flags, len(name_b),
+                              len(buffers)) + name_b
+        if self.compress:
+            return [header + zlib.compress(bytes(body), self.level)] \
+                + [zlib.compress(b, self.level) for b in buffers]
+        return [header + body] + buffers
+
+    def decode(self, frames: Sequence[Frame]) -> Tuple[str, Any]:
+        header = memoryview(frames[0])
+        if len(header) < _PREFIX.size:
+            raise ValueError('Message too short')
+        magic, version, flags, name_len, num_buffers \
+            = _PREFIX.unpack_from(header)
+        if magic != MAGIC:
+            raise ValueError('Not a donkeycar message')
+        if version != VERSION:
+            raise ValueError(f'Unsupported message version {version}, '
+                             f'expected {VERSION}')
+        if len(frames) != num_buffers + 1:
+            raise ValueError(f'Expected {num_buffers + 1} frames, got '
+                             f'{len(frames)}')
+        offset = _PREFIX.size
+        name = bytes(header[offset:offset + name_len]).decode('utf8')
+        offset += name_len
+        body = header[offset:]
+        buffers = [memoryview(f) for f in frames[1:]]
+        if flags & FLAG_COMPRESSED:
+            body = memoryview(zlib.decompress(body))
+            buffers = [memoryview(zlib.decompress(b)) for b in buffers]
+        value, _ = _decode_value(body, 0, buffers)
+        return name, value
+
+
+class PickleCodec(Codec):
+    """
+    The former zlib compressed pickle format, for talking to older cars.
+    The network parts send it unframed like they used to, one datagram or
+    stream write per message, so udp messages must fit in a datagram and
+    tcp clients decode whatever arrived as one message. Only use it with
+    trusted peers, unpickling can execute arbitrary code.
+    """
+    framed = False
+
+    def encode(self, name: str, value: Any) -> List[Frame]:
+        packet = {"name": name, "val": value}
+        return [zlib.compress(pickle.dumps(packet))]
+
+    def decode(self, frames: Sequence[Frame]) -> Tuple[str, Any]:
+        obj = pickle.loads(zlib.decompress(frames[0]))
+        return obj['name'], obj['val']
+
+    def encode_bytes(self, name: str, value: Any) -> bytes:
+        return self.encode(name, value)[0]
+
+    def decode_bytes(self, data: Frame) -> Tuple[str, Any]:
+        return self.decode([data])
+
+
+def get_codec(codec: Union[str, Codec, None] = None) -> Codec:
+    """
+    :param codec:   codec instance, or one of 'binary', 'binary_zlib',
+                    'pickle'. None selects 'binary'
+    :return:        codec instance
+    """
+    if isinstance(codec, Codec):
+        return codec
+    if codec is None or codec == 'binary':
+        return BinaryCodec()
+    if codec == 'binary_zlib':
+        return BinaryCodec(compress=True)
+    if codec == 'pickle':
+        return PickleCodec()
+    raise ValueError(f"Unknown codec {codec}, use one of 'binary', "
+                     f"'binary_zlib', 'pickle'")
+
+
+def pack_frames(frames: Sequence[Frame]) -> bytes:
+    """ Join frames into one buffer: uint32 count, uint32 lengths, data """
+    lengths = [memoryview(f).nbytes for f in frames]
+    head = struct.pack(f'<I{len(frames)}I', len(frames), *lengths)
+    return b''.join([head, *frames])
+
+
+def unpack_frames(data: Frame) -> List[memoryview]:
+    """ Split a buffer from pack_frames into frames, without copying """
+    data = memoryview(data)
+    count = _U32.unpack_from(data)[0]
+    lengths = struct.unpack_from(f'<{count}I', data, _U32.size)
+    offset = _U32.size * (count + 1)
+    frames = []
+    for length in lengths:
+        frames.append(data[offset:offset + length])
+        offset += length
+    if offset != len(data):
+        raise ValueError('Frame lengths do not match message length')
+    return frames
+
+
+def _encode_str(s: str, body: bytearray) -> None:
+    b = s.encode('utf8')
+    body += _U32.pack(len(b))
+    body += b
+
+
+def _encode_value(value: Any, body: bytearray, buffers: List[Frame]) -> None:
+    # bool before int, as bool is a subclass of int
+    if value is None:
+        body += b'N'
+    elif isinstance(value, (bool, np.bool_)):
+        body += b'T' if value else b'F'
+    elif isinstance(value, (int, np.integer)):
+        body += b'i'
+        body += _I64.pack(int(value))
+    elif isinstance(value, (float, np.floating)):
+        body += b'f'
+        body += _F64.pack(float(value))
+    elif isinstance(value, str):
+        body += b's'
+        _encode_str(value, body)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        body += b'b'
+        body += _U32.pack(len(buffers))
+        buffers.append(value)
+    elif isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError('Object arrays can not be encoded')
+        arr = np.ascontiguousarray(value)
+        dtype = arr.dtype.str.encode('ascii')
+        body += b'a'
+        body += _U8.pack(len(dtype))
+        body += dtype
+        body += _U8.pack(arr.ndim)
+        body += struct.pack(f'<{arr.ndim}I', *arr.shape)
+        body += _U32.pack(len(buffers))
+        # the array itself supports the buffer protocol, no copy here
+        buffers.append(arr.reshape(-1).view(np.uint8) if arr.ndim else
+                       arr.tobytes())
+    elif isinstance(value, (list, tuple)):
+        body += b'l' if isinstance(value, list) else b't'
+        body += _U32.pack(len(value))
+        for v in value:
+            _encode_value(v, body, buffers)
+    elif isinstance(value, dict):
+        body += b'd'
+        body += _U32.pack(len(value))
+        for k, v in value.items():
+            if not isinstance(k, str):
+                raise TypeError(f'Only str dict keys can be encoded, got '
+                                f'{type(k).__name__}')
+            _encode_str(k, body)
+            _encode_value(v, body, buffers)
+    else:
+        raise TypeError(f'Type {type(value).__name__} can not be encoded')
+
+
+def _decode_str(body: memoryview, offset: int) -> Tuple[str, int]:
+    length = _U32.unpack_from(body, offset)[0]
+    offset += _U32.size
+    return bytes(body[offset:offset + length]).decode('utf8'), offset + length
+
+
+def _decode_value(body: memoryview, offset: int,
+                  buffers: List[memoryview]) -> Tuple[Any, int]:
+    tag = body[offset:offset + 1].tobytes()
+    offset += 1
+    if tag == b'N':
+        return None, offset
+    if tag == b'T':
+        return True, offset
+    if tag == b'F':
+        return False, offset
+    if tag == b'i':
+        return _I64.unpack_from(body, offset)[0], offset + _I64.size
+    if tag == b'f':
+        return _F64.unpack_from(body, offset)[0], offset + _F64.size
+    if tag == b's':
+        return _decode_str(body, offset)
+    if tag == b'b':
+        index = _U32.unpack_from(body, offset)[0]
+        return bytes(buffers[index]), offset + _U32.size
+    if tag == b'a':
+        dtype_len = body[offset]
+        offset += 1
+        dtype = np.dtype(bytes(body[offset:offset + dtype_len]).decode())
+        offset += dtype_len
+        ndim = body[offset]
+        offset += 1
+        shape = struct.unpack_from(f'<{ndim}I', body, offset)
+        offset += 4 * ndim
+        index = _U32.unpack_from(body, offset)[0]
+        # read only view into the received buffer, see module doc
+        arr = np.frombuffer(buffers[index], dtype=dtype).reshape(shape)
+        return arr, offset + _U32.size
+    if tag in (b'l', b't'):
+        length = _U32.unpack_from(body, offset)[0]
+        offset += _U32.size
+        values = []
+        for _ in range(length):
+            v, offset = _decode_value(body, offset, buffers)
+            values.append(v)
+        return (values if tag == b'l' else tuple(values)), offset
+    if tag == b'd':
+        length = _U32.unpack_from(body, offset)[0]
+        offset += _U32.size
+        d = {}
+        for _ in range(length):
+            k, offset = _decode_str(body, offset)
+            d[k], offset = _decode_value(body, offset, buffers)
+        return d, offset
+    raise ValueError(f'Unknown type tag {tag}')
+
+
+def benchmark_codecs(iterations: int = 200) -> List[dict]:
+    """
+    Round trip times of the codecs for typical donkeycar values, encoded to
+    and decoded from a single buffer like the udp and tcp parts do.
+
+    :param iterations:  round trips per codec and value
+    :return:            list of dicts with value, codec, bytes and
+                        microseconds per round trip
+    """
+    rng = np.random.default_rng(0)
+    values = {
+        'controls': (0.1, 0.5, 'user', False),
+        'lidar scan': rng.random((360, 2), dtype=np.float32),
+        'camera image': rng.integers(0, 255, (120, 160, 3), dtype=np.uint8),
+        'jpg': rng.integers(0, 255, 8000, dtype=np.uint8).tobytes(),
+    }
+    codecs = {'pickle': PickleCodec(), 'binary': BinaryCodec(),
+              'binary_zlib': BinaryCodec(compress=True)}
+    results = []
+    for value_name, value in values.items():
+        for codec_name, codec in codecs.items():
+            data = codec.encode_bytes('bench', value)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                codec.decode_bytes(codec.encode_bytes('bench', value))
+            elapsed = time.perf_counter() - start
+            results.append({'value': value_name, 'codec': codec_name,
+                            'bytes': len(data),
+                            'us': 1e6 * elapsed / iterations})
+    return results
+
+
+if __name__ == '__main__':
+    from prettytable import PrettyTable
+    table = PrettyTable()
+    table.field_names = ['value', 'codec', 'bytes', 'round trip us']
+    for r in benchmark_codecs():
+        table.add_row([r['value'], r['codec'], r['bytes'], f"{r['us']:.1f}"])
+    print(table)
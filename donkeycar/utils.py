@@ -19,9 +19,10 @@ import signal
 import logging
 from typing import List, Any, Tuple, Union
 
-from PIL import Image
 import numpy as np
 
+from donkeycar.utilities import jpeg
+
 logger = logging.getLogger(__name__)
 
 
@@ -52,6 +53,7 @@ def scale(im, size=128):
     accepts: PIL image, size of square sides
     returns: PIL image scaled so sides length == size
     """
+    from PIL import Image
     size = (size,size)
     im.thumbnail(size, Image.ANTIALIAS)
     return im
@@ -75,8 +77,7 @@ def arr_to_binary(arr):
     accepts: numpy array with shape (Hight, Width, Channels)
     returns: binary stream (used to save to database)
     '''
-    img = arr_to_img(arr)
-    return img_to_binary(img)
+    return jpeg.encode(np.uint8(arr))
 
 
 def arr_to_img(arr):
@@ -84,6 +85,7 @@ def arr_to_img(arr):
     accepts: numpy array with shape (Height, Width, Channels)
     returns: binary stream (used to save to database)
     '''
+    from PIL import Image
     arr = np.uint8(arr)
     img = Image.fromarray(arr)
     return img
@@ -105,6 +107,7 @@ def binary_to_img(binary):
     if binary is None or len(binary) == 0:
         return None
 
+    from PIL import Image
     img = BytesIO(binary)
     try:
         img = Image.open(img)
@@ -113,6 +116,23 @@ def binary_to_img(binary):
         return None
 
 
+def binary_to_arr(binary, scale=1):
+    '''
+    accepts: image file bytes, JPEGs are decoded with the fastest installed
+             codec of donkeycar.utilities.jpeg, at 1/scale of their size
+    returns: numpy uint8 image array, (H, W) for greyscale images
+    '''
+    if binary is None or len(binary) == 0:
+        return None
+    try:
+        if jpeg.is_jpeg(binary):
+            return jpeg.decode(binary, scale)
+        from PIL import Image
+        return img_to_arr(Image.open(BytesIO(binary)))
+    except Exception:
+        return None
+
+
 def norm_img(img):
     return (img - img.mean() / np.std(img)) * ONE_BYTE_SCALE
 
@@ -168,8 +188,12 @@ def load_pil_image(filename, cfg):
 
     Returns: a PIL image.
     """
+    from PIL import Image
     try:
         img = Image.open(filename)
+        if getattr(cfg, 'IMAGE_DCT_SCALING', False):
+            # decode large JPEGs at 1/2, 1/4 or 1/8 of their size
+            img.draft(img.mode, (cfg.IMAGE_W, cfg.IMAGE_H))
         if img.height != cfg.IMAGE_H or img.width != cfg.IMAGE_W:
             img = img.resize((cfg.IMAGE_W, cfg.IMAGE_H))
 
@@ -179,7 +203,7 @@ def load_pil_image(filename, cfg):
         return img
 
     except Exception as e:
-        logger.error(f'failed to load image from {filename}: {e.message}')
+        logger.error(f'failed to load image from {filename}: {e}')
         return None
 
 
@@ -189,43 +213,59 @@ def load_image(filename, cfg):
     :param cfg:                 donkey config
     :return np.ndarray:         numpy uint8 image array
     """
-    img_arr = load_image_sized(filename, cfg.IMAGE_W, cfg.IMAGE_H, cfg.IMAGE_DEPTH)
+    img_arr = load_image_sized(filename, cfg.IMAGE_W, cfg.IMAGE_H, cfg.IMAGE_DEPTH,
+                               getattr(cfg, 'IMAGE_DCT_SCALING', False))
 
     return img_arr
 
 
-def load_image_sized(filename, image_width, image_height, image_depth):
-    """Loads an image from a file path as a PIL image. Also handles resizing.
+def load_image_sized(filename, image_width, image_height, image_depth,
+                     dct_scaling=False):
+    """Loads an image from a file path as a numpy array. Also handles resizing.
 
     Args:
         filename (string): path to the image file
         image_width: width in pixels of the output image
         image_height: height in pixels of the output image
         image_depth: depth of the output image (1 for greyscale)
+        dct_scaling: decode JPEGs which are at least twice the output size
+            at 1/2, 1/4 or 1/8 of their size before resizing
 
     Returns:
         (np.ndarray):         numpy uint8 image array.
     """
     try:
-        img = Image.open(filename)
-        if img.height != image_height or img.width != image_width:
-            img = img.resize((image_width, image_height))
-
-        if image_depth == 1:
-            img = img.convert('L')
-
-        img_arr = np.asarray(img)
-
-        # If the PIL image is greyscale, the np array will have shape (H, W)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        scale = 1
+        if dct_scaling and jpeg.is_jpeg(data):
+            width, height, _ = jpeg.jpeg_info(data)
+            scale = jpeg.dct_scale(width, height, image_width, image_height)
+        img_arr = binary_to_arr(data, scale)
+        if img_arr is None:
+            raise ValueError('not an image')
+        height, width = img_arr.shape[:2]
+        if height != image_height or width != image_width \
+                or (image_depth == 1 and img_arr.ndim == 3):
+            # resize and convert with PIL as the images were always resized
+            from PIL import Image
+            img = Image.fromarray(img_arr)
+            if height != image_height or width != image_width:
+                img = img.resize((image_width, image_height))
+            if image_depth == 1:
+                img = img.convert('L')
+            img_arr = np.asarray(img)
+
+        # Greyscale images have shape (H, W)
         # Need to add a depth channel by expanding to (H, W, 1)
-        if img.mode == 'L':
-            h, w = img_arr.shape[:2]
+        if img_arr.ndim == 2:
+            h, w = img_arr.shape
             img_arr = img_arr.reshape(h, w, 1)
 
         return img_arr
 
     except Exception as e:
-        logger.error(f'failed to load image from {filename}: {e.message}')
+        logger.error(f'failed to load image from {filename}: {e}')
         return None
 
 
@@ -484,66 +524,75 @@ def eprint(*args, **kwargs):
 def get_model_by_type(model_type: str, cfg: 'Config') -> Union['KerasPilot', 'FastAiPilot']:
     '''
     given the string model_type and the configuration settings in cfg
-    create a Keras model and return it.
+    create a Keras model and return it. The pilot and interpreter modules
+    are imported on demand through donkeycar.parts.registry.
     '''
-    from donkeycar.parts.keras import KerasCategorical, KerasLinear, \
-        KerasInferred, KerasIMU, KerasMemory, KerasBehavioral, KerasLocalizer, \
-        KerasLSTM, Keras3D_CNN
-    from donkeycar.parts.interpreter import KerasInterpreter, TfLite, TensorRT, \
-        FastAIInterpreter
+    from donkeycar.parts.registry import pilots, interpreters
 
     if model_type is None:
         model_type = cfg.DEFAULT_MODEL_TYPE
     logger.info(f'get_model_by_type: model type is: {model_type}')
-    input_shape = (cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH)
+    # the model sees the transformed image, e.g. cropped with
+    # ROI_CROP_MODE = 'crop'
+    from donkeycar.parts.image_transformations import transformed_image_shape
+    input_shape = (*transformed_image_shape(cfg), cfg.IMAGE_DEPTH)
     if 'tflite_' in model_type:
-        interpreter = TfLite()
+        interpreter = interpreters.create('tflite')
         used_model_type = model_type.replace('tflite_', '')
     elif 'tensorrt_' in model_type:
-        interpreter = TensorRT()
+        interpreter = interpreters.create('tensorrt')
         used_model_type = model_type.replace('tensorrt_', '')
     elif 'fastai_' in model_type:
-        interpreter = FastAIInterpreter()
+        interpreter = interpreters.create('fastai')
         used_model_type = model_type.replace('fastai_', '')
         if used_model_type == "linear":
-            from donkeycar.parts.fastai import FastAILinear
-            return FastAILinear(interpreter=interpreter, input_shape=input_shape)
+            return pilots.create('fastai_linear', interpreter=interpreter,
+                                 input_shape=input_shape)
     else:
-        interpreter = KerasInterpreter()
+        interpreter = interpreters.create('keras')
         used_model_type = model_type
 
     used_model_type = EqMemorizedString(used_model_type)
     if used_model_type == "linear":
-        kl = KerasLinear(interpreter=interpreter, input_shape=input_shape)
+        kl = pilots.create('linear', interpreter=interpreter,
+                           input_shape=input_shape)
     elif used_model_type == "categorical":
-        kl = KerasCategorical(
+        kl = pilots.create(
+            'categorical',
             interpreter=interpreter,
             input_shape=input_shape,
             throttle_range=cfg.MODEL_CATEGORICAL_MAX_THROTTLE_RANGE)
     elif used_model_type == 'inferred':
-        kl = KerasInferred(interpreter=interpreter, input_shape=input_shape)
+        kl = pilots.create('inferred', interpreter=interpreter,
+                           input_shape=input_shape)
     elif used_model_type == "imu":
-        kl = KerasIMU(interpreter=interpreter, input_shape=input_shape)
+        kl = pilots.create('imu', interpreter=interpreter,
+                           input_shape=input_shape)
     elif used_model_type == "memory":
         mem_length = getattr(cfg, 'SEQUENCE_LENGTH', 3)
         mem_depth = getattr(cfg, 'MEM_DEPTH', 0)
-        kl = KerasMemory(interpreter=interpreter, input_shape=input_shape,
-                         mem_length=mem_length, mem_depth=mem_depth)
+        kl = pilots.create('memory', interpreter=interpreter,
+                           input_shape=input_shape, mem_length=mem_length,
+                           mem_depth=mem_depth)
     elif used_model_type == "behavior":
-        kl = KerasBehavioral(
+        kl = pilots.create(
+            'behavior',
             interpreter=interpreter,
             input_shape=input_shape,
             throttle_range=cfg.MODEL_CATEGORICAL_MAX_THROTTLE_RANGE,
             num_behavior_inputs=len(cfg.BEHAVIOR_LIST))
     elif used_model_type == 'localizer':
-        kl = KerasLocalizer(interpreter=interpreter, input_shape=input_shape,
-                            num_locations=cfg.NUM_LOCATIONS)
+        kl = pilots.create('localizer', interpreter=interpreter,
+                           input_shape=input_shape,
+                           num_locations=cfg.NUM_LOCATIONS)
     elif used_model_type == 'rnn':
-        kl = KerasLSTM(interpreter=interpreter, input_shape=input_shape,
-                       seq_length=cfg.SEQUENCE_LENGTH)
+        kl = pilots.create('rnn', interpreter=interpreter,
+                           input_shape=input_shape,
+                           seq_length=cfg.SEQUENCE_LENGTH)
     elif used_model_type == '3d':
-        kl = Keras3D_CNN(interpreter=interpreter, input_shape=input_shape,
-                         seq_length=cfg.SEQUENCE_LENGTH)
+        kl = pilots.create('3d', interpreter=interpreter,
+                           input_shape=input_shape,
+                           seq_length=cfg.SEQUENCE_LENGTH)
     else:
         known = [k + u for k in ('', 'tflite_', 'tensorrt_')
                  for u in used_model_type.mem]
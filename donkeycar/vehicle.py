@@ -10,7 +10,7 @@ import time
 import numpy as np
 import logging
 from threading import Thread
-from .memory import Memory
+from .memory import Memory, Trace
 from prettytable import PrettyTable
 import traceback
 
@@ -20,6 +20,8 @@ logger = logging.getLogger(__name__)
 class PartProfiler:
     def __init__(self):
         self.records = {}
+        # latency name, like 'capture_actuation' -> seconds
+        self.latencies = {}
 
     def profile_part(self, p):
         self.records[p] = { "times" : [] }
@@ -36,6 +38,21 @@ class PartProfiler:
             delta = thresh
         self.records[p]['times'][-1] = delta
 
+    def record_latency(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def latency_histogram(self, name, bins=(0, 10, 20, 50, 100, 200, 500)):
+        """
+        Histogram of a traced latency.
+        :param name: latency name, like 'capture_actuation'
+        :param bins: bin edges in ms, the last bin collects all larger values
+        :return: tuple of counts and bin edges in ms
+        """
+        arr = np.asarray(self.latencies.get(name, [])) * 1000
+        edges = np.append(np.asarray(bins, dtype=np.float64), np.inf)
+        counts, _ = np.histogram(arr, bins=edges)
+        return counts, edges
+
     def report(self):
         logger.info("Part Profile Summary: (times in ms)")
         pt = PrettyTable()
@@ -56,6 +73,20 @@ class PartProfiler:
             row += ["%.2f" % (np.percentile(arr, p) * 1000) for p in pctile]
             pt.add_row(row)
         logger.info('\n' + str(pt))
+        if not self.latencies:
+            return
+        logger.info("Latency Summary: (times in ms)")
+        pt = PrettyTable()
+        pt.field_names = ["latency", "count", "max", "min", "avg"] \
+            + [str(p) + '%' for p in pctile]
+        for name, arr in self.latencies.items():
+            row = [name, len(arr),
+                   "%.2f" % (max(arr) * 1000),
+                   "%.2f" % (min(arr) * 1000),
+                   "%.2f" % (sum(arr) / len(arr) * 1000)]
+            row += ["%.2f" % (np.percentile(arr, p) * 1000) for p in pctile]
+            pt.add_row(row)
+        logger.info('\n' + str(pt))
 
 
 class Vehicle:
@@ -68,9 +99,11 @@ class Vehicle:
         self.on = True
         self.threads = []
         self.profiler = PartProfiler()
+        # True once a part marks a stage, see add()
+        self.tracing = False
 
     def add(self, part, inputs=[], outputs=[],
-            threaded=False, run_condition=None):
+            threaded=False, run_condition=None, stage=None, stage_time=None):
         """
         Method to add a part to the vehicle drive loop.
 
@@ -86,6 +119,16 @@ class Vehicle:
                 If a part should be run in a separate thread.
             run_condition : str
                 If a part should be run or not
+            stage : str
+                Name of the processing stage the part completes, like
+                'capture', 'inference' or 'actuation'. A part with a stage
+                and no traced inputs starts a trace of its outputs, other
+                parts mark the stage on the trace of their inputs. The
+                latencies between the stages of a trace are recorded in
+                the profiler and as 'latency/<stage>_<stage>' channels.
+            stage_time : str
+                Channel with the time of the stage, e.g. the capture time
+                of a camera frame, defaults to the time the part returns
         """
         assert type(inputs) is list, "inputs is not a list: %r" % inputs
         assert type(outputs) is list, "outputs is not a list: %r" % outputs
@@ -98,6 +141,10 @@ class Vehicle:
         entry['inputs'] = inputs
         entry['outputs'] = outputs
         entry['run_condition'] = run_condition
+        entry['stage'] = stage
+        entry['stage_time'] = stage_time
+        if stage is not None:
+            self.tracing = True
 
         if threaded:
             t = Thread(target=part.update, args=())
@@ -107,6 +154,19 @@ class Vehicle:
         self.parts.append(entry)
         self.profiler.profile_part(part)
 
+    def set_stage(self, part, stage, stage_time=None):
+        """
+        Set the stage of a part which was already added, see add().
+        """
+        for entry in self.parts:
+            if entry['part'] is part:
+                entry['stage'] = stage
+                entry['stage_time'] = stage_time
+                self.tracing = True
+                return
+        raise ValueError(f'{part.__class__.__name__} is not a part of '
+                         f'the vehicle')
+
     def remove(self, part):
         """
         remove part form list
@@ -211,9 +271,45 @@ class Vehicle:
                 # save the output to memory
                 if outputs is not None:
                     self.mem.put(entry['outputs'], outputs)
+                # parts without outputs, like actuators, still mark a stage
+                if self.tracing and \
+                        (outputs is not None or not entry['outputs']):
+                    self.trace(entry)
                 # finish timing part run
                 self.profiler.on_part_finished(p)
 
+    def trace(self, entry):
+        """
+        Carry the trace of the inputs of a part over to its outputs and
+        mark the stage of the part.
+        """
+        trace = self.mem.get_trace(entry['inputs'])
+        stage = entry['stage']
+        if stage is not None:
+            timestamp = None
+            if entry['stage_time']:
+                timestamp = self.mem.get([entry['stage_time']])[0]
+            if trace is None:
+                trace = Trace(stage, timestamp)
+            elif trace.mark(stage, timestamp):
+                self.record_latencies(trace)
+        self.mem.set_trace(entry['outputs'], trace)
+
+    def record_latencies(self, trace):
+        """
+        Record the latency from the previous and the first stage of a trace
+        to its last stage.
+        """
+        last = trace.stages[-1]
+        starts = [trace.stages[-2]]
+        if len(trace.stages) > 2:
+            starts.append(trace.stages[0])
+        for start in starts:
+            name = f'{start}_{last}'
+            latency = trace.latency(start, last)
+            self.profiler.record_latency(name, latency)
+            self.mem['latency/' + name] = latency * 1000
+
     def stop(self):        
         logger.info('Shutting down vehicle and its parts...')
         for entry in self.parts: